@@ -5,8 +5,8 @@
 import logging
 import os
 import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
 
 import telebot
 from telebot.types import Message, CallbackQuery, Contact
@@ -14,13 +14,14 @@ from telebot.types import Message, CallbackQuery, Contact
 from config import (
     BOT_TOKEN, ADMIN_IDS, MESSAGES, KEYBOARD_BUTTONS, SUPPORT_MESSAGES, get_web_base_url,
     BROADCAST_RATE_PER_SEC, BROADCAST_MAX_RETRIES, BROADCAST_RETRY_BASE_DELAY,
-    LOYALTY_CARD_LENGTH, MANUAL_REVIEW_REQUIRED
+    LOYALTY_CARD_LENGTH, MANUAL_REVIEW_REQUIRED, REGISTRATION_FLIGHT_TIMEOUT
 )
 from database.db_manager import (
     save_application, application_exists, get_all_applications,
     get_random_winner, get_winner, get_applications_stats, get_applications_count,
     create_support_ticket, get_support_ticket, reply_support_ticket,
-    get_open_support_tickets, loyalty_card_exists
+    get_open_support_tickets, loyalty_card_exists,
+    resubmit_application_photo, UNSCORED_RISK_DETAILS
 )
 from bot.keyboards import (
     get_main_keyboard, get_phone_keyboard, get_back_keyboard,
@@ -30,15 +31,18 @@ from bot.states import (
     UserState, set_user_state, get_user_state, clear_user_state,
     set_user_data, get_user_data
 )
-from utils.file_handler import save_photo, export_to_csv, export_to_excel
-from utils.image_validation import analyze_leaflet
-from utils.anti_fraud import AntiFraudSystem, sha256_hex
+from utils.file_handler import export_to_csv, export_to_excel
+from utils.photo_intake import (
+    PhotoRejected, select_intake_file, select_best_intake, is_image_document, rejection_message
+)
+from utils.media_group import MediaGroupCoalescer
+from utils.photo_downloader import get_photo_downloader
+from utils.single_flight import get_registration_flight
+from utils.anti_fraud import AntiFraudSystem
 from utils.randomizer import create_winner_announcement, get_hash_seed
 
 logger = logging.getLogger(__name__)
 
-# Пул потоков для обработки регистраций при высокой нагрузке
-registration_executor = ThreadPoolExecutor(max_workers=10, thread_name_prefix="RegWorker")
 RUNTIME_ADMINS = set()  # Админы, подтвержденные в текущем рантайме
 
 
@@ -90,6 +94,10 @@ def validate_loyalty_card(card: str) -> tuple[bool, str]:
 def create_bot() -> telebot.TeleBot:
     """Создает и настраивает Telegram бота"""
     bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=8)  # Увеличиваем количество потоков
+    # Альбом — одна заявка: апдейты с общим media_group_id обрабатываются вместе
+    albums = MediaGroupCoalescer(lambda messages: process_album_submission(bot, messages))
+    # Файл проверяется уже после ответа пользователю — об отклоненном сообщаем отдельно
+    get_photo_downloader().on_rejected = lambda row, error: notify_photo_rejected(bot, row, error)
     
     @bot.message_handler(commands=['start'])
     def handle_start(message: Message):
@@ -492,14 +500,18 @@ def create_bot() -> telebot.TeleBot:
     
     
     @bot.message_handler(content_types=['photo'])
+    @bot.message_handler(content_types=['document'], func=lambda message: is_image_document(message.document))
     def handle_photo(message: Message):
-        """Обработчик фотографий"""
+        """Обработчик фотографий (в т.ч. изображений, отправленных файлом)"""
         try:
             user_id = message.from_user.id
             state = get_user_state(user_id)
             
             if state == UserState.WAITING_PHOTO:
-                process_photo_submission(bot, message)
+                if message.media_group_id:
+                    albums.add(message)
+                else:
+                    process_photo_submission(bot, message)
             else:
                 # Определяем, на каком шаге находится пользователь и даем соответствующую инструкцию
                 if state == UserState.WAITING_NAME:
@@ -781,37 +793,6 @@ def handle_loyalty_card_input(bot: telebot.TeleBot, message: Message):
     )
 
 
-def save_application_in_background(user_data: dict, user_id: int, photo_path: str, photo_hash: str):
-    """Быстрое сохранение заявки в БД в фоновом режиме"""
-    try:
-        success = save_application(
-            name=user_data['name'],
-            phone_number=user_data['phone_number'],
-            telegram_username=user_data.get('telegram_username', ''),
-            telegram_id=user_id,
-            photo_path=photo_path,
-            photo_hash=photo_hash,
-            risk_score=0,
-            risk_level='low',
-            risk_details='{}',
-            status='pending',
-            participant_number=None,
-            leaflet_status='pending',
-            stickers_count=0,
-            validation_notes='{}',
-            manual_review_required=1 if MANUAL_REVIEW_REQUIRED else 0,
-            photo_phash=''
-        )
-        
-        if success:
-            logger.info(f"Заявка сохранена в БД для пользователя {user_id}")
-        else:
-            logger.warning(f"Заявка уже существовала для пользователя {user_id}")
-            
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении заявки в фоне: {e}")
-
-
 def process_photo_submission_async(bot: telebot.TeleBot, message: Message, user_id: int, photo_file: bytes, photo_path: str, photo_hash: str):
     """Асинхронная обработка регистрации"""
     try:
@@ -875,47 +856,154 @@ def process_photo_submission_async(bot: telebot.TeleBot, message: Message, user_
             pass
 
 
-def process_photo_submission(bot: telebot.TeleBot, message: Message):
-    """Обрабатывает отправку фото и завершает заявку быстро"""
+def process_album_submission(bot: telebot.TeleBot, messages: list):
+    """
+    Принимает альбом как одну отправку фото
+
+    Из фото альбома в заявку идет одно — подходящее с наибольшим разрешением;
+    если не подходит ни одно, пользователь получает один ответ, а не по
+    сообщению на каждое фото.
+    """
+    first = messages[0]
+    user_id = first.from_user.id
+    try:
+        message, photo = select_best_intake(messages)
+    except PhotoRejected as e:
+        logger.info(f"Альбом пользователя {user_id} ({len(messages)} фото) отклонен до скачивания: {e}")
+        bot.send_message(first.chat.id, rejection_message(e, MESSAGES), parse_mode='Markdown')
+        return
+    logger.info(f"Альбом пользователя {user_id}: {len(messages)} фото, в заявку идет сообщение {message.message_id}")
+    process_photo_submission(bot, message, photo)
+
+
+def notify_photo_rejected(bot: telebot.TeleBot, row: dict, error: PhotoRejected) -> None:
+    """Фоновое скачивание отклонило файл: шаг фото открывается заново для той же заявки"""
+    user_id = row.get('telegram_id')
+    if not user_id:
+        return
+    set_user_data(user_id, 'resubmit_application_id', row['application_id'])
+    set_user_state(user_id, UserState.WAITING_PHOTO)
+    bot.send_message(
+        user_id,
+        f"{rejection_message(error, MESSAGES)}\n\n{MESSAGES['photo_resend']}",
+        parse_mode='Markdown'
+    )
+    logger.info(f"Пользователю {user_id} предложено заменить отклоненное фото заявки {row['application_id']}")
+
+
+def _resubmit_photo(bot: telebot.TeleBot, message: Message, photo, application_id: int) -> None:
+    """Новое фото для заявки, файл которой был отклонен"""
+    user_id = message.from_user.id
+    if resubmit_application_photo(application_id, photo.file_id, photo.file_unique_id,
+                                  getattr(photo, 'mime_type', '')):
+        get_photo_downloader().notify()
+        bot.send_message(
+            message.chat.id,
+            MESSAGES['photo_resubmitted'],
+            reply_markup=get_main_keyboard(is_admin(user_id)),
+            parse_mode='Markdown'
+        )
+        logger.info(f"Фото заявки {application_id} пользователя {user_id} заменено, файл в очереди скачивания")
+    else:
+        bot.send_message(message.chat.id, MESSAGES['error'], reply_markup=get_main_keyboard(is_admin(user_id)))
+    clear_user_state(user_id)
+
+
+def _complete_registration(bot: telebot.TeleBot, message: Message, photo) -> None:
+    """Сохраняет заявку с file_id фото, ставит скачивание в очередь и отвечает пользователю"""
+    user_id = message.from_user.id
+    resubmit_id = get_user_data(user_id, 'resubmit_application_id')
+    if resubmit_id:
+        _resubmit_photo(bot, message, photo, resubmit_id)
+        return
+    user_data = get_user_data(user_id)
+    if not user_data:
+        logger.error(f"Не найдены данные пользователя {user_id}")
+        bot.send_message(message.chat.id, MESSAGES['error'])
+        return
+    
+    success = save_application(
+        name=user_data['name'],
+        phone_number=user_data['phone_number'],
+        telegram_username=user_data.get('telegram_username', ''),
+        telegram_id=user_id,
+        photo_path='',
+        photo_hash='',
+        risk_score=0,
+        risk_level='low',
+        risk_details=UNSCORED_RISK_DETAILS,  # риск посчитает очередь скоринга
+        status='pending',
+        participant_number=None,
+        leaflet_status='pending',
+        stickers_count=0,
+        validation_notes='{}',
+        manual_review_required=1 if MANUAL_REVIEW_REQUIRED else 0,
+        photo_phash='',
+        photo_file_unique_id=photo.file_unique_id,
+        photo_file_id=photo.file_id,
+        defer_photo_download=True,
+        photo_mime_type=getattr(photo, 'mime_type', '')  # есть только у документа
+    )
+    
+    is_admin_user = is_admin(user_id)
+    if success:
+        # Скачивание, проверка дубликата и анализ — в фоне
+        get_photo_downloader().notify()
+        # Показываем 984765378 как ориентир, реальный номер можно узнать через "Мой статус"
+        success_message = MESSAGES['application_success'].format(participant_number=984765378)
+        bot.send_message(
+            message.chat.id,
+            success_message,
+            reply_markup=get_main_keyboard(is_admin_user),
+            parse_mode='Markdown'
+        )
+        logger.info(f"Заявка пользователя {user_id} сохранена, фото в очереди скачивания")
+    else:
+        bot.send_message(
+            message.chat.id,
+            "❌ **ЗАЯВКА УЖЕ СУЩЕСТВУЕТ**\n\n✅ Вы уже зарегистрированы",
+            reply_markup=get_main_keyboard(is_admin_user),
+            parse_mode='Markdown'
+        )
+    
+    clear_user_state(user_id)
+
+
+def process_photo_submission(bot: telebot.TeleBot, message: Message, photo=None):
+    """
+    Принимает фото и завершает заявку
+
+    Заявка сохраняется с file_id фото одной записью в БД, и пользователь сразу
+    получает ответ; сам файл скачивает фоновый пул (utils.photo_downloader).
+
+    Args:
+        photo: Уже выбранный файл (альбом); по умолчанию выбирается из message
+    """
     user_id = message.from_user.id
     
     try:
-        # Получаем фото (берем меньшее разрешение для скорости)
-        photo = message.photo[0] if len(message.photo) > 0 else message.photo[-1]
-        file_info = bot.get_file(photo.file_id)
-        photo_file = bot.download_file(file_info.file_path)
-        
-        # Быстрое сохранение фото
-        photo_path = save_photo(photo_file, user_id)
-        
-        # Быстрый хеш (берем первые 1000 байт для скорости)
-        photo_hash = sha256_hex(photo_file[:1000] if len(photo_file) > 1000 else photo_file)
+        # Наименьший вариант фото, которого хватает для анализа; слишком
+        # маленькие и слишком большие отклоняем по метаданным, без скачивания
+        if photo is None:
+            try:
+                photo = select_intake_file(message)
+            except PhotoRejected as e:
+                logger.info(f"Фото пользователя {user_id} отклонено до скачивания: {e}")
+                bot.send_message(message.chat.id, rejection_message(e, MESSAGES), parse_mode='Markdown')
+                return
         
-        # Сразу показываем успех пользователю
-        user_data = get_user_data(user_id)
-        if user_data:
-            is_admin_user = is_admin(user_id)
-            # Используем простой номер для отображения (будет присвоен асинхронно)
-            # Показываем 984765378 как ориентир, реальный номер можно узнать через "Мой статус"
-            success_message = MESSAGES['application_success'].format(participant_number=984765378)
-            bot.send_message(
-                message.chat.id,
-                success_message,
-                reply_markup=get_main_keyboard(is_admin_user),
-                parse_mode='Markdown'
-            )
-            
-            # Очищаем состояние сразу
-            clear_user_state(user_id)
-            
-            # Сохранение в БД в фоне (не блокирует пользователя)
-            registration_executor.submit(
-                save_application_in_background,
-                user_data, user_id, photo_path, photo_hash
-            )
-            
-            logger.info(f"Пользователь {user_id} получил быстрый ответ, сохранение в фоне")
+        # Двойное нажатие / повторная отправка: второй вызов ждет первый, а не
+        # сохраняет заявку заново
+        _, shared = get_registration_flight().do(
+            user_id, lambda: _complete_registration(bot, message, photo), timeout=REGISTRATION_FLIGHT_TIMEOUT
+        )
+        if shared:
+            logger.info(f"Повторная отправка фото пользователя {user_id} объединена с выполняющейся регистрацией")
         
+    except FutureTimeoutError:
+        # Первая отправка еще выполняется и сама ответит пользователю
+        logger.warning(f"Повторная отправка фото пользователя {user_id}: регистрация не завершилась за "
+                       f"{REGISTRATION_FLIGHT_TIMEOUT:g}с")
     except Exception as e:
         logger.error(f"Ошибка при обработке фото: {e}")
         try:
@@ -22,6 +22,32 @@ CAMPAIGN_1_NAME = os.getenv('CAMPAIGN_1_NAME', 'Оплата улыбкой от
 CAMPAIGN_2_NAME = os.getenv('CAMPAIGN_2_NAME', 'Субакция от 1500₽')
 MANUAL_REVIEW_REQUIRED = os.getenv('MANUAL_REVIEW_REQUIRED', 'true').strip().lower() in ('1','true','yes','y','on')
 
+# Правила антифрода (JSON): перечитываются при изменении файла, не чаще раза в интервал, сек
+FRAUD_RULES_PATH = os.getenv('FRAUD_RULES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fraud_rules.json'))
+FRAUD_RULES_RELOAD_INTERVAL = float(os.getenv('FRAUD_RULES_RELOAD_INTERVAL', '5'))
+
+# Фоновый скоринг риска новых заявок: потоки, размер пакета, интервал сброса (сек);
+# при лаге очереди больше порога (сек) — упрощенные проверки без контекста из БД.
+# Заявки с риском от RISK_AUTO_FLAG_SCORE автоматически уходят на ручную модерацию
+RISK_SCORING_WORKERS = int(os.getenv('RISK_SCORING_WORKERS', '2'))
+RISK_SCORING_BATCH_SIZE = int(os.getenv('RISK_SCORING_BATCH_SIZE', '50'))
+RISK_SCORING_FLUSH_INTERVAL = float(os.getenv('RISK_SCORING_FLUSH_INTERVAL', '1.0'))
+RISK_SCORING_LAG_THRESHOLD = float(os.getenv('RISK_SCORING_LAG_THRESHOLD', '10'))
+RISK_AUTO_FLAG_SCORE = int(os.getenv('RISK_AUTO_FLAG_SCORE', '71'))
+
+# Кольца мошенников (заявки, связанные общими атрибутами): минимальный размер кольца
+# для админки, окно "всплеска" регистраций (сек), снапшот индекса и интервал его записи (сек)
+FRAUD_RING_MIN_SIZE = int(os.getenv('FRAUD_RING_MIN_SIZE', '3'))
+FRAUD_RING_BURST_WINDOW = int(os.getenv('FRAUD_RING_BURST_WINDOW', '60'))
+FRAUD_RING_SNAPSHOT_PATH = os.getenv('FRAUD_RING_SNAPSHOT_PATH', 'fraud_rings.npz')
+FRAUD_RING_SNAPSHOT_INTERVAL = float(os.getenv('FRAUD_RING_SNAPSHOT_INTERVAL', '300'))
+
+# Скорость регистраций по измерениям (блок телефона, блок карты, имя, шаблон username,
+# час суток): ключей на измерение в памяти (LRU), снапшот и интервал его записи (сек)
+VELOCITY_MAX_KEYS = int(os.getenv('VELOCITY_MAX_KEYS', '100000'))
+VELOCITY_SNAPSHOT_PATH = os.getenv('VELOCITY_SNAPSHOT_PATH', 'velocity.json')
+VELOCITY_SNAPSHOT_INTERVAL = float(os.getenv('VELOCITY_SNAPSHOT_INTERVAL', '60'))
+
 
 def get_local_ip() -> str:
     """Возвращает локальный IP-адрес машины (LAN), с надежным фолбэком на 127.0.0.1"""
@@ -74,6 +100,72 @@ def get_database_path() -> str:
 PHOTOS_DIR = 'photos'
 EXPORTS_DIR = 'exports'
 
+# Хранилище фото: 'local' (PHOTOS_DIR) или 's3' (S3-совместимое, общее для нескольких инстансов)
+PHOTO_STORAGE_BACKEND = os.getenv('PHOTO_STORAGE_BACKEND', 'local').lower()
+PHOTO_S3_BUCKET = os.getenv('PHOTO_S3_BUCKET', '')
+PHOTO_S3_PREFIX = os.getenv('PHOTO_S3_PREFIX', 'photos/')
+PHOTO_S3_ENDPOINT_URL = os.getenv('PHOTO_S3_ENDPOINT_URL', '')  # MinIO и т.п.; пусто — AWS
+PHOTO_S3_REGION = os.getenv('PHOTO_S3_REGION', '')
+PHOTO_S3_ACCESS_KEY = os.getenv('PHOTO_S3_ACCESS_KEY', '')
+PHOTO_S3_SECRET_KEY = os.getenv('PHOTO_S3_SECRET_KEY', '')
+# Локальный read-through кэш перед удаленным хранилищем и пул фоновых загрузок
+PHOTO_CACHE_DIR = os.getenv('PHOTO_CACHE_DIR', 'photo_cache')
+PHOTO_CACHE_MAX_MB = int(os.getenv('PHOTO_CACHE_MAX_MB', '2048'))
+PHOTO_UPLOAD_WORKERS = int(os.getenv('PHOTO_UPLOAD_WORKERS', '4'))
+PHOTO_UPLOAD_QUEUE_SIZE = int(os.getenv('PHOTO_UPLOAD_QUEUE_SIZE', '64'))
+# Скачивание фото из Telegram потоком (таймаут на соединение и чтение блока, сек)
+PHOTO_DOWNLOAD_TIMEOUT = float(os.getenv('PHOTO_DOWNLOAD_TIMEOUT', '30'))
+# Отложенное скачивание фото: число потоков, попытки, базовая задержка повтора
+# (удваивается с каждой попыткой, сек) и интервал опроса очереди в БД (сек)
+PHOTO_DOWNLOAD_WORKERS = int(os.getenv('PHOTO_DOWNLOAD_WORKERS', '4'))
+PHOTO_DOWNLOAD_MAX_ATTEMPTS = int(os.getenv('PHOTO_DOWNLOAD_MAX_ATTEMPTS', '6'))
+PHOTO_DOWNLOAD_RETRY_BASE_DELAY = float(os.getenv('PHOTO_DOWNLOAD_RETRY_BASE_DELAY', '5'))
+PHOTO_DOWNLOAD_POLL_INTERVAL = float(os.getenv('PHOTO_DOWNLOAD_POLL_INTERVAL', '5'))
+# Альбомы: апдейты одного media_group_id собираются, пока приходят чаще чем раз в
+# MEDIA_GROUP_WINDOW сек (но не дольше MEDIA_GROUP_MAX_WAIT), и дают одну регистрацию
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', '1.0'))
+MEDIA_GROUP_MAX_WAIT = float(os.getenv('MEDIA_GROUP_MAX_WAIT', '3.0'))
+# Сколько повторная отправка фото ждет уже выполняющуюся регистрацию (сек)
+REGISTRATION_FLIGHT_TIMEOUT = float(os.getenv('REGISTRATION_FLIGHT_TIMEOUT', '30'))
+
+# Превью фото для админки: каталог кэша и фиксированные размеры (длинная сторона, px)
+THUMBNAILS_DIR = os.getenv('THUMBNAILS_DIR', 'thumbnails')
+PHOTO_THUMBNAIL_SIZES = tuple(sorted(
+    int(s) for s in os.getenv('PHOTO_THUMBNAIL_SIZES', '128,512').split(',') if s.strip().isdigit()
+)) or (128, 512)
+# Срок кэширования фото в браузере (сек); файлы по хешу неизменяемы
+PHOTO_CACHE_MAX_AGE = int(os.getenv('PHOTO_CACHE_MAX_AGE', '31536000'))
+# Префикс internal-location nginx для X-Accel-Redirect (пусто — Flask отдает файл сам);
+# под ним nginx отдает photos/, photo_cache/ и thumbnails/ из PHOTOS_DIR, PHOTO_CACHE_DIR и THUMBNAILS_DIR
+PHOTO_X_ACCEL_PREFIX = os.getenv('PHOTO_X_ACCEL_PREFIX', '')
+
+# Перекодирование хранимых фото: формат (webp/avif), качество, процессы и nice-приоритет
+PHOTO_COMPACTION_FORMAT = os.getenv('PHOTO_COMPACTION_FORMAT', 'webp').lower()
+PHOTO_COMPACTION_QUALITY = int(os.getenv('PHOTO_COMPACTION_QUALITY', '80'))
+PHOTO_COMPACTION_WORKERS = int(os.getenv('PHOTO_COMPACTION_WORKERS', '1'))
+PHOTO_COMPACTION_NICE = int(os.getenv('PHOTO_COMPACTION_NICE', '15'))
+
+# Анализ фото лифлетов
+# Длинная сторона, до которой JPEG декодируется в draft-режиме (1/2, 1/4, 1/8); 0 — полное разрешение
+LEAFLET_ANALYSIS_MAX_SIDE = int(os.getenv('LEAFLET_ANALYSIS_MAX_SIDE', '1600'))
+# Минимальное разрешение фото для анализа (длинная и короткая сторона, px): по нему же
+# бот выбирает вариант PhotoSize и отклоняет слишком маленькие фото до скачивания
+LEAFLET_MIN_LONG_SIDE = int(os.getenv('LEAFLET_MIN_LONG_SIDE', '1024'))
+LEAFLET_MIN_SHORT_SIDE = int(os.getenv('LEAFLET_MIN_SHORT_SIDE', '768'))
+# Максимальный размер фото/файла-изображения (Bot API отдает файлы до 20 МБ)
+PHOTO_MAX_FILE_SIZE_MB = float(os.getenv('PHOTO_MAX_FILE_SIZE_MB', '10'))
+# Порог резкости (дисперсия лапласиана) для полного разрешения
+LEAFLET_BLUR_THRESHOLD = float(os.getenv('LEAFLET_BLUR_THRESHOLD', '80'))
+# Процессный пул анализа: число процессов (0 — по числу ядер), размер очереди и таймаут задачи
+LEAFLET_ANALYSIS_WORKERS = int(os.getenv('LEAFLET_ANALYSIS_WORKERS', '0'))
+LEAFLET_ANALYSIS_QUEUE_SIZE = int(os.getenv('LEAFLET_ANALYSIS_QUEUE_SIZE', '64'))
+LEAFLET_ANALYSIS_TIMEOUT = float(os.getenv('LEAFLET_ANALYSIS_TIMEOUT', '30'))
+# Фоновая очередь анализа: размер пакета UPDATE и максимальный интервал сброса (сек)
+LEAFLET_ANALYSIS_BATCH_SIZE = int(os.getenv('LEAFLET_ANALYSIS_BATCH_SIZE', '50'))
+LEAFLET_ANALYSIS_FLUSH_INTERVAL = float(os.getenv('LEAFLET_ANALYSIS_FLUSH_INTERVAL', '2.0'))
+# Попыток анализа (таймаут/ошибка пула) до окончательного статуса 'error'
+LEAFLET_ANALYSIS_MAX_ATTEMPTS = int(os.getenv('LEAFLET_ANALYSIS_MAX_ATTEMPTS', '3'))
+
 # Сообщения бота
 MESSAGES = {
 'welcome': (
@@ -125,6 +217,24 @@ MESSAGES = {
         "📸 Пожалуйста, отправьте фото лифлета\n"
         "💡 Поддерживаются: JPG, PNG (до 10 МБ)"
     ),
+    'photo_too_small': (
+        "❌ **ФОТО СЛИШКОМ МАЛЕНЬКОЕ**\n\n"
+        "📸 Нужно фото не меньше {min_long}×{min_short} пикселей\n"
+        "💡 Сфотографируйте лифлет целиком и отправьте еще раз"
+    ),
+    'photo_too_large': (
+        "❌ **ФАЙЛ СЛИШКОМ БОЛЬШОЙ**\n\n"
+        "📸 Максимальный размер фото — {max_mb:g} МБ"
+    ),
+    'photo_send_as_image': "💡 Отправьте фото как изображение, а не файлом",
+    'photo_resend': (
+        "📸 Заявка сохранена, но это фото не подошло.\n"
+        "Отправьте, пожалуйста, другое фото лифлета в этот чат"
+    ),
+    'photo_resubmitted': (
+        "✅ **ФОТО ПРИНЯТО**\n\n"
+        "📸 Новое фото прикреплено к вашей заявке"
+    ),
     'error': (
         "😔 **ПРОИЗОШЛА ОШИБКА**\n\n"
         "🔄 Попробуйте еще раз через несколько секунд\n"
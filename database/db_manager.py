@@ -9,7 +9,7 @@ import time
 import json
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable
 from functools import wraps
 
 # DuckDB import
@@ -22,7 +22,9 @@ except ImportError:
 # Fallback для SQLite
 import sqlite3
 
-from config import DATABASE_TYPE, get_database_path
+import pandas as pd
+
+from config import DATABASE_TYPE, get_database_path, RISK_AUTO_FLAG_SCORE
 
 logger = logging.getLogger(__name__)
 
@@ -113,6 +115,16 @@ def get_db_connection():
                 conn.close()
 
 
+# Колонки applications, появившиеся после первого релиза: CREATE TABLE IF NOT EXISTS
+# их в старые БД не добавит, поэтому init_* дописывает их через ALTER TABLE
+_APPLICATIONS_ADDED_COLUMNS = {
+    'duckdb': ["template_id BIGINT", "template_confidence DOUBLE", "photo_file_unique_id TEXT", "photo_file_id TEXT",
+               "telegram_username TEXT"],
+    'sqlite': ["template_id INTEGER", "template_confidence REAL", "photo_file_unique_id TEXT", "photo_file_id TEXT",
+               "telegram_username TEXT"],
+}
+
+
 def init_database():
     """Инициализация базы данных"""
     try:
@@ -165,7 +177,9 @@ def init_duckdb():
                 stickers_count INTEGER DEFAULT 0,
                 validation_notes TEXT,
                 manual_review_required BOOLEAN DEFAULT TRUE,
-                photo_phash TEXT
+                photo_phash TEXT,
+                template_id BIGINT,
+                template_confidence DOUBLE
             )
         """)
         
@@ -203,6 +217,71 @@ def init_duckdb():
             )
         """)
         
+        # Задачи массовой перевалидации фото (для возобновления после сбоя)
+        cursor.execute("""
+            CREATE SEQUENCE IF NOT EXISTS revalidation_jobs_id_seq START 1
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS revalidation_jobs (
+                id BIGINT PRIMARY KEY DEFAULT nextval('revalidation_jobs_id_seq'),
+                filters TEXT,
+                params_key TEXT,
+                status TEXT DEFAULT 'running',
+                last_id BIGINT DEFAULT 0,
+                processed INTEGER DEFAULT 0,
+                cached INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP
+            )
+        """)
+        
+        # Кэш результатов анализа по хешу содержимого фото и параметрам анализа
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS leaflet_analysis_cache (
+                content_hash TEXT NOT NULL,
+                params_key TEXT NOT NULL,
+                metrics TEXT NOT NULL,
+                PRIMARY KEY (content_hash, params_key)
+            )
+        """)
+        
+        # Файлы фото по хешу содержимого: одинаковые байты хранятся один раз
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS photo_blobs (
+                content_hash TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size_bytes BIGINT DEFAULT 0,
+                refcount INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                compacted_at TIMESTAMP
+            )
+        """)
+        
+        # Очередь отложенного скачивания фото: заявка сохраняется с file_id,
+        # файл скачивает фоновый пул. status: pending | failed (после всех попыток);
+        # mime_type — только у изображений, присланных документом
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS photo_downloads (
+                application_id BIGINT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                file_unique_id TEXT,
+                mime_type TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at DOUBLE DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Колонки, добавленные после первого релиза (для существующих БД)
+        for column_sql in _APPLICATIONS_ADDED_COLUMNS['duckdb']:
+            try:
+                cursor.execute(f"ALTER TABLE applications ADD COLUMN IF NOT EXISTS {column_sql}")
+            except Exception as col_err:
+                logger.warning(f"Не удалось добавить колонку: {col_err}")
+        
         # Создаем индексы для быстрого поиска
         indexes = [
             "CREATE INDEX IF NOT EXISTS idx_applications_telegram_id ON applications(telegram_id)",
@@ -214,6 +293,7 @@ def init_duckdb():
             "CREATE INDEX IF NOT EXISTS idx_applications_manual_review ON applications(manual_review_status)",
             "CREATE INDEX IF NOT EXISTS idx_applications_leaflet_status ON applications(leaflet_status)",
             "CREATE INDEX IF NOT EXISTS idx_applications_photo_phash ON applications(photo_phash)",
+            "CREATE INDEX IF NOT EXISTS idx_applications_photo_file_unique_id ON applications(photo_file_unique_id)",
             "CREATE INDEX IF NOT EXISTS idx_support_tickets_user_id ON support_tickets(user_id)",
             "CREATE INDEX IF NOT EXISTS idx_support_tickets_status ON support_tickets(status)",
         ]
@@ -282,10 +362,21 @@ def init_sqlite():
                 stickers_count INTEGER DEFAULT 0,
                 validation_notes TEXT,
                 manual_review_required INTEGER DEFAULT 1,
-                photo_phash TEXT
+                photo_phash TEXT,
+                template_id INTEGER,
+                template_confidence REAL
             )
         ''')
         
+        # Колонки, добавленные после первого релиза (для существующих БД)
+        existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(applications)").fetchall()}
+        for column_sql in _APPLICATIONS_ADDED_COLUMNS['sqlite']:
+            if column_sql.split()[0] not in existing_columns:
+                cursor.execute(f"ALTER TABLE applications ADD COLUMN {column_sql}")
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_applications_photo_file_unique_id ON applications(photo_file_unique_id)'
+        )
+        
         # Остальные таблицы для SQLite...
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS support_tickets (
@@ -313,6 +404,55 @@ def init_sqlite():
             )
         ''')
         
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS revalidation_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filters TEXT,
+                params_key TEXT,
+                status TEXT DEFAULT 'running',
+                last_id INTEGER DEFAULT 0,
+                processed INTEGER DEFAULT 0,
+                cached INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                started_at TEXT NOT NULL DEFAULT (datetime('now')),
+                updated_at TEXT
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leaflet_analysis_cache (
+                content_hash TEXT NOT NULL,
+                params_key TEXT NOT NULL,
+                metrics TEXT NOT NULL,
+                PRIMARY KEY (content_hash, params_key)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS photo_blobs (
+                content_hash TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size_bytes INTEGER DEFAULT 0,
+                refcount INTEGER DEFAULT 0,
+                created_at TEXT NOT NULL DEFAULT (datetime('now')),
+                compacted_at TEXT
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS photo_downloads (
+                application_id INTEGER PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                file_unique_id TEXT,
+                mime_type TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                last_error TEXT,
+                created_at TEXT NOT NULL DEFAULT (datetime('now'))
+            )
+        ''')
+        
         conn.commit()
 
 
@@ -329,6 +469,37 @@ def count_duplicate_photo_hash(photo_hash: str) -> int:
         return 0
 
 
+def find_application_by_file_unique_id(file_unique_id: str, exclude_id: int = 0) -> Optional[Dict[str, Any]]:
+    """
+    Первая заявка с тем же, уже скачанным фото Telegram (file_unique_id) —
+    проверка дубликата до скачивания; exclude_id — сама проверяемая заявка
+    """
+    if not file_unique_id:
+        return None
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, telegram_id, photo_path, photo_hash, photo_phash
+                FROM applications
+                WHERE photo_file_unique_id = ? AND id != ? AND COALESCE(photo_path, '') != ''
+                ORDER BY id LIMIT 1
+            ''', (file_unique_id, int(exclude_id or 0)))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return {
+                'id': row[0],
+                'telegram_id': row[1],
+                'photo_path': row[2] or '',
+                'photo_hash': row[3] or '',
+                'photo_phash': row[4] or '',
+            }
+    except Exception as e:
+        logger.error(f"Ошибка при поиске фото по file_unique_id: {e}")
+        return None
+
+
 def get_application_by_telegram_id(telegram_id: int) -> Optional[Dict[str, Any]]:
     """Возвращает заявку по telegram_id"""
     try:
@@ -431,63 +602,631 @@ def count_similar_photo_phash(photo_phash: str, max_hamming_distance: int = 5) -
         return 0
 
 
+_LEAFLET_TEMPLATE_COLUMNS = "id, name, required_stickers, template_image_path, active_from, active_until, validation_zones"
+
+
+def _leaflet_template_row(row) -> Dict[str, Any]:
+    validation_zones = row[6]
+    if DATABASE_TYPE == 'duckdb' and not isinstance(validation_zones, str):
+        # DuckDB может вернуть JSON как объект (а может и строкой — ее не кодируем повторно)
+        validation_zones_str = json.dumps(validation_zones) if validation_zones else '[]'
+    else:
+        validation_zones_str = validation_zones or '[]'
+    return {
+        'id': row[0],
+        'name': row[1],
+        'required_stickers': row[2] or 0,
+        'template_image_path': row[3] or '',
+        'active_from': row[4],
+        'active_until': row[5],
+        'validation_zones': validation_zones_str
+    }
+
+
+def _fetch_leaflet_templates(cursor, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Активные на текущий момент шаблоны (новые первыми), иначе — самый новый любой"""
+    now = datetime.now() if DATABASE_TYPE == 'duckdb' else datetime.now().isoformat(timespec='seconds')
+    sql = f"""
+        SELECT {_LEAFLET_TEMPLATE_COLUMNS}
+        FROM leaflet_templates
+        WHERE (active_from IS NULL OR active_from <= ?)
+          AND (active_until IS NULL OR active_until >= ?)
+        ORDER BY id DESC
+    """
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    cursor.execute(sql, (now, now))
+    rows = cursor.fetchall()
+    if not rows:
+        # Fallback - любой шаблон
+        cursor.execute(f'SELECT {_LEAFLET_TEMPLATE_COLUMNS} FROM leaflet_templates ORDER BY id DESC LIMIT 1')
+        rows = cursor.fetchall()
+    return [_leaflet_template_row(row) for row in rows]
+
+
 def get_active_leaflet_template() -> Optional[Dict[str, Any]]:
     """Возвращает активный шаблон лифлета"""
+    try:
+        with get_db_connection() as conn:
+            templates = _fetch_leaflet_templates(conn.cursor(), limit=1)
+            return templates[0] if templates else None
+    except Exception as e:
+        logger.error(f"Ошибка получения активного шаблона: {e}")
+        return None
+
+
+def get_active_leaflet_templates() -> List[Dict[str, Any]]:
+    """Все одновременно активные шаблоны лифлетов (например, по одному на акцию)"""
+    try:
+        with get_db_connection() as conn:
+            return _fetch_leaflet_templates(conn.cursor())
+    except Exception as e:
+        logger.error(f"Ошибка получения активных шаблонов: {e}")
+        return []
+
+
+def get_pending_leaflet_applications(limit: int = 10000) -> List[Dict[str, Any]]:
+    """Заявки с фото, которые еще не проанализированы (leaflet_status = 'pending')"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            if DATABASE_TYPE == 'duckdb':
-                current_time = datetime.now()
-                cursor.execute("""
-                    SELECT id, name, required_stickers, template_image_path, active_from, active_until, validation_zones
-                    FROM leaflet_templates
-                    WHERE (active_from IS NULL OR active_from <= ?)
-                      AND (active_until IS NULL OR active_until >= ?)
-                    ORDER BY id DESC
-                    LIMIT 1
-                """, (current_time, current_time))
-            else:
-                # SQLite fallback
-                now = datetime.now().isoformat(timespec='seconds')
-                cursor.execute('''
-                    SELECT id, name, required_stickers, template_image_path, active_from, active_until, validation_zones
-                    FROM leaflet_templates
-                    WHERE (active_from IS NULL OR active_from <= ?)
-                      AND (active_until IS NULL OR active_until >= ?)
-                    ORDER BY id DESC
-                    LIMIT 1
-                ''', (now, now))
-            
+            cursor.execute("""
+                SELECT id, photo_path
+                FROM applications
+                WHERE COALESCE(leaflet_status, 'pending') = 'pending'
+                  AND photo_path IS NOT NULL AND photo_path != ''
+                ORDER BY id
+                LIMIT ?
+            """, (int(limit),))
+            return [{'id': row[0], 'photo_path': row[1]} for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения непроанализированных заявок: {e}")
+        return []
+
+
+@db_retry(max_retries=3, delay=0.1)
+def bulk_update_leaflet_results(results: List[Dict[str, Any]]) -> int:
+    """Пакетно записывает результаты анализа лифлетов одним executemany.
+
+    Элемент: {id, leaflet_status, stickers_count, validation_notes (list|str),
+    manual_review_required, photo_phash, template_id, template_confidence}
+    """
+    if not results:
+        return 0
+    rows = []
+    for r in results:
+        notes = r.get('validation_notes') or []
+        if not isinstance(notes, str):
+            notes = json.dumps(notes, ensure_ascii=False)
+        rows.append((
+            r.get('leaflet_status') or 'pending',
+            int(r.get('stickers_count') or 0),
+            notes,
+            RISK_AUTO_FLAG_SCORE,
+            int(r.get('manual_review_required') or 0),
+            r.get('photo_phash') or '',
+            r.get('template_id'),
+            float(r.get('template_confidence') or 0.0),
+            r['id'],
+        ))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # Флаг модерации, выставленный скорингом риска, анализ не снимает
+        cursor.executemany('''
+            UPDATE applications
+            SET leaflet_status = ?, stickers_count = ?, validation_notes = ?,
+                manual_review_required = CASE WHEN COALESCE(risk_score, 0) >= ? THEN 1 ELSE ? END, photo_phash = ?,
+                template_id = ?, template_confidence = ?
+            WHERE id = ?
+        ''', rows)
+        conn.commit()
+        return len(rows)
+
+
+# Статусы лифлета, которые считаются "неудачной" проверкой для перевалидации
+LEAFLET_FAILED_STATUSES = ('rejected', 'incomplete', 'duplicate', 'error')
+
+_REVALIDATION_JOB_FIELDS = ('status', 'last_id', 'processed', 'cached', 'total')
+
+
+def _revalidation_where(campaign: str = None, status: str = None, only_failed: bool = False):
+    """Условия WHERE для выборки заявок на перевалидацию"""
+    where_conditions = ["photo_path IS NOT NULL", "photo_path != ''"]
+    params: List[Any] = []
+    if campaign:
+        where_conditions.append("COALESCE(campaign_type, 'pending') = ?")
+        params.append(campaign)
+    if status:
+        where_conditions.append("COALESCE(status, 'pending') = ?")
+        params.append(status)
+    if only_failed:
+        placeholders = ', '.join('?' for _ in LEAFLET_FAILED_STATUSES)
+        where_conditions.append(
+            f"(leaflet_status IN ({placeholders}) OR COALESCE(validation_notes, '') LIKE '%analyze_%')"
+        )
+        params.extend(LEAFLET_FAILED_STATUSES)
+    return where_conditions, params
+
+
+def get_revalidation_page(after_id: int = 0, limit: int = 500, campaign: str = None,
+                          status: str = None, only_failed: bool = False) -> List[Dict[str, Any]]:
+    """Страница заявок для перевалидации (keyset-пагинация по id, без OFFSET)"""
+    where_conditions, params = _revalidation_where(campaign, status, only_failed)
+    where_conditions.insert(0, "id > ?")
+    params.insert(0, int(after_id))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT id, photo_path
+            FROM applications
+            WHERE {' AND '.join(where_conditions)}
+            ORDER BY id
+            LIMIT ?
+        """, tuple(params) + (int(limit),))
+        return [{'id': row[0], 'photo_path': row[1]} for row in cursor.fetchall()]
+
+
+def count_revalidation_targets(campaign: str = None, status: str = None, only_failed: bool = False) -> int:
+    """Количество заявок, подходящих под фильтры перевалидации"""
+    try:
+        where_conditions, params = _revalidation_where(campaign, status, only_failed)
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT COUNT(*) FROM applications WHERE {' AND '.join(where_conditions)}",
+                tuple(params),
+            )
+            return cursor.fetchone()[0] or 0
+    except Exception as e:
+        logger.error(f"Ошибка подсчета заявок для перевалидации: {e}")
+        return 0
+
+
+def get_all_photo_phashes() -> List[tuple]:
+    """Все сохраненные pHash: [(id, photo_phash)] — для индекса похожих фото"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, photo_phash FROM applications
+                WHERE photo_phash IS NOT NULL AND photo_phash != ''
+            """)
+            return [(row[0], row[1]) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения pHash: {e}")
+        return []
+
+
+def _revalidation_job_row(row) -> Dict[str, Any]:
+    started_at, updated_at = row[8], row[9]
+    if DATABASE_TYPE == 'duckdb':
+        started_at = started_at.isoformat() if hasattr(started_at, 'isoformat') else started_at
+        updated_at = updated_at.isoformat() if hasattr(updated_at, 'isoformat') else updated_at
+    return {
+        'id': row[0],
+        'filters': json.loads(row[1]) if row[1] else {},
+        'params_key': row[2] or '',
+        'status': row[3],
+        'last_id': row[4] or 0,
+        'processed': row[5] or 0,
+        'cached': row[6] or 0,
+        'total': row[7] or 0,
+        'started_at': started_at,
+        'updated_at': updated_at,
+    }
+
+
+@db_retry(max_retries=3, delay=0.1)
+def create_revalidation_job(filters: Dict[str, Any], params_key: str, total: int) -> int:
+    """Создает запись задачи перевалидации и возвращает ее id"""
+    filters_json = json.dumps(filters or {}, ensure_ascii=False, sort_keys=True)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if DATABASE_TYPE == 'duckdb':
+            cursor.execute("""
+                INSERT INTO revalidation_jobs (filters, params_key, status, total, started_at, updated_at)
+                VALUES (?, ?, 'running', ?, ?, ?)
+                RETURNING id
+            """, (filters_json, params_key, int(total), datetime.now(), datetime.now()))
+            job_id = cursor.fetchone()[0]
+        else:
+            now = datetime.now().isoformat()
+            cursor.execute('''
+                INSERT INTO revalidation_jobs (filters, params_key, status, total, started_at, updated_at)
+                VALUES (?, ?, 'running', ?, ?, ?)
+            ''', (filters_json, params_key, int(total), now, now))
+            job_id = cursor.lastrowid
+        conn.commit()
+        return job_id
+
+
+@db_retry(max_retries=3, delay=0.1)
+def update_revalidation_job(job_id: int, **fields) -> bool:
+    """Обновляет прогресс/статус задачи (контрольная точка для возобновления)"""
+    updates = {k: v for k, v in fields.items() if k in _REVALIDATION_JOB_FIELDS}
+    if not updates:
+        return False
+    now = datetime.now() if DATABASE_TYPE == 'duckdb' else datetime.now().isoformat()
+    assignments = ', '.join(f"{k} = ?" for k in updates)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"UPDATE revalidation_jobs SET {assignments}, updated_at = ? WHERE id = ?",
+            tuple(updates.values()) + (now, job_id),
+        )
+        conn.commit()
+        return True
+
+
+def get_revalidation_job(job_id: int = None, unfinished_only: bool = False) -> Optional[Dict[str, Any]]:
+    """Задача перевалидации по id или последняя (опционально — только незавершенная)"""
+    try:
+        sql = """
+            SELECT id, filters, params_key, status, last_id, processed, cached, total, started_at, updated_at
+            FROM revalidation_jobs
+        """
+        where_conditions, params = [], []
+        if job_id is not None:
+            where_conditions.append("id = ?")
+            params.append(job_id)
+        if unfinished_only:
+            where_conditions.append("status != 'done'")
+        if where_conditions:
+            sql += " WHERE " + " AND ".join(where_conditions)
+        sql += " ORDER BY id DESC LIMIT 1"
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, tuple(params))
             row = cursor.fetchone()
-            if not row:
-                # Fallback - любой шаблон
-                cursor.execute('SELECT id, name, required_stickers, template_image_path, active_from, active_until, validation_zones FROM leaflet_templates ORDER BY id DESC LIMIT 1')
-                row = cursor.fetchone()
-                if not row:
-                    return None
-            
-            validation_zones = row[6]
-            if DATABASE_TYPE == 'duckdb':
-                # DuckDB возвращает JSON как объект
-                validation_zones_str = json.dumps(validation_zones) if validation_zones else '[]'
-            else:
-                validation_zones_str = validation_zones or '[]'
-            
-            return {
-                'id': row[0],
-                'name': row[1],
-                'required_stickers': row[2] or 0,
-                'template_image_path': row[3] or '',
-                'active_from': row[4],
-                'active_until': row[5],
-                'validation_zones': validation_zones_str
-            }
+            return _revalidation_job_row(row) if row else None
     except Exception as e:
-        logger.error(f"Ошибка получения активного шаблона: {e}")
+        logger.error(f"Ошибка получения задачи перевалидации: {e}")
         return None
 
 
+def get_cached_leaflet_metrics(content_hashes: List[str], params_key: str) -> Dict[str, Dict[str, Any]]:
+    """Кэшированные метрики анализа по хешам содержимого: {content_hash: metrics}"""
+    hashes = [h for h in set(content_hashes) if h]
+    if not hashes:
+        return {}
+    try:
+        placeholders = ', '.join('?' for _ in hashes)
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT content_hash, metrics FROM leaflet_analysis_cache
+                WHERE params_key = ? AND content_hash IN ({placeholders})
+            """, (params_key, *hashes))
+            return {row[0]: json.loads(row[1]) for row in cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Ошибка чтения кэша анализа: {e}")
+        return {}
+
+
+@db_retry(max_retries=3, delay=0.1)
+def save_leaflet_metrics_cache(entries: Dict[str, Dict[str, Any]], params_key: str) -> int:
+    """Пакетно сохраняет метрики анализа в кэш: {content_hash: metrics}"""
+    if not entries:
+        return 0
+    rows = [(h, params_key, json.dumps(m, ensure_ascii=False)) for h, m in entries.items()]
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT OR REPLACE INTO leaflet_analysis_cache (content_hash, params_key, metrics)
+            VALUES (?, ?, ?)
+        ''', rows)
+        conn.commit()
+        return len(rows)
+
+
+@db_retry(max_retries=3, delay=0.1)
+def acquire_photo_blob(content_hash: str, path: str, size_bytes: int = 0) -> tuple:
+    """
+    Регистрирует ссылку на файл фото (+1 к refcount)
+    
+    Returns:
+        tuple: (новый refcount, путь сохраненного файла — для refcount > 1 это
+        путь уже существующей копии, возможно перекодированной)
+    """
+    now = datetime.now() if DATABASE_TYPE == 'duckdb' else datetime.now().isoformat()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO photo_blobs (content_hash, path, size_bytes, refcount, created_at)
+            VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT (content_hash) DO UPDATE SET refcount = photo_blobs.refcount + 1
+        """, (content_hash, path, int(size_bytes or 0), now))
+        cursor.execute("SELECT refcount, path FROM photo_blobs WHERE content_hash = ?", (content_hash,))
+        refcount, stored_path = cursor.fetchone()
+        conn.commit()
+        return refcount, stored_path
+
+
+@db_retry(max_retries=3, delay=0.1)
+def release_photo_blob(content_hash: str) -> Optional[int]:
+    """Снимает ссылку на файл фото; при нуле удаляет запись. None — файл не учтен"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT refcount FROM photo_blobs WHERE content_hash = ?", (content_hash,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        remaining = max(0, (row[0] or 0) - 1)
+        if remaining:
+            cursor.execute("UPDATE photo_blobs SET refcount = ? WHERE content_hash = ?", (remaining, content_hash))
+        else:
+            cursor.execute("DELETE FROM photo_blobs WHERE content_hash = ?", (content_hash,))
+        conn.commit()
+        return remaining
+
+
+def get_photo_storage_stats() -> Dict[str, int]:
+    """Сводка по хранилищу фото: уникальные файлы, ссылки, байты"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*), SUM(refcount), SUM(size_bytes) FROM photo_blobs")
+            blobs, refs, size_bytes = cursor.fetchone()
+            return {'blobs': blobs or 0, 'references': int(refs or 0), 'bytes': int(size_bytes or 0)}
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики хранилища фото: {e}")
+        return {'blobs': 0, 'references': 0, 'bytes': 0}
+
+
+def get_compaction_candidates(after_hash: str = '', limit: int = 200) -> List[tuple]:
+    """Файлы хранилища, еще не проверенные компактором: [(content_hash, path, size_bytes)]"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT content_hash, path, size_bytes FROM photo_blobs
+                WHERE compacted_at IS NULL AND content_hash > ?
+                ORDER BY content_hash
+                LIMIT ?
+            """, (after_hash or '', int(limit)))
+            return [(row[0], row[1], row[2] or 0) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения файлов для перекодирования: {e}")
+        return []
+
+
+@db_retry(max_retries=3, delay=0.1)
+def mark_photo_compacted(content_hash: str, new_path: str = None, size_bytes: int = None) -> Optional[int]:
+    """
+    Отмечает файл как проверенный компактором; при new_path — переносит ссылки
+    заявок и запись хранилища на перекодированный файл (одной транзакцией).
+    Возвращает число заявок с обновленным photo_path; None — записи о файле
+    уже нет (последнюю ссылку сняли во время перекодирования).
+    """
+    now = datetime.now() if DATABASE_TYPE == 'duckdb' else datetime.now().isoformat()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        updated = 0
+        if new_path:
+            cursor.execute("SELECT path FROM photo_blobs WHERE content_hash = ?", (content_hash,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute("SELECT COUNT(*) FROM applications WHERE photo_path = ?", (row[0],))
+            updated = cursor.fetchone()[0] or 0
+            cursor.execute("UPDATE applications SET photo_path = ? WHERE photo_path = ?", (new_path, row[0]))
+            cursor.execute(
+                "UPDATE photo_blobs SET path = ?, size_bytes = ?, compacted_at = ? WHERE content_hash = ?",
+                (new_path, int(size_bytes or 0), now, content_hash),
+            )
+        else:
+            cursor.execute("UPDATE photo_blobs SET compacted_at = ? WHERE content_hash = ?", (now, content_hash))
+        conn.commit()
+        return updated
+
+
+def get_all_photo_paths() -> List[tuple]:
+    """Все пути к фото заявок: [(id, photo_path)] — для миграции хранилища"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, photo_path FROM applications
+                WHERE photo_path IS NOT NULL AND photo_path != ''
+                ORDER BY id
+            """)
+            return [(row[0], row[1]) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения путей к фото: {e}")
+        return []
+
+
+@db_retry(max_retries=3, delay=0.1)
+def update_photo_path(application_id: int, photo_path: str) -> bool:
+    """Обновляет путь к фото заявки"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE applications SET photo_path = ? WHERE id = ?", (photo_path, application_id))
+        conn.commit()
+        return True
+
+
+def get_application_photo_path(application_id: int) -> Optional[str]:
+    """Путь к фото заявки (None, если заявки нет)"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT photo_path FROM applications WHERE id = ?", (application_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Ошибка получения пути к фото заявки {application_id}: {e}")
+        return None
+
+
+def _photo_download_row(row) -> Dict[str, Any]:
+    return {
+        'application_id': row[0],
+        'file_id': row[1],
+        'file_unique_id': row[2] or '',
+        'status': row[3],
+        'attempts': row[4] or 0,
+        'next_attempt_at': row[5] or 0,
+        'last_error': row[6] or '',
+        'mime_type': row[7] or '',
+        'telegram_id': row[8],  # куда сообщить об отклоненном файле (личный чат = id пользователя)
+    }
+
+
+_PHOTO_DOWNLOAD_SELECT = """
+    SELECT d.application_id, d.file_id, d.file_unique_id, d.status, d.attempts, d.next_attempt_at, d.last_error,
+           d.mime_type, a.telegram_id
+    FROM photo_downloads d LEFT JOIN applications a ON a.id = d.application_id
+"""
+
+
+def get_due_photo_downloads(limit: int = 50, now: float = None) -> List[Dict[str, Any]]:
+    """Заявки в очереди скачивания, время попытки которых наступило (старые — первыми)"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_PHOTO_DOWNLOAD_SELECT + """
+                WHERE d.status = 'pending' AND COALESCE(d.next_attempt_at, 0) <= ?
+                ORDER BY d.next_attempt_at, d.application_id
+                LIMIT ?
+            """, (time.time() if now is None else now, int(limit)))
+            return [_photo_download_row(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения очереди скачивания фото: {e}")
+        return []
+
+
+def get_failed_photo_downloads(limit: int = 200) -> List[Dict[str, Any]]:
+    """Скачивания, исчерпавшие попытки (очередь на повторное скачивание)"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_PHOTO_DOWNLOAD_SELECT + """
+                WHERE d.status = 'failed'
+                ORDER BY d.application_id LIMIT ?
+            """, (int(limit),))
+            return [_photo_download_row(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения неудачных скачиваний фото: {e}")
+        return []
+
+
+@db_retry(max_retries=3, delay=0.1)
+def complete_photo_download(application_id: int, photo_path: str, photo_hash: str = '',
+                            leaflet_status: str = None, validation_notes: str = None, photo_phash: str = None) -> bool:
+    """
+    Записывает скачанное фото в заявку и убирает ее из очереди (одной транзакцией)
+
+    leaflet_status/validation_notes/photo_phash — для заявок, решение по
+    которым принято без анализа (дубликат, отклоненный файл)
+
+    Returns:
+        bool: False — заявку удалили, пока скачивалось фото (ссылку на файл
+        должен освободить вызывающий)
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if leaflet_status is None:
+            cursor.execute(
+                "UPDATE applications SET photo_path = ?, photo_hash = ? WHERE id = ?",
+                (photo_path, photo_hash, application_id),
+            )
+        else:
+            cursor.execute("""
+                UPDATE applications
+                SET photo_path = ?, photo_hash = ?, leaflet_status = ?, validation_notes = ?, photo_phash = ?
+                WHERE id = ?
+            """, (photo_path, photo_hash, leaflet_status, validation_notes or '[]', photo_phash or '', application_id))
+        # rowcount у DuckDB для UPDATE недоступен — проверяем заявку после записи, в той же транзакции
+        cursor.execute("SELECT 1 FROM applications WHERE id = ?", (application_id,))
+        exists = cursor.fetchone() is not None
+        cursor.execute("DELETE FROM photo_downloads WHERE application_id = ?", (application_id,))
+        conn.commit()
+        return exists
+
+
+@db_retry(max_retries=3, delay=0.1)
+def resubmit_application_photo(application_id: int, file_id: str, file_unique_id: str = '',
+                               mime_type: str = '') -> bool:
+    """
+    Новое фото вместо отклоненного: заявка снова ждет скачивания и скоринга
+
+    Returns:
+        bool: False — заявки нет или ее фото не было отклонено
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT leaflet_status FROM applications WHERE id = ?", (application_id,))
+        row = cursor.fetchone()
+        if not row or row[0] != 'rejected':
+            return False
+        cursor.execute("""
+            UPDATE applications
+            SET photo_file_id = ?, photo_file_unique_id = ?, leaflet_status = 'pending',
+                validation_notes = '{}', risk_details = ?
+            WHERE id = ?
+        """, (file_id, file_unique_id or None, UNSCORED_RISK_DETAILS, application_id))
+        cursor.execute("DELETE FROM photo_downloads WHERE application_id = ?", (application_id,))
+        cursor.execute(
+            'INSERT INTO photo_downloads (application_id, file_id, file_unique_id, mime_type) VALUES (?, ?, ?, ?)',
+            (application_id, file_id, file_unique_id or None, mime_type or None)
+        )
+        conn.commit()
+        return True
+
+
+@db_retry(max_retries=3, delay=0.1)
+def reschedule_photo_download(application_id: int, error: str, next_attempt_at: Optional[float]) -> bool:
+    """Учитывает неудачную попытку: следующая — в next_attempt_at, None — в очередь неудачных"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE photo_downloads
+            SET attempts = attempts + 1, last_error = ?, status = ?, next_attempt_at = ?
+            WHERE application_id = ?
+        """, (
+            (error or '')[:500],
+            'pending' if next_attempt_at is not None else 'failed',
+            float(next_attempt_at or 0),
+            application_id,
+        ))
+        conn.commit()
+        return True
+
+
+@db_retry(max_retries=3, delay=0.1)
+def requeue_failed_photo_downloads(application_ids: List[int] = None) -> int:
+    """Возвращает неудачные скачивания в очередь (все или указанные заявки)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        where, params = "status = 'failed'", []
+        if application_ids:
+            where += f" AND application_id IN ({', '.join('?' for _ in application_ids)})"
+            params = [int(i) for i in application_ids]
+        cursor.execute(f"SELECT COUNT(*) FROM photo_downloads WHERE {where}", params)
+        count = cursor.fetchone()[0] or 0
+        cursor.execute(
+            f"UPDATE photo_downloads SET status = 'pending', attempts = 0, next_attempt_at = 0 WHERE {where}",
+            params,
+        )
+        conn.commit()
+        return count
+
+
+def get_photo_download_stats() -> Dict[str, int]:
+    """Размер очереди скачивания фото по статусам"""
+    stats = {'pending': 0, 'failed': 0}
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT status, COUNT(*) FROM photo_downloads GROUP BY status")
+            for status, count in cursor.fetchall():
+                stats[status] = count or 0
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики скачивания фото: {e}")
+    return stats
+
+
 def count_recent_registrations(seconds: int = 60) -> int:
     """Подсчитывает количество регистраций за последние N секунд"""
     try:
@@ -534,6 +1273,130 @@ def update_risk(application_id: int, risk_score: int, risk_level: str, risk_deta
         return False
 
 
+# risk_details только что сохраненной заявки: риск еще не посчитан очередью скоринга
+UNSCORED_RISK_DETAILS = '{}'
+# Проверка-пометка в risk_details заявок, посчитанных упрощенно (без контекста из БД)
+DEGRADED_RISK_CHECK = 'degraded'
+
+RISK_PARTICIPANT_COLUMNS = ('id', 'name', 'phone_number', 'loyalty_card_number', 'telegram_id',
+                            'telegram_username', 'photo_hash', 'photo_phash', 'timestamp')
+
+
+@db_retry(max_retries=3, delay=0.1)
+def get_risk_participants(ids: List[int]) -> List[Dict[str, Any]]:
+    """
+    Поля заявок, нужные антифроду, одним запросом
+
+    Ошибка БД пробрасывается: пустой список значит только, что заявок уже нет.
+    """
+    if not ids:
+        return []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        qmarks = ','.join('?' for _ in ids)
+        cursor.execute(f"SELECT {', '.join(RISK_PARTICIPANT_COLUMNS)} FROM applications WHERE id IN ({qmarks})",
+                       tuple(int(i) for i in ids))
+        return [dict(zip(RISK_PARTICIPANT_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def get_risk_participants_page(after_id: int = 0, limit: int = 5000) -> List[Dict[str, Any]]:
+    """Страница заявок с id > after_id (поля RISK_PARTICIPANT_COLUMNS) — для обхода всей таблицы"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT {', '.join(RISK_PARTICIPANT_COLUMNS)} FROM applications
+                WHERE id > ? ORDER BY id LIMIT ?
+            """, (int(after_id), int(limit)))
+            return [dict(zip(RISK_PARTICIPANT_COLUMNS, row)) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы заявок: {e}")
+        return []
+
+
+def get_unscored_application_ids(after_id: int = 0, limit: int = 10000) -> List[int]:
+    """
+    Страница заявок с id > after_id, ждущих полного скоринга: риск не посчитан
+    или посчитан упрощенно (пометка DEGRADED_RISK_CHECK). Заявки, фото которых
+    еще ждет скачивания, пропускаются — их поставит в очередь загрузчик.
+    """
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id
+                FROM applications
+                WHERE id > ?
+                  AND (COALESCE(risk_details, '') IN ('', ?) OR risk_details LIKE ?)
+                  AND id NOT IN (SELECT application_id FROM photo_downloads WHERE status = 'pending')
+                ORDER BY id
+                LIMIT ?
+            """, (int(after_id), UNSCORED_RISK_DETAILS, f'%"name": "{DEGRADED_RISK_CHECK}"%', int(limit)))
+            return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения заявок без скоринга: {e}")
+        return []
+
+
+@db_retry(max_retries=3, delay=0.1)
+def flag_manual_review(ids: List[int]) -> int:
+    """Отправляет заявки на ручную модерацию (manual_review_required = 1)"""
+    if not ids:
+        return 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        qmarks = ','.join('?' for _ in ids)
+        cursor.execute(f'UPDATE applications SET manual_review_required = 1 WHERE id IN ({qmarks})',
+                       tuple(int(i) for i in ids))
+        conn.commit()
+        return len(ids)
+
+
+RISK_FRAME_COLUMNS = ('id', 'name', 'phone_number', 'loyalty_card_number', 'telegram_id', 'telegram_username',
+                      'photo_hash', 'timestamp', 'risk_score', 'risk_level', 'risk_details')
+
+
+@db_retry()
+def load_risk_frame() -> pd.DataFrame:
+    """Колонки всех заявок, нужные антифроду, одним запросом — для пакетного скоринга"""
+    query = f"SELECT {', '.join(RISK_FRAME_COLUMNS)} FROM applications ORDER BY id"
+    with get_db_connection() as conn:
+        if DATABASE_TYPE == 'duckdb':
+            return conn.execute(query).df()
+        return pd.read_sql_query(query, conn)
+
+
+@db_retry()
+def bulk_update_risk(updates: pd.DataFrame) -> int:
+    """
+    Записывает risk_score, risk_level и risk_details пачки заявок одним UPDATE
+
+    Args:
+        updates: DataFrame с колонками id, risk_score, risk_level, risk_details
+    """
+    if updates.empty:
+        return 0
+    updates = updates[['id', 'risk_score', 'risk_level', 'risk_details']]
+    with get_db_connection() as conn:
+        if DATABASE_TYPE == 'duckdb':
+            # DataFrame как таблица: один UPDATE ... FROM вместо построчного executemany
+            conn.register('risk_updates', updates)
+            conn.execute("""
+                UPDATE applications
+                SET risk_score = u.risk_score, risk_level = u.risk_level, risk_details = u.risk_details
+                FROM risk_updates u
+                WHERE applications.id = u.id
+            """)
+            conn.unregister('risk_updates')
+        else:
+            conn.executemany("""
+                UPDATE applications SET risk_score = ?, risk_level = ?, risk_details = ? WHERE id = ?
+            """, [(int(score), level, details, int(app_id)) for app_id, score, level, details in
+                  updates.itertuples(index=False, name=None)])
+            conn.commit()
+    return len(updates)
+
+
 @db_retry(max_retries=3, delay=0.1)
 def set_status(application_id: int, status: str) -> bool:
     """Устанавливает статус заявки"""
@@ -566,8 +1429,18 @@ def save_application(name: str, phone_number: str, telegram_username: str = "",
                     stickers_count: int = 0,
                     validation_notes: str = "",
                     manual_review_required: int = 1,
-                    photo_phash: str = "") -> bool:
-    """Сохраняет заявку в базу данных"""
+                    photo_phash: str = "",
+                    photo_file_unique_id: str = "",
+                    photo_file_id: str = "",
+                    defer_photo_download: bool = False,
+                    photo_mime_type: str = "") -> bool:
+    """
+    Сохраняет заявку в базу данных
+
+    defer_photo_download — фото еще не скачано: в той же транзакции заявка
+    ставится в очередь photo_downloads по photo_file_id (photo_mime_type —
+    тип файла, если фото прислано документом)
+    """
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -580,15 +1453,15 @@ def save_application(name: str, phone_number: str, telegram_username: str = "",
                         name, phone_number, telegram_username, telegram_id, photo_path, timestamp,
                         photo_hash, risk_score, risk_level, risk_details, status,
                         participant_number, leaflet_status, stickers_count, validation_notes, 
-                        manual_review_required, photo_phash
+                        manual_review_required, photo_phash, photo_file_unique_id, photo_file_id
                     )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     RETURNING id
                 """, (
                     name, phone_number, telegram_username, telegram_id, photo_path, current_timestamp,
                     photo_hash, risk_score, risk_level, risk_details, status,
                     participant_number, leaflet_status, stickers_count, validation_notes, 
-                    manual_review_required, photo_phash
+                    manual_review_required, photo_phash, photo_file_unique_id or None, photo_file_id or None
                 ))
                 # DuckDB возвращает id через RETURNING
                 app_id = cursor.fetchone()[0]
@@ -600,14 +1473,14 @@ def save_application(name: str, phone_number: str, telegram_username: str = "",
                         name, phone_number, telegram_username, telegram_id, photo_path, timestamp,
                         photo_hash, risk_score, risk_level, risk_details, status,
                         participant_number, leaflet_status, stickers_count, validation_notes, 
-                        manual_review_required, photo_phash
+                        manual_review_required, photo_phash, photo_file_unique_id, photo_file_id
                     )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
                     name, phone_number, telegram_username, telegram_id, photo_path, timestamp,
                     photo_hash, risk_score, risk_level, risk_details, status,
                     participant_number, leaflet_status, stickers_count, validation_notes, 
-                    manual_review_required, photo_phash
+                    manual_review_required, photo_phash, photo_file_unique_id or None, photo_file_id or None
                 ))
                 app_id = cursor.lastrowid
             
@@ -625,6 +1498,12 @@ def save_application(name: str, phone_number: str, telegram_username: str = "",
                 except Exception as e:
                     logger.warning(f"Не удалось присвоить номер участника: {e}")
             
+            if defer_photo_download:
+                cursor.execute(
+                    'INSERT INTO photo_downloads (application_id, file_id, file_unique_id, mime_type) VALUES (?, ?, ?, ?)',
+                    (app_id, photo_file_id, photo_file_unique_id or None, photo_mime_type or None)
+                )
+            
             conn.commit()
             logger.info(f"Создана заявка для пользователя {name} (ID: {telegram_id}, app_id: {app_id})")
             return True
@@ -641,20 +1520,42 @@ def save_application(name: str, phone_number: str, telegram_username: str = "",
 # Остальные функции аналогично адаптируются...
 # Для краткости показываю только основные, остальные следуют тому же паттерну
 
+# Подписчики на удаление заявок: индексы в памяти (кольца, скорость), которые
+# иначе держали бы удаленные заявки и путали их с новыми под теми же id
+_deletion_listeners: List[Callable[[Optional[List[int]]], None]] = []
+
+
+def on_applications_deleted(callback: Callable[[Optional[List[int]]], None]) -> None:
+    """Подписывает callback(ids) на удаление заявок; ids = None — удалены все заявки"""
+    if callback not in _deletion_listeners:
+        _deletion_listeners.append(callback)
+
+
+def _notify_applications_deleted(ids: Optional[List[int]]) -> None:
+    for callback in list(_deletion_listeners):
+        try:
+            callback(ids)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика удаления заявок: {e}")
+
+
 def delete_application(application_id: int) -> bool:
     """Удаляет заявку по ID"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('DELETE FROM applications WHERE id = ?', (application_id,))
-            
-            if cursor.rowcount > 0:
-                conn.commit()
-                logger.info(f"Удалена заявка с ID: {application_id}")
-                return True
-            else:
+            # rowcount у DuckDB для DELETE недоступен (-1) — проверяем заявку до удаления
+            cursor.execute('SELECT 1 FROM applications WHERE id = ?', (application_id,))
+            if cursor.fetchone() is None:
                 logger.warning(f"Заявка с ID {application_id} не найдена")
                 return False
+
+            cursor.execute('DELETE FROM applications WHERE id = ?', (application_id,))
+            cursor.execute('DELETE FROM photo_downloads WHERE application_id = ?', (application_id,))
+            conn.commit()
+            logger.info(f"Удалена заявка с ID: {application_id}")
+            _notify_applications_deleted([application_id])
+            return True
                 
     except Exception as e:
         logger.error(f"Ошибка при удалении заявки: {e}")
@@ -1250,6 +2151,49 @@ def get_user_by_id(user_id: int):
         return None
 
 
+@db_retry()
+def get_fraud_signal_counts(cards: List[str] = (), phones: List[str] = (), photo_hashes: List[str] = (),
+                            telegram_ids: List[int] = (), recent_seconds: int = 60) -> Dict[str, Any]:
+    """
+    Счетчики для антифрода по пачке значений — одним запросом
+
+    Returns:
+        dict: {'card': {номер: заявок}, 'phone': {...}, 'photo': {...},
+        'telegram': {str(telegram_id): ...}, 'recent': регистраций за recent_seconds}
+    """
+    counts: Dict[str, Any] = {'card': {}, 'phone': {}, 'photo': {}, 'telegram': {}, 'recent': 0}
+    parts, params = [], []
+    for kind, column, values in (
+        ('card', 'loyalty_card_number', cards),
+        ('phone', 'phone_number', phones),
+        ('photo', 'photo_hash', photo_hashes),
+        ('telegram', 'telegram_id', telegram_ids),
+    ):
+        values = sorted({v for v in values if v})
+        if not values:
+            continue
+        placeholders = ', '.join('?' for _ in values)
+        parts.append(f"SELECT '{kind}', CAST({column} AS TEXT), COUNT(*) FROM applications "
+                     f"WHERE {column} IN ({placeholders}) GROUP BY {column}")
+        params.extend(values)
+    if DATABASE_TYPE == 'duckdb':
+        parts.append("SELECT 'recent', '', COUNT(*) FROM applications WHERE timestamp >= ?")
+        params.append(datetime.now() - timedelta(seconds=recent_seconds))
+    else:
+        parts.append("SELECT 'recent', '', COUNT(*) FROM applications WHERE datetime(timestamp) >= datetime('now', ?)")
+        params.append(f'-{recent_seconds} seconds')
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(' UNION ALL '.join(parts), params)
+        for kind, value, count in cursor.fetchall():
+            if kind == 'recent':
+                counts['recent'] = count or 0
+            else:
+                counts[kind][value] = count or 0
+    return counts
+
+
 def loyalty_card_exists(loyalty_card_number: str) -> bool:
     """Проверяет, существует ли заявка с таким номером (используем telegram_username)"""
     try:
@@ -1390,6 +2334,10 @@ def clear_all_data():
             cursor.execute("DELETE FROM leaflet_templates")
             templates_deleted = cursor.rowcount
             
+            # Учет ссылок на файлы фото и очередь скачивания теряют смысл вместе с заявками
+            cursor.execute("DELETE FROM photo_blobs")
+            cursor.execute("DELETE FROM photo_downloads")
+            
             if DATABASE_TYPE == 'duckdb':
                 # DuckDB автоматически управляет последовательностями
                 pass
@@ -1398,6 +2346,7 @@ def clear_all_data():
                 cursor.execute("DELETE FROM sqlite_sequence WHERE name IN ('applications', 'support_tickets', 'leaflet_templates')")
             
             conn.commit()
+            _notify_applications_deleted(None)
             
             logger.info(f"Данные удалены: applications={apps_deleted}, support_tickets={tickets_deleted}, leaflet_templates={templates_deleted}")
             
@@ -1427,7 +2376,7 @@ def force_clear_all_data():
             
             if DATABASE_TYPE == 'duckdb':
                 # DuckDB таблицы
-                tables = ['applications', 'support_tickets', 'leaflet_templates']
+                tables = ['applications', 'support_tickets', 'leaflet_templates', 'photo_blobs', 'photo_downloads']
                 
                 for table_name in tables:
                     try:
@@ -1456,6 +2405,7 @@ def force_clear_all_data():
                 cursor.execute("PRAGMA foreign_keys = ON")
             
             conn.commit()
+            _notify_applications_deleted(None)
             
             # Проверяем результат
             cursor.execute("SELECT COUNT(*) FROM applications")
@@ -10,6 +10,12 @@ from typing import Dict, Any
 from database.db_manager import init_database
 from bot.telegram_bot import create_bot
 from web.admin_panel import create_web_app
+from utils.analysis_queue import start_analysis_queue
+from utils.file_handler import get_photo_storage
+from utils.photo_downloader import start_photo_downloader, get_photo_downloader
+from utils.risk_queue import start_risk_queue, get_risk_queue
+from utils.fraud_rings import start_ring_index, get_ring_index
+from utils.velocity import start_velocity_tracker, get_velocity_tracker
 
 # Настройка логирования
 logging.basicConfig(
@@ -115,6 +121,36 @@ def main():
         # Инициализируем базу данных
         init_database()
         
+        # Фоновый анализ фото лифлетов (подхватывает pending-заявки после рестарта)
+        try:
+            start_analysis_queue()
+        except Exception as e:
+            logger.warning(f"Очередь анализа фото не запущена: {e}")
+        
+        # Индекс колец мошенников: снапшот + доигрывание заявок после него
+        try:
+            start_ring_index()
+        except Exception as e:
+            logger.warning(f"Индекс колец не загружен: {e}")
+        
+        # Счетчики скорости регистраций по измерениям (снапшот после рестарта)
+        try:
+            start_velocity_tracker()
+        except Exception as e:
+            logger.warning(f"Снапшот скорости регистраций не загружен: {e}")
+        
+        # Фоновый скоринг риска новых заявок (подхватывает заявки без риска после рестарта)
+        try:
+            start_risk_queue()
+        except Exception as e:
+            logger.warning(f"Очередь скоринга риска не запущена: {e}")
+        
+        # Фоновое скачивание фото заявок (продолжает очередь из БД после рестарта)
+        try:
+            start_photo_downloader()
+        except Exception as e:
+            logger.warning(f"Скачивание фото не запущено: {e}")
+        
         # Запускаем веб-приложение в отдельном потоке
         web_thread = threading.Thread(target=start_web_app)
         web_thread.daemon = True
@@ -125,6 +161,16 @@ def main():
         
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
+    finally:
+        # Останавливаем скачивание (незавершенное продолжится после рестарта)
+        # и дожидаемся фоновых загрузок фото в удаленное хранилище
+        get_photo_downloader().stop()
+        # Сбрасываем посчитанный риск; непосчитанные заявки подхватятся после рестарта
+        get_risk_queue().stop()
+        get_ring_index().save_snapshot()
+        get_velocity_tracker().save_snapshot()
+        if not get_photo_storage().flush(timeout=30):
+            logger.warning("Не все фото загружены в хранилище до остановки")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+"""
+Benchmark: full-resolution decode vs JPEG draft-mode decode for leaflet analysis.
+
+Compares time, traced peak memory and agreement of the metrics (blur verdict,
+aHash distance, zone coverage) between max_side=0 (full decode) and the
+configured LEAFLET_ANALYSIS_MAX_SIDE. Uses photos from --photos-dir if given,
+otherwise renders synthetic leaflets with several blur radii.
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Ensure project root on sys.path
+CURRENT_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, os.pardir))
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from config import LEAFLET_ANALYSIS_MAX_SIDE
+from utils.image_validation import (
+    decode_gray, variance_of_laplacian, compute_ahash_hex,
+    blur_threshold_for_scale, _count_stickers_by_zones,
+)
+
+ZONES = json.dumps([
+    {"x": 0.10, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.41, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.72, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.25, "y": 0.52, "w": 0.18, "h": 0.18},
+    {"x": 0.56, "y": 0.52, "w": 0.18, "h": 0.18},
+])
+
+
+def render_leaflet(rng: np.random.Generator, width: int, height: int, blur: float) -> bytes:
+    img = Image.new('RGB', (width, height), (250, 250, 245))
+    draw = ImageDraw.Draw(img)
+    for _ in range(300):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        draw.text((x, y), "LEAFLET 2025", fill=(20, 20, 20), font_size=int(rng.integers(20, 80)))
+    for _ in range(25):
+        x, y = int(rng.integers(0, width - 300)), int(rng.integers(0, height - 300))
+        color = tuple(int(c) for c in rng.integers(0, 200, 3))
+        draw.ellipse((x, y, x + 250, y + 250), fill=color)
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur))
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+def measure(data: bytes, max_side: int) -> dict:
+    tracemalloc.start()
+    started = time.perf_counter()
+    img = Image.open(io.BytesIO(data))
+    width, height = img.size
+    gray = decode_gray(img, max_side=max_side)
+    factor = max(1, round(max(width, height) / max(gray.shape)))
+    blur = variance_of_laplacian(gray)
+    phash = compute_ahash_hex(gray)
+    _, coverage = _count_stickers_by_zones(gray, ZONES)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'factor': factor,
+        'seconds': elapsed,
+        'peak_mb': peak / 1e6,
+        'is_blurry': blur < blur_threshold_for_scale(factor),
+        'phash': phash,
+        'coverage': coverage,
+    }
+
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full vs draft-mode decoding for leaflet analysis")
+    parser.add_argument("--photos-dir", help="Directory with real JPEG photos (optional)")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--max-side", type=int, default=LEAFLET_ANALYSIS_MAX_SIDE or 1600)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="Write per-photo results to this file")
+    args = parser.parse_args()
+
+    samples = []
+    if args.photos_dir:
+        for name in sorted(os.listdir(args.photos_dir)):
+            if name.lower().endswith(('.jpg', '.jpeg')):
+                with open(os.path.join(args.photos_dir, name), 'rb') as f:
+                    samples.append((name, f.read()))
+    else:
+        rng = np.random.default_rng(args.seed)
+        for blur in (0, 1, 2, 4, 8):
+            samples.append((f"synthetic_blur{blur}", render_leaflet(rng, args.width, args.height, blur)))
+
+    rows = []
+    for name, data in samples:
+        full = measure(data, 0)
+        draft = measure(data, args.max_side)
+        rows.append({
+            'photo': name,
+            'factor': draft['factor'],
+            'full_s': round(full['seconds'], 4),
+            'draft_s': round(draft['seconds'], 4),
+            'full_peak_mb': round(full['peak_mb'], 1),
+            'draft_peak_mb': round(draft['peak_mb'], 1),
+            'blur_agree': full['is_blurry'] == draft['is_blurry'],
+            'phash_distance': hamming(full['phash'], draft['phash']) if full['phash'] and draft['phash'] else None,
+            'coverage_max_diff': round(max((abs(a - b) for a, b in zip(full['coverage'], draft['coverage'])), default=0.0), 4),
+        })
+
+    for row in rows:
+        print(
+            f"{row['photo']:<24} 1/{row['factor']}  "
+            f"time {row['full_s']:.3f}s -> {row['draft_s']:.3f}s  "
+            f"peak {row['full_peak_mb']:.0f}MB -> {row['draft_peak_mb']:.0f}MB  "
+            f"blur_agree={row['blur_agree']} phash_d={row['phash_distance']} cov_diff={row['coverage_max_diff']}"
+        )
+    if rows:
+        speedup = sum(r['full_s'] for r in rows) / max(1e-9, sum(r['draft_s'] for r in rows))
+        agree = sum(1 for r in rows if r['blur_agree']) / len(rows)
+        print(f"Speedup: x{speedup:.1f}, blur verdict agreement: {agree:.0%}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
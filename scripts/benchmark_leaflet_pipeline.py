@@ -0,0 +1,215 @@
+"""
+Benchmark of the leaflet analysis pipeline on a labelled corpus.
+
+Runs every photo of a corpus (see generate_leaflet_corpus.py) through the
+analysis stages - decode, blur, pHash, template match (alignment + zones),
+duplicate lookup and the final verdict - and reports photos/sec, p50/p99
+latency per stage, peak RSS and accuracy per stage against ground truth.
+With --workers N the end-to-end throughput is also measured through the
+process pool used in production. Results go to JSON so runs can be diffed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+# Ensure project root on sys.path
+CURRENT_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, os.pardir))
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+import numpy as np
+from PIL import Image
+
+from config import LEAFLET_ANALYSIS_MAX_SIDE
+from utils.image_validation import (
+    ANALYSIS_VERSION, decode_gray, variance_of_laplacian, blur_threshold_for_scale,
+    compute_ahash_hex, nonwhite_integral, read_exif_meta, decide_leaflet_status,
+)
+from utils.phash_index import PhashIndex
+from utils.template_features import match_templates
+
+STAGES = ('decode', 'blur', 'phash', 'template_match', 'duplicates', 'decide')
+
+
+def peak_rss_mb() -> dict:
+    scale = 1024.0 if platform.system() != 'Darwin' else 1024.0 * 1024.0  # ru_maxrss: KB на Linux, байты на macOS
+    return {
+        'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+def percentiles(values) -> dict:
+    arr = np.array(values, dtype=np.float64) * 1000.0
+    if not len(arr):
+        return {'p50_ms': None, 'p99_ms': None, 'mean_ms': None}
+    return {
+        'p50_ms': round(float(np.percentile(arr, 50)), 3),
+        'p99_ms': round(float(np.percentile(arr, 99)), 3),
+        'mean_ms': round(float(arr.mean()), 3),
+    }
+
+
+def run_stages(path: str, templates, max_side: int) -> tuple:
+    """Те же шаги, что analyze_leaflet_image, но с замером каждого."""
+    timings = {}
+    t = time.perf_counter()
+    with Image.open(path) as img:
+        width, height = img.size
+        exif = read_exif_meta(img)
+        gray = decode_gray(img, max_side=max_side)
+    factor = max(1, round(max(width, height) / max(gray.shape)))
+    timings['decode'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    blur = variance_of_laplacian(gray)
+    timings['blur'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    phash = compute_ahash_hex(gray)
+    timings['phash'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    match = match_templates(gray, nonwhite_integral(gray), templates)
+    timings['template_match'] = time.perf_counter() - t
+
+    metrics = {
+        'width': width,
+        'height': height,
+        'analysis_scale': 1.0 / factor,
+        'blur_score': float(blur),
+        'is_blurry': bool(blur < blur_threshold_for_scale(factor)),
+        'exif_has_datetime': bool(exif.get('DateTimeOriginal') or exif.get('DateTime')),
+        'orientation_ok': exif.get('Orientation') not in (3, 6, 8),
+        'photo_phash': phash,
+        'required_stickers': match['required_stickers'],
+        'stickers_count': match['stickers_count'],
+        'zones_coverage': match['zones_coverage'],
+        'template_id': match['template_id'],
+        'template_confidence': match['template_confidence'],
+        'template_alignment': match['alignment'],
+    }
+    return metrics, timings
+
+
+def pool_throughput(paths, templates, workers: int) -> dict:
+    from utils.analysis_service import LeafletAnalysisService
+    service = LeafletAnalysisService(max_workers=workers)
+    try:
+        # Прогрев процессов до замера
+        service.wait_metrics(service.submit(paths[0], templates))
+        started = time.perf_counter()
+        futures = [service.submit(p, templates) for p in paths]
+        failed = sum(1 for f in futures if service.wait_metrics(f)[0] is None)
+        elapsed = time.perf_counter() - started
+    finally:
+        service.shutdown()
+    return {
+        'workers': workers,
+        'photos_per_sec': round(len(paths) / elapsed, 2) if elapsed > 0 else None,
+        'failed': failed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark leaflet analysis throughput and accuracy")
+    parser.add_argument("--corpus", required=True, help="Corpus directory with labels.json")
+    parser.add_argument("--generate", type=int, default=0, help="Render N photos into --corpus first")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--max-side", type=int, default=LEAFLET_ANALYSIS_MAX_SIDE)
+    parser.add_argument("--workers", type=int, default=0, help="Also measure the process pool with N workers")
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    if args.generate:
+        # Отдельным процессом, чтобы рендеринг не попал в peak RSS замера
+        subprocess.run([sys.executable, os.path.join(CURRENT_DIR, 'generate_leaflet_corpus.py'),
+                        '--out', args.corpus, '--count', str(args.generate), '--seed', str(args.seed)], check=True)
+    with open(os.path.join(args.corpus, 'labels.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    with open(os.path.join(args.corpus, manifest['template']), encoding='utf-8') as f:
+        templates = [json.load(f)]
+    labels = manifest['photos']
+    paths = [os.path.join(args.corpus, label['photo']) for label in labels]
+
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    results = []
+    started = time.perf_counter()
+    for path in paths:
+        t0 = time.perf_counter()
+        metrics, stage_times = run_stages(path, templates, args.max_side)
+        results.append(metrics)
+        for stage, seconds in stage_times.items():
+            timings[stage].append(seconds)
+        totals.append(time.perf_counter() - t0)
+
+    # Дубликаты — по индексу pHash всего корпуса (как при перевалидации)
+    t = time.perf_counter()
+    index = PhashIndex((i, m['photo_phash']) for i, m in enumerate(results))
+    similar = [index.count_similar(m['photo_phash'], exclude_id=i) for i, m in enumerate(results)]
+    per_photo_dup = (time.perf_counter() - t) / max(1, len(results))
+    timings['duplicates'] = [per_photo_dup] * len(results)
+
+    verdicts = []
+    for i, metrics in enumerate(results):
+        t = time.perf_counter()
+        verdicts.append(decide_leaflet_status(metrics, similar[i]))
+        timings['decide'].append(time.perf_counter() - t)
+        totals[i] += timings['decide'][-1] + per_photo_dup
+    elapsed = time.perf_counter() - started
+
+    def accuracy(predicate) -> float:
+        return round(sum(1 for label, verdict in zip(labels, verdicts) if predicate(label, verdict)) / max(1, len(labels)), 4)
+
+    sharp_enough = [(l, v) for l, v in zip(labels, verdicts) if not l['low_resolution'] and not l['blurry']]
+    report = {
+        'analysis_version': ANALYSIS_VERSION,
+        'corpus': os.path.abspath(args.corpus),
+        'photos': len(labels),
+        'max_side': args.max_side,
+        'photos_per_sec': round(len(labels) / elapsed, 2) if elapsed > 0 else None,
+        'latency_total': percentiles(totals),
+        'stages': {
+            stage: percentiles(timings[stage]) for stage in STAGES
+        },
+        'accuracy': {
+            'decode_resolution': accuracy(lambda l, v: (v['width'] < 1024 or v['height'] < 768) == l['low_resolution']),
+            'blur': accuracy(lambda l, v: v['is_blurry'] == l['blurry']),
+            'phash_duplicates': accuracy(lambda l, v: (v['similar_phash_count'] > 0) == l['duplicate']),
+            # Стикеры осмысленно считать только на резких фото достаточного разрешения
+            'template_match_stickers': round(
+                sum(1 for l, v in sharp_enough if v['stickers_count'] == l['stickers']) / max(1, len(sharp_enough)), 4),
+            'decide_status': accuracy(lambda l, v: v['leaflet_status'] == l['expected_status']),
+        },
+        'manual_review_rate': round(sum(v['manual_review_required'] for v in verdicts) / max(1, len(verdicts)), 4),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if args.workers:
+        report['pool'] = pool_throughput(paths, templates, args.workers)
+        report['peak_rss_mb'] = peak_rss_mb()
+
+    print(f"{report['photos']} photos, {report['photos_per_sec']} photos/s, "
+          f"p50 {report['latency_total']['p50_ms']} ms, p99 {report['latency_total']['p99_ms']} ms, "
+          f"peak RSS {report['peak_rss_mb']['self']} MB")
+    for stage in STAGES:
+        s = report['stages'][stage]
+        print(f"  {stage:<16} p50 {s['p50_ms']:>8} ms  p99 {s['p99_ms']:>8} ms")
+    for name, value in report['accuracy'].items():
+        print(f"  accuracy {name:<24} {value:.1%}")
+    if 'pool' in report:
+        print(f"  pool x{report['pool']['workers']}: {report['pool']['photos_per_sec']} photos/s")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark: end-to-end anti-fraud scoring cost per application.
+
+Seeds a throwaway database (DATABASE_TYPE from the environment) with
+synthetic applications and compares two ways of scoring them:
+  * per-application: the old path, separate queries for each signal
+    (photo duplicates, recent registrations, loyalty card) per application;
+  * batched: FraudContextProvider gathers every signal for a chunk of
+    applications in one query, checks run as pure functions.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Ensure project root on sys.path
+CURRENT_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, os.pardir))
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+
+def seed(count: int, rng: random.Random) -> None:
+    from config import LOYALTY_CARD_LENGTH
+    from database.db_manager import get_db_connection
+
+    rows = []
+    for i in range(count):
+        # Каждое 20-е фото — повтор, каждая 50-я карта — с неверным форматом,
+        # чтобы проверкам было что находить
+        photo_hash = f"dup{rng.randrange(max(1, count // 100))}" if i % 20 == 0 else f"{i:064x}"
+        card = f"{rng.randrange(10 ** LOYALTY_CARD_LENGTH):0{LOYALTY_CARD_LENGTH}d}"
+        created = datetime.now() - timedelta(seconds=rng.randint(0, 60 * 24 * 3600))
+        rows.append((
+            f"User {i}", f"+7999{i:07d}", f"{card}-{i}" if i % 50 == 0 else card, 1_000_000 + i,
+            '', photo_hash, f"{rng.getrandbits(64):016x}", created.isoformat(sep=' ', timespec='seconds'),
+        ))
+    with get_db_connection() as conn:
+        conn.executemany("""
+            INSERT INTO applications (name, phone_number, loyalty_card_number, telegram_id,
+                                      photo_path, photo_hash, photo_phash, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+
+
+def load_participants():
+    from database.db_manager import get_db_connection
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, name, phone_number, loyalty_card_number, telegram_id, photo_hash, photo_phash
+            FROM applications ORDER BY id
+        """)
+        keys = ('id', 'name', 'phone_number', 'loyalty_card_number', 'telegram_id', 'photo_hash', 'photo_phash')
+        return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+
+def per_application(antifraud, participants) -> None:
+    from database.db_manager import count_duplicate_photo_hash, count_recent_registrations, get_db_connection
+
+    for p in participants:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM applications WHERE loyalty_card_number = ?',
+                           (p['loyalty_card_number'],))
+            card_count = cursor.fetchone()[0]
+        context = {
+            'is_telegram_id_unique': True,
+            'duplicate_card_count': max(0, card_count - 1),
+            'duplicate_photo_count': count_duplicate_photo_hash(p['photo_hash']),
+            'recent_registrations_60s': count_recent_registrations(60),
+        }
+        antifraud.calculate_risk_score(p, context)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure anti-fraud scoring cost per application")
+    parser.add_argument("--applications", type=int, default=2000, help="Synthetic applications to seed")
+    parser.add_argument("--sample", type=int, default=300, help="Applications scored by the per-application path")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="risk-bench-")
+    os.environ.setdefault('DATABASE_PATH', os.path.join(workdir, 'bench.duckdb'))
+    os.chdir(workdir)  # SQLite-файл создается относительно текущего каталога
+
+    from config import DATABASE_TYPE
+    from database.db_manager import init_database
+    from utils.anti_fraud import AntiFraudSystem
+    from utils.fraud_context import FraudContextProvider
+
+    init_database()
+    seed(args.applications, random.Random(args.seed))
+    participants = load_participants()
+    antifraud = AntiFraudSystem()
+    print(f"{DATABASE_TYPE}: {len(participants)} applications in {workdir}")
+
+    sample = participants[:args.sample]
+    started = time.perf_counter()
+    per_application(antifraud, sample)
+    per_app_ms = (time.perf_counter() - started) * 1000 / max(1, len(sample))
+
+    started = time.perf_counter()
+    results = antifraud.score_batch(participants, FraudContextProvider())
+    batch_ms = (time.perf_counter() - started) * 1000 / max(1, len(participants))
+
+    flagged = sum(1 for score, _, _ in results if score > 30)
+    print(f"Per-application: {per_app_ms:.3f} ms/app ({len(sample)} scored)")
+    print(f"Batched:         {batch_ms:.3f} ms/app ({len(participants)} scored, {flagged} above low risk)")
+    print(f"Speedup: x{per_app_ms / batch_ms:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Re-encodes stored photos to WebP/AVIF to cut disk usage and bandwidth.
+
+Works on the content-addressed store (run migrate_photo_storage.py first for
+legacy flat files). A file is replaced only when the re-encoded copy decodes,
+is noticeably smaller and keeps the analysis inputs (aHash, sharpness)
+stable. Checked files are marked in the database, so the job can be stopped
+and started again at any time.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+# Ensure project root on sys.path
+CURRENT_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, os.pardir))
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+from config import PHOTO_COMPACTION_FORMAT, PHOTO_COMPACTION_QUALITY, PHOTO_COMPACTION_WORKERS
+from database.db_manager import init_database
+from utils.photo_compaction import compact_storage
+
+
+def report(stats: dict) -> None:
+    saved_mb = stats['bytes_saved'] / (1024 * 1024)
+    ratio = stats['bytes_after'] / stats['bytes_before'] if stats['bytes_before'] else 1.0
+    print(f"checked={stats['checked']} recoded={stats['recoded']} kept={stats['kept']} errors={stats['errors']} "
+          f"saved={saved_mb:.1f} MB ({ratio:.0%} of original)", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encode stored photos to WebP/AVIF")
+    parser.add_argument("--format", default=PHOTO_COMPACTION_FORMAT, choices=["webp", "avif"])
+    parser.add_argument("--quality", type=int, default=PHOTO_COMPACTION_QUALITY)
+    parser.add_argument("--workers", type=int, default=PHOTO_COMPACTION_WORKERS)
+    parser.add_argument("--limit", type=int, default=0, help="Stop after N files (0 = all)")
+    parser.add_argument("--dry-run", action="store_true", help="Only estimate savings, change nothing")
+    args = parser.parse_args()
+
+    init_database()
+    try:
+        stats = compact_storage(args.format, args.quality, args.workers, args.limit, args.dry_run, on_progress=report)
+    except KeyboardInterrupt:
+        # Отмеченные файлы не пересчитываются — повторный запуск продолжит
+        print("Interrupted; run again to continue", flush=True)
+        return
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
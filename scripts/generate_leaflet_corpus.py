@@ -0,0 +1,194 @@
+"""
+Synthetic leaflet corpus with ground-truth labels.
+
+Renders a reference leaflet (the template image) and photos of it with a
+varying number of stickers, blur, rotation, scale/offset, resolution and JPEG
+quality, plus near-duplicate variants (re-encoded, brightened, slightly
+cropped copies). Writes photos, reference.png, template.json and
+labels.json with the expected verdict for every photo.
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+
+# Ensure project root on sys.path
+CURRENT_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, os.pardir))
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+
+REQUIRED_STICKERS = 5
+ZONES = [
+    {"x": 0.10, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.41, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.72, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.25, "y": 0.52, "w": 0.18, "h": 0.18},
+    {"x": 0.56, "y": 0.52, "w": 0.18, "h": 0.18},
+]
+
+# Reference canvas (4:3, same aspect as the photos); photos are rendered at
+# their own resolution so that large photos are not upscaled (= soft) copies
+BASE_W, BASE_H = 2048, 1536
+RESOLUTIONS = [(800, 600), (1280, 960), (2048, 1536), (4000, 3000)]
+BLUR_RADII = [0, 0, 0, 6, 12]  # blur only at clearly sharp/clearly blurry levels
+JPEG_QUALITIES = [60, 75, 90]
+
+
+def render_leaflet(size=(BASE_W, BASE_H), sticker_slots=(), sticker_seed: int = 0) -> Image.Image:
+    """Leaflet artwork at the given resolution; stickers are pasted into given zone slots."""
+    w, h = size
+    k = w / BASE_W
+    img = Image.new('L', (w, h), 255)
+    draw = ImageDraw.Draw(img)
+    layout = np.random.default_rng(7)
+    for _ in range(120):
+        x, y = int(layout.integers(40, BASE_W - 200) * k), int(layout.integers(int(BASE_H * 0.75), BASE_H - 40) * k)
+        draw.rectangle([x, y, x + int(layout.integers(40, 240) * k), y + max(1, int(12 * k))], fill=40)
+    draw.rectangle([int(40 * k), int(40 * k), w - int(40 * k), h - int(40 * k)], outline=0, width=max(1, int(12 * k)))
+    draw.text((int(80 * k), int(60 * k)), "LEAFLET 2025", fill=0, font_size=max(8, int(64 * k)))
+    stickers = np.random.default_rng(sticker_seed)
+    for i, z in enumerate(ZONES):
+        x0, y0 = int(z['x'] * w), int(z['y'] * h)
+        x1, y1 = x0 + int(z['w'] * w), y0 + int(z['h'] * h)
+        draw.rectangle([x0, y0, x1, y1], outline=120, width=max(1, int(6 * k)))
+        if i in sticker_slots:
+            pad = int(20 * k)
+            draw.ellipse([x0 + pad, y0 + pad, x1 - pad, y1 - pad], fill=int(stickers.integers(20, 120)))
+    return img
+
+
+def photograph(leaflet: Image.Image, rng: np.random.Generator, blur: float, rotation: float,
+               scale: float, dx: float, dy: float) -> Image.Image:
+    """Camera simulation: scale/offset/rotation about the center, background, blur, noise.
+
+    blur is a Gaussian radius in reference-canvas pixels (scaled to the photo).
+    """
+    inv = 1.0 / scale
+    w, h = leaflet.size
+    c = w / 2 * (1 - inv) - dx * w * inv
+    f = h / 2 * (1 - inv) - dy * h * inv
+    background = int(rng.integers(170, 255))
+    img = leaflet.transform((w, h), Image.Transform.AFFINE, (inv, 0, c, 0, inv, f),
+                            resample=Image.Resampling.BILINEAR, fillcolor=background)
+    if rotation:
+        img = img.rotate(rotation, resample=Image.Resampling.BILINEAR, fillcolor=background)
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur * w / BASE_W))
+    arr = np.asarray(img, dtype=np.int16) + rng.normal(0, 4, (h, w)).astype(np.int16)
+    return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8)).convert('RGB')
+
+
+def jpeg_bytes(img: Image.Image, quality: int) -> bytes:
+    exif = Image.Exif()
+    exif[0x0132] = '2025:01:01 12:00:00'
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=quality, exif=exif)
+    return buf.getvalue()
+
+
+def near_duplicate(img: Image.Image, rng: np.random.Generator) -> Image.Image:
+    """Re-shared copy: slight crop, brightness change, resize."""
+    w, h = img.size
+    crop = int(w * float(rng.uniform(0.0, 0.02)))
+    img = img.crop((crop, crop, w - crop, h - crop)).resize((w, h), Image.Resampling.BILINEAR)
+    return ImageEnhance.Brightness(img).enhance(float(rng.uniform(0.9, 1.1)))
+
+
+def expected_status(label: dict) -> str:
+    """Verdict the pipeline should reach (same precedence as decide_leaflet_status)."""
+    status = 'approved'
+    if label['low_resolution'] or label['blurry']:
+        status = 'rejected'
+    if label['duplicate']:
+        status = 'duplicate'
+    if status == 'approved' and label['stickers'] < REQUIRED_STICKERS:
+        status = 'incomplete'
+    return status
+
+
+def generate(out_dir: str, count: int, seed: int, duplicate_ratio: float = 0.15) -> dict:
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    reference_path = os.path.join(out_dir, 'reference.png')
+    render_leaflet().save(reference_path)
+    template = {
+        'id': 1,
+        'name': 'synthetic',
+        'required_stickers': REQUIRED_STICKERS,
+        'template_image_path': reference_path,
+        'validation_zones': json.dumps(ZONES),
+    }
+    with open(os.path.join(out_dir, 'template.json'), 'w', encoding='utf-8') as f:
+        json.dump(template, f, ensure_ascii=False, indent=2)
+
+    labels = []
+    originals = []
+    for i in range(count):
+        name = f"photo_{i:05d}.jpg"
+        if originals and rng.random() < duplicate_ratio:
+            src_idx, src_img = originals[int(rng.integers(0, len(originals)))]
+            img = near_duplicate(src_img, rng)
+            label = dict(labels[src_idx], photo=name, variant_of=labels[src_idx]['photo'],
+                         jpeg_quality=int(rng.choice(JPEG_QUALITIES)))
+            labels[src_idx]['duplicate'] = True
+            label['duplicate'] = True
+        else:
+            stickers = int(rng.choice([5, 5, 5, 4, 3, 0]))
+            slots = set(rng.choice(len(ZONES), size=stickers, replace=False).tolist())
+            size = RESOLUTIONS[int(rng.integers(0, len(RESOLUTIONS)))]
+            blur = float(rng.choice(BLUR_RADII))
+            rotation = float(rng.choice([0.0, 0.0, rng.uniform(-3, 3)]))
+            scale = float(rng.uniform(0.9, 1.1))
+            dx, dy = (float(v) for v in rng.uniform(-0.08, 0.08, 2))
+            img = photograph(render_leaflet(size, slots, sticker_seed=i), rng, blur, rotation, scale, dx, dy)
+            label = {
+                'photo': name,
+                'width': size[0],
+                'height': size[1],
+                'stickers': stickers,
+                'blur_radius': blur,
+                'blurry': blur > 0,
+                'low_resolution': size[0] < 1024 or size[1] < 768,
+                'rotation': round(rotation, 2),
+                'scale': round(scale, 3),
+                'offset': [round(dx, 3), round(dy, 3)],
+                'jpeg_quality': int(rng.choice(JPEG_QUALITIES)),
+                'variant_of': None,
+                'duplicate': False,
+            }
+            originals.append((len(labels), img))
+        with open(os.path.join(out_dir, name), 'wb') as f:
+            f.write(jpeg_bytes(img, label['jpeg_quality']))
+        labels.append(label)
+
+    for label in labels:
+        label['expected_status'] = expected_status(label)
+    manifest = {'seed': seed, 'count': count, 'template': 'template.json', 'photos': labels}
+    with open(os.path.join(out_dir, 'labels.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a synthetic leaflet corpus with ground-truth labels")
+    parser.add_argument("--out", required=True, help="Output directory")
+    parser.add_argument("--count", type=int, default=200, help="How many photos to render")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for reproducibility")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.15, help="Share of near-duplicate variants")
+    args = parser.parse_args()
+
+    manifest = generate(args.out, args.count, args.seed, args.duplicate_ratio)
+    statuses = {}
+    for label in manifest['photos']:
+        statuses[label['expected_status']] = statuses.get(label['expected_status'], 0) + 1
+    print(f"Rendered {manifest['count']} photos into {args.out}: {statuses}")
+
+
+if __name__ == "__main__":
+    main()
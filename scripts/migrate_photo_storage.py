@@ -0,0 +1,93 @@
+"""
+Moves photos from the flat photos/ directory into the content-addressed store.
+
+Each legacy file (photos/user_<id>_<timestamp>.jpg) is written to the
+configured photo storage as ab/cd/<sha256>.jpg (local directory or S3), the
+application's photo_path is rewritten and only then the old file is removed.
+Identical files collapse into one stored copy with a reference count. Already
+migrated rows are skipped, so an interrupted run can simply be started again.
+"""
+
+import argparse
+import os
+import sys
+from collections import defaultdict
+
+# Ensure project root on sys.path
+CURRENT_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, os.pardir))
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+from config import PHOTOS_DIR
+from database.db_manager import init_database, get_all_photo_paths, update_photo_path, get_photo_storage_stats
+from utils.file_handler import file_sha256
+from utils.photo_store import digest_from_path, store_photo_file, storage_for, DEFAULT_EXT
+from utils.thumbnails import warm_thumbnail
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate photos to content-addressed sharded storage")
+    parser.add_argument("--root", default=PHOTOS_DIR, help="Photo storage root")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be moved")
+    parser.add_argument("--keep-originals", action="store_true", help="Do not delete legacy files after moving")
+    parser.add_argument("--warm-thumbnails", action="store_true", help="Pre-render admin gallery thumbnails")
+    args = parser.parse_args()
+
+    init_database()
+    by_source = defaultdict(list)
+    already = 0
+    for app_id, photo_path in get_all_photo_paths():
+        if digest_from_path(photo_path):
+            already += 1
+        else:
+            by_source[photo_path].append(app_id)
+
+    moved = missing = removed = 0
+    digests = set()
+    to_remove = []
+    for source, app_ids in by_source.items():
+        if not os.path.isfile(source):
+            print(f"missing: {source} (applications {app_ids})")
+            missing += len(app_ids)
+            continue
+        digest = file_sha256(source)
+        digests.add(digest)
+        if args.dry_run:
+            moved += len(app_ids)
+            continue
+        ext = os.path.splitext(source)[1].lower() or DEFAULT_EXT
+        # Ссылка на файл учитывается для каждой заявки; старый файл удаляем
+        # только после того, как все заявки указывают на новый путь
+        target = None
+        for app_id in app_ids:
+            target = store_photo_file(source, digest, ext, args.root)
+            update_photo_path(app_id, target)
+            moved += 1
+        if not args.keep_originals and os.path.abspath(source) != os.path.abspath(target):
+            to_remove.append(source)
+
+    # Удаленное хранилище загружает фоном: оригиналы удаляем только после загрузки
+    if to_remove and storage_for(args.root).flush():
+        for source in to_remove:
+            os.remove(source)
+            removed += 1
+    elif to_remove:
+        print(f"uploads failed, {len(to_remove)} legacy files kept; run again to retry")
+
+    warmed = 0
+    if args.warm_thumbnails and not args.dry_run:
+        for photo_path in {path for _, path in get_all_photo_paths()}:
+            warmed += warm_thumbnail(photo_path)
+        print(f"thumbnails warmed: {warmed}")
+
+    prefix = "[dry-run] " if args.dry_run else ""
+    print(f"{prefix}applications: moved={moved}, already migrated={already}, missing files={missing}")
+    print(f"{prefix}unique files: {len(digests)} from {len(by_source)} legacy paths, removed={removed}")
+    if not args.dry_run:
+        stats = get_photo_storage_stats()
+        print(f"storage: {stats['blobs']} files, {stats['references']} references, {stats['bytes']} bytes")
+
+
+if __name__ == "__main__":
+    main()
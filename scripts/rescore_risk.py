@@ -0,0 +1,27 @@
+import argparse
+import json
+import os
+import sys
+
+# Ensure project root on sys.path
+CURRENT_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, os.pardir))
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+from database.db_manager import init_database
+from utils.risk_batch import rescore_all
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute anti-fraud risk for all applications in one pass")
+    parser.add_argument("--dry-run", action="store_true", help="Score and report changes without writing them")
+    args = parser.parse_args()
+
+    init_database()
+    stats = rescore_all(write=not args.dry_run)
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import sys
+import threading
+
+# Ensure project root on sys.path
+CURRENT_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, os.pardir))
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+from database.db_manager import init_database
+from utils.analysis_service import shutdown_analysis_service
+from utils.revalidation_job import RevalidationJob, RevalidationParamsChanged
+
+
+def report(job: RevalidationJob, interval: float) -> None:
+    while job.is_alive():
+        p = job.progress()
+        eta = f"{p['eta_seconds']}s" if p['eta_seconds'] is not None else "?"
+        print(f"[#{p['job_id']}] {p['processed']}/{p['total']} ({p['percent']}%), "
+              f"cached={p['cached']} failed={p['failed']} {p['photos_per_second']}/s eta={eta}", flush=True)
+        job.join(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-validate stored leaflet photos in bulk")
+    parser.add_argument("--campaign", help="Only applications of this campaign type")
+    parser.add_argument("--status", help="Only applications with this status")
+    parser.add_argument("--only-failed", action="store_true", help="Only rejected/incomplete/duplicate/errored photos")
+    parser.add_argument("--resume", action="store_true", help="Continue the last unfinished job")
+    parser.add_argument("--job-id", type=int, help="Continue a specific job")
+    parser.add_argument("--interval", type=float, default=10.0, help="Progress report interval, seconds")
+    args = parser.parse_args()
+
+    init_database()
+    job = None
+    if args.resume or args.job_id:
+        try:
+            job = RevalidationJob.resume(args.job_id)
+        except RevalidationParamsChanged as e:
+            print(f"Cannot resume: {e}")
+            return
+        if job is None:
+            print("No unfinished job to resume")
+            return
+    if job is None:
+        job = RevalidationJob(campaign=args.campaign, status=args.status, only_failed=args.only_failed)
+
+    job.start()
+    reporter = threading.Thread(target=report, args=(job, args.interval), daemon=True)
+    reporter.start()
+    try:
+        while job.is_alive():
+            job.join(0.5)
+    except KeyboardInterrupt:
+        # Прогресс уже сохранен до последнего пакета — можно продолжить с --resume
+        print("Cancelling, waiting for the current batch...", flush=True)
+        job.cancel()
+        job.join()
+    finally:
+        shutdown_analysis_service()
+    reporter.join(1.0)
+    print(json.dumps(job.progress(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
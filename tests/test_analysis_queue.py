@@ -0,0 +1,85 @@
+import pytest
+
+import utils.analysis_queue as aq
+from utils.image_validation import error_result
+
+
+class _FakeService:
+    """Пул анализа без процессов: collect сразу отдает результат по пути к фото"""
+
+    max_workers = 1
+
+    def __init__(self, results=None):
+        self.results = results or {}
+        self.seen = []
+
+    def submit(self, photo_path, templates=None):
+        self.seen.append(photo_path)
+        return photo_path
+
+    def collect(self, future):
+        result = self.results.get(future, {'leaflet_status': 'approved', 'validation_notes': []})
+        if isinstance(result, Exception):
+            raise result
+        return dict(result)
+
+
+@pytest.fixture
+def written(monkeypatch):
+    batches = []
+    monkeypatch.setattr(aq, 'bulk_update_leaflet_results', lambda batch: batches.append(batch) or len(batch))
+    monkeypatch.setattr(aq, 'get_active_leaflet_templates', lambda: [])
+    monkeypatch.setattr(aq, 'get_pending_leaflet_applications', lambda: [])
+    monkeypatch.setattr(aq, 'local_photo_path', lambda path: path)
+    return batches
+
+
+def _drain(q):
+    q.start()
+    q._queue.join()
+    q.stop()
+
+
+def test_fresh_photos_go_first_and_results_are_written_in_batches(written):
+    service = _FakeService()
+    q = aq.LeafletAnalysisQueue(service=service, workers=1, batch_size=2, flush_interval=60)
+    for app_id in (1, 2, 3):
+        q.enqueue(app_id, f'backlog-{app_id}', aq.PRIORITY_BACKLOG)
+    assert q.enqueue(4, 'fresh-4', aq.PRIORITY_FRESH)
+    assert not q.enqueue(4, 'fresh-4', aq.PRIORITY_FRESH)
+    assert (q.stats()['queue_fresh'], q.stats()['queue_backlog']) == (1, 3)
+
+    _drain(q)
+    assert service.seen == ['fresh-4', 'backlog-1', 'backlog-2', 'backlog-3']
+    # Полный пакет пишется сразу, остаток — при остановке
+    assert [[r['id'] for r in batch] for batch in written] == [[4, 1], [2, 3]]
+    stats = q.stats()
+    assert (stats['processed_total'], stats['written_total'], stats['queue_fresh'], stats['queue_backlog']) == (4, 4, 0, 0)
+
+
+def test_recover_pending_enqueues_backlog_once(written, monkeypatch):
+    rows = [{'id': 5, 'photo_path': 'a'}, {'id': 6, 'photo_path': 'b'}, {'id': 7, 'photo_path': ''}]
+    monkeypatch.setattr(aq, 'get_pending_leaflet_applications', lambda: rows)
+    q = aq.LeafletAnalysisQueue(service=_FakeService(), workers=1)
+    assert q.recover_pending() == 2
+    assert q.recover_pending() == 0
+    assert q.stats()['queue_backlog'] == 2
+
+
+def test_failing_photo_is_retried_then_marked_error(written):
+    service = _FakeService({'stuck': error_result('analyze_timeout'), 'broken': RuntimeError('pool')})
+    q = aq.LeafletAnalysisQueue(service=service, workers=1, batch_size=10, flush_interval=60, max_attempts=3)
+    q.enqueue(1, 'stuck')
+    q.enqueue(2, 'broken')
+    q.enqueue(3, 'ok')
+
+    _drain(q)
+    results = {r['id']: r for batch in written for r in batch}
+    assert service.seen.count('stuck') == 3 and service.seen.count('broken') == 3
+    assert results[1]['leaflet_status'] == aq.ANALYSIS_FAILED_STATUS
+    assert results[1]['validation_notes'] == ['analyze_timeout']
+    assert results[2]['leaflet_status'] == aq.ANALYSIS_FAILED_STATUS
+    assert results[3]['leaflet_status'] == 'approved'
+    stats = q.stats()
+    assert (stats['retried_total'], stats['errored_total']) == (4, 2)
+    assert not q._attempts
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+import pytest
+
+import utils.analysis_service as svc
+
+
+class _ThreadPool(ThreadPoolExecutor):
+    """Пул потоков вместо процессов: задачи видят подмененный _analyze_path"""
+
+    def __init__(self, broken=False):
+        super().__init__(max_workers=2)
+        self._broken = broken
+
+    def submit(self, fn, *args, **kwargs):
+        if self._broken:
+            raise BrokenProcessPool('worker died')
+        return super().submit(fn, *args, **kwargs)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    env = SimpleNamespace(release=threading.Event(), pools=[], broken_next=False)
+
+    def analyze(photo_path, templates):
+        if photo_path == 'slow':
+            env.release.wait(5)
+        if photo_path == 'crash':
+            raise BrokenProcessPool('worker died')
+        return {'photo_path': photo_path}
+
+    def create(self):
+        env.pools.append(_ThreadPool(broken=env.broken_next))
+        env.broken_next = False
+        return env.pools[-1]
+
+    monkeypatch.setattr(svc, '_analyze_path', analyze)
+    monkeypatch.setattr(svc.LeafletAnalysisService, '_create_executor', create)
+    env.service = svc.LeafletAnalysisService(max_workers=1, queue_size=1, task_timeout=0.05)
+    yield env
+    env.release.set()
+    env.service.shutdown()
+
+
+def test_pool_is_created_lazily_and_queue_is_bounded(pool):
+    service = pool.service
+    # Пул (и чтение шаблонов из БД для прогрева) — только при первой задаче
+    assert pool.pools == []
+
+    first = service.submit('slow')
+    second = service.submit('slow')
+    assert len(pool.pools) == 1
+    # Слоты: одна задача выполняется, одна ждет — третья не помещается
+    with pytest.raises(svc.AnalysisQueueFull):
+        service.submit('slow', block=False)
+    assert service.stats['rejected'] == 1
+
+    pool.release.set()
+    assert first.result(1) == second.result(1) == {'photo_path': 'slow'}
+    assert service.submit('ok', block=False).result(1) == {'photo_path': 'ok'}
+
+
+def test_task_timeout_returns_error_result(pool):
+    metrics, error = pool.service.wait_metrics(pool.service.submit('slow'))
+    assert metrics is None
+    assert error['leaflet_status'] == 'pending' and error['validation_notes'] == ['analyze_timeout']
+    assert pool.service.stats['timeouts'] == 1
+
+
+def test_broken_pool_is_restarted(pool):
+    service = pool.service
+    # Пул сломался до постановки задачи — она уходит в новый пул
+    pool.broken_next = True
+    assert service.submit('ok').result(1) == {'photo_path': 'ok'}
+    assert len(pool.pools) == 2 and service.stats['restarts'] == 1
+
+    # Процесс упал во время задачи: ошибка анализа и новый пул
+    future = service.submit('crash')
+    pool.pools[-1]._broken = True
+    metrics, error = service.wait_metrics(future)
+    assert metrics is None and error['validation_notes'] == ['analyze_error']
+    assert len(pool.pools) == 3 and service.stats['restarts'] == 2
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+import database.db_manager as db
+
+
+@pytest.fixture
+def duck(tmp_path, monkeypatch):
+    """Пустая DuckDB-база во временной папке; listeners — полученные уведомления об удалении"""
+    pytest.importorskip('duckdb')
+    monkeypatch.setattr(db, 'DATABASE_TYPE', 'duckdb')
+    monkeypatch.setattr(db, 'get_database_path', lambda: str(tmp_path / 'test.duckdb'))
+    monkeypatch.setattr(db, '_deletion_listeners', [])
+    db.init_database()
+    deleted = []
+    db.on_applications_deleted(deleted.append)
+    return deleted
+
+
+def _insert_application(app_id: int, photo_path: str = 'ab/cd/photo.jpg') -> None:
+    with db.get_db_connection() as conn:
+        conn.execute(
+            'INSERT INTO applications (id, name, phone_number, loyalty_card_number, telegram_id, photo_path) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (app_id, f'user {app_id}', f'+7900000000{app_id}', f'card-{app_id}', 1000 + app_id, photo_path),
+        )
+        conn.execute('INSERT INTO photo_downloads (application_id, file_id) VALUES (?, ?)', (app_id, f'F{app_id}'))
+        conn.commit()
+
+
+def _ids(table: str, column: str = 'id'):
+    with db.get_db_connection() as conn:
+        return sorted(row[0] for row in conn.execute(f'SELECT {column} FROM {table}').fetchall())
+
+
+def test_delete_application_reports_deletion_on_duckdb(duck):
+    _insert_application(1)
+    _insert_application(2)
+
+    assert db.delete_application(1) is True
+    assert duck == [[1]]
+    assert _ids('applications') == [2]
+    # Строка очереди скачивания уходит вместе с заявкой — загрузчик ее не подберет
+    assert _ids('photo_downloads', 'application_id') == [2]
+    assert [row['application_id'] for row in db.get_due_photo_downloads()] == [2]
+
+    # Повторное удаление — заявки уже нет, подписчиков не трогаем
+    assert db.delete_application(1) is False
+    assert duck == [[1]]
+
+
+def test_admin_delete_releases_photo_and_thumbnails(duck, tmp_path, monkeypatch):
+    import utils.photo_store as ps
+    import web.admin_panel as admin
+
+    root = str(tmp_path / 'photos')
+    path, digest = ps.store_photo_bytes(b'photo-bytes', root=root)
+    _insert_application(1, photo_path=path)
+    removed = []
+    monkeypatch.setattr(admin, 'BOT_TOKEN', '1:test')
+    monkeypatch.setattr(admin, 'release_photo', lambda photo_path: ps.release_photo(photo_path, root))
+    monkeypatch.setattr(admin, 'remove_thumbnails', removed.append)
+
+    client = admin.create_web_app().test_client()
+    with client.session_transaction() as session:
+        session['authenticated'] = True
+    assert client.delete('/api/delete_application/1').get_json() == {'success': True}
+    # Последняя ссылка снята: файл, его учет и превью удалены
+    assert not os.path.exists(path) and _ids('photo_blobs', 'content_hash') == []
+    assert removed == [path] and duck == [[1]]
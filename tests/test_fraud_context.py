@@ -0,0 +1,35 @@
+import utils.fraud_context as fc
+from utils.anti_fraud import AntiFraudSystem
+from utils.phash_index import PhashIndex
+
+
+def test_batch_context_is_one_query_and_excludes_own_row(monkeypatch):
+    calls = []
+
+    def counts(**kwargs):
+        calls.append(kwargs)
+        return {
+            'card': {'1234567890': 2},
+            'phone': {'+375291111111': 1},
+            'photo': {'aa': 2, 'bb': 1},
+            'telegram': {'1': 1},
+            'recent': 3,
+        }
+
+    monkeypatch.setattr(fc, 'get_fraud_signal_counts', counts)
+    saved = {'id': 1, 'name': 'Anna', 'phone_number': '+375291111111', 'loyalty_card_number': '1234567890',
+             'telegram_id': 1, 'photo_hash': 'aa', 'photo_phash': 'ff00ff00ff00ff00'}
+    new = {'name': 'Oleg', 'phone_number': '+375292222222', 'loyalty_card_number': '1234567890',
+           'telegram_id': 2, 'photo_hash': 'bb', 'photo_phash': 'ff00ff00ff00ff01'}
+    index = PhashIndex([(1, 'ff00ff00ff00ff00')])
+
+    own, other = fc.FraudContextProvider(index).for_batch([saved, new])
+
+    assert len(calls) == 1
+    # Сохраненная заявка не считается дубликатом самой себя
+    assert (own['duplicate_card_count'], own['duplicate_photo_count'], own['similar_photo_count']) == (1, 1, 0)
+    assert own['is_telegram_id_unique'] and own['duplicate_phone_count'] == 0
+    assert (other['duplicate_card_count'], other['duplicate_photo_count'], other['similar_photo_count']) == (2, 1, 1)
+
+    details = {d['name']: d for d in AntiFraudSystem().calculate_risk_score(new, other)[2]}
+    assert not details['loyalty_card_uniqueness']['passed']
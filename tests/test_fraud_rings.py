@@ -0,0 +1,84 @@
+from datetime import datetime
+
+import utils.fraud_rings as fr
+
+
+def _app(app_id, phone, card, **extra):
+    return {'id': app_id, 'phone_number': phone, 'loyalty_card_number': card, 'telegram_username': '',
+            'photo_hash': '', 'photo_phash': '', 'timestamp': datetime(2026, 1, 1, 12, 0, app_id % 60), **extra}
+
+
+def test_shared_attributes_merge_rings_incrementally(tmp_path):
+    index = fr.FraudRingIndex(snapshot_path=None)
+    index.add(_app(1, '+375291000001', '1000000001', telegram_username='@Alice'))
+    index.add(_app(2, '+375292000002', '1000000001'))  # та же карта
+    index.add(_app(3, '+375293000003', '3000000003', telegram_username='alice'))  # тот же username
+    index.add(_app(4, '+375294000004', '4000000004', photo_phash='ffff0000aaaa5555'))
+    assert index.ring_of(1)['size'] == 3 and not index.same_ring(1, 4)
+
+    # pHash отличается одним битом — совпадает вторая полоса
+    index.add(_app(5, '+375295000005', '5000000005', photo_phash='ffff0001aaaa5555'))
+    # Соседний номер того же блока в том же окне — всплеск
+    index.add(_app(6, '+375293000999', '6000000006'))
+    assert index.same_ring(4, 5) and index.same_ring(3, 6)
+
+    (ring,) = index.rings(min_size=4)
+    assert ring['members'] == [1, 2, 3, 6]
+    assert ring['links'] == {'card': 1, 'username': 1, 'burst': 1}
+    assert index.stats(min_size=2)['rings'] == 2
+
+
+def test_snapshot_restores_rings_and_replays_only_new_applications(tmp_path, monkeypatch):
+    rows = [_app(1, '+375291000001', '1000000001', photo_phash='0123456789abcdef'),
+            _app(2, '+375292000002', '1000000001', photo_phash='fedcba9876543210'),
+            _app(3, '+375293000003', '3000000003', photo_hash='aa', photo_phash='1111222233334444'),
+            _app(4, '+375294000004', '4000000004', photo_hash='aa', photo_phash='5555666677778888')]
+    pages = []
+
+    def page(after_id, limit):
+        pages.append(after_id)
+        return [r for r in rows if r['id'] > after_id][:limit]
+
+    monkeypatch.setattr(fr, 'get_risk_participants_page', page)
+    path = str(tmp_path / 'rings.npz')
+
+    first = fr.FraudRingIndex(snapshot_path=path)
+    first.add_many(rows[:3])
+    assert first.save_snapshot()
+
+    restored = fr.FraudRingIndex(snapshot_path=path)
+    assert restored.load() == 1
+    assert pages[0] == 3 and restored.loaded_from_snapshot
+    assert restored.members(1) == [1, 2] and restored.members(4) == [3, 4]
+    assert restored.rings(min_size=2)[0]['links'] == {'card': 1}
+
+
+def test_deleted_applications_leave_rings_and_clear_resets_index(tmp_path, monkeypatch):
+    rows = [_app(1, '+375291000001', '1000000001'),
+            _app(2, '+375292000002', '1000000001'),
+            _app(3, '+375293000003', '3000000003', telegram_username='bob'),
+            _app(4, '+375294000004', '1000000001', telegram_username='bob')]
+    monkeypatch.setattr(fr, 'get_risk_participants_page',
+                        lambda after_id, limit: [r for r in rows if r['id'] > after_id][:limit])
+    path = tmp_path / 'rings.npz'
+    index = fr.FraudRingIndex(snapshot_path=str(path))
+    rebuilds = []
+    monkeypatch.setattr(index, 'request_rebuild', lambda: rebuilds.append(1))
+    index.add_many(rows)
+    assert index.save_snapshot() and index.members(1) == [1, 2, 3, 4]
+
+    # Заявка 4 связывала карту с username: сразу скрыта, после перестроения кольца распадаются
+    del rows[3]
+    index.on_deleted([4])
+    assert index.members(1) == [1, 2, 3] and index.ring_of(4)['size'] == 0
+    assert not path.exists() and rebuilds == [1]
+    index.rebuild()
+    assert index.members(1) == [1, 2] and index.members(3) == [3]
+    assert index.stats()['pending_deletions'] == 0 and path.exists()
+
+    # Очистка БД: id начинаются заново, новая заявка 1 не наследует старое кольцо
+    rows.clear()
+    index.on_deleted(None)
+    assert not path.exists() and index.stats()['applications'] == 0
+    index.add(_app(1, '+375299999999', '9999999999'))
+    assert index.members(1) == [1]
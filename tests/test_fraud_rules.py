@@ -0,0 +1,160 @@
+"""
+Общий набор тестов для обоих evaluator'ов правил: каждый случай считается
+построчно (RuleEngine.score) и колоночно (RuleEngine.score_frame).
+"""
+
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from config import FRAUD_RULES_PATH
+from utils.fraud_rules import RuleEngine, RuleError, _EngineHolder
+
+CLEAN = {
+    'name': 'Anna Petrova',
+    'phone_number': '+375291234567',
+    'loyalty_card_number': '5821937460',
+    'telegram_id': 1,
+    'photo_hash': 'abc',
+}
+CLEAN_CONTEXT = {
+    'is_telegram_id_unique': True,
+    'duplicate_card_count': 0,
+    'duplicate_photo_count': 0,
+    'recent_registrations_60s': 0,
+}
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return RuleEngine.from_file(FRAUD_RULES_PATH)
+
+
+@pytest.fixture(params=['row', 'vector'])
+def score(request):
+    def run(engine, participant, context):
+        if request.param == 'row':
+            return engine.score(participant, context)
+        row = engine.score_frame(pd.DataFrame([{**participant, **context}])).iloc[0]
+        return int(row.risk_score), row.risk_level, json.loads(row.risk_details)
+    return run
+
+
+def _failed(details):
+    return [d['name'] for d in details if not d['passed']]
+
+
+@pytest.mark.parametrize('participant, context, expected_score, expected_failed', [
+    ({}, {}, 0, []),
+    ({'name': ' A '}, {}, 10, ['behavior_analysis']),
+    ({'phone_number': '+7 (999) 12'}, {}, 25, ['phone_validation']),
+    ({'loyalty_card_number': '  '}, {}, 35, ['loyalty_card_uniqueness', 'loyalty_card_pattern']),
+    ({'loyalty_card_number': '1111111111'}, {}, 25, ['loyalty_card_pattern']),
+    ({'loyalty_card_number': '0123'}, {}, 25, ['loyalty_card_pattern']),
+    ({'photo_hash': None}, {}, 30, ['photo_hash']),
+    ({}, {'duplicate_photo_count': 2}, 60, ['photo_hash']),
+    # Общий всплеск регистраций больше не штрафуется — только скорость по измерениям
+    ({}, {'recent_registrations_60s': 100}, 0, []),
+    ({}, {'velocity_phone_prefix': 10}, 0, []),
+    ({}, {'velocity_phone_prefix': 11, 'velocity_name_throttled': True}, 15, ['velocity']),
+    ({}, {'velocity_hour_throttled': True}, 5, ['hour_velocity']),
+    ({}, {'is_telegram_id_unique': False, 'duplicate_card_count': 1}, 100,
+     ['device_fingerprint', 'loyalty_card_uniqueness']),
+])
+def test_default_rules(engine, score, participant, context, expected_score, expected_failed):
+    total, level, details = score(engine, {**CLEAN, **participant}, {**CLEAN_CONTEXT, **context})
+    assert total == expected_score
+    assert _failed(details) == expected_failed
+    assert level == ('low' if total <= 30 else 'medium' if total <= 70 else 'high')
+
+
+def test_pattern_reasons_are_joined(engine, score):
+    _, _, details = score(engine, {**CLEAN, 'loyalty_card_number': '0000'}, CLEAN_CONTEXT)
+    pattern = next(d for d in details if d['name'] == 'loyalty_card_pattern')
+    assert pattern['impact'] == 25
+    assert pattern['message'].split('; ')[1:] == ['Все цифры одинаковые']
+
+
+def test_short_circuits_once_score_saturates(engine, score):
+    context = {**CLEAN_CONTEXT, 'is_telegram_id_unique': False, 'duplicate_card_count': 1}
+    total, level, details = score(engine, {**CLEAN, 'phone_number': '1'}, context)
+    # 40 + 25 + 60 — дальше loyalty_card_uniqueness правила не считаются
+    assert (total, level) == (100, 'high')
+    assert [d['name'] for d in details] == ['device_fingerprint', 'phone_validation', 'loyalty_card_uniqueness']
+
+
+def test_custom_rules_with_combinators(score):
+    engine = RuleEngine({'rules': [{
+        'name': 'burst',
+        'outcomes': [{
+            'when': {'all': [
+                {'feature': 'recent_registrations_60s', 'op': 'ge', 'value': 5},
+                {'any': [{'feature': 'duplicate_photo_count', 'op': 'gt', 'value': 0},
+                         {'not': {'feature': 'card', 'op': 'len_eq', 'value': '$LOYALTY_CARD_LENGTH'}}]},
+            ]},
+            'impact': 70,
+            'message': 'Всплеск: карта не из {LOYALTY_CARD_LENGTH} цифр',
+        }],
+        'pass': 'ok',
+    }]})
+    hit = score(engine, {**CLEAN, 'loyalty_card_number': '123'}, {'recent_registrations_60s': 5})
+    assert hit[0] == 70 and hit[2][0]['message'] == 'Всплеск: карта не из 10 цифр'
+    assert score(engine, CLEAN, {'recent_registrations_60s': 5})[0] == 0
+    assert score(engine, {**CLEAN, 'loyalty_card_number': '123'}, {'recent_registrations_60s': 4})[0] == 0
+
+
+def test_invalid_rules_are_rejected():
+    with pytest.raises(RuleError):
+        RuleEngine({'rules': [{'name': 'x', 'outcomes': [{'when': {'feature': 'nope', 'op': 'eq'},
+                                                          'impact': 1, 'message': ''}]}]})
+    with pytest.raises(RuleError):
+        RuleEngine({'rules': []})
+
+
+def test_hot_reload_keeps_last_good_rules(tmp_path):
+    path = tmp_path / 'rules.json'
+    rules = {'rules': [{'name': 'velocity', 'outcomes': [
+        {'when': {'feature': 'recent_registrations_60s', 'op': 'gt', 'value': 30}, 'impact': 15, 'message': 'v'}]}]}
+    path.write_text(json.dumps(rules), encoding='utf-8')
+    holder = _EngineHolder(str(path), reload_interval=0)
+    assert holder.get().score(CLEAN, {'recent_registrations_60s': 20})[0] == 0
+
+    # Порог понижен в файле — применяется без рестарта
+    rules['rules'][0]['outcomes'][0]['when']['value'] = 10
+    path.write_text(json.dumps(rules), encoding='utf-8')
+    os.utime(path, (1, 1))
+    assert holder.get().score(CLEAN, {'recent_registrations_60s': 20})[0] == 15
+    assert holder.reloads == 1
+
+    path.write_text('{"rules": [', encoding='utf-8')
+    os.utime(path, (2, 2))
+    assert holder.get().score(CLEAN, {'recent_registrations_60s': 20})[0] == 15
+    assert holder.last_error
+
+
+@pytest.mark.parametrize('breakage', [
+    lambda r: r['rules'][0]['outcomes'][0].pop('impact'),
+    lambda r: r['rules'][0]['outcomes'][0].pop('when'),
+    lambda r: r['rules'][0]['outcomes'][0].update(message='{PHONE}'),
+    lambda r: r['rules'].append('velocity'),
+    lambda r: r['rules'][0].update(reasons={'items': [{'when': {'feature': 'card', 'op': 'empty'},
+                                                       'message': 'x'}]}),
+])
+def test_broken_rules_file_keeps_previous_engine(tmp_path, breakage):
+    path = tmp_path / 'rules.json'
+    rules = {'rules': [{'name': 'velocity', 'outcomes': [
+        {'when': {'feature': 'recent_registrations_60s', 'op': 'gt', 'value': 10}, 'impact': 15, 'message': 'v'}]}]}
+    path.write_text(json.dumps(rules), encoding='utf-8')
+    holder = _EngineHolder(str(path), reload_interval=0)
+    engine = holder.get()
+
+    breakage(rules)
+    with pytest.raises(RuleError):
+        RuleEngine(rules)
+    path.write_text(json.dumps(rules), encoding='utf-8')
+    os.utime(path, (1, 1))
+    assert holder.get() is engine and holder.last_error
+    # Сломанный файл не перечитывается на каждой проверке
+    assert holder._mtime == 1
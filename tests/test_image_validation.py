@@ -0,0 +1,121 @@
+import io
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+import utils.image_validation as iv
+
+
+def _jpeg_bytes(width: int, height: int, orientation: int = 1) -> bytes:
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    img = Image.fromarray(arr)
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif[0x0132] = '2025:01:01 12:00:00'
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=85, exif=exif)
+    return buf.getvalue()
+
+
+def _patch_db(monkeypatch):
+    zones = '[{"x": 0.1, "y": 0.1, "w": 0.2, "h": 0.2}]'
+    monkeypatch.setattr(iv, 'count_similar_photo_phash', lambda phash: 0)
+    monkeypatch.setattr(iv, 'get_active_leaflet_templates',
+                        lambda: [{'id': 1, 'required_stickers': 1, 'validation_zones': zones}])
+
+
+def test_decode_gray_matches_exif_transpose():
+    for orientation in range(1, 9):
+        img = Image.open(io.BytesIO(_jpeg_bytes(64, 48, orientation)))
+        expected = np.asarray(ImageOps.exif_transpose(img).convert('L'))
+        img = Image.open(io.BytesIO(_jpeg_bytes(64, 48, orientation)))
+        assert np.array_equal(iv.decode_gray(img), expected)
+
+
+def test_analyze_leaflet_peak_memory(monkeypatch):
+    _patch_db(monkeypatch)
+    width, height = 2000, 1500
+    data = _jpeg_bytes(width, height)
+
+    tracemalloc.start()
+    res = iv.analyze_leaflet(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert res['width'] == width and res['height'] == height
+    assert 'analyze_error' not in res['validation_notes']
+    # uint8-кадр, его копия с рамкой и int16-буфер лапласиана, без float-копий: < 6 байт на пиксель
+    assert peak < 6 * width * height
+
+
+@pytest.mark.skipif(not os.getenv('RUN_BENCHMARKS'), reason='бенчмарк: RUN_BENCHMARKS=1')
+def test_analyze_leaflet_time(monkeypatch, record_property):
+    _patch_db(monkeypatch)
+    data = _jpeg_bytes(2000, 1500)
+    iv.analyze_leaflet(data)  # прогрев
+
+    started = time.perf_counter()
+    iv.analyze_leaflet(data)
+    elapsed = time.perf_counter() - started
+    record_property('analyze_leaflet_s', round(elapsed, 3))
+    assert elapsed < 2.0
+
+
+def test_draft_decode_keeps_header_resolution(monkeypatch):
+    _patch_db(monkeypatch)
+    data = _jpeg_bytes(2048, 1536)
+    img = Image.open(io.BytesIO(data))
+    assert iv.decode_gray(img, max_side=512).shape == (384, 512)
+
+    res = iv.analyze_leaflet(data, max_side=512)
+    assert (res['width'], res['height']) == (2048, 1536)
+    assert res['analysis_scale'] == 0.25
+    assert 'low_resolution' not in res['validation_notes']
+
+
+def test_best_of_several_active_templates(tmp_path):
+    # Лифлет: белый фон, темные квадраты-стикеры в левой половине
+    gray = np.full((768, 1024), 255, dtype=np.uint8)
+    for x in (100, 300):
+        gray[200:400, x:x + 150] = 30
+    reference = tmp_path / 'reference.png'
+    Image.fromarray(gray).save(reference)
+    left = '[{"x": 0.1, "y": 0.27, "w": 0.14, "h": 0.25}, {"x": 0.3, "y": 0.27, "w": 0.14, "h": 0.25}]'
+    right = '[{"x": 0.6, "y": 0.27, "w": 0.14, "h": 0.25}, {"x": 0.8, "y": 0.27, "w": 0.14, "h": 0.25}]'
+    templates = [
+        {'id': 2, 'required_stickers': 2, 'validation_zones': right},
+        {'id': 1, 'required_stickers': 2, 'validation_zones': left, 'template_image_path': str(reference)},
+    ]
+    buf = io.BytesIO()
+    Image.fromarray(gray).save(buf, 'JPEG', quality=90)
+
+    res = iv.analyze_leaflet_image(buf.getvalue(), templates)
+    assert res['template_id'] == 1
+    assert res['stickers_count'] == 2 and res['required_stickers'] == 2
+    assert res['template_confidence'] > 0.9
+
+
+def test_zero_sticker_template_does_not_win_over_real_template():
+    gray = np.full((768, 1024), 255, dtype=np.uint8)
+    gray[200:400, 100:250] = 30
+    zones = '[{"x": 0.1, "y": 0.27, "w": 0.14, "h": 0.25}, {"x": 0.6, "y": 0.27, "w": 0.14, "h": 0.25}]'
+    templates = [
+        {'id': 2, 'required_stickers': 0, 'validation_zones': '[]'},
+        {'id': 1, 'required_stickers': 2, 'validation_zones': zones},
+    ]
+    buf = io.BytesIO()
+    Image.fromarray(gray).save(buf, 'JPEG', quality=90)
+
+    # Найден один стикер из двух — требование не снимается шаблоном без стикеров
+    res = iv.analyze_leaflet_image(buf.getvalue(), templates)
+    assert res['template_id'] == 1
+    assert (res['stickers_count'], res['required_stickers']) == (1, 2)
+    assert res['template_confidence'] == 0.5
+
+    only = iv.analyze_leaflet_image(buf.getvalue(), templates[:1])
+    assert only['template_id'] == 2 and only['template_confidence'] == 1.0
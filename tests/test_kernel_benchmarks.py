@@ -0,0 +1,102 @@
+"""
+Микро-бенчмарки ядер анализа фото: время на мегапиксель.
+
+Замеры по времени запускаются только с RUN_BENCHMARKS=1: значения пишутся
+в отчет pytest (record_property, видно в --junitxml). Бюджеты с большим
+запасом — ловят регрессии на порядок, а не шум машины. Сверка ядер с
+эталонной реализацией выполняется всегда.
+"""
+
+import io
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils.image_validation as iv
+
+WIDTH, HEIGHT = 2000, 1500
+MEGAPIXELS = WIDTH * HEIGHT / 1e6
+
+# Бюджет, мс на мегапиксель
+BUDGET_MS_PER_MP = {
+    'decode_gray': 60.0,
+    'variance_of_laplacian': 25.0,
+    'nonwhite_integral': 25.0,
+    'zone_coverage_64': 0.5,
+    'compute_ahash_hex': 25.0,
+}
+
+ZONES = json.dumps([
+    {'x': (i % 8) / 8, 'y': (i // 8) / 8, 'w': 0.1, 'h': 0.1} for i in range(64)
+])
+
+
+@pytest.fixture(scope='module')
+def gray():
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 256, (HEIGHT, WIDTH), dtype=np.uint8)
+    arr[:, ::5] = 255
+    return arr
+
+
+@pytest.fixture(scope='module')
+def jpeg(gray):
+    buf = io.BytesIO()
+    Image.fromarray(gray).save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+def _ms_per_mp(fn, repeat: int = 5) -> float:
+    fn()  # прогрев
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000.0 / MEGAPIXELS
+
+
+def _laplacian_reference(gray: np.ndarray) -> float:
+    padded = np.pad(gray, 1, mode='edge').astype(np.float64)
+    lap = padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:] - 4 * padded[1:-1, 1:-1]
+    return float(lap.var())
+
+
+def _coverage_reference(gray: np.ndarray, zones_json: str):
+    h, w = gray.shape
+    result = []
+    for z in json.loads(zones_json):
+        x0 = max(0, min(w - 1, int(z['x'] * w)))
+        y0 = max(0, min(h - 1, int(z['y'] * h)))
+        x1 = max(0, min(w, x0 + int(z['w'] * w)))
+        y1 = max(0, min(h, y0 + int(z['h'] * h)))
+        crop = gray[y0:y1, x0:x1]
+        result.append(float((crop < 240).sum()) / crop.size if crop.size else 0.0)
+    return result
+
+
+def test_kernels_match_reference(gray):
+    assert iv.variance_of_laplacian(gray) == pytest.approx(_laplacian_reference(gray), rel=1e-9)
+    _, coverage = iv._count_stickers_by_zones(gray, ZONES)
+    assert coverage == pytest.approx(_coverage_reference(gray, ZONES))
+
+
+@pytest.mark.skipif(not os.getenv('RUN_BENCHMARKS'), reason='бенчмарк: RUN_BENCHMARKS=1')
+@pytest.mark.parametrize('kernel', sorted(BUDGET_MS_PER_MP))
+def test_kernel_ms_per_megapixel(kernel, gray, jpeg, record_property):
+    integral = iv.nonwhite_integral(gray)
+    calls = {
+        'decode_gray': lambda: iv.decode_gray(Image.open(io.BytesIO(jpeg))),
+        'variance_of_laplacian': lambda: iv.variance_of_laplacian(gray),
+        'nonwhite_integral': lambda: iv.nonwhite_integral(gray),
+        # Стоимость зон при готовом интегральном изображении не зависит от их площади
+        'zone_coverage_64': lambda: iv._count_stickers_by_zones(gray, ZONES, integral=integral),
+        'compute_ahash_hex': lambda: iv.compute_ahash_hex(gray),
+    }
+    ms = _ms_per_mp(calls[kernel])
+    record_property(f'{kernel}_ms_per_mp', round(ms, 3))
+    assert ms < BUDGET_MS_PER_MP[kernel]
@@ -0,0 +1,107 @@
+import io
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import utils.image_validation as iv
+import utils.template_features as tf
+
+W, H = 1024, 768
+ZONES = [
+    {"x": 0.10, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.41, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.72, "y": 0.15, "w": 0.18, "h": 0.18},
+    {"x": 0.25, "y": 0.52, "w": 0.18, "h": 0.18},
+    {"x": 0.56, "y": 0.52, "w": 0.18, "h": 0.18},
+]
+
+
+def _leaflet(rng=None) -> Image.Image:
+    """Лифлет: рамка, "текст" внизу, контуры слотов; с rng — наклеенные стикеры."""
+    img = Image.new('L', (W, H), 255)
+    draw = ImageDraw.Draw(img)
+    layout = np.random.default_rng(7)
+    for _ in range(60):
+        x, y = layout.integers(0, W - 80), layout.integers(int(H * 0.75), H - 10)
+        draw.rectangle([x, y, x + layout.integers(20, 120), y + 6], fill=40)
+    draw.rectangle([20, 20, W - 20, H - 20], outline=0, width=6)
+    for z in ZONES:
+        x0, y0 = int(z['x'] * W), int(z['y'] * H)
+        x1, y1 = x0 + int(z['w'] * W), y0 + int(z['h'] * H)
+        draw.rectangle([x0, y0, x1, y1], outline=120, width=3)
+        if rng is not None:
+            draw.ellipse([x0 + 10, y0 + 10, x1 - 10, y1 - 10], fill=int(rng.integers(20, 120)))
+    return img
+
+
+def _photo(rng, scale: float, dx: float, dy: float) -> bytes:
+    """Фото лифлета со стикерами: масштаб относительно центра, сдвиг, фон, шум, EXIF."""
+    inv = 1.0 / scale
+    c = W / 2 * (1 - inv) - dx * W * inv
+    f = H / 2 * (1 - inv) - dy * H * inv
+    img = _leaflet(rng).transform((W, H), Image.Transform.AFFINE, (inv, 0, c, 0, inv, f),
+                                  resample=Image.Resampling.BILINEAR, fillcolor=int(rng.integers(180, 255)))
+    arr = np.asarray(img, dtype=np.int16) + rng.normal(0, 6, (H, W)).astype(np.int16)
+    exif = Image.Exif()
+    exif[0x0132] = '2025:01:01 12:00:00'
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8)).save(buf, 'JPEG', quality=90, exif=exif)
+    return buf.getvalue()
+
+
+def _manual_review_rate(corpus, template) -> float:
+    flagged = 0
+    for data in corpus:
+        metrics = iv.analyze_leaflet_image(data, [template])
+        flagged += iv.decide_leaflet_status(metrics, 0)['manual_review_required']
+    return flagged / len(corpus)
+
+
+def test_alignment_reduces_manual_review_on_shifted_photos(tmp_path, monkeypatch):
+    reference = tmp_path / 'reference.png'
+    _leaflet().save(reference)
+    template = {'id': 1, 'required_stickers': 5, 'validation_zones': json.dumps(ZONES),
+                'template_image_path': str(reference)}
+
+    rng = np.random.default_rng(0)
+    corpus = [_photo(rng, float(rng.uniform(0.85, 1.15)), *rng.uniform(-0.12, 0.12, 2)) for _ in range(16)]
+
+    monkeypatch.setattr(tf, 'ALIGN_TO_REFERENCE', False)
+    unaligned = _manual_review_rate(corpus, template)
+    monkeypatch.setattr(tf, 'ALIGN_TO_REFERENCE', True)
+    aligned = _manual_review_rate(corpus, template)
+
+    assert aligned <= 0.25
+    assert aligned < unaligned
+
+
+def _aligned_sample(tmp_path):
+    reference = tmp_path / 'reference.png'
+    _leaflet().save(reference)
+    features = [tf.get_template_features({'id': 1, 'required_stickers': 5, 'validation_zones': json.dumps(ZONES),
+                                          'template_image_path': str(reference)})]
+    gray = np.asarray(Image.open(io.BytesIO(_photo(np.random.default_rng(1), 0.9, 0.08, -0.05))).convert('L'))
+    small = np.asarray(Image.fromarray(gray).resize((tf.REFERENCE_SIZE, tf.REFERENCE_SIZE), Image.Resampling.BILINEAR))
+    return small, features
+
+
+def test_alignment_recovers_transform(tmp_path):
+    small, features = _aligned_sample(tmp_path)
+    scale, dx, dy, _ = tf.estimate_alignment(small, features)[0]
+    assert scale == 0.9
+    assert abs(dx - 0.08) < 0.02 and abs(dy + 0.05) < 0.02
+
+
+@pytest.mark.skipif(not os.getenv('RUN_BENCHMARKS'), reason='бенчмарк: RUN_BENCHMARKS=1')
+def test_alignment_takes_few_ms(tmp_path, record_property):
+    small, features = _aligned_sample(tmp_path)
+    tf.estimate_alignment(small, features)  # прогрев FFT
+    started = time.perf_counter()
+    tf.estimate_alignment(small, features)
+    elapsed = time.perf_counter() - started
+    record_property('estimate_alignment_ms', round(elapsed * 1000, 3))
+    assert elapsed < 0.02
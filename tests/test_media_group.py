@@ -0,0 +1,36 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from utils.media_group import MediaGroupCoalescer
+from utils.photo_intake import select_best_intake
+
+
+def _message(message_id, group='G', width=1280, height=960):
+    size = SimpleNamespace(width=width, height=height, file_size=100_000, file_id=f'f{message_id}')
+    return SimpleNamespace(message_id=message_id, media_group_id=group, photo=[size], document=None)
+
+
+def test_album_updates_flush_once_in_order():
+    groups = []
+    done = threading.Event()
+
+    def on_group(messages):
+        groups.append([m.message_id for m in messages])
+        done.set()
+
+    coalescer = MediaGroupCoalescer(on_group, window=0.1, max_wait=1.0)
+    for message_id in (12, 10, 11):
+        coalescer.add(_message(message_id))
+        time.sleep(0.02)
+
+    assert done.wait(2.0)
+    time.sleep(0.15)
+    assert groups == [[10, 11, 12]]
+    assert coalescer.pending_groups() == 0 and coalescer.messages_coalesced == 2
+
+
+def test_album_picks_largest_acceptable_photo():
+    messages = [_message(1, width=320, height=240), _message(2, width=1600, height=1200), _message(3)]
+    message, photo = select_best_intake(messages)
+    assert message.message_id == 2 and photo.file_id == 'f2'
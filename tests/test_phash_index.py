@@ -0,0 +1,22 @@
+from utils.phash_index import PhashIndex
+
+
+def _hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def test_count_similar_matches_bruteforce_and_excludes_self():
+    items = [(i, f'{(0x0F0F0F0F0F0F0F0F ^ (1 << i) ^ (3 << (i + 20))):016x}') for i in range(40)]
+    items.append((100, 'not-a-hash'))
+    index = PhashIndex(items)
+    assert len(index) == 40
+
+    probe = '0f0f0f0f0f0f0f0f'
+    expected = sum(1 for _, h in items[:40] if _hamming(probe, h) <= 5)
+    assert index.count_similar(probe) == expected
+    assert index.count_similar(items[3][1], max_hamming_distance=0, exclude_id=3) == 0
+
+    index.update(3, probe)
+    index.update(200, probe)
+    assert index.count_similar(probe, max_hamming_distance=0) == 2
+    assert index.count_similar(probe, max_hamming_distance=0, exclude_id=200) == 1
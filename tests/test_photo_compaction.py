@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from utils.photo_compaction import recode_photo, PHASH_TOLERANCE
+from utils.image_validation import compute_ahash_hex, read_exif_meta
+
+
+def _photo(path, edges_blur: float = 0.0, noise: float = 2.0):
+    img = Image.new('L', (1600, 1200), 235)
+    draw = ImageDraw.Draw(img)
+    for i in range(8):
+        draw.rectangle([100 + i * 170, 300, 200 + i * 170, 500 + i * 40], fill=40 + i * 20)
+        draw.text((100 + i * 170, 800), "LEAFLET", fill=20, font_size=40)
+    arr = np.asarray(img.filter(ImageFilter.GaussianBlur(edges_blur)), dtype=np.float32)
+    arr += np.random.default_rng(0).normal(0, noise, arr.shape)
+    exif = Image.Exif()
+    exif[0x0132] = '2025:01:01 12:00:00'
+    Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8)).convert('RGB').save(path, 'JPEG', quality=95, exif=exif)
+
+
+def test_recode_to_webp_keeps_analysis_inputs(tmp_path):
+    path = str(tmp_path / ('ab' * 32 + '.jpg'))
+    _photo(path)
+
+    dry = recode_photo(path, 'webp', 80, write=False)
+    assert dry['status'] == 'recoded' and not os.path.exists(dry['new_path'])
+
+    result = recode_photo(path, 'webp', 80)
+    assert result['new_path'].endswith('.webp') and result['new_bytes'] < result['old_bytes']
+    with Image.open(path) as a, Image.open(result['new_path']) as b:
+        assert bin(int(compute_ahash_hex(a), 16) ^ int(compute_ahash_hex(b), 16)).count('1') <= PHASH_TOLERANCE
+        assert read_exif_meta(b).get('DateTime') == '2025:01:01 12:00:00'
+
+
+def test_recode_keeps_original_when_sharpness_was_only_noise(tmp_path):
+    # Мягкие края + шум: "резкость" держится на шуме, кодек его сгладит
+    path = str(tmp_path / ('cd' * 32 + '.jpg'))
+    _photo(path, edges_blur=4.0, noise=4.0)
+    assert recode_photo(path, 'webp', 75)['status'] == 'blur_changed'
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+
+def test_recode_reports_error_for_missing_file(tmp_path):
+    assert recode_photo(str(tmp_path / 'missing.jpg'), 'webp', 80)['status'] == 'error'
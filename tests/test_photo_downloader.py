@@ -0,0 +1,106 @@
+import io
+import time
+
+from PIL import Image
+
+import utils.photo_downloader as pd
+import utils.photo_store as ps
+
+
+def _jpeg(width=1280, height=960, fmt='JPEG'):
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), (240, 240, 240)).save(buf, fmt)
+    return buf.getvalue()
+
+
+def _fake_queue(monkeypatch, tmp_path, duplicate=None, exists=True):
+    calls = {'complete': [], 'reschedule': []}
+    refs = {}
+
+    def acquire(digest, path, size_bytes=0):
+        refs[digest] = refs.get(digest, 0) + 1
+        return refs[digest], path
+
+    monkeypatch.setattr(ps, 'acquire_photo_blob', acquire)
+    monkeypatch.setattr(ps, 'release_photo_blob', lambda digest: refs.pop(digest, None))
+    monkeypatch.setattr(pd, 'store_photo_stream', lambda chunks, ext=ps.DEFAULT_EXT: ps.store_photo_stream(chunks, ext, root=str(tmp_path)))
+    monkeypatch.setattr(pd, 'find_application_by_file_unique_id', lambda fuid, exclude_id=0: duplicate)
+    monkeypatch.setattr(pd, 'complete_photo_download', lambda app_id, *a, **kw: calls['complete'].append((app_id, a, kw)) or exists)
+    monkeypatch.setattr(pd, 'reschedule_photo_download', lambda *a: calls['reschedule'].append(a))
+    return calls, refs
+
+
+def test_download_retries_with_backoff_then_fails(tmp_path, monkeypatch):
+    calls, _ = _fake_queue(monkeypatch, tmp_path)
+
+    def flaky(file_id):
+        raise ConnectionError('timeout')
+
+    downloader = pd.PhotoDownloader(max_attempts=3, retry_base_delay=10, fetch=flaky)
+    row = {'application_id': 7, 'file_id': 'F', 'file_unique_id': 'U', 'attempts': 1}
+    assert downloader.process(row) == 'retry'
+    app_id, error, next_at = calls['reschedule'][-1]
+    # Вторая попытка — задержка удваивается
+    assert app_id == 7 and 'timeout' in error and 19 < next_at - time.time() <= 20
+
+    assert downloader.process(dict(row, attempts=2)) == 'failed'
+    assert calls['reschedule'][-1][2] is None
+    assert not calls['complete']
+
+
+def test_download_stores_photo_and_short_circuits_duplicates(tmp_path, monkeypatch):
+    calls, refs = _fake_queue(monkeypatch, tmp_path)
+    data = _jpeg()
+    done = []
+    downloader = pd.PhotoDownloader(fetch=lambda file_id: iter([data[:1000], data[1000:]]),
+                                    on_downloaded=lambda app_id, path: done.append((app_id, path)))
+
+    assert downloader.process({'application_id': 1, 'file_id': 'F', 'file_unique_id': 'U'}) == 'downloaded'
+    app_id, (path, digest), _ = calls['complete'][0]
+    assert app_id == 1 and done == [(1, path)] and refs[digest] == 1
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+    # Тот же file_unique_id у другой заявки — без скачивания, сразу duplicate
+    calls, refs = _fake_queue(monkeypatch, tmp_path, duplicate={'id': 1, 'photo_path': path, 'photo_hash': digest})
+    refs[digest] = 1
+    downloader._fetch = None
+    assert downloader.process({'application_id': 2, 'file_id': 'F2', 'file_unique_id': 'U'}) == 'duplicate'
+    app_id, (dup_path, dup_hash), kwargs = calls['complete'][0]
+    assert (app_id, dup_path, dup_hash, kwargs['leaflet_status']) == (2, path, digest, 'duplicate')
+    assert refs[digest] == 2 and downloader.outcomes['duplicate'] == 1
+
+
+def test_rejected_file_is_reported_and_deleted_application_releases_photo(tmp_path, monkeypatch):
+    calls, refs = _fake_queue(monkeypatch, tmp_path)
+    rejected, resolved = [], []
+    downloader = pd.PhotoDownloader(fetch=lambda file_id: iter([_jpeg(320, 240)]),
+                                    on_resolved=lambda app_id, outcome: resolved.append(outcome),
+                                    on_rejected=lambda row, error: rejected.append((row['telegram_id'], error.reason)))
+    row = {'application_id': 3, 'file_id': 'F', 'file_unique_id': 'U', 'telegram_id': 42}
+    assert downloader.process(row) == 'rejected'
+    assert rejected == [(42, 'too_small')] and calls['complete'][0][2]['leaflet_status'] == 'rejected'
+
+    # Заявку удалили, пока фото скачивалось: ссылка на файл освобождается, скоринга нет
+    calls, refs = _fake_queue(monkeypatch, tmp_path, exists=False)
+    released = []
+    monkeypatch.setattr(pd, 'release_photo', released.append)
+    downloader._fetch = lambda file_id: iter([_jpeg()])
+    assert downloader.process(dict(row, application_id=4)) == 'deleted'
+    assert released == [calls['complete'][0][1][0]]
+    assert resolved == ['rejected'] and downloader.outcomes['deleted'] == 1
+
+
+def test_image_document_keeps_its_format_and_rejection_marks_document(tmp_path, monkeypatch):
+    calls, _ = _fake_queue(monkeypatch, tmp_path)
+    rejected = []
+    downloader = pd.PhotoDownloader(fetch=lambda file_id: iter([_jpeg(fmt='PNG')]),
+                                    on_rejected=lambda row, error: rejected.append(error))
+    row = {'application_id': 5, 'file_id': 'F', 'file_unique_id': 'U', 'mime_type': 'image/png'}
+    assert downloader.process(row) == 'downloaded'
+    assert calls['complete'][0][1][0].endswith('.png')
+
+    downloader._fetch = lambda file_id: iter([_jpeg(320, 240)])
+    assert downloader.process(dict(row, application_id=6)) == 'rejected'
+    assert downloader.process(dict(row, application_id=7, mime_type='')) == 'rejected'
+    assert [e.document for e in rejected] == [True, False]
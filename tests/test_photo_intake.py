@@ -0,0 +1,66 @@
+import io
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from config import MESSAGES
+from utils.photo_intake import (
+    PhotoRejected, select_photo_size, check_image_document, gate_image_stream, rejection_message,
+)
+
+
+def _size(width, height, file_size=None):
+    return SimpleNamespace(width=width, height=height, file_size=file_size, file_id=f'{width}x{height}')
+
+
+def test_smallest_size_that_meets_analysis_resolution():
+    sizes = [_size(90, 68, 1_500), _size(320, 240, 20_000), _size(1280, 960, 180_000), _size(2560, 1920, 900_000)]
+    assert select_photo_size(sizes).width == 1280
+    # Портретное фото подходит так же, как альбомное
+    assert select_photo_size([_size(72, 90), _size(960, 1280)]).height == 1280
+
+    with pytest.raises(PhotoRejected) as exc:
+        select_photo_size(sizes[:2])
+    assert exc.value.reason == 'too_small'
+    with pytest.raises(PhotoRejected) as exc:
+        select_photo_size(sizes, max_bytes=100_000)
+    assert exc.value.reason == 'too_large'
+
+
+def test_document_gate_stops_download_on_small_header():
+    doc = SimpleNamespace(mime_type='image/png', file_size=5_000_000)
+    assert check_image_document(doc) is doc
+    with pytest.raises(PhotoRejected):
+        check_image_document(SimpleNamespace(mime_type='application/pdf', file_size=10))
+
+    buf = io.BytesIO()
+    Image.new('RGB', (640, 480), (255, 255, 255)).save(buf, 'JPEG')
+    data = buf.getvalue()
+    pulled = []
+
+    def chunks():
+        for i in range(0, len(data), 256):
+            pulled.append(i)
+            yield data[i:i + 256]
+
+    with pytest.raises(PhotoRejected) as exc:
+        list(gate_image_stream(chunks()))
+    assert exc.value.reason == 'too_small'
+    # Обрыв по заголовку, а не после скачивания всего файла
+    assert len(pulled) < len(data) // 256
+
+    with pytest.raises(PhotoRejected) as exc:
+        list(gate_image_stream(iter([data]), max_bytes=100))
+    assert exc.value.reason == 'too_large'
+
+
+def test_send_as_image_hint_only_for_documents():
+    with pytest.raises(PhotoRejected) as exc:
+        check_image_document(SimpleNamespace(mime_type='image/jpeg', file_size=10), max_bytes=5)
+    assert exc.value.document
+    assert MESSAGES['photo_send_as_image'] in rejection_message(exc.value, MESSAGES)
+
+    with pytest.raises(PhotoRejected) as exc:
+        select_photo_size([_size(1280, 960, 500)], max_bytes=100)
+    assert MESSAGES['photo_send_as_image'] not in rejection_message(exc.value, MESSAGES)
@@ -0,0 +1,192 @@
+import io
+import os
+
+import pytest
+
+import utils.photo_store as ps
+from utils.file_handler import CachedPhotoStorage, S3PhotoStorage
+
+
+def _fake_refcounts(monkeypatch):
+    refs, paths = {}, {}
+
+    def acquire(digest, path, size_bytes=0):
+        refs[digest] = refs.get(digest, 0) + 1
+        paths.setdefault(digest, path)
+        return refs[digest], paths[digest]
+
+    def release(digest):
+        if digest not in refs:
+            return None
+        refs[digest] -= 1
+        if not refs[digest]:
+            del refs[digest], paths[digest]
+            return 0
+        return refs[digest]
+
+    monkeypatch.setattr(ps, 'acquire_photo_blob', acquire)
+    monkeypatch.setattr(ps, 'release_photo_blob', release)
+    return refs, paths
+
+
+def test_identical_bytes_stored_once_and_released_by_refcount(tmp_path, monkeypatch):
+    refs, _ = _fake_refcounts(monkeypatch)
+    root = str(tmp_path)
+
+    path1, digest = ps.store_photo_bytes(b'photo-bytes', root=root)
+    path2, _ = ps.store_photo_bytes(b'photo-bytes', root=root)
+    assert path1 == path2 == os.path.join(root, digest[:2], digest[2:4], digest + '.jpg')
+    assert refs[digest] == 2
+    assert ps.digest_from_path(path1) == digest
+    # Временных файлов после атомарной записи не остается
+    assert os.listdir(os.path.dirname(path1)) == [digest + '.jpg']
+
+    assert ps.release_photo(path1, root) is False and os.path.exists(path1)
+    assert ps.release_photo(path1, root) is True and not os.path.exists(path1)
+    # Старые плоские пути хранилищем не учитываются
+    assert ps.release_photo(os.path.join(root, "user_1_20240101_000000.jpg"), root) is False
+
+
+def test_resolve_and_relpath_stay_inside_root(tmp_path):
+    root = str(tmp_path)
+    path = ps.content_path('ab' * 32, root=root)
+    ps.write_atomic(path, b'x')
+    rel = ps.photo_relpath(path, root)
+    assert rel == f"ab/ab/{'ab' * 32}.jpg"
+    assert ps.resolve_photo(rel, root) == os.path.realpath(path)
+    assert ps.photo_relpath('photos/user_1_20240101_000000.jpg', root) == 'user_1_20240101_000000.jpg'
+    assert ps.resolve_photo('../etc/passwd', root) is None
+    assert ps.resolve_photo('ab/../../etc/passwd', root) is None
+
+
+def test_recoded_variant_found_by_hash(tmp_path, monkeypatch):
+    _, paths = _fake_refcounts(monkeypatch)
+    root = str(tmp_path)
+    path, digest = ps.store_photo_bytes(b'jpeg-bytes', root=root)
+    webp = os.path.splitext(path)[0] + '.webp'
+    os.replace(path, webp)
+    paths[digest] = webp  # как после mark_photo_compacted
+
+    # Старая ссылка .jpg и повторная загрузка тех же байт ведут на .webp
+    assert ps.resolve_photo(ps.photo_relpath(path, root), root) == os.path.realpath(webp)
+    assert ps.store_photo_bytes(b'jpeg-bytes', root=root) == (webp, digest)
+    assert ps.photo_mimetype(webp) == 'image/webp'
+
+
+def test_compacted_copy_replaces_original_unless_released_meanwhile(tmp_path, monkeypatch):
+    _, paths = _fake_refcounts(monkeypatch)
+    root = str(tmp_path)
+
+    def mark(digest, new_path, size_bytes):
+        if digest not in paths:
+            return None
+        paths[digest] = new_path
+        return 1
+
+    monkeypatch.setattr(ps, 'mark_photo_compacted', mark)
+    path, digest = ps.store_photo_bytes(b'jpeg-bytes', root=root)
+    webp = os.path.splitext(path)[0] + '.webp'
+    ps.write_atomic(webp, b'webp-bytes')
+    assert ps.replace_stored_photo(digest, path, webp, 10, root) == 1
+    assert not os.path.exists(path) and os.path.exists(webp)
+    # Заявка успела сохранить старый путь .jpg — освобождение удаляет .webp
+    assert ps.release_photo(path, root) is True and not os.path.exists(webp)
+
+    # Последнюю ссылку сняли, пока файл перекодировался: новая копия не остается
+    path, digest = ps.store_photo_bytes(b'other-bytes', root=root)
+    ps.release_photo(path, root)
+    webp = os.path.splitext(path)[0] + '.webp'
+    ps.write_atomic(webp, b'webp-bytes')
+    assert ps.replace_stored_photo(digest, path, webp, 10, root) is None
+    assert not os.path.exists(webp)
+
+
+class _FakeS3:
+    """Минимальный клиент S3 в памяти"""
+
+    class NotFound(Exception):
+        response = {'Error': {'Code': '404'}}
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body.read() if hasattr(Body, 'read') else Body
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.NotFound()
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.NotFound()
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+
+def test_cached_storage_reads_through_after_eviction(tmp_path):
+    client = _FakeS3()
+    storage = CachedPhotoStorage(S3PhotoStorage(bucket='b', prefix='photos', client=client),
+                                 cache_dir=str(tmp_path), max_bytes=10, upload_workers=1, upload_queue_size=1)
+    storage.put('aa/aa/one.jpg', b'12345678')
+    storage.put('bb/bb/two.jpg', b'87654321')  # вытесняет первый файл из кэша
+    assert storage.flush(timeout=5)
+    assert set(client.objects) == {'photos/aa/aa/one.jpg', 'photos/bb/bb/two.jpg'}
+    assert not os.path.exists(tmp_path / 'aa' / 'aa' / 'one.jpg')
+
+    path = storage.local_path('aa/aa/one.jpg')
+    with open(path, 'rb') as f:
+        assert f.read() == b'12345678'
+    assert storage.stats['misses'] == 1 and storage.stats['evictions'] >= 1
+
+    storage.delete('aa/aa/one.jpg')
+    assert not storage.exists('aa/aa/one.jpg') and storage.local_path('aa/aa/one.jpg') is None
+
+
+def test_cached_storage_uploads_staged_file_without_reading_it(tmp_path, monkeypatch):
+    client = _FakeS3()
+    backend = S3PhotoStorage(bucket='b', prefix='photos', client=client)
+    storage = CachedPhotoStorage(backend, cache_dir=str(tmp_path / 'cache'), upload_workers=1)
+    monkeypatch.setattr(backend, 'put', lambda key, data: pytest.fail('байты файла прочитаны в память'))
+    staged = tmp_path / 'cache' / '.tmp-staged.jpg'
+    staged.parent.mkdir()
+    staged.write_bytes(b'staged-photo')
+
+    storage.put_file('cc/cc/three.jpg', str(staged))
+    assert storage.flush(timeout=5)
+    assert client.objects == {'photos/cc/cc/three.jpg': b'staged-photo'} and not staged.exists()
+    # Копия остается в кэше: фото доступно без скачивания
+    assert storage.local_path('cc/cc/three.jpg') and storage.stats['uploads'] == 1
+
+
+def test_retain_photo_reuses_stored_file(tmp_path, monkeypatch):
+    refs, _ = _fake_refcounts(monkeypatch)
+    root = str(tmp_path)
+    path, digest = ps.store_photo_bytes(b'forwarded', root=root)
+
+    # Дубликат по file_unique_id берет ссылку на тот же файл без скачивания
+    assert ps.retain_photo(path, root) == path and refs[digest] == 2
+    assert ps.release_photo(path, root) is False
+    assert ps.release_photo(path, root) is True
+    # Файл уже удален — дубликат нужно скачать заново
+    assert ps.retain_photo(path, root) is None and digest not in refs
+
+
+def test_stream_hashes_full_content_while_writing(tmp_path, monkeypatch):
+    refs, _ = _fake_refcounts(monkeypatch)
+    root = str(tmp_path)
+    header = b'\xff\xd8' + b'h' * 2000
+
+    path, digest = ps.store_photo_stream(iter([header, b'body-1']), root=root)
+    # Одинаковый заголовок, разное содержимое — разные файлы
+    other, other_digest = ps.store_photo_stream(iter([header, b'body-2']), root=root)
+    assert digest != other_digest and path != other
+    assert ps.store_photo_stream(iter([header + b'body-1']), root=root) == (path, digest)
+    assert refs[digest] == 2
+    with open(path, 'rb') as f:
+        assert f.read() == header + b'body-1'
+    # Временные файлы в корне хранилища не остаются
+    assert not [n for n in os.listdir(root) if n.startswith('.tmp-')]
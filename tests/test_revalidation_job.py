@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+
+import utils.revalidation_job as rj
+from utils.phash_index import PhashIndex
+
+METRICS = {
+    'width': 1280, 'height': 960, 'is_blurry': False, 'orientation_ok': True, 'exif_has_datetime': True,
+    'required_stickers': 0, 'stickers_count': 0, 'photo_phash': '',
+}
+
+
+class _FakeService:
+    """Пул анализа без процессов; analyzed — фото, дошедшие до результата"""
+
+    def __init__(self):
+        self.analyzed = []
+        self.on_wait = None
+
+    def submit(self, photo_path, templates=None):
+        return SimpleNamespace(path=photo_path, cancel=lambda: True)
+
+    def wait_metrics(self, future):
+        self.analyzed.append(future.path)
+        if self.on_wait is not None:
+            self.on_wait(future.path)
+        return dict(METRICS), None
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Таблицы задачи и кэша метрик в памяти"""
+    state = SimpleNamespace(apps=[{'id': i, 'photo_path': f'p{i}'} for i in range(1, 6)], templates=[],
+                            jobs={}, cache={}, written=[])
+
+    def create_job(filters, params_key, total):
+        job_id = len(state.jobs) + 1
+        state.jobs[job_id] = {'id': job_id, 'filters': filters, 'params_key': params_key, 'status': 'running',
+                              'last_id': 0, 'processed': 0, 'cached': 0, 'total': total}
+        return job_id
+
+    def get_job(job_id=None, unfinished_only=False):
+        rows = [row for row in state.jobs.values() if job_id in (None, row['id'])
+                and not (unfinished_only and row['status'] == 'done')]
+        return dict(rows[-1]) if rows else None
+
+    patches = {
+        'get_active_leaflet_templates': lambda: state.templates,
+        'count_revalidation_targets': lambda **filters: len(state.apps),
+        'create_revalidation_job': create_job,
+        'update_revalidation_job': lambda job_id, **fields: state.jobs[job_id].update(fields),
+        'get_revalidation_job': get_job,
+        'get_revalidation_page': lambda after_id, limit, **filters:
+            [row for row in state.apps if row['id'] > after_id][:limit],
+        'get_cached_leaflet_metrics': lambda hashes, key:
+            {h: state.cache[(h, key)] for h in hashes if (h, key) in state.cache},
+        'save_leaflet_metrics_cache': lambda metrics, key:
+            state.cache.update({(h, key): m for h, m in metrics.items()}),
+        'bulk_update_leaflet_results': lambda results: state.written.extend(results),
+        '_hash_or_none': lambda path: f'sha-{path}',
+        'local_photo_path': lambda path: path,
+    }
+    for name, value in patches.items():
+        monkeypatch.setattr(rj, name, value)
+    monkeypatch.setattr(rj.PhashIndex, 'from_db', classmethod(lambda cls: PhashIndex()))
+    return state
+
+
+def test_cancelled_job_resumes_from_checkpoint_and_rerun_uses_cache(db):
+    service = _FakeService()
+    job = rj.RevalidationJob(service=service, batch_size=1, page_size=2)
+    # Отмена во время анализа второго фото: оно дописывается, дальше задача не идет
+    service.on_wait = lambda path: job.cancel() if path == 'p2' else None
+    progress = job.run()
+    assert (progress['status'], progress['processed'], progress['last_id']) == ('cancelled', 2, 2)
+    assert db.jobs[1]['status'] == 'cancelled' and db.jobs[1]['last_id'] == 2
+
+    service.on_wait = None
+    resumed = rj.RevalidationJob.resume(service=service)
+    assert resumed.job_id == 1
+    progress = resumed.run()
+    assert (progress['status'], progress['processed'], progress['total']) == ('done', 5, 5)
+    assert service.analyzed == ['p1', 'p2', 'p3', 'p4', 'p5']
+    assert [r['id'] for r in db.written] == [1, 2, 3, 4, 5]
+
+    # Те же фото и параметры — метрики из кэша, пул не нужен
+    progress = rj.RevalidationJob(service=service).run()
+    assert (progress['processed'], progress['cached']) == (5, 5)
+    assert len(service.analyzed) == 5
+
+
+def test_resume_refuses_changed_analysis_params(db):
+    service = _FakeService()
+    job = rj.RevalidationJob(service=service, batch_size=1)
+    service.on_wait = lambda path: job.cancel()
+    job.run()
+
+    db.templates = [{'id': 7, 'required_stickers': 3}]
+    with pytest.raises(rj.RevalidationParamsChanged):
+        rj.RevalidationJob.resume(service=service)
+
+    # Шаблон сменился уже после resume() — поток не продолжает задачу со старой точки
+    db.templates = []
+    resumed = rj.RevalidationJob.resume(service=service)
+    db.templates = [{'id': 7, 'required_stickers': 3}]
+    progress = resumed.run()
+    assert progress['status'] == 'failed' and progress['processed'] == 1
+    assert service.analyzed == ['p1']
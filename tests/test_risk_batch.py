@@ -0,0 +1,71 @@
+import json
+import random
+
+import pandas as pd
+import pytest
+
+import utils.fraud_context as fc
+from config import LOYALTY_CARD_LENGTH
+from utils.anti_fraud import AntiFraudSystem
+from utils.fraud_rules import RuleEngine, RuleError
+from utils.risk_batch import build_context, score_frame
+
+
+def _participants(count=400, seed=7):
+    rng = random.Random(seed)
+    cards = ['', '  ', '1' * LOYALTY_CARD_LENGTH, '0123', '9876543210', '²' * 10, ' 5551234567 ', '5551234567']
+    rows = []
+    for i in range(count):
+        card = rng.choice(cards) if rng.random() < 0.3 else f"{rng.randrange(10 ** LOYALTY_CARD_LENGTH):0{LOYALTY_CARD_LENGTH}d}"
+        rows.append({
+            'id': i + 1,
+            'name': rng.choice(['Anna', 'A', ' B ', '', None, 'Oleg Petrov']),
+            'phone_number': rng.choice(['+375291234567', '12', '', None, '+7 (999) 123-45-67']),
+            'loyalty_card_number': card,
+            'telegram_id': rng.choice([rng.randrange(1, 10 ** 9), 5, 0]),
+            'photo_hash': rng.choice(['', None, 'dup', f'h{i}']),
+        })
+    return rows
+
+
+def _fake_counts(rows):
+    def counts(cards=(), phones=(), photo_hashes=(), telegram_ids=(), recent_seconds=60):
+        def count(column, values):
+            return {str(v): sum(1 for r in rows if r[column] == v) for v in set(values) if v}
+        return {'card': count('loyalty_card_number', cards), 'phone': count('phone_number', phones),
+                'photo': count('photo_hash', photo_hashes), 'telegram': count('telegram_id', telegram_ids),
+                'recent': 42}
+    return counts
+
+
+def test_vectorised_scores_match_per_row_antifraud(monkeypatch):
+    rows = _participants()
+    monkeypatch.setattr(fc, 'get_fraud_signal_counts', _fake_counts(rows))
+    antifraud = AntiFraudSystem()
+    expected = antifraud.score_batch(rows, fc.FraudContextProvider())
+
+    scored = score_frame(pd.DataFrame(rows), recent_registrations=42)
+
+    assert scored['id'].tolist() == [r['id'] for r in rows]
+    for (score, level, details), row in zip(expected, scored.itertuples(index=False)):
+        assert (row.risk_score, row.risk_level) == (score, level)
+        assert row.risk_details == json.dumps(details, ensure_ascii=False)
+
+
+def test_duplicate_phone_count_matches_per_row_context(monkeypatch):
+    rows = _participants(count=60, seed=3)
+    monkeypatch.setattr(fc, 'get_fraud_signal_counts', _fake_counts(rows))
+    expected = fc.FraudContextProvider(similar_photos=False).for_batch(rows)
+
+    context = build_context(pd.DataFrame(rows), recent_registrations=42)
+
+    assert context['duplicate_phone_count'].tolist() == [c['duplicate_phone_count'] for c in expected]
+
+
+def test_rules_on_features_missing_from_batch_context_are_rejected():
+    rule = {'name': 'similar', 'outcomes': [
+        {'when': {'feature': 'similar_photo_count', 'op': 'gt', 'value': 0}, 'impact': 50, 'message': 's'}]}
+    antifraud = AntiFraudSystem(RuleEngine({'rules': [rule]}))
+
+    with pytest.raises(RuleError, match='similar_photo_count'):
+        score_frame(pd.DataFrame(_participants(count=5)), antifraud=antifraud)
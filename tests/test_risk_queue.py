@@ -0,0 +1,95 @@
+import json
+import time
+
+import utils.fraud_context as fc
+import utils.risk_queue as rq
+
+PARTICIPANTS = {
+    1: {'id': 1, 'name': 'Anna', 'phone_number': '+375291111111', 'loyalty_card_number': '1234567891',
+        'telegram_id': 1, 'photo_hash': 'aa', 'photo_phash': ''},
+    2: {'id': 2, 'name': 'Oleg', 'phone_number': '+375292222222', 'loyalty_card_number': '1234567891',
+        'telegram_id': 2, 'photo_hash': 'aa', 'photo_phash': ''},
+}
+
+
+def _patch_db(monkeypatch):
+    written, flagged, context_calls = [], [], []
+    monkeypatch.setattr(rq, 'get_risk_participants', lambda ids: [PARTICIPANTS[i] for i in ids])
+    monkeypatch.setattr(rq, 'bulk_update_risk', lambda df: written.append(df) or len(df))
+    monkeypatch.setattr(rq, 'flag_manual_review', lambda ids: flagged.extend(ids) or len(ids))
+
+    def counts(**kwargs):
+        context_calls.append(kwargs)
+        return {'card': {'1234567891': 2}, 'phone': {}, 'photo': {'aa': 2}, 'telegram': {}, 'recent': 0}
+
+    monkeypatch.setattr(fc, 'get_fraud_signal_counts', counts)
+    return written, flagged, context_calls
+
+
+def _items(q, *ids, enqueued_at=None):
+    for app_id in ids:
+        q.enqueue(app_id)
+    return [(0, n, enqueued_at or time.time(), app_id) for n, app_id in enumerate(ids)]
+
+
+def test_batch_is_scored_with_context_written_once_and_flagged(monkeypatch):
+    written, flagged, context_calls = _patch_db(monkeypatch)
+    q = rq.RiskScoringQueue(batch_size=10, auto_flag_score=71)
+
+    results = q.score_batch(_items(q, 1, 2))
+    assert q.flush() == 2
+
+    # Контекст пачки — один запрос; общие карта и фото дают высокий риск обеим заявкам
+    assert len(context_calls) == 1
+    assert [r['risk_level'] for r in results] == ['high', 'high']
+    assert len(written) == 1 and list(written[0]['id']) == [1, 2]
+    assert flagged == [1, 2]
+    stats = q.stats()
+    assert (stats['scored_total'], stats['flagged_total'], stats['queue_fresh']) == (2, 2, 0)
+
+
+def test_lagging_batch_degrades_to_context_free_rules_and_is_rescored_later(monkeypatch):
+    written, flagged, context_calls = _patch_db(monkeypatch)
+    q = rq.RiskScoringQueue(batch_size=10, lag_threshold=5)
+
+    (result,) = q.score_batch(_items(q, 1, enqueued_at=time.time() - 30))
+
+    assert context_calls == []
+    details = {d['name'] for d in json.loads(result['risk_details'])}
+    assert 'degraded' in details and 'loyalty_card_uniqueness' not in details
+    assert q.stats()['deferred'] == 1
+
+    # Лаг спал: следующая пачка считается полностью, отложенная заявка возвращается в очередь
+    q.score_batch(_items(q, 2))
+    assert len(context_calls) == 1
+    stats = q.stats()
+    assert (stats['deferred'], stats['queue_backlog'], stats['degraded_total']) == (0, 1, 1)
+
+
+def test_recovery_pages_through_all_rows_and_backlog_is_never_degraded(monkeypatch):
+    written, flagged, context_calls = _patch_db(monkeypatch)
+    pending = [1, 2]
+    monkeypatch.setattr(rq, 'RECOVER_PAGE_SIZE', 1)
+    monkeypatch.setattr(rq, 'get_unscored_application_ids',
+                        lambda after_id, limit: [i for i in pending if i > after_id][:limit])
+    q = rq.RiskScoringQueue(batch_size=10, lag_threshold=5)
+
+    assert q.recover_unscored() == 2
+    # Фоновые заявки (в т.ч. упрощенные до рестарта) ждали долго, но считаются полностью
+    backlog = [(rq.PRIORITY_BACKLOG, n, time.time() - 30, app_id) for n, app_id in enumerate(pending)]
+    results = q.score_batch(backlog)
+    assert len(context_calls) == 1
+    assert all('degraded' not in r['risk_details'] for r in results)
+
+
+def test_failed_batch_is_retried_then_left_for_restart(monkeypatch):
+    _patch_db(monkeypatch)
+    monkeypatch.setattr(rq, 'RETRY_DELAY', 0)
+    q = rq.RiskScoringQueue(batch_size=10)
+    batch = _items(q, 1)
+
+    for _ in range(rq.MAX_BATCH_ATTEMPTS - 1):
+        assert q._retry_later(batch) == 1
+        batch = [q._queue.get_nowait()]
+    assert q._retry_later(batch) == 0
+    assert q.stats()['queue_backlog'] == 0 and q._attempts == {}
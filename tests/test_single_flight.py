@@ -0,0 +1,69 @@
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+from utils.single_flight import SingleFlight
+
+
+def test_concurrent_calls_for_same_key_share_one_execution():
+    flight = SingleFlight()
+    entered = threading.Event()
+    release = threading.Event()
+    runs = []
+    results = []
+
+    def work():
+        runs.append(1)
+        entered.set()
+        release.wait(2.0)
+        return 'saved'
+
+    def call():
+        results.append(flight.do(42, work))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    assert entered.wait(2.0)
+    followers = [threading.Thread(target=call) for _ in range(3)]
+    for t in followers:
+        t.start()
+    while flight.stats()['coalesced'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for t in [leader] + followers:
+        t.join(2.0)
+
+    assert len(runs) == 1
+    assert sorted(results) == [('saved', False)] + [('saved', True)] * 3
+    assert flight.stats() == {'calls': 4, 'coalesced': 3, 'timeouts': 0, 'in_flight': 0}
+
+    # После завершения ключ свободен — следующий вызов выполняется заново
+    assert flight.do(42, lambda: 'again') == ('again', False)
+
+
+def test_leader_error_is_not_cached():
+    flight = SingleFlight()
+    with pytest.raises(RuntimeError):
+        flight.do('k', lambda: (_ for _ in ()).throw(RuntimeError('db down')))
+    assert flight.do('k', lambda: 1) == (1, False)
+
+
+def test_follower_wait_is_bounded():
+    flight = SingleFlight(timeout=10.0)
+    entered = threading.Event()
+    release = threading.Event()
+    leader = threading.Thread(target=flight.do, args=('k', lambda: entered.set() or release.wait(2.0)))
+    leader.start()
+    assert entered.wait(2.0)
+
+    # Таймаут вызывающего важнее значения по умолчанию
+    with pytest.raises(FutureTimeoutError):
+        flight.do('k', lambda: 'never', timeout=0.05)
+    flight.timeout = 0.05
+    with pytest.raises(FutureTimeoutError):
+        flight.do('k', lambda: 'never')
+    release.set()
+    leader.join(2.0)
+    assert flight.stats()['timeouts'] == 2 and flight.stats()['in_flight'] == 0
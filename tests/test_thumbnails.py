@@ -0,0 +1,27 @@
+import os
+
+from PIL import Image
+
+import utils.thumbnails as th
+from utils.photo_store import content_path
+
+
+def test_thumbnail_cached_by_content_hash(tmp_path):
+    digest = 'cd' * 32
+    source = content_path(digest, root=str(tmp_path / 'photos'))
+    os.makedirs(os.path.dirname(source))
+    Image.new('RGB', (4000, 3000), (200, 30, 30)).save(source, 'JPEG')
+
+    size = th.snap_size(100)
+    assert size == th.PHOTO_THUMBNAIL_SIZES[0]
+    assert th.snap_size(10 ** 6) == th.PHOTO_THUMBNAIL_SIZES[-1] and th.snap_size(None) is None
+
+    root = str(tmp_path / 'thumbs')
+    path = th.get_thumbnail(source, size, root)
+    assert path == content_path(digest, '.jpg', os.path.join(root, str(size)))
+    with Image.open(path) as thumb:
+        assert max(thumb.size) == size and thumb.size[0] > thumb.size[1]
+
+    mtime = os.stat(path).st_mtime_ns
+    assert th.get_thumbnail(source, size, root) == path and os.stat(path).st_mtime_ns == mtime
+    assert th.remove_thumbnails(source, root) == 1 and not os.path.exists(path)
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from utils.velocity import VelocityTracker, velocity_frame
+
+START = datetime(2026, 3, 2, 14, 0, 0)
+
+
+def _app(app_id, phone, seconds, **extra):
+    return {'id': app_id, 'name': f'User {app_id}', 'phone_number': phone,
+            'loyalty_card_number': f'{app_id:010d}', 'timestamp': START + timedelta(seconds=seconds), **extra}
+
+
+def test_burst_from_one_phone_block_is_throttled_without_touching_others():
+    tracker = VelocityTracker(snapshot_path=None)
+    block = [tracker.observe(_app(i, f'+37529123{i:04d}', i)) for i in range(1, 8)]
+    other = tracker.observe(_app(100, '+375339990000', 8))
+
+    # burst ведра блока номеров — 5 регистраций, дальше пусто
+    assert [f['velocity_phone_prefix_throttled'] for f in block] == [False] * 5 + [True] * 2
+    assert block[-1]['velocity_phone_prefix'] == 7
+    assert other['velocity_phone_prefix'] == 1 and not other['velocity_phone_prefix_throttled']
+    # Повторный скоринг той же заявки не считает ее второй раз
+    assert tracker.observe(_app(7, '+375291230007', 7)) == block[-1]
+
+    # Через окно ведро пополнилось, а счетчик скользящего окна затухает
+    later = tracker.observe(_app(8, '+375291230008', 3600 + 900))
+    assert not later['velocity_phone_prefix_throttled']
+    assert later['velocity_phone_prefix'] == 6  # 1 + 7 · (1 - 0.25)
+
+
+def test_keys_are_lru_bounded_and_state_survives_snapshot(tmp_path):
+    path = str(tmp_path / 'velocity.json')
+    tracker = VelocityTracker(max_keys=3, snapshot_path=path)
+    for i in range(1, 6):
+        tracker.observe(_app(i, f'+3752{i}0000000', i, telegram_username=f'shop_bot_{i}'))
+    stats = tracker.stats()
+    assert stats['keys']['phone_prefix'] == 3 and stats['seen_applications'] == 3
+    assert stats['keys']['username_pattern'] == 1
+    assert tracker.save_snapshot()
+
+    restored = VelocityTracker(max_keys=3, snapshot_path=path)
+    assert restored.load_snapshot()
+    features = restored.observe(_app(6, '+375260000000', 6, telegram_username='shop_bot_6'))
+    assert features['velocity_username_pattern'] == 6
+    assert features['velocity_username_pattern_throttled']
+
+
+def test_frame_replay_matches_online_observation():
+    # ~2 часа: счетчики переходят через границу окна, ведра успевают и опустеть, и пополниться
+    apps = [_app(i, f'+37529123{i % 3:04d}', (i * 397) % 7200, name='Anna' if i % 2 else ' oleg  Petrov',
+                 telegram_username=f'bot{i % 4}_{i}') for i in range(1, 80)]
+    apps.append({**_app(80, '+375291230000', 0), 'timestamp': None})
+    tracker = VelocityTracker(snapshot_path=None)
+    online = {app['id']: tracker.observe(app)
+              for app in sorted(apps, key=lambda a: a['timestamp'] or datetime.max)}
+
+    columns = velocity_frame(pd.DataFrame(apps))
+
+    for pos, app in enumerate(apps):
+        assert {name: column[pos] for name, column in columns.items()} == online[app['id']]
+
+
+def test_peek_does_not_record_and_clear_forgets_reused_ids(tmp_path):
+    path = tmp_path / 'velocity.json'
+    tracker = VelocityTracker(max_keys=2, snapshot_path=str(path))
+    for i in range(1, 4):
+        tracker.observe(_app(i, f'+37529123{i:04d}', i))
+    # Заявка 1 вытеснена из кэша: пересчет читает счетчики, но не учитывает ее второй раз
+    peeked = tracker.peek(_app(1, '+375291230001', 1))
+    assert peeked['velocity_phone_prefix'] == 3
+    assert tracker.observe(_app(4, '+375291230004', 4))['velocity_phone_prefix'] == 4
+
+    assert tracker.save_snapshot() and path.exists()
+    tracker.on_deleted(None)
+    assert not path.exists() and tracker.stats()['seen_applications'] == 0
+    # Новая заявка с id удаленной получает свои признаки, а не кэш старой
+    assert tracker.observe(_app(4, '+375330000004', 10))['velocity_phone_prefix'] == 1
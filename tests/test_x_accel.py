@@ -0,0 +1,17 @@
+import os
+
+from web.admin_panel import x_accel_path
+
+
+def test_redirect_path_is_relative_to_its_storage_area(tmp_path, monkeypatch):
+    photos, thumbs = tmp_path / 'data' / 'photos', tmp_path / 'thumbs'
+    areas = (('photos', str(photos)), ('thumbnails', str(thumbs)))
+    photo = photos / 'ab' / 'cd' / 'x.webp'
+    photo.parent.mkdir(parents=True)
+    photo.write_bytes(b'x')
+
+    # Рабочий каталог процесса на путь не влияет
+    monkeypatch.chdir(tmp_path / 'data')
+    assert x_accel_path(str(photo), '/protected-media/', areas) == '/protected-media/photos/ab/cd/x.webp'
+    assert x_accel_path(os.path.join(str(thumbs), '128', 'y.jpg'), '/m', areas) == '/m/thumbnails/128/y.jpg'
+    assert x_accel_path(str(tmp_path / 'other.jpg'), '/m', areas) is None
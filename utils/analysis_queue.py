@@ -0,0 +1,289 @@
+"""
+Фоновая очередь анализа фото лифлетов
+
+Новые фото ставятся в приоритетную очередь, потоки-диспетчеры отправляют их
+в процессный пул (utils.analysis_service), результаты копятся в буфере и
+пишутся в БД пакетными UPDATE. Свежие регистрации обрабатываются раньше
+пересканирования бэклога. После рестарта очередь подхватывает заявки,
+оставшиеся в leaflet_status = 'pending'. Фото, анализ которого завершился
+таймаутом или ошибкой, возвращается в очередь бэклога; после
+LEAFLET_ANALYSIS_MAX_ATTEMPTS попыток заявка получает статус 'error' и больше
+не подхватывается (ее можно перепроверить перевалидацией).
+"""
+
+from __future__ import annotations
+
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from config import LEAFLET_ANALYSIS_BATCH_SIZE, LEAFLET_ANALYSIS_FLUSH_INTERVAL, LEAFLET_ANALYSIS_MAX_ATTEMPTS
+from database.db_manager import (
+    get_active_leaflet_templates, get_pending_leaflet_applications, bulk_update_leaflet_results,
+)
+from utils.fraud_rings import get_ring_index
+from utils.image_validation import error_result
+from utils.photo_store import local_photo_path
+
+logger = logging.getLogger(__name__)
+
+# Меньше — раньше
+PRIORITY_FRESH = 0
+PRIORITY_BACKLOG = 10
+
+TEMPLATE_TTL = 60.0  # сек кэша активных шаблонов
+
+# Окончательный статус фото, которое не удалось проанализировать
+ANALYSIS_FAILED_STATUS = 'error'
+
+
+class LeafletAnalysisQueue:
+    """Приоритетная очередь анализа с пакетной записью результатов."""
+
+    def __init__(self, service=None, workers: Optional[int] = None,
+                 batch_size: int = LEAFLET_ANALYSIS_BATCH_SIZE,
+                 flush_interval: float = LEAFLET_ANALYSIS_FLUSH_INTERVAL,
+                 max_attempts: int = LEAFLET_ANALYSIS_MAX_ATTEMPTS,
+                 on_flushed: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+        self._service = service
+        self._on_flushed = on_flushed
+        self._workers = workers
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_attempts = max(1, max_attempts)
+
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._queued: Dict[int, int] = {}  # app_id -> priority
+        self._attempts: Dict[int, int] = {}  # app_id -> неудачных попыток анализа
+        self._depth = {PRIORITY_FRESH: 0, PRIORITY_BACKLOG: 0}
+        self._pending_results: List[Dict[str, Any]] = []
+        self._flush_lock = threading.Lock()
+
+        self._templates: Optional[List[Dict[str, Any]]] = None
+        self._templates_at = 0.0
+
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.started_at: Optional[float] = None
+
+        # Метрики
+        self._completions: deque = deque(maxlen=10000)  # (время завершения, лаг в очереди)
+        self.processed_total = 0
+        self.written_total = 0
+        self.failed_writes = 0
+        self.retried_total = 0
+        self.errored_total = 0
+
+    # --- Постановка в очередь -------------------------------------------------
+
+    def enqueue(self, app_id: int, photo_path: str, priority: int = PRIORITY_FRESH) -> bool:
+        """Ставит заявку в очередь. Повторная постановка того же id игнорируется."""
+        if not photo_path:
+            return False
+        with self._lock:
+            if app_id in self._queued:
+                return False
+            self._queued[app_id] = priority
+            self._depth[priority] = self._depth.get(priority, 0) + 1
+        self._queue.put((priority, next(self._seq), time.time(), app_id, photo_path))
+        return True
+
+    def recover_pending(self) -> int:
+        """Подхватывает заявки, оставшиеся непроанализированными (например, после рестарта)."""
+        rows = get_pending_leaflet_applications()
+        added = sum(1 for row in rows if self.enqueue(row['id'], row['photo_path'], PRIORITY_BACKLOG))
+        if added:
+            logger.info(f"Очередь анализа: подхвачено {added} заявок в статусе pending")
+        return added
+
+    # --- Жизненный цикл --------------------------------------------------------
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        if self._service is None:
+            from utils.analysis_service import get_analysis_service
+            self._service = get_analysis_service()
+        workers = self._workers or self._service.max_workers
+        self._stop.clear()
+        self.started_at = time.time()
+        for i in range(workers):
+            t = threading.Thread(target=self._worker_loop, name=f"LeafletAnalysis-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        flusher = threading.Thread(target=self._flusher_loop, name="LeafletAnalysisFlush", daemon=True)
+        flusher.start()
+        self._threads.append(flusher)
+        self.recover_pending()
+        logger.info(f"Очередь анализа лифлетов запущена ({workers} потоков)")
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+        self.flush()
+
+    # --- Обработка --------------------------------------------------------------
+
+    def _active_templates(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        if self._templates is None or now - self._templates_at > TEMPLATE_TTL:
+            self._templates = get_active_leaflet_templates()
+            self._templates_at = now
+        return self._templates
+
+    def _worker_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                priority, _, enqueued_at, app_id, photo_path = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                # Для удаленного хранилища фото скачивается в локальный кэш
+                local_path = local_photo_path(photo_path) or photo_path
+                future = self._service.submit(local_path, self._active_templates())
+                result = self._service.collect(future)
+            except Exception as e:
+                logger.error(f"Очередь анализа: ошибка обработки заявки {app_id}: {e}")
+                result = error_result()
+            try:
+                self._complete(app_id, photo_path, priority, enqueued_at, result)
+            finally:
+                self._queue.task_done()
+
+    def _complete(self, app_id: int, photo_path: str, priority: int, enqueued_at: float,
+                  result: Dict[str, Any]) -> None:
+        # Таймаут и ошибка пула оставляют статус 'pending'
+        if result.get('leaflet_status') == 'pending':
+            with self._lock:
+                attempts = self._attempts.get(app_id, 0) + 1
+                self._attempts[app_id] = attempts
+                retry = attempts < self.max_attempts
+                if retry:
+                    self.retried_total += 1
+                else:
+                    self.errored_total += 1
+            if retry:
+                self._forget(app_id, priority)
+                self.enqueue(app_id, photo_path, PRIORITY_BACKLOG)
+                logger.warning(f"Очередь анализа: заявка {app_id}, попытка {attempts} не удалась "
+                               f"({result.get('validation_notes')}), повтор")
+                return
+            result = dict(result, leaflet_status=ANALYSIS_FAILED_STATUS)
+            logger.error(f"Очередь анализа: заявка {app_id} не проанализирована за {attempts} попыток, "
+                         f"статус '{ANALYSIS_FAILED_STATUS}'")
+        with self._lock:
+            self._attempts.pop(app_id, None)
+        result['id'] = app_id
+        self._record(app_id, priority, enqueued_at, result)
+
+    def _forget(self, app_id: int, priority: int) -> None:
+        with self._lock:
+            self._queued.pop(app_id, None)
+            self._depth[priority] = max(0, self._depth.get(priority, 0) - 1)
+
+    def _record(self, app_id: int, priority: int, enqueued_at: float, result: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._pending_results.append(result)
+            self._completions.append((now, now - enqueued_at))
+            self.processed_total += 1
+            batch_ready = len(self._pending_results) >= self.batch_size
+        self._forget(app_id, priority)
+        if batch_ready:
+            self.flush()
+
+    def _flusher_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self) -> int:
+        """Пишет накопленные результаты одним пакетным UPDATE."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending_results = self._pending_results, []
+            if not batch:
+                return 0
+            try:
+                written = bulk_update_leaflet_results(batch)
+                self.written_total += written
+            except Exception as e:
+                # Строки остаются pending и будут подхвачены при следующем запуске
+                self.failed_writes += len(batch)
+                logger.error(f"Очередь анализа: не удалось записать пакет из {len(batch)}: {e}")
+                return 0
+            if self._on_flushed is not None:
+                try:
+                    self._on_flushed(batch)
+                except Exception as e:
+                    logger.error(f"Очередь анализа: ошибка обработчика записанного пакета: {e}")
+            return written
+
+    # --- Метрики ----------------------------------------------------------------
+
+    def stats(self) -> Dict[str, Any]:
+        """Пропускная способность и лаг очереди для дашборда."""
+        now = time.time()
+        with self._lock:
+            recent = [(ts, lag) for ts, lag in self._completions if now - ts <= 60.0]
+            depth_fresh = self._depth.get(PRIORITY_FRESH, 0)
+            depth_backlog = self._depth.get(PRIORITY_BACKLOG, 0)
+            buffered = len(self._pending_results)
+        lags = [lag for _, lag in recent]
+        return {
+            'running': bool(self._threads),
+            'queue_fresh': depth_fresh,
+            'queue_backlog': depth_backlog,
+            'buffered_results': buffered,
+            'processed_total': self.processed_total,
+            'written_total': self.written_total,
+            'failed_writes': self.failed_writes,
+            'retried_total': self.retried_total,
+            'errored_total': self.errored_total,
+            'throughput_per_min': len(recent),
+            'avg_lag_seconds': round(sum(lags) / len(lags), 2) if lags else 0.0,
+            'max_lag_seconds': round(max(lags), 2) if lags else 0.0,
+        }
+
+
+def _index_phashes(results: List[Dict[str, Any]]) -> None:
+    # pHash появляется только после анализа — связываем похожие фото в кольца
+    get_ring_index().add_many({'id': r['id'], 'photo_phash': r['photo_phash']}
+                              for r in results if r.get('photo_phash'))
+
+
+_analysis_queue: Optional[LeafletAnalysisQueue] = None
+_analysis_queue_lock = threading.Lock()
+
+
+def get_analysis_queue() -> LeafletAnalysisQueue:
+    """Синглтон очереди (создание не запускает пул процессов)."""
+    global _analysis_queue
+    if _analysis_queue is None:
+        with _analysis_queue_lock:
+            if _analysis_queue is None:
+                _analysis_queue = LeafletAnalysisQueue(on_flushed=_index_phashes)
+    return _analysis_queue
+
+
+def start_analysis_queue() -> LeafletAnalysisQueue:
+    q = get_analysis_queue()
+    q.start()
+    return q
+
+
+__all__ = [
+    'PRIORITY_FRESH',
+    'PRIORITY_BACKLOG',
+    'ANALYSIS_FAILED_STATUS',
+    'LeafletAnalysisQueue',
+    'get_analysis_queue',
+    'start_analysis_queue',
+]
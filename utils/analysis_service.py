@@ -0,0 +1,199 @@
+"""
+Сервис анализа фото лифлетов в пуле процессов
+
+Анализ фото — чистый CPU (декодирование JPEG, NumPy-свертки, ресайз, EXIF),
+поэтому в потоках он упирается в GIL. Сервис выполняет analyze_leaflet_image
+в ProcessPoolExecutor: задачи принимают путь к файлу (а не байты), очередь
+ограничена, у каждой задачи есть таймаут. Обращения к БД (шаблон, похожие
+pHash) выполняются в родительском процессе. Пул (и шаблоны для прогрева
+процессов) создается при первой задаче, а не при создании сервиса.
+"""
+
+from __future__ import annotations
+
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import (
+    LEAFLET_ANALYSIS_WORKERS, LEAFLET_ANALYSIS_QUEUE_SIZE, LEAFLET_ANALYSIS_TIMEOUT,
+)
+from database.db_manager import get_active_leaflet_templates, count_similar_photo_phash
+from utils.image_validation import analyze_leaflet_image, decide_leaflet_status, error_result
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisQueueFull(RuntimeError):
+    """Очередь сервиса анализа заполнена"""
+
+
+def _warm_up_worker(templates: Optional[List[Dict[str, Any]]]) -> None:
+    """Инициализатор процесса: импорты, прогрев NumPy/PIL и кэша признаков шаблонов."""
+    try:
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new('RGB', (64, 48), (255, 255, 255)).save(buf, 'JPEG')
+        analyze_leaflet_image(buf.getvalue(), templates)
+    except Exception as e:
+        logger.warning(f"Прогрев процесса анализа не удался: {e}")
+
+
+def _analyze_path(photo_path: str, templates: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Задача процесса: чистые метрики фото по пути к файлу."""
+    return analyze_leaflet_image(photo_path, templates)
+
+
+class LeafletAnalysisService:
+    """Пул процессов для анализа фото с ограниченной очередью и таймаутами."""
+
+    def __init__(self, max_workers: int = LEAFLET_ANALYSIS_WORKERS,
+                 queue_size: int = LEAFLET_ANALYSIS_QUEUE_SIZE,
+                 task_timeout: float = LEAFLET_ANALYSIS_TIMEOUT):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.task_timeout = task_timeout
+        # Слоты = выполняемые + ожидающие задачи
+        self._slots = threading.BoundedSemaphore(self.max_workers + max(0, queue_size))
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'timeouts': 0, 'rejected': 0, 'restarts': 0}
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # spawn: бот многопоточный, fork из потока небезопасен
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_warm_up_worker,
+            initargs=(get_active_leaflet_templates(),),
+        )
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._create_executor()
+            return self._executor
+
+    def _restart_if_broken(self) -> None:
+        """Пересоздает пул, если процесс-воркер упал (OOM, segfault в декодере)."""
+        with self._lock:
+            broken = self._executor
+            if broken is None or not getattr(broken, '_broken', False):
+                return
+            logger.warning("Пул анализа фото сломан, пересоздаем")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._create_executor()
+            self.stats['restarts'] += 1
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def submit(self, photo_path: str, templates: Optional[List[Dict[str, Any]]] = None,
+               block: bool = True, timeout: Optional[float] = None) -> Future:
+        """Ставит фото в очередь пула. Возвращает Future с чистыми метриками.
+
+        При заполненной очереди ждет свободный слот (block=True) не дольше timeout,
+        иначе выбрасывает AnalysisQueueFull.
+        """
+        if not self._slots.acquire(blocking=block, timeout=timeout if block else None):
+            self._count('rejected')
+            raise AnalysisQueueFull("Очередь анализа фото заполнена")
+        try:
+            future = self._get_executor().submit(_analyze_path, photo_path, templates)
+        except BrokenProcessPool:
+            self._restart_if_broken()
+            try:
+                future = self._get_executor().submit(_analyze_path, photo_path, templates)
+            except Exception:
+                self._slots.release()
+                raise
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _f: self._slots.release())
+        self._count('submitted')
+        return future
+
+    def wait_metrics(self, future: Future) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Дожидается чистых метрик с таймаутом: (metrics, None) или (None, результат-ошибка).
+
+        Зависшую задачу ProcessPoolExecutor прервать не может: по таймауту
+        возвращаем analyze_timeout, а процесс освободится сам.
+        """
+        try:
+            metrics = future.result(timeout=self.task_timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._count('timeouts')
+            logger.warning(f"Анализ фото превысил таймаут {self.task_timeout}s")
+            return None, error_result('analyze_timeout')
+        except BrokenProcessPool as e:
+            self._count('failed')
+            logger.error(f"Процесс анализа упал: {e}")
+            self._restart_if_broken()
+            return None, error_result()
+        except Exception as e:
+            self._count('failed')
+            logger.error(f"Ошибка анализа лифлета в пуле: {e}")
+            return None, error_result()
+        self._count('completed')
+        return metrics, None
+
+    def collect(self, future: Future) -> Dict[str, Any]:
+        """Дожидается метрик и принимает решение по статусу."""
+        metrics, error = self.wait_metrics(future)
+        if error is not None:
+            return error
+        phash = metrics.get('photo_phash') or ''
+        similar_cnt = count_similar_photo_phash(phash) if phash else 0
+        return decide_leaflet_status(metrics, similar_cnt)
+
+    def analyze(self, photo_path: str) -> Dict[str, Any]:
+        """Синхронный анализ одного фото через пул (для веб-эндпоинтов)."""
+        templates = get_active_leaflet_templates()
+        try:
+            future = self.submit(photo_path, templates, timeout=self.task_timeout)
+        except AnalysisQueueFull:
+            return error_result('analyze_queue_full')
+        return self.collect(future)
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_service: Optional[LeafletAnalysisService] = None
+_service_lock = threading.Lock()
+
+
+def get_analysis_service() -> LeafletAnalysisService:
+    """Ленивый синглтон сервиса анализа (пул процессов создается при первой задаче)."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = LeafletAnalysisService()
+    return _service
+
+
+def shutdown_analysis_service() -> None:
+    global _service
+    with _service_lock:
+        if _service is not None:
+            _service.shutdown(wait=False)
+            _service = None
+
+
+__all__ = [
+    'AnalysisQueueFull',
+    'LeafletAnalysisService',
+    'get_analysis_service',
+    'shutdown_analysis_service',
+]
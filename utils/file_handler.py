@@ -4,47 +4,443 @@
 
 import os
 import csv
+import hashlib
 import logging
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict
+from typing import Iterator, List, Dict, Optional
 
 import pandas as pd
+import requests
 
-from config import PHOTOS_DIR, EXPORTS_DIR
+# boto3 нужен только для PHOTO_STORAGE_BACKEND=s3
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+    BOTO3_AVAILABLE = True
+except ImportError:
+    BOTO3_AVAILABLE = False
+
+from config import (
+    BOT_TOKEN, EXPORTS_DIR, PHOTOS_DIR, PHOTO_STORAGE_BACKEND, PHOTO_DOWNLOAD_TIMEOUT,
+    PHOTO_S3_BUCKET, PHOTO_S3_PREFIX, PHOTO_S3_ENDPOINT_URL, PHOTO_S3_REGION,
+    PHOTO_S3_ACCESS_KEY, PHOTO_S3_SECRET_KEY,
+    PHOTO_CACHE_DIR, PHOTO_CACHE_MAX_MB, PHOTO_UPLOAD_WORKERS, PHOTO_UPLOAD_QUEUE_SIZE,
+)
 
 logger = logging.getLogger(__name__)
 
 
-def save_photo(photo_file, user_id: int) -> str:
+def write_atomic(path: str, data: bytes) -> None:
+    """Пишет файл через временный файл и rename (атомарно в пределах ФС)"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix=os.path.splitext(path)[1])
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# --- Хранилище фото -----------------------------------------------------------
+# Ключ — путь относительно корня хранилища ('ab/cd/<sha256>.jpg'); в БД
+# хранится PHOTOS_DIR/<ключ>, одинаковый для всех бэкендов.
+
+class PhotoStorage:
+    """Интерфейс хранилища фото"""
+
+    def put(self, key: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def put_file(self, key: str, src_path: str) -> None:
+        """Сохраняет готовый файл; src_path переходит во владение хранилища и удаляется"""
+        self.upload_file(key, src_path)
+        os.remove(src_path)
+
+    def upload_file(self, key: str, src_path: str) -> None:
+        """Копирует локальный файл в хранилище; src_path остается на месте"""
+        with open(src_path, 'rb') as f:
+            self.put(key, f.read())
+
+    def staging_dir(self) -> str:
+        """Каталог для временных файлов, которые потом передаются в put_file"""
+        return tempfile.gettempdir()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Содержимое файла или None, если его нет"""
+        path = self.local_path(key)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Локальный файл с содержимым (для декодеров и send_file) или None"""
+        raise NotImplementedError
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Ждет завершения фоновых загрузок; True — очередь пуста"""
+        return True
+
+
+class LocalPhotoStorage(PhotoStorage):
+    """Файлы в локальном каталоге (по умолчанию PHOTOS_DIR)"""
+
+    def __init__(self, root: str = PHOTOS_DIR):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        base = os.path.realpath(self.root)
+        path = os.path.realpath(os.path.join(base, key))
+        if os.path.commonpath([base, path]) != base:
+            raise ValueError(f"Ключ вне хранилища: {key}")
+        return path
+
+    def put(self, key: str, data: bytes) -> None:
+        write_atomic(self._path(key), data)
+
+    def put_file(self, key: str, src_path: str) -> None:
+        # Временный файл лежит в staging_dir() на той же ФС — переносим без копирования
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+
+    def upload_file(self, key: str, src_path: str) -> None:
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix=os.path.splitext(path)[1])
+        os.close(fd)
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def staging_dir(self) -> str:
+        return self.root
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        return path if os.path.isfile(path) else None
+
+
+class S3PhotoStorage(PhotoStorage):
+    """S3-совместимое хранилище (AWS S3, MinIO и т.п.); доступ только через get/put"""
+
+    def __init__(self, bucket: str = PHOTO_S3_BUCKET, prefix: str = PHOTO_S3_PREFIX,
+                 endpoint_url: str = PHOTO_S3_ENDPOINT_URL, region: str = PHOTO_S3_REGION,
+                 access_key: str = PHOTO_S3_ACCESS_KEY, secret_key: str = PHOTO_S3_SECRET_KEY,
+                 client=None):
+        if client is None:
+            if not BOTO3_AVAILABLE:
+                raise ImportError("boto3 не установлен. Выполните: pip install boto3")
+            client = boto3.client(
+                's3',
+                endpoint_url=endpoint_url or None,
+                region_name=region or None,
+                aws_access_key_id=access_key or None,
+                aws_secret_access_key=secret_key or None,
+            )
+        if not bucket:
+            raise ValueError("PHOTO_S3_BUCKET не задан")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix and prefix.strip('/') else ''
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    @staticmethod
+    def _is_missing(error: Exception) -> bool:
+        code = str(getattr(error, 'response', {}).get('Error', {}).get('Code', ''))
+        return code in ('404', 'NoSuchKey', 'NotFound')
+
+    def put(self, key: str, data: bytes) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def upload_file(self, key: str, src_path: str) -> None:
+        # put_object читает открытый файл сам, байты целиком в память не попадают
+        with open(src_path, 'rb') as f:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=f)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body'].read()
+        except Exception as e:
+            if self._is_missing(e):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except Exception as e:
+            if self._is_missing(e):
+                return False
+            raise
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def local_path(self, key: str) -> Optional[str]:
+        return None  # только через CachedPhotoStorage
+
+
+class CachedPhotoStorage(PhotoStorage):
+    """
+    Локальный read-through кэш перед удаленным хранилищем
+
+    Запись сначала попадает в кэш (фото сразу доступно этому инстансу), а в
+    удаленное хранилище уходит из ограниченного пула потоков: при заполненной
+    очереди put() ждет свободный слот. Чтение берет файл из кэша, при промахе
+    скачивает его; при превышении max_bytes удаляются давно не читанные файлы.
+    """
+
+    UPLOAD_RETRIES = 3
+    UPLOAD_RETRY_DELAY = 1.0
+
+    def __init__(self, backend: PhotoStorage, cache_dir: str = PHOTO_CACHE_DIR,
+                 max_bytes: int = PHOTO_CACHE_MAX_MB * 1024 * 1024,
+                 upload_workers: int = PHOTO_UPLOAD_WORKERS, upload_queue_size: int = PHOTO_UPLOAD_QUEUE_SIZE):
+        self.backend = backend
+        self.cache = LocalPhotoStorage(cache_dir)
+        self.max_bytes = max_bytes
+        self._uploader = ThreadPoolExecutor(max_workers=max(1, upload_workers), thread_name_prefix="PhotoUpload")
+        self._slots = threading.BoundedSemaphore(max(1, upload_workers) + max(0, upload_queue_size))
+        self._lock = threading.Lock()
+        self._pending: Dict[str, object] = {}
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # LRU: ключ -> размер
+        self._cache_bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'uploads': 0, 'upload_failures': 0, 'evictions': 0}
+        self._scan_cache()
+
+    def _scan_cache(self) -> None:
+        root = self.cache.root
+        if not os.path.isdir(root):
+            return
+        found = []
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                found.append((stat.st_atime, os.path.relpath(path, root).replace(os.sep, '/'), stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._cache_bytes += size
+
+    def _remember(self, key: str, size: int) -> None:
+        with self._lock:
+            self._cache_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+        self._evict()
+
+    def _evict(self) -> None:
+        while True:
+            with self._lock:
+                if self._cache_bytes <= self.max_bytes or not self._entries:
+                    return
+                key = next((k for k in self._entries if k not in self._pending), None)
+                if key is None:
+                    return
+                self._cache_bytes -= self._entries.pop(key)
+                self.stats['evictions'] += 1
+            self.cache.delete(key)
+
+    def _upload(self, key: str, data: Optional[bytes]) -> None:
+        try:
+            for attempt in range(1, self.UPLOAD_RETRIES + 1):
+                try:
+                    if data is not None:
+                        self.backend.put(key, data)
+                    else:
+                        # Файл из put_file отдаем из кэша (не вытесняется, пока загрузка в очереди)
+                        path = self.cache.local_path(key)
+                        if path is None:
+                            raise FileNotFoundError(f"Файл {key} пропал из кэша до загрузки")
+                        self.backend.upload_file(key, path)
+                    self.stats['uploads'] += 1
+                    return
+                except Exception as e:
+                    if attempt == self.UPLOAD_RETRIES:
+                        self.stats['upload_failures'] += 1
+                        logger.error(f"Не удалось загрузить фото {key} в хранилище: {e}")
+                        return
+                    time.sleep(self.UPLOAD_RETRY_DELAY * attempt)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            self._slots.release()
+
+    def _enqueue_upload(self, key: str, data: Optional[bytes], size: int) -> None:
+        self._slots.acquire()
+        try:
+            with self._lock:
+                self._pending[key] = self._uploader.submit(self._upload, key, data)
+        except BaseException:
+            self._slots.release()
+            raise
+        # Учитываем размер после постановки в очередь, чтобы вытеснение не
+        # удалило файл, который еще не загружен
+        self._remember(key, size)
+
+    def put(self, key: str, data: bytes) -> None:
+        self.cache.put(key, data)
+        self._enqueue_upload(key, data, len(data))
+
+    def put_file(self, key: str, src_path: str) -> None:
+        size = os.path.getsize(src_path)
+        self.cache.put_file(key, src_path)
+        self._enqueue_upload(key, None, size)
+
+    def upload_file(self, key: str, src_path: str) -> None:
+        size = os.path.getsize(src_path)
+        self.cache.upload_file(key, src_path)
+        self._enqueue_upload(key, None, size)
+
+    def staging_dir(self) -> str:
+        return self.cache.root
+
+    def exists(self, key: str) -> bool:
+        if key in self._pending or self.cache.exists(key):
+            return True
+        return self.backend.exists(key)
+
+    def delete(self, key: str) -> None:
+        future = self._pending.get(key)
+        if future is not None:
+            future.result()  # не даем отложенной загрузке воскресить удаленный файл
+        with self._lock:
+            self._cache_bytes -= self._entries.pop(key, 0)
+        self.cache.delete(key)
+        self.backend.delete(key)
+
+    def local_path(self, key: str) -> Optional[str]:
+        path = self.cache.local_path(key)
+        if path is not None:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+            return path
+        self.stats['misses'] += 1
+        data = self.backend.get(key)
+        if data is None:
+            return None
+        self.cache.put(key, data)
+        self._remember(key, len(data))
+        return self.cache.local_path(key)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                futures = list(self._pending.values())
+            if not futures:
+                return True
+            for future in futures:
+                remaining = None if deadline is None else max(0.0, deadline - time.time())
+                try:
+                    future.result(timeout=remaining)
+                except Exception:
+                    return False
+
+
+_photo_storage: Optional[PhotoStorage] = None
+_photo_storage_lock = threading.Lock()
+
+
+def get_photo_storage() -> PhotoStorage:
+    """Хранилище фото из настроек (ленивый синглтон)"""
+    global _photo_storage
+    if _photo_storage is None:
+        with _photo_storage_lock:
+            if _photo_storage is None:
+                if PHOTO_STORAGE_BACKEND == 's3':
+                    _photo_storage = CachedPhotoStorage(S3PhotoStorage())
+                    logger.info(f"Хранилище фото: S3 {PHOTO_S3_BUCKET}/{PHOTO_S3_PREFIX}, кэш {PHOTO_CACHE_DIR}")
+                else:
+                    _photo_storage = LocalPhotoStorage(PHOTOS_DIR)
+    return _photo_storage
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def get_telegram_file_path(file_id: str, token: str = BOT_TOKEN) -> str:
+    """Путь файла на серверах Telegram по file_id (getFile)"""
+    from telebot import apihelper
+    return apihelper.get_file(token, file_id)['file_path']
+
+
+def iter_telegram_file(file_path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                       token: str = BOT_TOKEN) -> Iterator[bytes]:
+    """
+    Скачивает файл из Telegram блоками (file_path — из bot.get_file)
+
+    Учитывает apihelper.FILE_URL (локальный Bot API сервер) и apihelper.proxy,
+    как bot.download_file, но не собирает ответ целиком в памяти.
+    """
+    from telebot import apihelper
+    url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(token, file_path)
+    with requests.get(url, stream=True, proxies=apihelper.proxy, timeout=PHOTO_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+
+
+def file_sha256(file_path: str, chunk_size: int = 1024 * 1024) -> str:
     """
-    Сохраняет фото в папку photos
+    SHA-256 содержимого файла (читается блоками, без загрузки целиком)
     
     Args:
-        photo_file: Объект файла фото из Telegram
-        user_id: ID пользователя
+        file_path: Путь к файлу
+        chunk_size: Размер блока чтения
     
     Returns:
-        str: Путь к сохраненному файлу
+        str: hex-дайджест
     """
-    try:
-        # Создаем папку если она не существует
-        os.makedirs(PHOTOS_DIR, exist_ok=True)
-        
-        # Генерируем имя файла
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"user_{user_id}_{timestamp}.jpg"
-        file_path = os.path.join(PHOTOS_DIR, filename)
-        
-        # Сохраняем файл
-        with open(file_path, 'wb') as f:
-            f.write(photo_file)
-        
-        logger.info(f"Фото сохранено: {file_path}")
-        return file_path
-        
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении фото: {e}")
-        raise
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def export_to_csv(applications: List[Dict]) -> str:
@@ -0,0 +1,105 @@
+"""
+Контекст антифрода для одной заявки или пачки
+
+Проверки AntiFraudSystem — чистые функции участника и контекста. Все
+сигналы из БД (дубликаты карты, телефона, telegram_id и фото, скорость
+регистраций) собираются одним запросом на пачку (get_fraud_signal_counts),
+похожие фото — по индексу pHash в памяти, без запроса на каждую заявку,
+скорость по измерениям — трекером utils.velocity, если он передан.
+
+Заявка с id уже лежит в БД и учтена в счетчиках — ее собственная строка
+вычитается; новая (без id) сравнивается со всеми.
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import Any, Dict, List, Optional
+
+from database.db_manager import get_fraud_signal_counts
+from utils.phash_index import PhashIndex
+from utils.velocity import VelocityTracker
+
+logger = logging.getLogger(__name__)
+
+# Заявок на запрос: 4 значения на заявку — в пределах лимита параметров SQLite
+CONTEXT_CHUNK_SIZE = 200
+
+SIMILAR_PHASH_DISTANCE = 5
+VELOCITY_WINDOW_SECONDS = 60
+
+
+def _card(participant: Dict) -> str:
+    return (participant.get('loyalty_card_number') or '').strip()
+
+
+class FraudContextProvider:
+    """Собирает context для AntiFraudSystem.calculate_risk_score."""
+
+    def __init__(self, phash_index: Optional[PhashIndex] = None, similar_photos: bool = True,
+                 velocity: Optional[VelocityTracker] = None, record_velocity: bool = True):
+        """
+        similar_photos=False — не считать похожие фото (индекс pHash грузит всю таблицу);
+        velocity — трекер скорости регистраций: заявки учитываются в нем, признаки идут в контекст;
+        record_velocity=False — только прочитать признаки (пересчет уже учтенной заявки)
+        """
+        self._phash_index = phash_index
+        self.similar_photos = similar_photos
+        self.velocity = velocity
+        self.record_velocity = record_velocity
+
+    def _index(self, participants: List[Dict]) -> Optional[PhashIndex]:
+        if not self.similar_photos:
+            return None
+        if self._phash_index is None and any(p.get('photo_phash') for p in participants):
+            self._phash_index = PhashIndex.from_db()
+        return self._phash_index
+
+    def for_participant(self, participant: Dict) -> Dict[str, Any]:
+        return self.for_batch([participant])[0]
+
+    def for_batch(self, participants: List[Dict]) -> List[Dict[str, Any]]:
+        """Контексты в порядке participants"""
+        index = self._index(participants)
+        contexts: List[Dict[str, Any]] = []
+        for start in range(0, len(participants), CONTEXT_CHUNK_SIZE):
+            chunk = participants[start:start + CONTEXT_CHUNK_SIZE]
+            counts = get_fraud_signal_counts(
+                cards=[_card(p) for p in chunk],
+                phones=[p.get('phone_number') or '' for p in chunk],
+                photo_hashes=[p.get('photo_hash') or '' for p in chunk],
+                telegram_ids=[p.get('telegram_id') for p in chunk if p.get('telegram_id')],
+                recent_seconds=VELOCITY_WINDOW_SECONDS,
+            )
+            contexts.extend(self._build(p, counts, index) for p in chunk)
+        if self.velocity is not None:
+            features = (self.velocity.observe_many(participants) if self.record_velocity
+                        else [self.velocity.peek(p) for p in participants])
+            for context, values in zip(contexts, features):
+                context.update(values)
+        return contexts
+
+    @staticmethod
+    def _build(participant: Dict, counts: Dict[str, Any], index: Optional[PhashIndex]) -> Dict[str, Any]:
+        saved = 1 if participant.get('id') else 0
+
+        def others(kind: str, value: Any) -> int:
+            if not value:
+                return 0
+            return max(0, counts[kind].get(str(value), 0) - saved)
+
+        phash = participant.get('photo_phash') or ''
+        return {
+            'is_telegram_id_unique': others('telegram', participant.get('telegram_id')) == 0,
+            'duplicate_card_count': others('card', _card(participant)),
+            'duplicate_phone_count': others('phone', participant.get('phone_number')),
+            'duplicate_photo_count': others('photo', participant.get('photo_hash')),
+            'similar_photo_count': index.count_similar(phash, SIMILAR_PHASH_DISTANCE, exclude_id=participant.get('id'))
+            if index is not None and phash else 0,
+            'recent_registrations_60s': counts['recent'],
+        }
+
+
+__all__ = [
+    'FraudContextProvider',
+]
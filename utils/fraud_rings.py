@@ -0,0 +1,491 @@
+"""
+Инкрементальный индекс колец мошенников
+
+group_similar_applications кластеризует всю таблицу попарным сравнением.
+Этот индекс держит ту же связность онлайн: система непересекающихся
+множеств (union-find со сжатием путей и объединением по размеру) над
+заявками, где ребро — общий атрибут:
+
+* телефон, номер карты, username Telegram, точный хеш фото;
+* полоса pHash — 64-битный хеш делится на PHASH_BANDS частей, фото с
+  расстоянием Хэмминга < PHASH_BANDS гарантированно совпадают хотя бы в одной;
+* всплеск регистраций — один блок номеров (телефон без последних
+  BURST_PHONE_SUFFIX цифр) в одном окне FRAUD_RING_BURST_WINDOW.
+
+Для каждого атрибута запоминается первая заявка с ним (якорь); новая заявка
+объединяется с якорями своих атрибутов, так что добавление стоит
+O(атрибутов · α(N)), размер и корень кольца заявки — O(α(N)).
+
+Индекс пополняется очередью скоринга (атрибуты заявки после скачивания фото)
+и очередью анализа (pHash). Состояние периодически пишется снапшотом; после
+рестарта индекс загружает снапшот и доигрывает только заявки после него.
+
+Из union-find нельзя удалить вершину: удаленная заявка сразу пропадает из
+ответов, а индекс в фоне перестраивается из БД (иначе кольцо держалось бы
+на удаленной заявке и ее якорях). Очистка БД сбрасывает индекс и снапшот.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import (
+    FRAUD_RING_MIN_SIZE, FRAUD_RING_BURST_WINDOW, FRAUD_RING_SNAPSHOT_PATH, FRAUD_RING_SNAPSHOT_INTERVAL,
+)
+from database.db_manager import get_risk_participants_page, on_applications_deleted
+
+logger = logging.getLogger(__name__)
+
+# 2 полосы по 32 бита: случайное совпадение полосы ~1/4·10^9 — без гигантской компоненты из шума
+PHASH_BANDS = 2
+BURST_PHONE_SUFFIX = 3
+# Заявка без pHash ждет его (анализ фото) не дольше, затем не держит точку доигрывания
+AWAITING_PHASH_TTL = 3600.0
+SNAPSHOT_FORMAT = 1
+REPLAY_PAGE_SIZE = 5000
+
+
+def _digits(value: Any) -> str:
+    return ''.join(ch for ch in str(value or '') if ch.isdigit())
+
+
+def _epoch(value: Any) -> Optional[float]:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str) and value:
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def ring_attributes(app: Dict[str, Any], burst_window: int = FRAUD_RING_BURST_WINDOW) -> List[Tuple[str, str]]:
+    """Атрибуты заявки, по которым она связывается с другими: [(вид, значение)]"""
+    attrs = []
+    phone = _digits(app.get('phone_number'))
+    if phone:
+        attrs.append(('phone', phone))
+    card = (app.get('loyalty_card_number') or '').strip()
+    if card:
+        attrs.append(('card', card))
+    username = (app.get('telegram_username') or '').strip().lstrip('@').lower()
+    if username:
+        attrs.append(('username', username))
+    if app.get('photo_hash'):
+        attrs.append(('photo', app['photo_hash']))
+    phash = app.get('photo_phash') or ''
+    if len(phash) == 16:
+        width = 16 // PHASH_BANDS
+        attrs.extend((f'phash{i}', phash[i * width:(i + 1) * width].lower()) for i in range(PHASH_BANDS))
+    registered = _epoch(app.get('timestamp'))
+    if registered is not None and len(phone) > BURST_PHONE_SUFFIX:
+        attrs.append(('burst', f"{int(registered // burst_window)}:{phone[:-BURST_PHONE_SUFFIX]}"))
+    return attrs
+
+
+def _attribute_key(kind: str, value: str) -> int:
+    """64-битный ключ атрибута: словарь и снапшот не хранят строки"""
+    digest = hashlib.blake2b(f"{kind}:{value}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class FraudRingIndex:
+    """Union-find над заявками, связанными общими атрибутами."""
+
+    def __init__(self, snapshot_path: Optional[str] = FRAUD_RING_SNAPSHOT_PATH,
+                 snapshot_interval: float = FRAUD_RING_SNAPSHOT_INTERVAL,
+                 burst_window: int = FRAUD_RING_BURST_WINDOW):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.burst_window = burst_window
+
+        self._lock = threading.RLock()
+        self._parent: Dict[int, int] = {}
+        self._size: Dict[int, int] = {}  # только корни колец из 2+ заявок
+        self._members: Dict[int, List[int]] = {}  # корень -> заявки, только кольца из 2+
+        self._links: Dict[int, Counter] = {}  # корень -> сколько объединений дал каждый вид атрибута
+        self._anchors: Dict[int, int] = {}  # ключ атрибута -> первая заявка с ним
+        self._awaiting_phash: Dict[int, float] = {}
+        self.last_id = 0
+        self._deleted: set = set()  # удалены из БД, ждут перестроения
+        self._rebuild_log: Optional[List[Dict[str, Any]]] = None  # заявки, добавленные во время перестроения
+        self._rebuild_requested = False
+        self._rebuild_thread: Optional[threading.Thread] = None
+        self._generation = 0  # растет при сбросе: перестроение по старой БД не подменяет пустой индекс
+
+        self._dirty = False
+        self._snapshot_at = time.time()
+        self.loaded_from_snapshot = False
+        self.replayed = 0
+
+    # --- Union-find ---------------------------------------------------------------
+
+    def _find(self, node: int) -> int:
+        parent = self._parent
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def _union(self, a: int, b: int, kind: str) -> None:
+        ra, rb = self._find(a), self._find(b)
+        if ra == rb:
+            return
+        if self._size.get(ra, 1) < self._size.get(rb, 1):
+            ra, rb = rb, ra
+        self._parent[rb] = ra
+        self._size[ra] = self._size.get(ra, 1) + self._size.pop(rb, 1)
+        # Меньшее кольцо вливается в большее: каждая заявка переносится O(log N) раз
+        self._members.setdefault(ra, [ra]).extend(self._members.pop(rb, [rb]))
+        links = self._links.setdefault(ra, Counter())
+        links.update(self._links.pop(rb, {}))
+        links[kind] += 1
+
+    # --- Пополнение ---------------------------------------------------------------
+
+    def add(self, app: Dict[str, Any]) -> int:
+        """
+        Добавляет заявку (или ее новые атрибуты — повторный вызов идемпотентен)
+
+        Returns:
+            int: размер кольца заявки
+        """
+        app_id = int(app['id'])
+        attrs = ring_attributes(app, self.burst_window)
+        with self._lock:
+            if self._rebuild_log is not None:
+                self._rebuild_log.append(app)
+            if app_id not in self._parent:
+                self._parent[app_id] = app_id
+                self.last_id = max(self.last_id, app_id)
+            if app.get('photo_phash'):
+                self._awaiting_phash.pop(app_id, None)
+            elif 'timestamp' in app:
+                # Полная строка заявки без pHash: анализ фото еще впереди
+                self._awaiting_phash.setdefault(app_id, _epoch(app['timestamp']) or time.time())
+            for kind, value in attrs:
+                anchor = self._anchors.setdefault(_attribute_key(kind, value), app_id)
+                if anchor != app_id:
+                    self._union(app_id, anchor, kind)
+            self._dirty = True
+            return self._size.get(self._find(app_id), 1)
+
+    def add_many(self, apps: Iterable[Dict[str, Any]]) -> int:
+        count = 0
+        for app in apps:
+            self.add(app)
+            count += 1
+        self.maybe_snapshot()
+        return count
+
+    def replay(self, after_id: int = 0) -> int:
+        """Доигрывает заявки из БД с id > after_id (после снапшота или с нуля)"""
+        total = 0
+        while True:
+            page = get_risk_participants_page(after_id, REPLAY_PAGE_SIZE)
+            if not page:
+                break
+            with self._lock:
+                for app in page:
+                    self.add(app)
+            total += len(page)
+            after_id = page[-1]['id']
+        self.replayed += total
+        return total
+
+    # --- Запросы ---------------------------------------------------------------------
+
+    def _known(self, app_id: int) -> bool:
+        return app_id in self._parent and app_id not in self._deleted
+
+    def _live_members(self, root: int) -> List[int]:
+        members = self._members.get(root, [root])
+        if self._deleted:
+            members = [m for m in members if m not in self._deleted]
+        return sorted(members)
+
+    def ring_of(self, app_id: int) -> Dict[str, Any]:
+        """Кольцо заявки: {ring_id, size}; ring_id — корень, общий для всех заявок кольца"""
+        with self._lock:
+            if not self._known(app_id):
+                return {'ring_id': None, 'size': 0}
+            root = self._find(app_id)
+            size = len(self._live_members(root)) if self._deleted else self._size.get(root, 1)
+            return {'ring_id': root, 'size': size}
+
+    def same_ring(self, a: int, b: int) -> bool:
+        with self._lock:
+            return self._known(a) and self._known(b) and self._find(a) == self._find(b)
+
+    def members(self, app_id: int) -> List[int]:
+        with self._lock:
+            if not self._known(app_id):
+                return []
+            return self._live_members(self._find(app_id))
+
+    def rings(self, min_size: int = FRAUD_RING_MIN_SIZE, limit: int = 50) -> List[Dict[str, Any]]:
+        """Кольца не меньше min_size, крупные первыми"""
+        with self._lock:
+            members = {root: self._live_members(root) for root, n in self._size.items() if n >= min_size}
+            roots = sorted((r for r, m in members.items() if len(m) >= min_size),
+                           key=lambda r: (-len(members[r]), r))[:limit]
+            return [{
+                'ring_id': root,
+                'size': len(members[root]),
+                'links': dict(self._links.get(root, {})),
+                'members': members[root],
+            } for root in roots]
+
+    def stats(self, min_size: int = FRAUD_RING_MIN_SIZE) -> Dict[str, Any]:
+        with self._lock:
+            sizes = list(self._size.values())
+            return {
+                'applications': len(self._parent),
+                'attributes': len(self._anchors),
+                'linked_applications': sum(sizes),
+                'rings': len(sizes),
+                'rings_over_min_size': sum(1 for n in sizes if n >= min_size),
+                'largest_ring': max(sizes, default=1 if self._parent else 0),
+                'last_id': self.last_id,
+                'pending_deletions': len(self._deleted),
+                'loaded_from_snapshot': self.loaded_from_snapshot,
+                'replayed': self.replayed,
+            }
+
+    # --- Удаление заявок -------------------------------------------------------------
+
+    def _clear_state(self) -> None:
+        self._parent, self._size, self._members, self._links = {}, {}, {}, {}
+        self._anchors, self._awaiting_phash = {}, {}
+        self._deleted = set()
+        self.last_id = 0
+
+    def _remove_snapshot(self) -> None:
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            try:
+                os.remove(self.snapshot_path)
+            except OSError as e:
+                logger.error(f"Кольца: не удалось удалить снапшот: {e}")
+
+    def reset(self) -> None:
+        """Пустой индекс и без снапшота — после очистки БД (id заявок начнутся заново)"""
+        with self._lock:
+            self._clear_state()
+            self._generation += 1
+            self._rebuild_log = None
+            self._dirty = False
+        self._remove_snapshot()
+        logger.info("Кольца: индекс сброшен")
+
+    def forget(self, ids: Iterable[int]) -> None:
+        """Удаленные заявки сразу скрываются из ответов; индекс перестраивается в фоне"""
+        with self._lock:
+            self._deleted.update(int(app_id) for app_id in ids if int(app_id) in self._parent)
+            if not self._deleted:
+                return
+        # Снапшот содержит удаленные заявки — без него рестарт построит индекс из БД
+        self._remove_snapshot()
+        self.request_rebuild()
+
+    def on_deleted(self, ids: Optional[List[int]]) -> None:
+        """Обработчик удаления заявок в БД (db_manager.on_applications_deleted)"""
+        if ids is None:
+            self.reset()
+        else:
+            self.forget(ids)
+
+    def request_rebuild(self) -> None:
+        """Перестраивает индекс из БД в фоне; запросы во время перестроения сливаются в одно"""
+        with self._lock:
+            self._rebuild_requested = True
+            if self._rebuild_thread is not None:
+                return
+            self._rebuild_thread = threading.Thread(target=self._rebuild_loop, name="FraudRingsRebuild", daemon=True)
+            self._rebuild_thread.start()
+
+    def _rebuild_loop(self) -> None:
+        while True:
+            with self._lock:
+                if not self._rebuild_requested:
+                    self._rebuild_thread = None
+                    return
+                self._rebuild_requested = False
+            try:
+                self.rebuild()
+            except Exception as e:
+                logger.error(f"Кольца: ошибка перестроения индекса: {e}")
+
+    def rebuild(self) -> int:
+        """Строит индекс из БД заново и подменяет им текущий"""
+        started = time.perf_counter()
+        with self._lock:
+            self._rebuild_log = []
+            generation = self._generation
+        try:
+            fresh = FraudRingIndex(snapshot_path=None, burst_window=self.burst_window)
+            fresh.replay(0)
+        except Exception:
+            with self._lock:
+                self._rebuild_log = None
+            raise
+        with self._lock:
+            if generation != self._generation:
+                return len(self._parent)  # БД очищена во время перестроения
+            # Заявки, пришедшие во время чтения БД, — поверх свежего индекса
+            for app in self._rebuild_log:
+                fresh.add(app)
+            deleted = self._deleted
+            self._parent, self._size, self._members = fresh._parent, fresh._size, fresh._members
+            self._links, self._anchors, self._awaiting_phash = fresh._links, fresh._anchors, fresh._awaiting_phash
+            self.last_id = fresh.last_id
+            # Удаленные во время перестроения могли попасть в свежий индекс
+            self._deleted = {app_id for app_id in deleted if app_id in self._parent}
+            self._rebuild_log = None
+            self._dirty = True
+        if self._deleted:
+            self.request_rebuild()
+        else:
+            self.save_snapshot()
+        logger.info(f"Кольца: индекс перестроен ({len(self._parent)} заявок, "
+                    f"{time.perf_counter() - started:.2f}с)")
+        return len(self._parent)
+
+    # --- Снапшот --------------------------------------------------------------------
+
+    def _signature(self) -> str:
+        return f"bands={PHASH_BANDS};suffix={BURST_PHONE_SUFFIX};window={self.burst_window}"
+
+    def _resume_id(self) -> int:
+        """Первая заявка, которую нужно доиграть после снапшота: ждущие pHash и все новые"""
+        cutoff = time.time() - AWAITING_PHASH_TTL
+        for app_id in [a for a, added in self._awaiting_phash.items() if added < cutoff]:
+            del self._awaiting_phash[app_id]
+        return min(self._awaiting_phash, default=self.last_id + 1)
+
+    def save_snapshot(self) -> bool:
+        """Атомарно пишет состояние в snapshot_path (временный файл + переименование)"""
+        if not self.snapshot_path:
+            return False
+        with self._lock:
+            if self._deleted:
+                return False  # снапшот с удаленными заявками запишет перестроение
+            meta = {
+                'format': SNAPSHOT_FORMAT,
+                'signature': self._signature(),
+                'last_id': self.last_id,
+                'resume_id': self._resume_id(),
+                'links': {str(root): dict(links) for root, links in self._links.items()},
+            }
+            nodes = np.fromiter(self._parent.keys(), dtype=np.int64, count=len(self._parent))
+            parents = np.fromiter(self._parent.values(), dtype=np.int64, count=len(self._parent))
+            keys = np.fromiter(self._anchors.keys(), dtype=np.int64, count=len(self._anchors))
+            anchors = np.fromiter(self._anchors.values(), dtype=np.int64, count=len(self._anchors))
+            self._dirty = False
+            self._snapshot_at = time.time()
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            directory = os.path.dirname(self.snapshot_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, meta=np.array(json.dumps(meta)), nodes=nodes, parents=parents, keys=keys, anchors=anchors)
+            os.replace(tmp_path, self.snapshot_path)
+            logger.info(f"Кольца: снапшот записан ({len(nodes)} заявок)")
+            return True
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"Кольца: не удалось записать снапшот: {e}")
+            return False
+
+    def maybe_snapshot(self) -> bool:
+        if self._dirty and time.time() - self._snapshot_at >= self.snapshot_interval:
+            return self.save_snapshot()
+        return False
+
+    def load_snapshot(self) -> Optional[int]:
+        """
+        Загружает снапшот
+
+        Returns:
+            int | None: id, с которого нужно доиграть заявки; None — снапшота нет или он не подходит
+        """
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with np.load(self.snapshot_path, allow_pickle=False) as data:
+                meta = json.loads(str(data['meta']))
+                if meta.get('format') != SNAPSHOT_FORMAT or meta.get('signature') != self._signature():
+                    logger.info("Кольца: снапшот другой версии, индекс будет перестроен")
+                    return None
+                parent = dict(zip(data['nodes'].tolist(), data['parents'].tolist()))
+                anchors = dict(zip(data['keys'].tolist(), data['anchors'].tolist()))
+        except Exception as e:
+            logger.error(f"Кольца: не удалось прочитать снапшот: {e}")
+            return None
+
+        with self._lock:
+            self._parent = parent
+            self._anchors = anchors
+            self._members = {}
+            for node in parent:
+                root = self._find(node)
+                if root != node:
+                    self._members.setdefault(root, [root]).append(node)
+            self._size = {root: len(members) for root, members in self._members.items()}
+            self._links = {int(root): Counter(links) for root, links in meta.get('links', {}).items()}
+            self._awaiting_phash = {}
+            self.last_id = int(meta.get('last_id', 0))
+            self._dirty = False
+            self.loaded_from_snapshot = True
+        return int(meta.get('resume_id', self.last_id + 1))
+
+    def load(self) -> int:
+        """Снапшот + доигрывание новых заявок; без снапшота — полное построение из БД"""
+        started = time.perf_counter()
+        resume_id = self.load_snapshot()
+        replayed = self.replay(0 if resume_id is None else resume_id - 1)
+        if replayed:
+            self.save_snapshot()
+        logger.info(f"Кольца: индекс готов ({len(self._parent)} заявок, доиграно {replayed}, "
+                    f"{time.perf_counter() - started:.2f}с)")
+        return replayed
+
+
+_ring_index: Optional[FraudRingIndex] = None
+_ring_index_lock = threading.Lock()
+
+
+def get_ring_index() -> FraudRingIndex:
+    """Синглтон индекса колец (создание не читает снапшот и БД)."""
+    global _ring_index
+    if _ring_index is None:
+        with _ring_index_lock:
+            if _ring_index is None:
+                _ring_index = FraudRingIndex()
+                on_applications_deleted(_ring_index.on_deleted)
+    return _ring_index
+
+
+def start_ring_index() -> FraudRingIndex:
+    index = get_ring_index()
+    index.load()
+    return index
+
+
+__all__ = [
+    'ring_attributes',
+    'FraudRingIndex',
+    'get_ring_index',
+    'start_ring_index',
+]
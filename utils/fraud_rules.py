@@ -0,0 +1,536 @@
+"""
+Декларативные правила антифрода
+
+Правила (условия, веса, пороги, тексты) описаны в FRAUD_RULES_PATH (JSON) и
+при загрузке компилируются в замыкания двух видов: построчное — для одной
+заявки (регистрация, пересчет из админки) и колоночное — для DataFrame
+(пакетный пересчет всей таблицы). Оба вычисляют одни и те же условия над
+одними и теми же признаками, поэтому дают одинаковый результат; их общий
+набор тестов — tests/test_fraud_rules.py.
+
+Правило — одна проверка:
+  outcomes — исходы по порядку, срабатывает первый подходящий (impact, message);
+  reasons  — если ни один исход не сработал: все подходящие причины
+             объединяются в одно сообщение с общим impact;
+  pass     — сообщение, если не сработало ничего.
+Условие — {"feature", "op", "value"} или {"all": [...]}, {"any": [...]},
+{"not": ...}. Значение "$ИМЯ" и {ИМЯ} в сообщениях подставляются из
+констант (LOYALTY_CARD_LENGTH).
+
+Подсчет останавливается, как только балл достигает 100: дальнейшие правила
+его уже не изменят, в details их нет. Файл перечитывается при изменении,
+не чаще раза в FRAUD_RULES_RELOAD_INTERVAL секунд, — пороги и веса
+настраиваются без рестарта; файл с ошибкой не заменяет рабочие правила.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import operator
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import FRAUD_RULES_PATH, FRAUD_RULES_RELOAD_INTERVAL, LOYALTY_CARD_LENGTH
+from utils.velocity import FEATURE_DEFAULTS as VELOCITY_FEATURE_DEFAULTS
+
+logger = logging.getLogger(__name__)
+
+MAX_SCORE = 100
+MAX_REASONS = 6  # 2^6 сочетаний причин на правило
+
+_SEQ = "0123456789"
+_SEQ_SUBSTRINGS = frozenset(_SEQ[i:j] for i in range(10) for j in range(i + 1, 11))
+_SEQ_REVERSED_SUBSTRINGS = frozenset(s[::-1] for s in _SEQ_SUBSTRINGS)
+
+
+class RuleError(ValueError):
+    """Ошибка в описании правил"""
+
+
+@dataclass
+class CheckResult:
+    name: str
+    passed: bool
+    impact: int
+    message: str
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "passed": self.passed,
+            "impact": self.impact,
+            "message": self.message,
+        }
+
+
+def risk_level_for(score: int) -> str:
+    """Уровень риска по баллу 0..100: low/medium/high"""
+    if score <= 30:
+        return "low"
+    if score <= 70:
+        return "medium"
+    return "high"
+
+
+# --- Признаки ---------------------------------------------------------------------
+# Каждый признак — пара: из (participant, context) для одной заявки и из
+# DataFrame (колонки заявки + колонки контекста) для пачки.
+
+_CONTEXT_DEFAULTS = {
+    'is_telegram_id_unique': True,
+    'duplicate_card_count': 0,
+    'duplicate_phone_count': 0,
+    'duplicate_photo_count': 0,
+    'similar_photo_count': 0,
+    'recent_registrations_60s': 0,
+    **VELOCITY_FEATURE_DEFAULTS,
+}
+
+
+def _text(frame: pd.DataFrame, column: str) -> pd.Series:
+    if column not in frame:
+        return pd.Series([''] * len(frame), index=frame.index, dtype=object)
+    return frame[column].fillna('').astype(str)
+
+
+def _row_card_digits(raw: str) -> str:
+    return ''.join(ch for ch in raw if ch.isdigit())
+
+
+def _vector_card_digits(frame: pd.DataFrame) -> pd.Series:
+    raw = _text(frame, 'loyalty_card_number')
+    # Номера почти всегда уже из одних цифр — регулярка только для остальных
+    plain = raw.str.isdigit()
+    if plain.all():
+        return raw
+    digits = raw.copy()
+    digits[~plain] = raw[~plain].str.replace(r"\D", "", regex=True)
+    # str.isdigit шире ASCII-цифр — не-ASCII номера разбираем так же, как построчно
+    exotic = ~raw.str.isascii()
+    if exotic.any():
+        digits[exotic] = raw[exotic].map(_row_card_digits)
+    return digits
+
+
+def _context_column(name: str) -> Callable[[pd.DataFrame], np.ndarray]:
+    default = _CONTEXT_DEFAULTS[name]
+
+    def column(frame: pd.DataFrame) -> np.ndarray:
+        if name not in frame:
+            return np.full(len(frame), default)
+        return frame[name].fillna(default).to_numpy()
+    return column
+
+
+ROW_FEATURES: Dict[str, Callable[[Dict, Dict], Any]] = {
+    'name': lambda p, c: (p.get('name') or '').strip(),
+    'phone_digits': lambda p, c: re.sub(r"\D+", "", p.get('phone_number') or ''),
+    'card': lambda p, c: (p.get('loyalty_card_number') or '').strip(),
+    'card_digits': lambda p, c: _row_card_digits(p.get('loyalty_card_number') or ''),
+    'photo_hash': lambda p, c: p.get('photo_hash') or '',
+    **{name: (lambda p, c, name=name, default=default: c.get(name, default))
+       for name, default in _CONTEXT_DEFAULTS.items()},
+}
+
+VECTOR_FEATURES: Dict[str, Callable[[pd.DataFrame], Any]] = {
+    'name': lambda f: _text(f, 'name').str.strip(),
+    'phone_digits': lambda f: _text(f, 'phone_number').str.replace(r"\D+", "", regex=True),
+    'card': lambda f: _text(f, 'loyalty_card_number').str.strip(),
+    'card_digits': _vector_card_digits,
+    'photo_hash': lambda f: _text(f, 'photo_hash'),
+    **{name: _context_column(name) for name in _CONTEXT_DEFAULTS},
+}
+
+
+# Признаки из полей самой заявки — без контекста из БД
+PARTICIPANT_FEATURES = frozenset({'name', 'phone_digits', 'card', 'card_digits', 'photo_hash'})
+# Признаки без запросов к БД: поля заявки и счетчики скорости в памяти
+LOCAL_FEATURES = PARTICIPANT_FEATURES | frozenset(VELOCITY_FEATURE_DEFAULTS)
+
+
+class _RowFeatures:
+    """Признаки одной заявки, вычисляются по требованию"""
+
+    __slots__ = ('participant', 'context', 'values')
+
+    def __init__(self, participant: Dict, context: Dict):
+        self.participant = participant
+        self.context = context
+        self.values: Dict[str, Any] = {}
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self.values:
+            self.values[name] = ROW_FEATURES[name](self.participant, self.context)
+        return self.values[name]
+
+
+class _FrameFeatures:
+    """Колонки признаков пачки, каждая вычисляется один раз"""
+
+    __slots__ = ('frame', 'values')
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame
+        self.values: Dict[str, Any] = {}
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self.values:
+            self.values[name] = VECTOR_FEATURES[name](self.frame)
+        return self.values[name]
+
+
+# --- Операции условий: (построчно, по колонке) -------------------------------------
+
+def _sequential(value: str) -> bool:
+    return bool(value) and (value in _SEQ or value in _SEQ[::-1] or _SEQ.find(value[:4]) != -1)
+
+
+def _compare(op: Callable[[Any, Any], Any]):
+    return op, lambda column, arg: op(np.asarray(column), arg)
+
+
+def _length(op: Callable[[Any, Any], Any]):
+    return (lambda value, arg: op(len(value), arg),
+            lambda column, arg: op(column.str.len().to_numpy(), arg))
+
+
+OPS: Dict[str, Tuple[Callable, Callable]] = {
+    'eq': _compare(operator.eq),
+    'ne': _compare(operator.ne),
+    'gt': _compare(operator.gt),
+    'ge': _compare(operator.ge),
+    'lt': _compare(operator.lt),
+    'le': _compare(operator.le),
+    'empty': (lambda value, arg: value == '',
+              lambda column, arg: (column == '').to_numpy()),
+    'len_lt': _length(operator.lt),
+    'len_gt': _length(operator.gt),
+    'len_eq': _length(operator.eq),
+    'len_ne': _length(operator.ne),
+    'len_between': (lambda value, arg: arg[0] <= len(value) <= arg[1],
+                    lambda column, arg: column.str.len().between(arg[0], arg[1]).to_numpy()),
+    'same_chars': (lambda value, arg: len(set(value)) == 1,
+                   lambda column, arg: column.str.fullmatch(r"(?s)(.)\1*").fillna(False).to_numpy(dtype=bool)),
+    'sequential': (lambda value, arg: _sequential(value),
+                   lambda column, arg: ((column != '') & (column.isin(_SEQ_SUBSTRINGS)
+                                                          | column.isin(_SEQ_REVERSED_SUBSTRINGS)
+                                                          | column.str[:4].isin(_SEQ_SUBSTRINGS))).to_numpy()),
+}
+
+RowCondition = Callable[[_RowFeatures], bool]
+VectorCondition = Callable[[_FrameFeatures], np.ndarray]
+
+
+def _substitute(value: Any, constants: Dict[str, Any]) -> Any:
+    if isinstance(value, str) and value.startswith('$'):
+        if value[1:] not in constants:
+            raise RuleError(f"Неизвестная константа {value}")
+        return constants[value[1:]]
+    if isinstance(value, list):
+        return [_substitute(v, constants) for v in value]
+    return value
+
+
+def condition_features(spec: Dict) -> set:
+    """Признаки, которые читает условие (spec уже проверен compile_condition)"""
+    if 'all' in spec or 'any' in spec:
+        return set().union(*(condition_features(s) for s in spec.get('all', spec.get('any'))))
+    if 'not' in spec:
+        return condition_features(spec['not'])
+    return {spec.get('feature')}
+
+
+def compile_condition(spec: Dict, constants: Dict[str, Any]) -> Tuple[RowCondition, VectorCondition]:
+    """Условие -> (построчная функция, колоночная функция)"""
+    if not isinstance(spec, dict):
+        raise RuleError(f"Условие должно быть объектом: {spec!r}")
+    if 'all' in spec or 'any' in spec:
+        combine_all = 'all' in spec
+        items = spec['all' if combine_all else 'any']
+        if not isinstance(items, list) or not items:
+            raise RuleError(f"Ожидается непустой список условий: {spec!r}")
+        parts = [compile_condition(s, constants) for s in items]
+        rows = [p[0] for p in parts]
+        vectors = [p[1] for p in parts]
+        if combine_all:
+            return (lambda f: all(c(f) for c in rows),
+                    lambda f: np.logical_and.reduce([c(f) for c in vectors]))
+        return (lambda f: any(c(f) for c in rows),
+                lambda f: np.logical_or.reduce([c(f) for c in vectors]))
+    if 'not' in spec:
+        row, vector = compile_condition(spec['not'], constants)
+        return (lambda f: not row(f)), (lambda f: ~vector(f))
+
+    feature, op = spec.get('feature'), spec.get('op')
+    if feature not in ROW_FEATURES:
+        raise RuleError(f"Неизвестный признак {feature!r}")
+    if op not in OPS:
+        raise RuleError(f"Неизвестная операция {op!r}")
+    arg = _substitute(spec.get('value'), constants)
+    row_op, vector_op = OPS[op]
+    return (lambda f: bool(row_op(f[feature], arg)),
+            lambda f: np.asarray(vector_op(f[feature], arg), dtype=bool))
+
+
+def _items(spec: Dict, key: str, rule: str) -> List[Dict]:
+    items = spec.get(key) or []
+    if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+        raise RuleError(f"{rule}: {key} должно быть списком объектов")
+    return items
+
+
+def _impact(spec: Dict, rule: str) -> int:
+    try:
+        return int(spec['impact'])
+    except KeyError:
+        raise RuleError(f"{rule}: не задан impact") from None
+    except (TypeError, ValueError):
+        raise RuleError(f"{rule}: impact должен быть числом, а не {spec['impact']!r}") from None
+
+
+def _format(text: Any, constants: Dict[str, Any], rule: str) -> str:
+    try:
+        return str(text).format(**constants)
+    except (KeyError, IndexError, ValueError) as e:
+        raise RuleError(f"{rule}: ошибка подстановки в сообщении {text!r}: {e!r}") from None
+
+
+class CompiledRule:
+    """
+    Одна проверка: таблица исходов по коду и условия, дающие код
+
+    Коды: 0..k-1 — исходы outcomes, k — проверка пройдена, k + маска — сочетание reasons.
+    """
+
+    def __init__(self, spec: Dict, constants: Dict[str, Any]):
+        if not isinstance(spec, dict):
+            raise RuleError(f"Правило должно быть объектом: {spec!r}")
+        self.name = spec.get('name')
+        if not self.name:
+            raise RuleError("У правила нет name")
+        outcomes = _items(spec, 'outcomes', self.name)
+        reasons = spec.get('reasons') or {}
+        if not isinstance(reasons, dict):
+            raise RuleError(f"{self.name}: reasons должно быть объектом")
+        reason_items = _items(reasons, 'items', self.name)
+        if len(reason_items) > MAX_REASONS:
+            raise RuleError(f"{self.name}: больше {MAX_REASONS} причин")
+        reasons_impact = _impact(reasons, self.name) if reason_items else 0
+
+        def message(item: Dict) -> str:
+            if 'message' not in item:
+                raise RuleError(f"{self.name}: у исхода нет message")
+            return _format(item['message'], constants, self.name)
+
+        for item in outcomes + reason_items:
+            if 'when' not in item:
+                raise RuleError(f"{self.name}: у исхода нет when")
+        self._outcomes = [compile_condition(o['when'], constants) for o in outcomes]
+        self._reasons = [compile_condition(r['when'], constants) for r in reason_items]
+        self.features = set().union(*(condition_features(c['when']) for c in outcomes + reason_items))
+        self.results: List[CheckResult] = [
+            CheckResult(self.name, False, _impact(o, self.name), message(o)) for o in outcomes
+        ]
+        self.pass_code = len(self.results)
+        self.results.append(CheckResult(self.name, True, 0, _format(spec.get('pass', 'OK'), constants, self.name)))
+        reason_messages = [message(r) for r in reason_items]
+        for mask in range(1, 1 << len(reason_items)):
+            text = "; ".join(m for bit, m in enumerate(reason_messages) if mask & (1 << bit))
+            self.results.append(CheckResult(self.name, False, reasons_impact, text))
+
+    def evaluate_row(self, features: _RowFeatures) -> CheckResult:
+        for code, (row, _) in enumerate(self._outcomes):
+            if row(features):
+                return self.results[code]
+        mask = 0
+        for bit, (row, _) in enumerate(self._reasons):
+            if row(features):
+                mask |= 1 << bit
+        return self.results[self.pass_code + mask]
+
+    def evaluate_frame(self, features: _FrameFeatures, size: int) -> np.ndarray:
+        codes = np.full(size, self.pass_code, dtype=np.int64)
+        for bit, (_, vector) in enumerate(self._reasons):
+            codes += vector(features).astype(np.int64) << bit
+        # С конца, чтобы при нескольких совпадениях остался первый исход
+        for code in range(len(self._outcomes) - 1, -1, -1):
+            codes = np.where(self._outcomes[code][1](features), code, codes)
+        return codes
+
+
+class RuleEngine:
+    """Скомпилированный набор правил."""
+
+    def __init__(self, spec: Dict, constants: Dict[str, Any] = None, source: str = ''):
+        constants = {'LOYALTY_CARD_LENGTH': LOYALTY_CARD_LENGTH, **(constants or {})}
+        rules = spec.get('rules') if isinstance(spec, dict) else None
+        if not rules or not isinstance(rules, list):
+            raise RuleError("В описании нет правил")
+        self.rules = [CompiledRule(r, constants) for r in rules]
+        names = [r.name for r in self.rules]
+        if len(set(names)) != len(names):
+            raise RuleError("Повторяющиеся имена правил")
+        self.features = set().union(*(rule.features for rule in self.rules))
+        # Правила, которым не нужен контекст из БД, — упрощенный скоринг под нагрузкой
+        self.context_free_rules = [rule for rule in self.rules if rule.features <= LOCAL_FEATURES]
+        self.spec = spec
+        self.source = source
+        self.version = hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def from_file(cls, path: str) -> "RuleEngine":
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f), source=path)
+
+    def score(self, participant: Dict, context: Dict,
+              rules: List[CompiledRule] = None) -> Tuple[int, str, List[Dict]]:
+        """Построчно: (risk_score 0..100, risk_level, details[]); rules — подмножество правил"""
+        features = _RowFeatures(participant, context)
+        total = 0
+        details: List[Dict] = []
+        for rule in self.rules if rules is None else rules:
+            result = rule.evaluate_row(features)
+            details.append(result.to_dict())
+            if not result.passed:
+                total += result.impact
+                if total >= MAX_SCORE:
+                    break
+        total = max(0, min(MAX_SCORE, total))
+        return total, risk_level_for(total), details
+
+    def score_frame(self, frame: pd.DataFrame) -> pd.DataFrame:
+        """
+        Колоночно: риск всех строк frame (колонки заявки и контекста)
+
+        Коды всех правил складываются в одно число на строку; балл, уровень и
+        JSON details считаются один раз на уникальное сочетание.
+
+        Returns:
+            DataFrame: id, risk_score, risk_level, risk_details
+        """
+        features = _FrameFeatures(frame)
+        key = np.zeros(len(frame), dtype=np.int64)
+        for rule in self.rules:
+            key = key * len(rule.results) + rule.evaluate_frame(features, len(frame))
+
+        combos, unique_keys = pd.factorize(key)
+        scores, levels, details_json = [], [], []
+        for combo_key in unique_keys:
+            codes = []
+            for rule in reversed(self.rules):
+                combo_key, code = divmod(int(combo_key), len(rule.results))
+                codes.append(code)
+            total = 0
+            details: List[Dict] = []
+            for rule, code in zip(self.rules, reversed(codes)):
+                result = rule.results[code]
+                details.append(result.to_dict())
+                if not result.passed:
+                    total += result.impact
+                    if total >= MAX_SCORE:
+                        break
+            total = max(0, min(MAX_SCORE, total))
+            scores.append(total)
+            levels.append(risk_level_for(total))
+            details_json.append(json.dumps(details, ensure_ascii=False))
+
+        ids = frame['id'].to_numpy() if 'id' in frame else np.arange(len(frame))
+        return pd.DataFrame({
+            'id': ids,
+            'risk_score': np.asarray(scores, dtype=np.int64)[combos],
+            'risk_level': np.asarray(levels, dtype=object)[combos],
+            'risk_details': np.asarray(details_json, dtype=object)[combos],
+        })
+
+
+class _EngineHolder:
+    """Текущие правила из файла; перечитывает файл при изменении mtime"""
+
+    def __init__(self, path: str, reload_interval: float):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._engine: Optional[RuleEngine] = None
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self.reloads = 0
+        self.last_error = ''
+
+    def get(self) -> RuleEngine:
+        now = time.monotonic()
+        if self._engine is not None and now - self._checked_at < self.reload_interval:
+            return self._engine
+        with self._lock:
+            if self._engine is not None and now - self._checked_at < self.reload_interval:
+                return self._engine
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError as e:
+                if self._engine is None:
+                    raise
+                self.last_error = str(e)
+                logger.error(f"Правила антифрода: файл {self.path} недоступен, работают прежние правила: {e}")
+                return self._engine
+            if self._engine is None or mtime != self._mtime:
+                try:
+                    engine = RuleEngine.from_file(self.path)
+                except Exception as e:
+                    # RuleError/JSON — ожидаемые ошибки; любые другие тоже не должны ронять скоринг
+                    if self._engine is None:
+                        raise
+                    self.last_error = str(e)
+                    logger.error(f"Правила антифрода: ошибка в {self.path}, работают прежние правила: {e}")
+                    self._mtime = mtime  # не перечитываем тот же сломанный файл
+                    return self._engine
+                if self._engine is not None:
+                    self.reloads += 1
+                    logger.info(f"Правила антифрода перезагружены: версия {engine.version}")
+                self._engine, self._mtime, self.last_error = engine, mtime, ''
+            return self._engine
+
+    def status(self) -> Dict[str, Any]:
+        engine = self.get()
+        return {
+            'path': self.path,
+            'version': engine.version,
+            'rules': [rule.name for rule in engine.rules],
+            'reloads': self.reloads,
+            'last_error': self.last_error,
+        }
+
+
+_holder = _EngineHolder(FRAUD_RULES_PATH, FRAUD_RULES_RELOAD_INTERVAL)
+
+
+def get_rule_engine() -> RuleEngine:
+    """Действующие правила (с горячей перезагрузкой из FRAUD_RULES_PATH)"""
+    return _holder.get()
+
+
+def get_rules_status() -> Dict[str, Any]:
+    return _holder.status()
+
+
+__all__ = [
+    'CheckResult',
+    'RuleError',
+    'RuleEngine',
+    'CompiledRule',
+    'risk_level_for',
+    'compile_condition',
+    'condition_features',
+    'PARTICIPANT_FEATURES',
+    'LOCAL_FEATURES',
+    'get_rule_engine',
+    'get_rules_status',
+]
@@ -4,32 +4,126 @@
 
 from __future__ import annotations
 
+import hashlib
 import io
 import json
 import logging
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Optional, Tuple, Union
 
 import numpy as np
-from PIL import Image, ImageOps, ExifTags
+from PIL import Image, ExifTags
 
+from config import LEAFLET_ANALYSIS_MAX_SIDE, LEAFLET_BLUR_THRESHOLD, LEAFLET_MIN_LONG_SIDE, LEAFLET_MIN_SHORT_SIDE
 from database.db_manager import (
-    get_active_leaflet_template,
+    get_active_leaflet_templates,
     count_similar_photo_phash,
 )
+from utils.template_features import (
+    STICKER_COVERAGE_THRESHOLD, match_templates, parse_zones, zone_coverage,
+)
 
 
 logger = logging.getLogger(__name__)
 
+# Во сколько раз растет дисперсия лапласиана при декодировании в 1/N масштаба.
+# Калибровка на синтетических лифлетах (scripts/benchmark_draft_decode.py):
+# граница "размытое/резкое" зависит от плотности текстуры, поэтому для 1/4 и 1/8
+# множители компромиссные — перекалибруйте скриптом на реальных фото.
+BLUR_THRESHOLD_MULTIPLIERS = {1: 1.0, 2: 9.0, 4: 40.0, 8: 100.0}
+
+# Белый фон ~ >= 240; "чернила" (стикеры) — темнее
+_WHITE_LEVEL = 240
+
+# Размер блока (в пикселях) для подсчета дисперсии лапласиана
+_VARIANCE_CHUNK_PIXELS = 1 << 18
+
+# Версия алгоритма метрик: входит в ключ кэша результатов анализа.
+# Повышайте при любом изменении analyze_leaflet_image.
+ANALYSIS_VERSION = 3
+
 
 def _image_from_bytes(photo_bytes: bytes) -> Image.Image:
     return Image.open(io.BytesIO(photo_bytes))
 
 
-def compute_ahash_hex(image: Image.Image, hash_size: int = 8) -> str:
+# EXIF Orientation → последовательность numpy-преобразований (без копирования буфера)
+_ORIENTATION_TAG = 0x0112
+
+
+def _apply_orientation(arr: np.ndarray, orientation: int) -> np.ndarray:
+    """Поворачивает/отражает массив согласно EXIF Orientation (возвращает view)."""
+    if orientation == 2:
+        return arr[:, ::-1]
+    if orientation == 3:
+        return arr[::-1, ::-1]
+    if orientation == 4:
+        return arr[::-1, :]
+    if orientation == 5:
+        return arr.T
+    if orientation == 6:
+        return np.rot90(arr, -1)
+    if orientation == 7:
+        return arr.T[::-1, ::-1]
+    if orientation == 8:
+        return np.rot90(arr, 1)
+    return arr
+
+
+def _reduction_factor(width: int, height: int, max_side: int) -> int:
+    """Максимальный делитель из (8, 4, 2), при котором длинная сторона >= max_side."""
+    if not max_side:
+        return 1
+    long_side = max(width, height)
+    for factor in (8, 4, 2):
+        if long_side // factor >= max_side:
+            return factor
+    return 1
+
+
+def decode_gray(image: Image.Image, max_side: int = 0) -> np.ndarray:
+    """Декодирует фото один раз: грейскейл + EXIF-ориентация → uint8 буфер (H, W).
+
+    Все метрики анализа считаются из этого буфера, поэтому 12-Мп фото
+    декодируется и конвертируется ровно один раз. При max_side > 0 JPEG
+    декодируется сразу в уменьшенном масштабе (draft: 1/2, 1/4, 1/8),
+    остальные форматы уменьшаются через reduce() после перевода в грейскейл.
+    """
+    try:
+        orientation = int(image.getexif().get(_ORIENTATION_TAG) or 1)
+    except Exception:
+        orientation = 1
+    width, height = image.size
+    factor = _reduction_factor(width, height, max_side)
+    if factor > 1 and image.format == 'JPEG':
+        # DCT-масштабирование в декодере: пиксели полного разрешения не создаются
+        image.draft('L', (width // factor, height // factor))
+        width, height = image.size
+    gray = image if image.mode == 'L' else image.convert('L')
+    remaining = _reduction_factor(width, height, max_side)
+    if remaining > 1:
+        gray = gray.reduce(remaining)
+    arr = np.asarray(gray, dtype=np.uint8)
+    del gray
+    return _apply_orientation(arr, orientation)
+
+
+def blur_threshold_for_scale(factor: int) -> float:
+    """Порог размытости, пересчитанный для масштаба декодирования 1/factor."""
+    return LEAFLET_BLUR_THRESHOLD * BLUR_THRESHOLD_MULTIPLIERS.get(int(factor), 1.0)
+
+
+def _as_gray(image: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    if isinstance(image, np.ndarray):
+        return image
+    return decode_gray(image)
+
+
+def compute_ahash_hex(image: Union[Image.Image, np.ndarray], hash_size: int = 8) -> str:
     """Average hash (aHash) в hex-формате (64-бит → 16 hex-символов)."""
     try:
-        # Грейскейл и уменьшение
-        img = ImageOps.exif_transpose(image.convert('L')).resize((hash_size, hash_size), Image.Resampling.LANCZOS)
+        gray = np.ascontiguousarray(_as_gray(image))
+        # Уменьшение из общего грейскейл-буфера (fromarray не копирует C-contiguous uint8)
+        img = Image.fromarray(gray).resize((hash_size, hash_size), Image.Resampling.LANCZOS)
         pixels = np.asarray(img, dtype=np.float32)
         avg = pixels.mean()
         bits = pixels > avg
@@ -41,23 +135,40 @@ def compute_ahash_hex(image: Image.Image, hash_size: int = 8) -> str:
         return ""
 
 
-def variance_of_laplacian(image: Image.Image) -> float:
-    """Оценка резкости: дисперсия Лапласиана (чем выше, тем резче)."""
+def variance_of_laplacian(image: Union[Image.Image, np.ndarray]) -> float:
+    """Оценка резкости: дисперсия Лапласиана (чем выше, тем резче).
+
+    Считается по уже уменьшенному при декодировании буферу. Лапласиан
+    раскладывается на d2y + d2x и накапливается in-place в int16 (значения
+    в пределах ±1020), дисперсия — блоками строк без полноразмерных копий.
+    """
     try:
-        img = ImageOps.exif_transpose(image.convert('L'))
-        arr = np.asarray(img, dtype=np.float32)
-        # 3x3 лапласиан
-        kernel = np.array([[0, 1, 0], [1, -4, 1], [0, 1, 0]], dtype=np.float32)
-        # Пэддинг по краям
-        padded = np.pad(arr, 1, mode='edge')
-        h, w = arr.shape
-        # Свёртка вручную (без SciPy)
-        out = (
-            kernel[0, 0] * padded[0:h, 0:w] + kernel[0, 1] * padded[0:h, 1:w+1] + kernel[0, 2] * padded[0:h, 2:w+2] +
-            kernel[1, 0] * padded[1:h+1, 0:w] + kernel[1, 1] * padded[1:h+1, 1:w+1] + kernel[1, 2] * padded[1:h+1, 2:w+2] +
-            kernel[2, 0] * padded[2:h+2, 0:w] + kernel[2, 1] * padded[2:h+2, 1:w+1] + kernel[2, 2] * padded[2:h+2, 2:w+2]
-        )
-        return float(out.var())
+        gray = _as_gray(image)
+        padded = np.pad(gray, 1, mode='edge')
+        h, w = gray.shape
+        center = padded[1:h+1, 1:w+1]
+        # d2y = верх + низ - 2*центр
+        out = padded[0:h, 1:w+1].astype(np.int16)
+        out += padded[2:h+2, 1:w+1]
+        out -= center
+        out -= center
+        # d2x = лево + право - 2*центр
+        out += padded[1:h+1, 0:w]
+        out += padded[1:h+1, 2:w+2]
+        out -= center
+        out -= center
+        del padded
+        total = 0
+        squares = 0.0
+        rows = max(1, _VARIANCE_CHUNK_PIXELS // max(1, w))
+        for r in range(0, h, rows):
+            block = out[r:r+rows]
+            total += int(block.sum(dtype=np.int64))
+            flat = block.ravel().astype(np.float64)
+            squares += float(np.dot(flat, flat))
+        n = out.size
+        mean = total / n
+        return max(0.0, squares / n - mean * mean)
     except Exception as e:
         logger.warning(f"Ошибка расчета резкости: {e}")
         return 0.0
@@ -77,148 +188,221 @@ def read_exif_meta(image: Image.Image) -> Dict[str, Any]:
         return {}
 
 
-def _parse_validation_zones(zones_json: str) -> List[Dict[str, float]]:
-    try:
-        arr = json.loads(zones_json or '[]')
-        if isinstance(arr, list):
-            return [z for z in arr if isinstance(z, dict) and all(k in z for k in ('x', 'y', 'w', 'h'))]
-        return []
-    except Exception:
-        return []
+def nonwhite_integral(image: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    """Интегральное изображение маски "не белого" (gray < 240), размер (h+1, w+1).
+
+    Сумма по любому прямоугольнику — четыре обращения: I[y1,x1] - I[y0,x1] - I[y1,x0] + I[y0,x0].
+    """
+    gray = _as_gray(image)
+    h, w = gray.shape
+    integral = np.zeros((h + 1, w + 1), dtype=np.int32)
+    np.less(gray, _WHITE_LEVEL, out=integral[1:, 1:], casting='unsafe')
+    np.cumsum(integral[1:, 1:], axis=0, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
 
 
-def _count_stickers_by_zones(image: Image.Image, zones_json: str) -> Tuple[int, List[float]]:
+def _count_stickers_by_zones(image: Union[Image.Image, np.ndarray], zones_json: str,
+                             integral: Optional[np.ndarray] = None) -> Tuple[int, List[float]]:
     """
     Простая эвристика: считаем зону "заполненной", если доля не-белых пикселей > threshold.
+    Доли считаются по одному интегральному изображению — O(1) на зону.
     Возвращает: (количество_стикеров, список_покрытий_зон)
     """
-    zones = _parse_validation_zones(zones_json)
-    if not zones:
+    zones = parse_zones(zones_json)
+    if not len(zones):
         return 0, []
-    img = ImageOps.exif_transpose(image.convert('L'))
-    arr = np.asarray(img, dtype=np.uint8)
-    h, w = arr.shape
-    coverage_list: List[float] = []
-    for z in zones:
-        x0 = max(0, min(w - 1, int(z['x'] * w)))
-        y0 = max(0, min(h - 1, int(z['y'] * h)))
-        x1 = max(0, min(w, x0 + int(z['w'] * w)))
-        y1 = max(0, min(h, y0 + int(z['h'] * h)))
-        if x1 <= x0 or y1 <= y0:
-            coverage_list.append(0.0)
-            continue
-        crop = arr[y0:y1, x0:x1]
-        # Порог: белый фон ~ >= 240; считаем "чернила" как < 240
-        nonwhite_ratio = float((crop < 240).sum()) / float(crop.size)
-        coverage_list.append(nonwhite_ratio)
+    if integral is None:
+        integral = nonwhite_integral(image)
+    coverage_list = [float(c) for c in zone_coverage(integral, zones)]
     # Порог покрытия зоны, чтобы считать стикер "видимым"
-    stickers = sum(1 for c in coverage_list if c >= 0.20)
+    stickers = sum(1 for c in coverage_list if c >= STICKER_COVERAGE_THRESHOLD)
     return stickers, coverage_list
 
 
-def analyze_leaflet(photo_bytes: bytes) -> Dict[str, Any]:
+def _as_template_list(templates) -> List[Dict[str, Any]]:
+    if not templates:
+        return []
+    if isinstance(templates, dict):
+        return [templates]
+    return [t for t in templates if t]
+
+
+def error_result(note: str = 'analyze_error') -> Dict[str, Any]:
+    """Результат анализа, который не удалось выполнить: статус остается 'pending', note — причина"""
+    return {
+        'width': 0, 'height': 0, 'analysis_scale': 1.0,
+        'blur_score': 0.0, 'is_blurry': False,
+        'exif_has_datetime': False, 'orientation_ok': True,
+        'photo_phash': '', 'similar_phash_count': 0,
+        'required_stickers': 0, 'stickers_count': 0,
+        'zones_coverage': [],
+        'template_id': None, 'template_confidence': 0.0,
+        'leaflet_status': 'pending',
+        'validation_notes': [note],
+        'manual_review_required': 1,
+    }
+
+
+def analysis_params_key(templates=None, max_side: int = LEAFLET_ANALYSIS_MAX_SIDE) -> str:
+    """Ключ параметров анализа: версия алгоритма, порог размытия, масштаб и шаблоны.
+
+    Одинаковое фото с одинаковым ключом дает одинаковые метрики, поэтому
+    ключ используется вместе с хешем содержимого для кэша результатов.
+    """
+    payload = json.dumps({
+        'version': ANALYSIS_VERSION,
+        'max_side': int(max_side),
+        'blur_threshold': LEAFLET_BLUR_THRESHOLD,
+        'templates': [
+            [t.get('id'), int(t.get('required_stickers') or 0), t.get('validation_zones') or '[]',
+             t.get('template_image_path') or '']
+            for t in _as_template_list(templates)
+        ],
+    }, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def analyze_leaflet_image(source: Union[bytes, str], templates=None,
+                          max_side: int = LEAFLET_ANALYSIS_MAX_SIDE) -> Dict[str, Any]:
+    """Чистый (без обращений к БД) анализ фото: метрики качества, pHash, покрытие зон.
+
+    source — байты фото или путь к файлу (для процессного пула передаем путь,
+    чтобы не сериализовать мегабайты между процессами). templates — шаблон или
+    список активных шаблонов: фото оценивается по всем, в результат идет лучший.
+    Исключения не глушатся: их обрабатывает вызывающий код.
+    """
+    img = _image_from_bytes(source) if isinstance(source, (bytes, bytearray)) else Image.open(source)
+    try:
+        width, height = img.size
+
+        # EXIF читаем до декодирования пикселей
+        exif = read_exif_meta(img)
+
+        # Единственное (по возможности уменьшенное) декодирование:
+        # все метрики ниже считаются из gray, разрешение — по заголовку
+        gray = decode_gray(img, max_side=max_side)
+    finally:
+        img.close()
+    factor = max(1, round(max(width, height) / max(gray.shape)))
+
+    # Качество
+    blur = variance_of_laplacian(gray)
+    is_blurry = blur < blur_threshold_for_scale(factor)
+
+    # EXIF
+    exif_dt = bool(exif.get('DateTimeOriginal') or exif.get('DateTime'))
+
+    # Ориентация
+    orientation_ok = exif.get('Orientation') not in (3, 6, 8)
+
+    # pHash
+    phash = compute_ahash_hex(gray)
+
+    # Шаблоны и стикеры: фото выравнивается по эталону каждого шаблона, затем
+    # все зоны всех шаблонов считаются по одному интегральному изображению
+    match = match_templates(gray, nonwhite_integral(gray), _as_template_list(templates))
+
+    return {
+        'width': width,
+        'height': height,
+        'analysis_scale': 1.0 / factor,
+        'blur_score': float(blur),
+        'is_blurry': bool(is_blurry),
+        'exif_has_datetime': bool(exif_dt),
+        'orientation_ok': bool(orientation_ok),
+        'photo_phash': phash,
+        'required_stickers': match['required_stickers'],
+        'stickers_count': match['stickers_count'],
+        'zones_coverage': match['zones_coverage'],
+        'template_id': match['template_id'],
+        'template_confidence': match['template_confidence'],
+        'template_alignment': match['alignment'],
+    }
+
+
+def meets_min_resolution(width: int, height: int) -> bool:
+    """Достаточно ли разрешения для анализа (без учета ориентации: 768×1024 тоже подходит)"""
+    return max(width, height) >= LEAFLET_MIN_LONG_SIDE and min(width, height) >= LEAFLET_MIN_SHORT_SIDE
+
+
+def decide_leaflet_status(metrics: Dict[str, Any], similar_cnt: int) -> Dict[str, Any]:
+    """Решение по статусу лифлета на основе метрик и числа похожих фото в БД."""
+    width, height = metrics['width'], metrics['height']
+    required_stickers = metrics['required_stickers']
+    stickers_count = metrics['stickers_count']
+
+    notes: List[str] = []
+    leaflet_status = 'approved'
+    manual_review = 0
+
+    if not meets_min_resolution(width, height):
+        leaflet_status = 'rejected'
+        notes.append('low_resolution')
+    if metrics['is_blurry']:
+        leaflet_status = 'rejected'
+        notes.append('blurry')
+    if not metrics['orientation_ok']:
+        notes.append('orientation_suspect')
+        manual_review = 1
+    if similar_cnt > 0:
+        leaflet_status = 'duplicate'
+        notes.append('duplicate_photo')
+    if required_stickers > 0 and stickers_count < required_stickers:
+        # Не перекрываем duplicate/rejected, если уже определены более критичные статусы
+        if leaflet_status == 'approved':
+            leaflet_status = 'incomplete'
+        notes.append(f'stickers_{stickers_count}_of_{required_stickers}')
+        # Просим перезаливку, но оставляем на ручную при сомнених
+        manual_review = 1
+    if not metrics['exif_has_datetime']:
+        notes.append('exif_datetime_missing')
+        manual_review = 1
+
+    result = dict(metrics)
+    result.update({
+        'similar_phash_count': int(similar_cnt),
+        'leaflet_status': leaflet_status,
+        'validation_notes': notes,
+        'manual_review_required': int(manual_review),
+    })
+    return result
+
+
+def analyze_leaflet(photo_bytes: bytes, max_side: int = LEAFLET_ANALYSIS_MAX_SIDE) -> Dict[str, Any]:
     """Проводит анализ загруженного фото и возвращает метрики и статусы.
 
     Возврат:
         {
-          width, height, blur_score, is_blurry, exif_has_datetime, orientation_ok,
+          width, height, analysis_scale, blur_score, is_blurry, exif_has_datetime, orientation_ok,
           photo_phash, similar_phash_count,
-          required_stickers, stickers_count, zones_coverage[],
+          required_stickers, stickers_count, zones_coverage[], template_id, template_confidence,
           leaflet_status, validation_notes[], manual_review_required
         }
     """
     try:
-        img = _image_from_bytes(photo_bytes)
-        width, height = img.size
-
-        # Качество
-        blur = variance_of_laplacian(img)
-        is_blurry = blur < 80.0  # эмпирический порог
-
-        # EXIF
-        exif = read_exif_meta(img)
-        exif_dt = bool(exif.get('DateTimeOriginal') or exif.get('DateTime'))
-
-        # Ориентация
-        orientation_ok = True
-        try:
-            orientation = exif.get('Orientation')
-            if orientation in (3, 6, 8):
-                orientation_ok = False
-        except Exception:
-            pass
-
-        # pHash
-        phash = compute_ahash_hex(img)
+        templates = get_active_leaflet_templates()
+        metrics = analyze_leaflet_image(photo_bytes, templates, max_side=max_side)
+        phash = metrics['photo_phash']
         similar_cnt = count_similar_photo_phash(phash) if phash else 0
-
-        # Шаблон и стикеры
-        tpl = get_active_leaflet_template() or {}
-        required_stickers = int(tpl.get('required_stickers') or 0)
-        stickers_count, coverages = _count_stickers_by_zones(img, tpl.get('validation_zones') or '[]') if required_stickers > 0 else (0, [])
-
-        # Решение по статусу
-        notes: List[str] = []
-        leaflet_status = 'approved'
-        manual_review = 0
-
-        if width < 1024 or height < 768:
-            leaflet_status = 'rejected'
-            notes.append('low_resolution')
-        if is_blurry:
-            leaflet_status = 'rejected'
-            notes.append('blurry')
-        if not orientation_ok:
-            notes.append('orientation_suspect')
-            manual_review = 1
-        if similar_cnt > 0:
-            leaflet_status = 'duplicate'
-            notes.append('duplicate_photo')
-        if required_stickers > 0 and stickers_count < required_stickers:
-            # Не перекрываем duplicate/rejected, если уже определены более критичные статусы
-            if leaflet_status == 'approved':
-                leaflet_status = 'incomplete'
-            notes.append(f'stickers_{stickers_count}_of_{required_stickers}')
-            # Просим перезаливку, но оставляем на ручную при сомнених
-            manual_review = 1
-        if not exif_dt:
-            notes.append('exif_datetime_missing')
-            manual_review = 1
-
-        return {
-            'width': width,
-            'height': height,
-            'blur_score': float(blur),
-            'is_blurry': bool(is_blurry),
-            'exif_has_datetime': bool(exif_dt),
-            'orientation_ok': bool(orientation_ok),
-            'photo_phash': phash,
-            'similar_phash_count': int(similar_cnt),
-            'required_stickers': int(required_stickers),
-            'stickers_count': int(stickers_count),
-            'zones_coverage': [float(c) for c in coverages],
-            'leaflet_status': leaflet_status,
-            'validation_notes': notes,
-            'manual_review_required': int(manual_review),
-        }
+        return decide_leaflet_status(metrics, similar_cnt)
     except Exception as e:
         logger.error(f"Ошибка анализа лифлета: {e}")
-        return {
-            'width': 0, 'height': 0,
-            'blur_score': 0.0, 'is_blurry': False,
-            'exif_has_datetime': False, 'orientation_ok': True,
-            'photo_phash': '', 'similar_phash_count': 0,
-            'required_stickers': 0, 'stickers_count': 0,
-            'zones_coverage': [],
-            'leaflet_status': 'pending',
-            'validation_notes': ['analyze_error'],
-            'manual_review_required': 1,
-        }
+        return error_result()
 
 
 __all__ = [
+    'ANALYSIS_VERSION',
+    'meets_min_resolution',
     'analyze_leaflet',
+    'analyze_leaflet_image',
+    'analysis_params_key',
+    'decide_leaflet_status',
+    'error_result',
     'compute_ahash_hex',
+    'decode_gray',
+    'nonwhite_integral',
+    'variance_of_laplacian',
 ]
 
 
@@ -0,0 +1,91 @@
+"""
+Склейка альбомов (media group) в одну отправку
+
+Альбом приходит отдельным апдейтом на каждое фото с общим media_group_id.
+Буфер собирает апдейты группы, пока новые приходят чаще, чем раз в window
+секунд (но не дольше max_wait от первого), и один раз вызывает обработчик
+со всеми сообщениями группы — регистрация и скачивание выполняются один
+раз, без гонки нескольких save_application на UNIQUE-ограничениях.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from config import MEDIA_GROUP_WINDOW, MEDIA_GROUP_MAX_WAIT
+
+logger = logging.getLogger(__name__)
+
+
+class _Group:
+    __slots__ = ('messages', 'started_at', 'timer', 'version')
+
+    def __init__(self, started_at: float):
+        self.messages: List[Any] = []
+        self.started_at = started_at
+        self.timer: Optional[threading.Timer] = None
+        self.version = 0
+
+
+class MediaGroupCoalescer:
+    """Буфер апдейтов альбома по media_group_id."""
+
+    def __init__(self, on_group: Callable[[List[Any]], None], window: float = MEDIA_GROUP_WINDOW,
+                 max_wait: float = MEDIA_GROUP_MAX_WAIT):
+        self._on_group = on_group
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self._lock = threading.Lock()
+        self._groups: Dict[str, _Group] = {}
+        self.groups_flushed = 0
+        self.messages_coalesced = 0
+
+    def add(self, message: Any) -> None:
+        """Добавляет сообщение альбома; обработчик вызовется после паузы в поступлении"""
+        group_id = message.media_group_id
+        now = time.monotonic()
+        with self._lock:
+            group = self._groups.get(group_id)
+            if group is None:
+                group = self._groups[group_id] = _Group(now)
+            group.messages.append(message)
+            if group.timer is not None:
+                group.timer.cancel()
+            group.version += 1
+            delay = max(0.0, min(self.window, group.started_at + self.max_wait - now))
+            group.timer = threading.Timer(delay, self._flush, args=(group_id, group, group.version))
+            group.timer.daemon = True
+            group.timer.start()
+
+    def _flush(self, group_id: str, group: _Group, version: int) -> None:
+        with self._lock:
+            # Таймер мог быть заменен более поздним апдейтом той же группы
+            if self._groups.get(group_id) is not group or group.version != version:
+                return
+            del self._groups[group_id]
+            self.groups_flushed += 1
+            self.messages_coalesced += len(group.messages) - 1
+        messages = sorted(group.messages, key=lambda m: m.message_id)
+        try:
+            self._on_group(messages)
+        except Exception as e:
+            logger.error(f"Ошибка обработки альбома {group_id}: {e}")
+
+    def flush_all(self) -> None:
+        """Немедленно обрабатывает все накопленные группы (остановка бота, тесты)"""
+        with self._lock:
+            pending = [(group_id, group, group.version) for group_id, group in self._groups.items()]
+            for _, group, _ in pending:
+                group.timer.cancel()
+        for group_id, group, version in pending:
+            self._flush(group_id, group, version)
+
+    def pending_groups(self) -> int:
+        with self._lock:
+            return len(self._groups)
+
+
+__all__ = [
+    'MediaGroupCoalescer',
+]
@@ -0,0 +1,92 @@
+"""
+Индекс перцептивных хешей фото в памяти
+
+count_similar_photo_phash сканирует всю таблицу на каждый вызов, что при
+массовой перевалидации дает O(N^2). Индекс загружает все pHash один раз в
+массив uint64 и считает расстояние Хэмминга векторно (XOR + popcount).
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from database.db_manager import get_all_photo_phashes
+
+# Таблица popcount по байтам — для NumPy без np.bitwise_count (< 2.0)
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _popcount64(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return _POPCOUNT8[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _parse_phash(phash: str) -> Optional[int]:
+    try:
+        value = int(phash, 16)
+    except (TypeError, ValueError):
+        return None
+    return value if 0 <= value < (1 << 64) else None
+
+
+class PhashIndex:
+    """pHash всех заявок: id -> 64-битный хеш, поиск похожих за один проход."""
+
+    def __init__(self, items: Iterable[Tuple[int, str]] = ()):
+        self._lock = threading.Lock()
+        self._positions: Dict[int, int] = {}
+        ids, hashes = [], []
+        for app_id, phash in items:
+            value = _parse_phash(phash)
+            if value is None or app_id in self._positions:
+                continue
+            self._positions[app_id] = len(ids)
+            ids.append(app_id)
+            hashes.append(value)
+        self._ids = np.array(ids, dtype=np.int64)
+        self._hashes = np.array(hashes, dtype=np.uint64)
+        self._valid = np.ones(len(ids), dtype=bool)
+
+    @classmethod
+    def from_db(cls) -> "PhashIndex":
+        return cls(get_all_photo_phashes())
+
+    def __len__(self) -> int:
+        return int(self._valid.sum())
+
+    def update(self, app_id: int, phash: str) -> None:
+        """Заменяет pHash заявки (после перевалидации хеш мог измениться)."""
+        value = _parse_phash(phash)
+        with self._lock:
+            pos = self._positions.get(app_id)
+            if pos is not None:
+                if value is None:
+                    self._valid[pos] = False
+                else:
+                    self._hashes[pos] = value
+                    self._valid[pos] = True
+            elif value is not None:
+                self._positions[app_id] = len(self._ids)
+                self._ids = np.append(self._ids, np.int64(app_id))
+                self._hashes = np.append(self._hashes, np.uint64(value))
+                self._valid = np.append(self._valid, True)
+
+    def count_similar(self, phash: str, max_hamming_distance: int = 5,
+                      exclude_id: Optional[int] = None) -> int:
+        """Число pHash в пределах расстояния Хэмминга (без самой заявки exclude_id)."""
+        value = _parse_phash(phash)
+        if value is None or not len(self._ids):
+            return 0
+        with self._lock:
+            distances = _popcount64(np.bitwise_xor(self._hashes, np.uint64(value)))
+            mask = (distances <= max_hamming_distance) & self._valid
+            if exclude_id is not None:
+                mask &= self._ids != exclude_id
+            return int(mask.sum())
+
+
+__all__ = ['PhashIndex']
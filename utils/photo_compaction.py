@@ -0,0 +1,224 @@
+"""
+Перекодирование хранимых фото в WebP/AVIF
+
+Фото лифлетов хранятся бессрочно в том виде, в каком их отдал Telegram.
+Компактор перекодирует файлы хранилища (photos/ab/cd/<sha256>.jpg) в WebP
+или AVIF в пуле процессов с пониженным приоритетом. Замена выполняется
+только если новый файл декодируется, заметно меньше, а входные данные
+анализа не меняются: aHash отличается не больше чем на PHASH_TOLERANCE бит,
+а резкое фото остается резким с запасом BLUR_MARGIN над порогом. Кодек
+сглаживает шум сенсора, поэтому дисперсия лапласиана может заметно упасть —
+важен не сам балл, а то, что вердикт "размыто" не меняется.
+Имя файла остается хешем исходной загрузки, меняется только расширение,
+поэтому дедупликация, кэш анализа и превью продолжают работать.
+Проверенные файлы отмечаются в photo_blobs.compacted_at — повторный запуск
+продолжает с непроверенных. При удаленном хранилище файл перекодируется из
+локального кэша, а результат загружается обратно под новым ключом.
+"""
+
+from __future__ import annotations
+
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from PIL import Image, features
+
+from config import (
+    PHOTO_COMPACTION_FORMAT, PHOTO_COMPACTION_QUALITY, PHOTO_COMPACTION_WORKERS, PHOTO_COMPACTION_NICE,
+    LEAFLET_ANALYSIS_MAX_SIDE,
+)
+from database.db_manager import get_compaction_candidates, mark_photo_compacted
+from utils.image_validation import decode_gray, compute_ahash_hex, variance_of_laplacian, blur_threshold_for_scale
+from utils.file_handler import LocalPhotoStorage
+from utils.photo_store import write_atomic, storage_for, photo_key, local_photo_path, replace_stored_photo
+
+logger = logging.getLogger(__name__)
+
+PHASH_TOLERANCE = 2       # бит aHash из 64
+BLUR_MARGIN = 0.10        # запас над порогом размытости после перекодирования
+MIN_SAVING = 0.10         # меньше 10% экономии — оставляем оригинал
+PAGE_SIZE = 200
+
+_FORMATS = {'webp': ('WEBP', '.webp'), 'avif': ('AVIF', '.avif')}
+
+
+def resolve_format(fmt: str = PHOTO_COMPACTION_FORMAT) -> str:
+    """Целевой формат с учетом поддержки в Pillow (AVIF → WebP, если нет кодека)"""
+    fmt = (fmt or 'webp').lower()
+    if fmt not in _FORMATS:
+        raise ValueError(f"Неподдерживаемый формат перекодирования: {fmt}")
+    if fmt == 'avif' and not features.check('avif'):
+        logger.warning("Pillow собран без AVIF, перекодируем в WebP")
+        fmt = 'webp'
+    return fmt
+
+
+def _lower_priority(nice: int) -> None:
+    """Инициализатор процесса: пониженный приоритет, чтобы не мешать боту и анализу"""
+    try:
+        os.nice(nice)
+    except (AttributeError, OSError):
+        pass
+
+
+def _analysis_inputs(image: Image.Image) -> tuple:
+    """aHash, резкость и порог размытости — как их посчитает analyze_leaflet_image"""
+    long_side = max(image.size)
+    gray = decode_gray(image, max_side=LEAFLET_ANALYSIS_MAX_SIDE)
+    factor = max(1, round(long_side / max(gray.shape)))
+    return compute_ahash_hex(gray), variance_of_laplacian(gray), blur_threshold_for_scale(factor)
+
+
+def recode_photo(path: str, fmt: str, quality: int, write: bool = True) -> Dict[str, Any]:
+    """
+    Задача процесса: перекодирует один файл и проверяет результат
+
+    Returns:
+        dict: status ('recoded' | 'no_gain' | 'phash_changed' | 'blur_changed' | 'error'),
+        old_bytes, new_bytes, new_path
+    """
+    pil_format, ext = _FORMATS[fmt]
+    result = {'path': path, 'status': 'error', 'old_bytes': 0, 'new_bytes': 0, 'new_path': None}
+    try:
+        result['old_bytes'] = os.path.getsize(path)
+        with Image.open(path) as original:
+            exif = original.info.get('exif')
+            source = original.convert('RGB') if original.mode not in ('RGB', 'L') else original.copy()
+        with Image.open(path) as original:
+            # Отдельное открытие: decode_gray включает draft-режим JPEG
+            ahash_before, blur_before, threshold = _analysis_inputs(original)
+
+        buf = io.BytesIO()
+        save_kwargs = {'quality': int(quality)}
+        if exif:
+            save_kwargs['exif'] = exif  # DateTime/Orientation нужны анализу
+        if pil_format == 'WEBP':
+            save_kwargs['method'] = 6
+        source.save(buf, pil_format, **save_kwargs)
+        data = buf.getvalue()
+        result['new_bytes'] = len(data)
+
+        # Проверка декодирования и стабильности входов анализа
+        with Image.open(io.BytesIO(data)) as recoded:
+            recoded.load()
+            if recoded.size != source.size:
+                result['status'] = 'error'
+                result['error'] = 'size_mismatch'
+                return result
+            ahash_after, blur_after, _ = _analysis_inputs(recoded)
+        if bin(int(ahash_before, 16) ^ int(ahash_after, 16)).count('1') > PHASH_TOLERANCE:
+            result['status'] = 'phash_changed'
+        elif blur_before >= threshold and blur_after < threshold * (1.0 + BLUR_MARGIN):
+            result['status'] = 'blur_changed'
+        elif len(data) > result['old_bytes'] * (1.0 - MIN_SAVING):
+            result['status'] = 'no_gain'
+        else:
+            result['status'] = 'recoded'
+            result['new_path'] = os.path.splitext(path)[0] + ext
+            if write:
+                write_atomic(result['new_path'], data)
+        return result
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+
+
+def _replace_stored(content_hash: str, path: str, result: Dict[str, Any], stats: Dict[str, Any]) -> None:
+    """Переносит ссылки на перекодированный файл и удаляет оригинал из хранилища"""
+    new_path = os.path.splitext(path)[0] + os.path.splitext(result['new_path'])[1]
+    new_key = photo_key(new_path)
+    storage = storage_for()
+    if not isinstance(storage, LocalPhotoStorage) and new_key is not None:
+        storage.put_file(new_key, result['new_path'])
+    updated = replace_stored_photo(content_hash, path, new_path, result['new_bytes'])
+    if updated is None:
+        logger.info(f"Фото {content_hash[:12]} удалено во время перекодирования, новая копия убрана")
+    stats['applications_updated'] += updated or 0
+
+
+def compact_storage(fmt: str = PHOTO_COMPACTION_FORMAT, quality: int = PHOTO_COMPACTION_QUALITY,
+                    workers: int = PHOTO_COMPACTION_WORKERS, limit: int = 0, dry_run: bool = False,
+                    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Перекодирует непроверенные файлы хранилища и возвращает сводку
+
+    Args:
+        fmt: 'webp' или 'avif'
+        quality: Качество кодека (0-100)
+        workers: Число процессов
+        limit: Максимум файлов за запуск (0 — все)
+        dry_run: Только оценить экономию, ничего не менять
+        on_progress: Колбэк со сводкой после каждой страницы
+    """
+    fmt = resolve_format(fmt)
+    stats = {'format': fmt, 'quality': quality, 'checked': 0, 'recoded': 0, 'kept': 0, 'errors': 0,
+             'bytes_before': 0, 'bytes_after': 0, 'bytes_saved': 0, 'applications_updated': 0, 'dry_run': dry_run}
+    executor = ProcessPoolExecutor(
+        max_workers=max(1, workers),
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_lower_priority,
+        initargs=(PHOTO_COMPACTION_NICE,),
+    )
+    after_hash = ''
+    try:
+        while not limit or stats['checked'] < limit:
+            page_size = PAGE_SIZE if not limit else min(PAGE_SIZE, limit - stats['checked'])
+            page = get_compaction_candidates(after_hash, page_size)
+            if not page:
+                break
+            after_hash = page[-1][0]
+            # Скачивание из удаленного хранилища — в основном процессе, чтобы
+            # кэш и очередь загрузок были одни на весь запуск
+            futures = []
+            for content_hash, path, _ in page:
+                local_path = local_photo_path(path)
+                if local_path is None:
+                    futures.append((content_hash, path, None))
+                    continue
+                futures.append((content_hash, path, executor.submit(recode_photo, local_path, fmt, quality, not dry_run)))
+            for content_hash, path, future in futures:
+                if future is None:
+                    result = {'path': path, 'status': 'error', 'old_bytes': 0, 'new_bytes': 0,
+                              'new_path': None, 'error': 'photo_missing'}
+                else:
+                    result = future.result()
+                stats['checked'] += 1
+                stats['bytes_before'] += result['old_bytes']
+                if result['status'] == 'recoded':
+                    stats['recoded'] += 1
+                    stats['bytes_after'] += result['new_bytes']
+                    if not dry_run:
+                        _replace_stored(content_hash, path, result, stats)
+                    continue
+                stats['bytes_after'] += result['old_bytes']
+                if result['status'] == 'error':
+                    stats['errors'] += 1
+                    logger.warning(f"Не удалось перекодировать {result['path']}: {result.get('error')}")
+                    # Отсутствующий/битый файл не отмечаем — попробуем в следующий раз
+                    continue
+                stats['kept'] += 1
+                if not dry_run:
+                    mark_photo_compacted(content_hash)
+            stats['bytes_saved'] = stats['bytes_before'] - stats['bytes_after']
+            if on_progress:
+                on_progress(dict(stats))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    logger.info(
+        f"Перекодирование ({fmt}, q={quality}): проверено {stats['checked']}, перекодировано {stats['recoded']}, "
+        f"сэкономлено {stats['bytes_saved']} байт"
+    )
+    return stats
+
+
+__all__ = [
+    'PHASH_TOLERANCE',
+    'BLUR_MARGIN',
+    'resolve_format',
+    'recode_photo',
+    'compact_storage',
+]
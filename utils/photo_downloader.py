@@ -0,0 +1,295 @@
+"""
+Отложенное скачивание фото заявок
+
+Обработчик бота сохраняет заявку вместе с file_id фото и сразу отвечает
+пользователю: вся работа на шаге фото — одна запись в БД. Файл скачивает
+этот пул потоков: по очереди photo_downloads в БД диспетчер раздает готовые
+к попытке заявки потокам, поток проверяет точный дубликат по
+file_unique_id, скачивает файл потоком (с хешем по ходу записи), сохраняет
+его и ставит заявку в очередь анализа. Когда судьба фото решена (скачано,
+дубликат, отклонено или окончательно не скачалось), заявка уходит в
+очередь скоринга риска — уже с хешем фото. Ошибки повторяются с
+экспоненциальной задержкой; после PHOTO_DOWNLOAD_MAX_ATTEMPTS заявка
+переходит в очередь неудачных (status = 'failed'), откуда ее возвращают
+requeue_failed(). Очередь живет в БД, поэтому после рестарта скачивание
+продолжается с того же места.
+
+Пользователь получает ответ раньше, чем файл скачан, поэтому об отклоненном
+файле (мал, велик, не читается) ему сообщает on_rejected — бот просит
+прислать другое фото. Если заявку удалили, пока фото скачивалось, ссылка на
+сохраненный файл освобождается.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+from config import (
+    PHOTO_DOWNLOAD_WORKERS, PHOTO_DOWNLOAD_MAX_ATTEMPTS, PHOTO_DOWNLOAD_RETRY_BASE_DELAY,
+    PHOTO_DOWNLOAD_POLL_INTERVAL,
+)
+from database.db_manager import (
+    get_due_photo_downloads, complete_photo_download, reschedule_photo_download,
+    requeue_failed_photo_downloads, get_photo_download_stats, find_application_by_file_unique_id,
+)
+from utils.analysis_queue import get_analysis_queue, PRIORITY_FRESH
+from utils.file_handler import get_telegram_file_path, iter_telegram_file
+from utils.photo_intake import PhotoRejected, gate_image_stream
+from utils.photo_store import store_photo_stream, retain_photo, release_photo, photo_extension
+from utils.risk_queue import get_risk_queue
+from utils.thumbnails import warm_thumbnail
+
+logger = logging.getLogger(__name__)
+
+RETRY_MAX_DELAY = 600.0  # сек, потолок экспоненциальной задержки
+
+
+def _telegram_chunks(file_id: str) -> Iterator[bytes]:
+    return iter_telegram_file(get_telegram_file_path(file_id))
+
+
+def _is_permanent(error: Exception) -> bool:
+    """Ошибки, которые повтор не исправит: неверный file_id, файл больше лимита Bot API"""
+    return getattr(error, 'error_code', None) == 400
+
+
+class PhotoDownloader:
+    """Пул фонового скачивания фото с очередью в БД."""
+
+    def __init__(self, workers: int = PHOTO_DOWNLOAD_WORKERS, max_attempts: int = PHOTO_DOWNLOAD_MAX_ATTEMPTS,
+                 retry_base_delay: float = PHOTO_DOWNLOAD_RETRY_BASE_DELAY,
+                 poll_interval: float = PHOTO_DOWNLOAD_POLL_INTERVAL,
+                 fetch: Callable[[str], Iterator[bytes]] = _telegram_chunks,
+                 on_downloaded: Optional[Callable[[int, str], None]] = None,
+                 on_resolved: Optional[Callable[[int, str], None]] = None,
+                 on_rejected: Optional[Callable[[Dict[str, Any], PhotoRejected], None]] = None):
+        self.workers = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_base_delay = retry_base_delay
+        self.poll_interval = poll_interval
+        self._fetch = fetch
+        self._on_downloaded = on_downloaded
+        self._on_resolved = on_resolved
+        # Задается ботом после создания пула: уведомление пользователя об отклоненном файле
+        self.on_rejected = on_rejected
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._dispatcher: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._in_flight: Set[int] = set()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+        self.outcomes = {'downloaded': 0, 'duplicate': 0, 'rejected': 0, 'retry': 0, 'failed': 0, 'deleted': 0}
+
+    # --- Жизненный цикл --------------------------------------------------------
+
+    def start(self) -> None:
+        if self._dispatcher is not None:
+            return
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="PhotoDownload")
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="PhotoDownloadDispatch", daemon=True)
+        self._dispatcher.start()
+        logger.info(f"Скачивание фото запущено ({self.workers} потоков)")
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._dispatcher is not None:
+            self._dispatcher.join(timeout=timeout)
+            self._dispatcher = None
+        if self._executor is not None:
+            # Незавершенные скачивания остаются в БД и продолжатся после рестарта
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def notify(self) -> None:
+        """Будит диспетчер: в очереди появилась новая заявка"""
+        self._wake.set()
+
+    def requeue_failed(self, application_ids: List[int] = None) -> int:
+        """Возвращает неудачные скачивания в очередь"""
+        count = requeue_failed_photo_downloads(application_ids)
+        if count:
+            logger.info(f"Скачивание фото: {count} заявок возвращено в очередь")
+            self.notify()
+        return count
+
+    # --- Диспетчер ---------------------------------------------------------------
+
+    def _dispatch_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.dispatch_due()
+            except Exception as e:
+                logger.error(f"Скачивание фото: ошибка диспетчера: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def dispatch_due(self) -> int:
+        """Раздает потокам готовые к попытке заявки; очередь в пуле — не больше двух на поток"""
+        with self._lock:
+            free = self.workers * 2 - len(self._in_flight)
+            busy = set(self._in_flight)
+        if free <= 0 or self._executor is None:
+            return 0
+        rows = [row for row in get_due_photo_downloads(free + len(busy)) if row['application_id'] not in busy][:free]
+        for row in rows:
+            with self._lock:
+                self._in_flight.add(row['application_id'])
+            self._executor.submit(self._run, row)
+        return len(rows)
+
+    def _run(self, row: Dict[str, Any]) -> None:
+        try:
+            self.process(row)
+        except Exception as e:
+            logger.error(f"Скачивание фото: необработанная ошибка заявки {row['application_id']}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(row['application_id'])
+            # Освободился слот — забираем следующую заявку, не дожидаясь опроса
+            self._wake.set()
+
+    # --- Обработка одной заявки ----------------------------------------------------
+
+    def process(self, row: Dict[str, Any]) -> str:
+        """
+        Скачивает фото одной заявки из очереди
+
+        Returns:
+            str: 'downloaded' | 'duplicate' | 'rejected' | 'retry' | 'failed' | 'deleted'
+        """
+        app_id = row['application_id']
+        try:
+            outcome = self._download(row)
+        except PhotoRejected as e:
+            saved = complete_photo_download(app_id, '', '', leaflet_status='rejected',
+                                            validation_notes=json.dumps([f'photo_{e.reason}']))
+            logger.info(f"Скачивание фото: файл заявки {app_id} отклонен ({e})")
+            outcome = 'rejected' if saved else 'deleted'
+            if saved and self.on_rejected is not None:
+                try:
+                    self.on_rejected(row, e)
+                except Exception as notify_error:
+                    logger.error(f"Скачивание фото: не удалось сообщить об отклоненном файле заявки {app_id}: "
+                                 f"{notify_error}")
+        except Exception as e:
+            attempts = row.get('attempts', 0) + 1
+            if _is_permanent(e) or attempts >= self.max_attempts:
+                reschedule_photo_download(app_id, str(e), None)
+                logger.error(f"Скачивание фото: заявка {app_id} в очереди неудачных после {attempts} попыток: {e}")
+                outcome = 'failed'
+            else:
+                delay = min(RETRY_MAX_DELAY, self.retry_base_delay * (2 ** (attempts - 1)))
+                reschedule_photo_download(app_id, str(e), time.time() + delay)
+                logger.warning(f"Скачивание фото: заявка {app_id}, попытка {attempts} не удалась, повтор через {delay:.0f}с: {e}")
+                outcome = 'retry'
+        with self._lock:
+            self.outcomes[outcome] += 1
+        if outcome not in ('retry', 'deleted') and self._on_resolved is not None:
+            self._on_resolved(app_id, outcome)
+        return outcome
+
+    def _download(self, row: Dict[str, Any]) -> str:
+        app_id = row['application_id']
+        # Пересланное фото уже скачано для другой заявки — берем сохраненный файл
+        duplicate_of = find_application_by_file_unique_id(row.get('file_unique_id'), exclude_id=app_id)
+        photo_path = retain_photo(duplicate_of['photo_path']) if duplicate_of else None
+        if photo_path:
+            try:
+                saved = complete_photo_download(
+                    app_id, photo_path, duplicate_of['photo_hash'], leaflet_status='duplicate',
+                    validation_notes=json.dumps(['duplicate_photo', f"duplicate_of_{duplicate_of['id']}"]),
+                    photo_phash=duplicate_of.get('photo_phash') or '',
+                )
+            except BaseException:
+                release_photo(photo_path)
+                raise
+            if not saved:
+                return self._application_gone(app_id, photo_path)
+            logger.info(f"Скачивание фото: заявка {app_id} — дубликат заявки {duplicate_of['id']}, скачивание пропущено")
+            return 'duplicate'
+
+        # Изображение-документ хранится в своем формате (png/webp), фото Telegram — jpg
+        mime_type = row.get('mime_type')
+        chunks = gate_image_stream(self._fetch(row['file_id']), document=bool(mime_type))
+        photo_path, photo_hash = store_photo_stream(chunks, ext=photo_extension(mime_type))
+        logger.info(f"Скачивание фото: фото заявки {app_id} сохранено: {photo_path}")
+        try:
+            saved = complete_photo_download(app_id, photo_path, photo_hash)
+        except BaseException:
+            release_photo(photo_path)
+            raise
+        if not saved:
+            return self._application_gone(app_id, photo_path)
+        if self._on_downloaded is not None:
+            self._on_downloaded(app_id, photo_path)
+        return 'downloaded'
+
+    @staticmethod
+    def _application_gone(app_id: int, photo_path: str) -> str:
+        release_photo(photo_path)
+        logger.info(f"Скачивание фото: заявка {app_id} удалена во время скачивания, файл освобожден")
+        return 'deleted'
+
+    # --- Метрики ----------------------------------------------------------------
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._in_flight)
+            outcomes = dict(self.outcomes)
+        queue = get_photo_download_stats()
+        return {
+            'running': self._dispatcher is not None,
+            'in_flight': in_flight,
+            'queue_pending': queue.get('pending', 0),
+            'queue_failed': queue.get('failed', 0),
+            **outcomes,
+        }
+
+
+def _after_download(app_id: int, photo_path: str) -> None:
+    # Анализ — асинхронно, свежие регистрации идут вперед бэклога
+    get_analysis_queue().enqueue(app_id, photo_path, PRIORITY_FRESH)
+    # Превью для галереи админки строим сразу, пока фото в page cache
+    warm_thumbnail(photo_path)
+
+
+def _after_resolve(app_id: int, outcome: str) -> None:
+    # Риск считается, когда photo_hash уже известен (или известно, что фото не будет)
+    get_risk_queue().enqueue(app_id, PRIORITY_FRESH)
+
+
+_photo_downloader: Optional[PhotoDownloader] = None
+_photo_downloader_lock = threading.Lock()
+
+
+def get_photo_downloader() -> PhotoDownloader:
+    """Синглтон пула скачивания (создание не запускает потоки)."""
+    global _photo_downloader
+    if _photo_downloader is None:
+        with _photo_downloader_lock:
+            if _photo_downloader is None:
+                _photo_downloader = PhotoDownloader(on_downloaded=_after_download,
+                                                    on_resolved=_after_resolve)
+    return _photo_downloader
+
+
+def start_photo_downloader() -> PhotoDownloader:
+    downloader = get_photo_downloader()
+    downloader.start()
+    return downloader
+
+
+__all__ = [
+    'PhotoDownloader',
+    'get_photo_downloader',
+    'start_photo_downloader',
+]
@@ -0,0 +1,189 @@
+"""
+Прием фото из Telegram до скачивания
+
+Telegram присылает фото в нескольких вариантах PhotoSize (от миниатюры ~90px
+до оригинала). Бот выбирает наименьший вариант, которого хватает для анализа
+(LEAFLET_MIN_LONG_SIDE × LEAFLET_MIN_SHORT_SIDE) и который не превышает
+PHOTO_MAX_FILE_SIZE_MB, — по метаданным, без скачивания. Изображение,
+отправленное файлом (document), проходит тот же фильтр: тип и размер файла
+проверяются по метаданным, а разрешение — по заголовку, как только он
+скачан, не дожидаясь остальных байт.
+"""
+
+import io
+import logging
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+from config import LEAFLET_MIN_LONG_SIDE, LEAFLET_MIN_SHORT_SIDE, PHOTO_MAX_FILE_SIZE_MB
+from utils.image_validation import meets_min_resolution
+
+logger = logging.getLogger(__name__)
+
+PHOTO_MAX_FILE_SIZE = int(PHOTO_MAX_FILE_SIZE_MB * 1024 * 1024)
+
+IMAGE_DOCUMENT_MIMETYPES = ('image/jpeg', 'image/png', 'image/webp')
+
+# Сколько первых байт ждем, чтобы прочитать размеры из заголовка
+HEADER_PROBE_LIMIT = 256 * 1024
+
+
+class PhotoRejected(ValueError):
+    """
+    Фото не подходит для приема; reason — 'too_small' | 'too_large' | 'unsupported_type'
+
+    document — файл прислан документом (от этого зависит подсказка пользователю)
+    """
+
+    def __init__(self, reason: str, detail: str = '', document: bool = False):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+        self.document = document
+
+
+def select_photo_size(sizes: Iterable[Any], max_bytes: int = PHOTO_MAX_FILE_SIZE) -> Any:
+    """
+    Наименьший PhotoSize, достаточный для анализа и не больше max_bytes
+
+    Args:
+        sizes: message.photo (объекты с width, height, file_size)
+        max_bytes: Максимальный размер файла
+
+    Raises:
+        PhotoRejected: Ни один вариант не подходит
+    """
+    sizes = list(sizes or [])
+    large_enough = [s for s in sizes if meets_min_resolution(s.width, s.height)]
+    if not large_enough:
+        biggest = max(sizes, key=lambda s: s.width * s.height, default=None)
+        raise PhotoRejected('too_small', f"{biggest.width}x{biggest.height}" if biggest else 'нет вариантов')
+    # file_size в PhotoSize необязателен — неизвестный размер не отсекаем
+    fitting = [s for s in large_enough if not s.file_size or s.file_size <= max_bytes]
+    if not fitting:
+        raise PhotoRejected('too_large', f"{min(s.file_size for s in large_enough)} байт")
+    return min(fitting, key=lambda s: (s.width * s.height, s.file_size or 0))
+
+
+def is_image_document(document: Any) -> bool:
+    """Документ — изображение поддерживаемого типа (фото, отправленное файлом)"""
+    return bool(document) and (document.mime_type or '').lower() in IMAGE_DOCUMENT_MIMETYPES
+
+
+def check_image_document(document: Any, max_bytes: int = PHOTO_MAX_FILE_SIZE) -> Any:
+    """
+    Проверяет документ-изображение по метаданным
+
+    Raises:
+        PhotoRejected: Не изображение или файл слишком большой
+    """
+    if not is_image_document(document):
+        raise PhotoRejected('unsupported_type', getattr(document, 'mime_type', '') or '', document=True)
+    if document.file_size and document.file_size > max_bytes:
+        raise PhotoRejected('too_large', f"{document.file_size} байт", document=True)
+    return document
+
+
+def select_intake_file(message: Any, max_bytes: int = PHOTO_MAX_FILE_SIZE) -> Any:
+    """Файл для скачивания из сообщения: подходящий PhotoSize или документ-изображение"""
+    if message.photo:
+        return select_photo_size(message.photo, max_bytes)
+    return check_image_document(message.document, max_bytes)
+
+
+def select_best_intake(messages: List[Any], max_bytes: int = PHOTO_MAX_FILE_SIZE) -> Tuple[Any, Any]:
+    """
+    Лучшее фото альбома: из подходящих — с наибольшим разрешением выбранного
+    варианта (у документов разрешение заранее неизвестно, они идут после фото)
+
+    Returns:
+        tuple: (сообщение, файл для скачивания)
+
+    Raises:
+        PhotoRejected: Ни одно фото альбома не подходит (причина первого)
+    """
+    candidates = []
+    first_error: Optional[PhotoRejected] = None
+    for message in messages:
+        try:
+            file = select_intake_file(message, max_bytes)
+        except PhotoRejected as e:
+            first_error = first_error or e
+            continue
+        area = (getattr(file, 'width', 0) or 0) * (getattr(file, 'height', 0) or 0)
+        candidates.append((area, message, file))
+    if not candidates:
+        raise first_error or PhotoRejected('unsupported_type', 'пустой альбом')
+    _, message, file = max(candidates, key=lambda c: c[0])
+    return message, file
+
+
+def _probe_size(head: bytes) -> Optional[tuple]:
+    try:
+        with Image.open(io.BytesIO(head)) as image:
+            return image.size  # Image.open читает только заголовок
+    except Exception:
+        return None
+
+
+def gate_image_stream(chunks: Iterable[bytes], max_bytes: int = PHOTO_MAX_FILE_SIZE,
+                      document: bool = False) -> Iterator[bytes]:
+    """
+    Пропускает блоки скачивания, обрывая его, как только фото не подходит
+
+    Размеры читаются из заголовка по первым блокам; file_size в метаданных
+    может отсутствовать, поэтому объем считается и по факту. document
+    передается в PhotoRejected.
+
+    Raises:
+        PhotoRejected: Разрешение меньше минимального, файл больше max_bytes
+        или заголовок не читается как изображение
+    """
+    head = b''
+    checked = False
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > max_bytes:
+            raise PhotoRejected('too_large', f"больше {max_bytes} байт", document)
+        if not checked:
+            head += chunk
+            size = _probe_size(head)
+            if size is not None:
+                checked = True
+                head = b''
+                if not meets_min_resolution(*size):
+                    raise PhotoRejected('too_small', f"{size[0]}x{size[1]}", document)
+            elif len(head) >= HEADER_PROBE_LIMIT:
+                raise PhotoRejected('unsupported_type', 'заголовок изображения не распознан', document)
+        yield chunk
+    if not checked:
+        size = _probe_size(head)
+        if size is None:
+            raise PhotoRejected('unsupported_type', 'заголовок изображения не распознан', document)
+        if not meets_min_resolution(*size):
+            raise PhotoRejected('too_small', f"{size[0]}x{size[1]}", document)
+
+
+def rejection_message(error: PhotoRejected, messages: dict) -> str:
+    """Текст ответа пользователю для отклоненного фото"""
+    if error.reason == 'too_small':
+        return messages['photo_too_small'].format(min_long=LEAFLET_MIN_LONG_SIDE, min_short=LEAFLET_MIN_SHORT_SIDE)
+    if error.reason == 'too_large':
+        text = messages['photo_too_large'].format(max_mb=PHOTO_MAX_FILE_SIZE_MB)
+        # Фото, отправленное как изображение, Telegram сжимает — совет имеет смысл только для файла
+        return f"{text}\n{messages['photo_send_as_image']}" if error.document else text
+    return messages['invalid_photo']
+
+
+__all__ = [
+    'PHOTO_MAX_FILE_SIZE',
+    'PhotoRejected',
+    'select_photo_size',
+    'is_image_document',
+    'check_image_document',
+    'select_intake_file',
+    'select_best_intake',
+    'gate_image_stream',
+    'rejection_message',
+]
@@ -0,0 +1,322 @@
+"""
+Хранилище фото по хешу содержимого
+
+Файл называется SHA-256 своего содержимого и раскладывается по вложенным
+каталогам photos/ab/cd/<sha256>.jpg, чтобы в одном каталоге не копились
+сотни тысяч файлов. Одинаковые байты хранятся один раз, ссылки считаются в
+photo_blobs (refcount). Байты пишутся через хранилище из get_photo_storage()
+(локальный каталог или S3-совместимое с локальным кэшем); в БД хранится путь
+PHOTOS_DIR/ab/cd/<sha256>.jpg, одинаковый для всех бэкендов. Локальная запись
+атомарная: временный файл в том же каталоге, fsync и os.replace.
+"""
+
+import hashlib
+import logging
+import os
+import posixpath
+import re
+import tempfile
+import threading
+from typing import Callable, Iterable, Optional, Tuple
+
+from config import PHOTOS_DIR
+from database.db_manager import acquire_photo_blob, release_photo_blob, mark_photo_compacted
+from utils.file_handler import PhotoStorage, LocalPhotoStorage, get_photo_storage, write_atomic
+
+logger = logging.getLogger(__name__)
+
+SHARD_LEVELS = 2      # photos/ab/cd/...
+SHARD_WIDTH = 2       # символов хеша на уровень
+DEFAULT_EXT = '.jpg'
+
+# Форматы хранимых фото. Имя файла — SHA-256 исходной загрузки, поэтому после
+# перекодирования (jpg → webp/avif) путь меняется только расширением; при
+# поиске по хешу перекодированные варианты проверяются первыми
+PHOTO_MIMETYPES = {
+    '.avif': 'image/avif',
+    '.webp': 'image/webp',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+}
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Запись/удаление файла и изменение refcount — одна операция: иначе
+# параллельное удаление последней ссылки может стереть только что
+# переиспользованный файл
+_store_lock = threading.Lock()
+
+
+def content_path(digest: str, ext: str = DEFAULT_EXT, root: str = PHOTOS_DIR) -> str:
+    """Путь к файлу по хешу: <root>/ab/cd/<digest><ext>"""
+    shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return os.path.join(root, *shards, digest + ext)
+
+
+def digest_from_path(path: str) -> Optional[str]:
+    """SHA-256 из имени файла хранилища (None для старых путей user_<id>_<ts>.jpg)"""
+    if not path:
+        return None
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem if _DIGEST_RE.match(stem) else None
+
+
+def storage_for(root: str = PHOTOS_DIR) -> PhotoStorage:
+    """Хранилище из настроек для PHOTOS_DIR, для другого корня — локальный каталог"""
+    return get_photo_storage() if root == PHOTOS_DIR else LocalPhotoStorage(root)
+
+
+def photo_key(path: str, root: str = PHOTOS_DIR) -> Optional[str]:
+    """Ключ хранилища ('ab/cd/<sha256>.jpg') по пути из БД; None — путь вне хранилища"""
+    if not path:
+        return None
+    try:
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(root)).replace(os.sep, '/')
+    except ValueError:  # другой диск (Windows)
+        return None
+    if rel in ('.', '..') or rel.startswith('../'):
+        return None
+    return rel
+
+
+def find_stored(digest: str, root: str = PHOTOS_DIR) -> Optional[str]:
+    """Путь к уже сохраненному файлу с этим хешем (в любом из форматов) или None"""
+    storage = storage_for(root)
+    for ext in PHOTO_MIMETYPES:
+        path = content_path(digest, ext, root)
+        if storage.exists(photo_key(path, root)):
+            return path
+    return None
+
+
+def photo_mimetype(path: str) -> str:
+    return PHOTO_MIMETYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+
+
+def photo_extension(mime_type: Optional[str]) -> str:
+    """Расширение файла хранилища по MIME-типу загрузки (фото из Telegram — всегда JPEG)"""
+    mime_type = (mime_type or '').lower()
+    return next((ext for ext, mime in PHOTO_MIMETYPES.items() if mime == mime_type), DEFAULT_EXT)
+
+
+def _store(digest: str, size: int, ext: str, root: str, write: Callable[[PhotoStorage, str], None]) -> str:
+    # Сначала ссылка в БД: она же сообщает, где лежит уже сохраненная копия
+    # (в т.ч. перекодированная), и избавляет от проб хранилища по форматам
+    path = content_path(digest, ext, root)
+    with _store_lock:
+        refcount, stored_path = acquire_photo_blob(digest, path, size)
+        if refcount > 1:
+            logger.info(f"Фото {digest[:12]} уже в хранилище, ссылок: {refcount}")
+            return stored_path
+        try:
+            write(storage_for(root), photo_key(path, root))
+        except BaseException:
+            release_photo_blob(digest)
+            raise
+    return path
+
+
+def store_photo_bytes(data: bytes, ext: str = DEFAULT_EXT, root: str = PHOTOS_DIR) -> Tuple[str, str]:
+    """
+    Сохраняет фото в хранилище и учитывает ссылку на него
+
+    Args:
+        data: Байты фото
+        ext: Расширение файла
+        root: Корень хранилища
+
+    Returns:
+        tuple: (путь к файлу, sha256)
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    return _store(digest, len(data), ext, root, lambda storage, key: storage.put(key, data)), digest
+
+
+def store_photo_stream(chunks: Iterable[bytes], ext: str = DEFAULT_EXT, root: str = PHOTOS_DIR) -> Tuple[str, str]:
+    """
+    Сохраняет фото из потока блоков (скачивание из Telegram)
+
+    Каждый блок сразу идет и в SHA-256, и во временный файл рядом с
+    хранилищем: отдельного прохода для хеша и копии байт в памяти нет.
+    Имя файла известно только после последнего блока, поэтому готовый файл
+    переносится в хранилище через put_file; дубликат просто удаляется.
+
+    Returns:
+        tuple: (путь к файлу, sha256)
+    """
+    storage = storage_for(root)
+    staging = storage.staging_dir()
+    os.makedirs(staging, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=staging, prefix='.tmp-', suffix=ext)
+    try:
+        hasher = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        digest = hasher.hexdigest()
+        return _store(digest, size, ext, root, lambda storage, key: storage.put_file(key, tmp_path)), digest
+    finally:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def store_photo_file(src_path: str, digest: str, ext: str = DEFAULT_EXT, root: str = PHOTOS_DIR) -> str:
+    """
+    Переносит существующий файл в хранилище (для миграции) и учитывает ссылку
+
+    Исходный файл не удаляется: его убирают после того, как в БД записан
+    новый путь, чтобы сбой между шагами не оставил заявку без фото.
+    """
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    return _store(digest, len(data), ext, root, lambda storage, key: storage.put(key, data))
+
+
+def retain_photo(path: str, root: str = PHOTOS_DIR) -> Optional[str]:
+    """
+    Добавляет ссылку на уже сохраненное фото (новая заявка с тем же файлом)
+
+    Returns:
+        str: Путь к фото для новой заявки или None, если фото уже удалено
+        и его нужно скачать заново
+    """
+    digest = digest_from_path(path)
+    if digest is None:
+        # Старые плоские пути не учитываются в photo_blobs
+        return path if path and os.path.isfile(path) else None
+    with _store_lock:
+        refcount, stored_path = acquire_photo_blob(digest, path)
+        if refcount > 1:
+            return stored_path
+        # Ссылок не было — файл удален вместе с последней заявкой
+        release_photo_blob(digest)
+    return None
+
+
+def release_photo(path: str, root: str = PHOTOS_DIR) -> bool:
+    """
+    Снимает ссылку на фото; файл удаляется, когда ссылок не осталось
+
+    Returns:
+        bool: True, если файл удален
+    """
+    digest = digest_from_path(path)
+    key = photo_key(path, root)
+    if digest is None or key is None:
+        return False
+    with _store_lock:
+        remaining = release_photo_blob(digest)
+        if remaining != 0:
+            return False
+        storage = storage_for(root)
+        storage.delete(key)
+        # Ссылка могла остаться на исходный .jpg, а файл уже перекодирован
+        stored = find_stored(digest, root)
+        if stored is not None:
+            storage.delete(photo_key(stored, root))
+    logger.info(f"Фото {digest[:12]} удалено из хранилища: ссылок не осталось")
+    return True
+
+
+def replace_stored_photo(digest: str, old_path: str, new_path: str, size_bytes: int,
+                         root: str = PHOTOS_DIR) -> Optional[int]:
+    """
+    Переводит ссылки на перекодированную копию (уже записанную в хранилище
+    под new_path) и удаляет оригинал
+
+    Перенос ссылок и удаление выполняются под той же блокировкой, что прием и
+    освобождение фото: параллельная регистрация не получит путь к файлу,
+    который сейчас будет удален.
+
+    Returns:
+        int: Число заявок с обновленным путем; None — ссылок не осталось, пока
+        файл перекодировался (новая копия удалена)
+    """
+    storage = storage_for(root)
+    old_key, new_key = photo_key(old_path, root), photo_key(new_path, root)
+    with _store_lock:
+        updated = mark_photo_compacted(digest, new_path, size_bytes)
+        if updated is None:
+            if new_key is not None and new_key != old_key:
+                storage.delete(new_key)
+            return None
+        # Старый файл удаляем только после переноса ссылок в БД
+        if old_key is not None and old_key != new_key:
+            storage.delete(old_key)
+    return updated
+
+
+def local_photo_path(path: str, root: str = PHOTOS_DIR) -> Optional[str]:
+    """
+    Локальный файл с фото (для анализа, превью и send_file) или None
+
+    Для удаленного хранилища файл скачивается в кэш. Старая ссылка (.jpg)
+    ведет на перекодированный файл с тем же хешем (.webp/.avif). Старые
+    плоские пути вне хранилища возвращаются как есть, если файл существует.
+    """
+    key = photo_key(path, root)
+    if key is None:
+        return path if path and os.path.isfile(path) else None
+    storage = storage_for(root)
+    local = storage.local_path(key)
+    if local is not None:
+        return local
+    digest = digest_from_path(key)
+    if digest is not None:
+        stored = find_stored(digest, root)
+        if stored is not None:
+            return storage.local_path(photo_key(stored, root))
+    return None
+
+
+def resolve_photo(relative_path: str, root: str = PHOTOS_DIR) -> Optional[str]:
+    """Локальный путь к фото по пути из URL; None, если путь выходит за root или фото нет"""
+    key = posixpath.normpath(relative_path.replace('\\', '/'))
+    if key in ('.', '..') or key.startswith('../') or key.startswith('/'):
+        return None
+    try:
+        return local_photo_path(os.path.join(root, key), root)
+    except ValueError:  # симлинк за пределы хранилища
+        return None
+
+
+def photo_relpath(path: str, root: str = PHOTOS_DIR) -> str:
+    """Путь фото относительно корня хранилища (с '/') — для URL /photo/<path>"""
+    if not path:
+        return ''
+    try:
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    except ValueError:  # другой диск (Windows)
+        rel = os.path.basename(path)
+    if rel.startswith(os.pardir):
+        rel = os.path.basename(path)
+    return rel.replace(os.sep, '/')
+
+
+__all__ = [
+    'content_path',
+    'digest_from_path',
+    'storage_for',
+    'photo_key',
+    'find_stored',
+    'photo_mimetype',
+    'photo_extension',
+    'write_atomic',
+    'store_photo_bytes',
+    'store_photo_stream',
+    'store_photo_file',
+    'retain_photo',
+    'release_photo',
+    'replace_stored_photo',
+    'local_photo_path',
+    'resolve_photo',
+    'photo_relpath',
+]
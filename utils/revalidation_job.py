@@ -0,0 +1,302 @@
+"""
+Массовая перевалидация сохраненных фото лифлетов
+
+После смены шаблона или порога размытия задача проходит по всем заявкам
+(с фильтрами по акции, статусу и "только неудачные"), анализирует фото в
+процессном пуле и пишет результаты пакетными UPDATE. Прогресс сохраняется в
+revalidation_jobs после каждого пакета, поэтому задачу можно отменить и
+продолжить после сбоя с последнего записанного id. Фото с неизменным
+содержимым (SHA-256) и неизменными параметрами анализа берутся из кэша
+leaflet_analysis_cache и повторно не декодируются. Продолжить можно только с
+теми же параметрами анализа, с которыми задача запущена: иначе часть заявок
+была бы проверена по старым шаблонам, часть — по новым.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from config import LEAFLET_ANALYSIS_BATCH_SIZE
+from database.db_manager import (
+    get_active_leaflet_templates, get_revalidation_page, count_revalidation_targets,
+    create_revalidation_job, update_revalidation_job, get_revalidation_job,
+    get_cached_leaflet_metrics, save_leaflet_metrics_cache, bulk_update_leaflet_results,
+)
+from utils.file_handler import file_sha256
+from utils.image_validation import analysis_params_key, decide_leaflet_status, error_result
+from utils.phash_index import PhashIndex
+from utils.photo_store import digest_from_path, local_photo_path
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 500
+HASH_THREADS = 4  # hashlib отпускает GIL на больших буферах
+
+
+class RevalidationParamsChanged(RuntimeError):
+    """Параметры анализа изменились после запуска задачи — продолжать ее нельзя"""
+
+
+def _hash_or_none(photo_path: str) -> Optional[str]:
+    # Файлы хранилища уже названы своим SHA-256 — читать их не нужно (и не
+    # нужно скачивать из удаленного хранилища, если метрики есть в кэше)
+    digest = digest_from_path(photo_path)
+    if digest is not None:
+        return digest
+    try:
+        return file_sha256(photo_path)
+    except OSError:
+        return None
+
+
+class RevalidationJob:
+    """Одна задача перевалидации; run() синхронный, start() — в фоновом потоке."""
+
+    def __init__(self, campaign: Optional[str] = None, status: Optional[str] = None,
+                 only_failed: bool = False, service=None,
+                 batch_size: int = LEAFLET_ANALYSIS_BATCH_SIZE, page_size: int = PAGE_SIZE,
+                 job_row: Optional[Dict[str, Any]] = None):
+        self.filters = {'campaign': campaign or None, 'status': status or None, 'only_failed': bool(only_failed)}
+        self.batch_size = max(1, batch_size)
+        self.page_size = max(1, page_size)
+        self._service = service
+
+        self.job_id: Optional[int] = None
+        self.params_key: Optional[str] = None
+        self.status = 'created'
+        self.last_id = 0
+        self.processed = 0
+        self.cached = 0
+        self.failed = 0
+        self.total = 0
+        self.error: Optional[str] = None
+        if job_row:
+            self.job_id = job_row['id']
+            self.params_key = job_row.get('params_key') or None
+            self.filters.update(job_row.get('filters') or {})
+            self.last_id = job_row.get('last_id') or 0
+            self.processed = job_row.get('processed') or 0
+            self.cached = job_row.get('cached') or 0
+            self.total = job_row.get('total') or 0
+
+        self._cancel = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started_at: Optional[float] = None
+        self._processed_at_start = self.processed
+
+    @classmethod
+    def resume(cls, job_id: Optional[int] = None, service=None) -> Optional["RevalidationJob"]:
+        """Задача из БД для продолжения (по id или последняя незавершенная).
+
+        Raises:
+            RevalidationParamsChanged: Шаблоны или параметры анализа изменились
+        """
+        row = get_revalidation_job(job_id, unfinished_only=job_id is None)
+        if not row or row['status'] == 'done':
+            return None
+        job = cls(service=service, job_row=row)
+        job._check_params(analysis_params_key(get_active_leaflet_templates()))
+        return job
+
+    def _check_params(self, params_key: str) -> None:
+        if self.params_key and params_key != self.params_key:
+            raise RevalidationParamsChanged(
+                f"Параметры анализа изменились после запуска перевалидации #{self.job_id} — "
+                f"запустите новую задачу"
+            )
+
+    # --- Жизненный цикл --------------------------------------------------------
+
+    def start(self) -> "RevalidationJob":
+        self._thread = threading.Thread(target=self.run, name="LeafletRevalidation", daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def is_alive(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        if self._thread:
+            self._thread.join(timeout)
+
+    def progress(self) -> Dict[str, Any]:
+        elapsed = time.time() - self._started_at if self._started_at else 0.0
+        done_now = self.processed - self._processed_at_start
+        rate = done_now / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, self.total - self.processed)
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'filters': self.filters,
+            'processed': self.processed,
+            'cached': self.cached,
+            'failed': self.failed,
+            'total': self.total,
+            'last_id': self.last_id,
+            'percent': round(100.0 * self.processed / self.total, 1) if self.total else 0.0,
+            'photos_per_second': round(rate, 2),
+            'eta_seconds': round(remaining / rate) if rate > 0 else None,
+            'error': self.error,
+        }
+
+    # --- Обработка --------------------------------------------------------------
+
+    def run(self) -> Dict[str, Any]:
+        self._started_at = time.time()
+        self._processed_at_start = self.processed
+        self.status = 'running'
+        try:
+            if self._service is None:
+                from utils.analysis_service import get_analysis_service
+                self._service = get_analysis_service()
+            templates = get_active_leaflet_templates()
+            params_key = analysis_params_key(templates)
+            # Шаблоны могли смениться и после resume(), до запуска потока
+            self._check_params(params_key)
+            self.params_key = params_key
+            if self.job_id is None:
+                self.total = count_revalidation_targets(**self.filters)
+                self.job_id = create_revalidation_job(self.filters, params_key, self.total)
+                logger.info(f"Перевалидация #{self.job_id}: {self.total} заявок, фильтры {self.filters}")
+            else:
+                update_revalidation_job(self.job_id, status='running')
+                logger.info(f"Перевалидация #{self.job_id}: продолжаем с id > {self.last_id}")
+
+            index = PhashIndex.from_db()
+            with ThreadPoolExecutor(max_workers=HASH_THREADS) as hasher:
+                while not self._cancel.is_set():
+                    page = get_revalidation_page(self.last_id, self.page_size, **self.filters)
+                    if not page:
+                        break
+                    self._process_page(page, templates, params_key, index, hasher)
+
+            self.status = 'cancelled' if self._cancel.is_set() else 'done'
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+            logger.error(f"Перевалидация #{self.job_id} прервана: {e}")
+        if self.job_id is not None:
+            try:
+                update_revalidation_job(self.job_id, status=self.status)
+            except Exception as e:
+                logger.error(f"Перевалидация #{self.job_id}: не удалось сохранить статус: {e}")
+        logger.info(f"Перевалидация #{self.job_id}: {self.status}, обработано {self.processed}/{self.total}")
+        return self.progress()
+
+    def _process_page(self, page: List[Dict[str, Any]], templates: List[Dict[str, Any]], params_key: str,
+                      index: PhashIndex, hasher: ThreadPoolExecutor) -> None:
+        hashes = list(hasher.map(_hash_or_none, [row['photo_path'] for row in page]))
+        cache = get_cached_leaflet_metrics([h for h in hashes if h], params_key)
+
+        # Некэшированные фото получаем локально (из удаленного хранилища —
+        # скачиванием в кэш) и сразу отправляем в пул: submit блокируется на
+        # заполненной очереди, а результаты забираем по порядку id
+        uncached = [row for row, content_hash in zip(page, hashes) if content_hash and content_hash not in cache]
+        local_paths = dict(zip(
+            (row['id'] for row in uncached),
+            hasher.map(local_photo_path, [row['photo_path'] for row in uncached]),
+        ))
+        futures = {}
+        for app_id, local_path in local_paths.items():
+            if local_path is not None:
+                futures[app_id] = self._service.submit(local_path, templates)
+
+        results: List[Dict[str, Any]] = []
+        new_cache: Dict[str, Dict[str, Any]] = {}
+        cached = 0
+        try:
+            for row, content_hash in zip(page, hashes):
+                if self._cancel.is_set():
+                    break
+                app_id = row['id']
+                if content_hash is None:
+                    result = error_result('photo_missing' if not os.path.exists(row['photo_path']) else 'analyze_error')
+                    self.failed += 1
+                elif app_id in local_paths and local_paths[app_id] is None:
+                    result = error_result('photo_missing')
+                    self.failed += 1
+                else:
+                    metrics = cache.get(content_hash)
+                    if metrics is not None:
+                        cached += 1
+                    else:
+                        metrics, error = self._service.wait_metrics(futures.pop(app_id))
+                        if metrics is not None:
+                            new_cache[content_hash] = metrics
+                    if metrics is None:
+                        result = error
+                        self.failed += 1
+                    else:
+                        # Своя строка уже хранит pHash — не считаем ее дубликатом
+                        similar_cnt = index.count_similar(metrics['photo_phash'], exclude_id=app_id)
+                        index.update(app_id, metrics['photo_phash'])
+                        result = decide_leaflet_status(metrics, similar_cnt)
+                result['id'] = app_id
+                results.append(result)
+                if len(results) >= self.batch_size:
+                    cached = self._flush(results, new_cache, params_key, cached)
+                    results, new_cache = [], {}
+            self._flush(results, new_cache, params_key, cached)
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+    def _flush(self, results: List[Dict[str, Any]], new_cache: Dict[str, Dict[str, Any]],
+               params_key: str, cached: int) -> int:
+        """Пишет пакет и сдвигает контрольную точку на последний записанный id."""
+        if not results:
+            return cached
+        bulk_update_leaflet_results(results)
+        save_leaflet_metrics_cache(new_cache, params_key)
+        self.last_id = results[-1]['id']
+        self.processed += len(results)
+        self.cached += cached
+        update_revalidation_job(self.job_id, last_id=self.last_id, processed=self.processed, cached=self.cached)
+        return 0
+
+
+_current_job: Optional[RevalidationJob] = None
+_current_job_lock = threading.Lock()
+
+
+def start_revalidation(campaign: Optional[str] = None, status: Optional[str] = None,
+                       only_failed: bool = False, resume: bool = False) -> RevalidationJob:
+    """Запускает (или продолжает) перевалидацию в фоне. Одновременно — одна задача."""
+    global _current_job
+    with _current_job_lock:
+        if _current_job is not None and _current_job.is_alive():
+            raise RuntimeError("Перевалидация уже выполняется")
+        job = RevalidationJob.resume() if resume else None
+        if job is None:
+            job = RevalidationJob(campaign=campaign, status=status, only_failed=only_failed)
+        _current_job = job.start()
+        return job
+
+
+def get_current_revalidation() -> Optional[RevalidationJob]:
+    return _current_job
+
+
+def cancel_revalidation() -> bool:
+    job = _current_job
+    if job is None or not job.is_alive():
+        return False
+    job.cancel()
+    return True
+
+
+__all__ = [
+    'RevalidationParamsChanged',
+    'RevalidationJob',
+    'start_revalidation',
+    'get_current_revalidation',
+    'cancel_revalidation',
+]
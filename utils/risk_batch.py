@@ -0,0 +1,111 @@
+"""
+Пакетный скоринг риска по всей таблице заявок
+
+Колонки заявок загружаются одним запросом в DataFrame, сигналы контекста
+(дубликаты, скорость регистраций) считаются по всей таблице группировками,
+признаки скорости по измерениям — доигрыванием истории в порядке регистрации,
+правила вычисляются колоночным evaluator'ом RuleEngine. Результат
+записывается одним UPDATE, только для заявок, у которых риск изменился.
+Совпадение с построчным AntiFraudSystem проверяется тестом паритета.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+
+from database.db_manager import load_risk_frame, bulk_update_risk, count_recent_registrations
+from utils.anti_fraud import AntiFraudSystem
+from utils.fraud_context import VELOCITY_WINDOW_SECONDS
+from utils.fraud_rules import PARTICIPANT_FEATURES, RuleError
+from utils.velocity import velocity_frame
+
+logger = logging.getLogger(__name__)
+
+
+def _others(keys: pd.Series, raw: pd.Series) -> np.ndarray:
+    """Сколько других заявок со значением keys — как FraudContextProvider для сохраненной заявки"""
+    codes, uniques = pd.factorize(raw)
+    counts = np.bincount(codes, minlength=len(uniques))
+    found = counts[codes]
+    # Ключ отличается от значения в БД (карта с пробелами) — ищем ключ среди значений
+    differ = keys.to_numpy() != raw.to_numpy()
+    if differ.any():
+        found[differ] = keys[differ].map(pd.Series(counts, index=uniques)).fillna(0).to_numpy(dtype=np.int64)
+    return np.where(keys.to_numpy() != '', np.maximum(found - 1, 0), 0)
+
+
+def build_context(frame: pd.DataFrame, recent_registrations: int) -> Dict[str, Any]:
+    """Колоночный аналог FraudContextProvider (с трекером скорости): сигналы контекста для всех строк frame"""
+    telegram_ids = frame['telegram_id'].fillna(0).astype(np.int64)
+    telegram_found = telegram_ids.map(telegram_ids[telegram_ids != 0].value_counts()).fillna(0).to_numpy()
+    card = frame['loyalty_card_number'].fillna('').astype(str)
+    phone = frame['phone_number'].fillna('').astype(str)
+    photo_hash = frame['photo_hash'].fillna('').astype(str)
+    return {
+        'is_telegram_id_unique': (telegram_ids.to_numpy() == 0) | (telegram_found <= 1),
+        'duplicate_card_count': _others(card.str.strip(), card),
+        'duplicate_phone_count': _others(phone, phone),
+        'duplicate_photo_count': _others(photo_hash, photo_hash),
+        'recent_registrations_60s': np.full(len(frame), int(recent_registrations or 0)),
+        **velocity_frame(frame),
+    }
+
+
+def score_frame(frame: pd.DataFrame, recent_registrations: int = 0,
+                antifraud: AntiFraudSystem = None) -> pd.DataFrame:
+    """
+    Риск всех строк frame по действующим правилам
+
+    Правила с признаком контекста, которого нет в build_context (похожие фото —
+    попарное сравнение pHash по всей таблице), отвергаются RuleError: колоночный
+    evaluator молча подставил бы значение по умолчанию и разошелся с построчным.
+
+    Returns:
+        DataFrame: id, risk_score, risk_level, risk_details (JSON как у построчного пересчета)
+    """
+    engine = (antifraud or AntiFraudSystem()).engine
+    context = build_context(frame, recent_registrations)
+    unsupported = engine.features - PARTICIPANT_FEATURES - set(context)
+    if unsupported:
+        raise RuleError(f"Пакетный пересчет не поддерживает признаки правил: {', '.join(sorted(unsupported))}")
+    return engine.score_frame(frame.assign(**context))
+
+
+def rescore_all(write: bool = True) -> Dict[str, Any]:
+    """Пересчитывает риск всех заявок; записывает только изменившиеся"""
+    started = time.perf_counter()
+    frame = load_risk_frame()
+    loaded = time.perf_counter()
+    scored = score_frame(frame, count_recent_registrations(VELOCITY_WINDOW_SECONDS) or 0)
+    computed = time.perf_counter()
+
+    changed = ((frame['risk_score'].fillna(-1).astype(np.int64).to_numpy() != scored['risk_score'].to_numpy())
+               | (frame['risk_level'].fillna('').to_numpy() != scored['risk_level'].to_numpy())
+               | (frame['risk_details'].fillna('').to_numpy() != scored['risk_details'].to_numpy()))
+    written = bulk_update_risk(scored[changed]) if write else 0
+    finished = time.perf_counter()
+
+    stats = {
+        'total': len(scored),
+        'changed': int(changed.sum()),
+        'written': written,
+        'levels': {level: int(n) for level, n in scored['risk_level'].value_counts().items()},
+        'load_seconds': round(loaded - started, 3),
+        'score_seconds': round(computed - loaded, 3),
+        'write_seconds': round(finished - computed, 3),
+    }
+    logger.info(f"Пакетный пересчет риска: {stats['total']} заявок, изменилось {stats['changed']}, "
+                f"{finished - started:.2f}с")
+    return stats
+
+
+__all__ = [
+    'build_context',
+    'score_frame',
+    'rescore_all',
+]
@@ -0,0 +1,349 @@
+"""
+Фоновый скоринг риска новых заявок
+
+Регистрация сохраняет заявку с risk_details = UNSCORED_RISK_DETAILS и сразу
+отвечает пользователю. Когда фото заявки скачано (или окончательно не
+скачалось), заявка ставится в эту очередь: потоки забирают ее пачками до
+batch_size, собирают контекст всей пачки одним запросом
+(FraudContextProvider), считают риск по действующим правилам и копят
+результаты в буфере, который пишется одним bulk_update_risk. Заявки с
+риском от auto_flag_score уходят на ручную модерацию. Атрибуты заявок
+попутно попадают в индекс колец (utils.fraud_rings).
+
+Если свежие заявки пачки ждали в очереди дольше lag_threshold, пачка
+считается упрощенно — только правилами, которым не нужен контекст из БД
+(поля заявки и счетчики скорости в памяти). Такие заявки помечены в
+risk_details проверкой DEGRADED_RISK_CHECK и пересчитываются полностью с
+низким приоритетом, когда лаг спадет; пачки из одних фоновых заявок
+упрощенно не считаются. После рестарта очередь подхватывает заявки без
+риска и с упрощенным риском. Пачка, на которой упала БД, повторяется с
+паузой до MAX_BATCH_ATTEMPTS раз; дальше заявки ждут следующего запуска.
+"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from config import (
+    RISK_SCORING_WORKERS, RISK_SCORING_BATCH_SIZE, RISK_SCORING_FLUSH_INTERVAL,
+    RISK_SCORING_LAG_THRESHOLD, RISK_AUTO_FLAG_SCORE,
+)
+from database.db_manager import (
+    DEGRADED_RISK_CHECK, get_risk_participants, get_unscored_application_ids, bulk_update_risk, flag_manual_review,
+)
+from utils.analysis_queue import PRIORITY_FRESH, PRIORITY_BACKLOG
+from utils.anti_fraud import AntiFraudSystem, CheckResult
+from utils.fraud_context import FraudContextProvider
+from utils.fraud_rings import FraudRingIndex, get_ring_index
+from utils.velocity import VelocityTracker, get_velocity_tracker
+
+logger = logging.getLogger(__name__)
+
+DEGRADED_NOTE = CheckResult(DEGRADED_RISK_CHECK, True, 0,
+                            'Упрощенная проверка без контекста: очередь скоринга перегружена')
+RECOVER_PAGE_SIZE = 10000
+MAX_BATCH_ATTEMPTS = 5
+RETRY_DELAY = 1.0
+
+
+class RiskScoringQueue:
+    """Приоритетная очередь скоринга с пакетной записью и деградацией под нагрузкой."""
+
+    def __init__(self, antifraud: AntiFraudSystem = None, workers: int = RISK_SCORING_WORKERS,
+                 batch_size: int = RISK_SCORING_BATCH_SIZE,
+                 flush_interval: float = RISK_SCORING_FLUSH_INTERVAL,
+                 lag_threshold: float = RISK_SCORING_LAG_THRESHOLD,
+                 auto_flag_score: int = RISK_AUTO_FLAG_SCORE,
+                 ring_index: Optional[FraudRingIndex] = None,
+                 velocity: Optional[VelocityTracker] = None):
+        self._antifraud = antifraud or AntiFraudSystem()
+        self._ring_index = ring_index
+        self._velocity = velocity
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.lag_threshold = lag_threshold
+        self.auto_flag_score = auto_flag_score
+
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._queued: Dict[int, Tuple[int, float]] = {}  # app_id -> (priority, время постановки)
+        self._deferred: Set[int] = set()  # посчитаны упрощенно, ждут полного скоринга
+        self._attempts: Dict[int, int] = {}  # app_id -> неудачных попыток пачки
+        self._pending_results: List[Dict[str, Any]] = []
+        self._flush_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+        # Метрики
+        self._completions: deque = deque(maxlen=10000)  # (время завершения, лаг в очереди)
+        self.scored_total = 0
+        self.degraded_total = 0
+        self.flagged_total = 0
+        self.written_total = 0
+        self.failed_writes = 0
+
+    # --- Постановка в очередь -------------------------------------------------
+
+    def enqueue(self, app_id: int, priority: int = PRIORITY_FRESH) -> bool:
+        """Ставит заявку в очередь. Повторная постановка того же id игнорируется."""
+        now = time.time()
+        with self._lock:
+            if app_id in self._queued:
+                return False
+            self._queued[app_id] = (priority, now)
+        self._queue.put((priority, next(self._seq), now, app_id))
+        return True
+
+    def recover_unscored(self) -> int:
+        """Подхватывает заявки без риска или с упрощенным риском (например, после рестарта)."""
+        added, after_id = 0, 0
+        while True:
+            ids = get_unscored_application_ids(after_id, RECOVER_PAGE_SIZE)
+            if not ids:
+                break
+            added += sum(1 for app_id in ids if self.enqueue(app_id, PRIORITY_BACKLOG))
+            after_id = ids[-1]
+        if added:
+            logger.info(f"Очередь скоринга: подхвачено {added} заявок без полного скоринга")
+        return added
+
+    # --- Жизненный цикл --------------------------------------------------------
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker_loop, name=f"RiskScoring-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        flusher = threading.Thread(target=self._flusher_loop, name="RiskScoringFlush", daemon=True)
+        flusher.start()
+        self._threads.append(flusher)
+        self.recover_unscored()
+        logger.info(f"Очередь скоринга риска запущена ({self.workers} потоков)")
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+        self.flush()
+
+    # --- Обработка --------------------------------------------------------------
+
+    def _take_batch(self) -> List[Tuple[int, int, float, int]]:
+        """Блокирует до первой заявки, затем добирает готовые без ожидания"""
+        batch = [self._queue.get(timeout=0.5)]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                batch = self._take_batch()
+            except queue.Empty:
+                continue
+            try:
+                self.score_batch(batch)
+            except Exception as e:
+                logger.error(f"Очередь скоринга: ошибка обработки пачки из {len(batch)}: {e}")
+                self._retry_later(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _retry_later(self, batch: List[Tuple[int, int, float, int]]) -> int:
+        """Пачка не посчитана (ошибка БД): повтор с паузой, после MAX_BATCH_ATTEMPTS — до рестарта"""
+        ids = [item[3] for item in batch]
+        self._forget(ids)
+        retry, dropped = [], []
+        with self._lock:
+            for app_id in ids:
+                attempts = self._attempts.get(app_id, 0) + 1
+                if attempts >= MAX_BATCH_ATTEMPTS:
+                    self._attempts.pop(app_id, None)
+                    dropped.append(app_id)
+                else:
+                    self._attempts[app_id] = attempts
+                    retry.append(app_id)
+        if dropped:
+            # risk_details остается пустым/упрощенным — заявки подхватит recover_unscored
+            logger.error(f"Очередь скоринга: {len(dropped)} заявок отложены до рестарта после "
+                         f"{MAX_BATCH_ATTEMPTS} неудачных попыток")
+        self._stop.wait(RETRY_DELAY)
+        return sum(1 for app_id in retry if self.enqueue(app_id, PRIORITY_BACKLOG))
+
+    def score_batch(self, batch: List[Tuple[int, int, float, int]]) -> List[Dict[str, Any]]:
+        """
+        Считает риск пачки элементов очереди (priority, seq, enqueued_at, app_id)
+
+        Returns:
+            list[dict]: id, risk_score, risk_level, risk_details — результаты, отправленные в буфер
+        """
+        now = time.time()
+        ids = [item[3] for item in batch]
+        lag = now - min(item[2] for item in batch)
+        # Деградация бережет задержку свежих заявок; фоновые считаются полностью, сколько бы ни ждали
+        fresh = [item[2] for item in batch if item[0] == PRIORITY_FRESH]
+        degraded = bool(fresh) and now - min(fresh) > self.lag_threshold
+
+        engine = self._antifraud.engine
+        participants = get_risk_participants(ids)
+        if self._ring_index is not None:
+            try:
+                self._ring_index.add_many(participants)
+            except Exception as e:
+                logger.error(f"Очередь скоринга: не удалось обновить индекс колец: {e}")
+        if degraded:
+            # Без запросов к БД: поля заявки и счетчики скорости в памяти
+            rules = engine.context_free_rules
+            contexts: List[Dict[str, Any]] = (self._velocity.observe_many(participants) if self._velocity is not None
+                                              else [{} for _ in participants])
+        else:
+            rules = None
+            provider = FraudContextProvider(similar_photos='similar_photo_count' in engine.features,
+                                            velocity=self._velocity)
+            contexts = provider.for_batch(participants)
+
+        results = []
+        for participant, context in zip(participants, contexts):
+            score, level, details = engine.score(participant, context, rules)
+            if degraded:
+                details.append(DEGRADED_NOTE.to_dict())
+            results.append({'id': participant['id'], 'risk_score': score, 'risk_level': level,
+                             'risk_details': json.dumps(details, ensure_ascii=False)})
+
+        scored = {r['id'] for r in results}
+        with self._lock:
+            self._pending_results.extend(results)
+            self._completions.extend((now, now - item[2]) for item in batch)
+            self.scored_total += len(results)
+            if degraded:
+                self.degraded_total += len(results)
+                self._deferred.update(scored)
+            else:
+                self._deferred.difference_update(scored)
+            for app_id in ids:
+                self._attempts.pop(app_id, None)
+            batch_ready = len(self._pending_results) >= self.batch_size
+        self._forget(ids)
+        if degraded:
+            logger.warning(f"Очередь скоринга: лаг {lag:.1f}с, {len(results)} заявок посчитаны упрощенно")
+        else:
+            self._requeue_deferred()
+        if batch_ready:
+            self.flush()
+        return results
+
+    def _requeue_deferred(self) -> None:
+        """Лаг спал — заявки, посчитанные упрощенно, идут на полный скоринг"""
+        with self._lock:
+            if not self._deferred or any(p == PRIORITY_FRESH for p, _ in self._queued.values()):
+                return
+            deferred, self._deferred = self._deferred, set()
+        added = sum(1 for app_id in sorted(deferred) if self.enqueue(app_id, PRIORITY_BACKLOG))
+        logger.info(f"Очередь скоринга: {added} заявок поставлены на полный пересчет")
+
+    def _forget(self, ids: List[int]) -> None:
+        with self._lock:
+            for app_id in ids:
+                self._queued.pop(app_id, None)
+
+    def _flusher_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self) -> int:
+        """Пишет накопленные результаты одним пакетным UPDATE и помечает заявки высокого риска."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending_results = self._pending_results, []
+            if not batch:
+                return 0
+            try:
+                written = bulk_update_risk(pd.DataFrame(batch))
+                flagged = [r['id'] for r in batch if r['risk_score'] >= self.auto_flag_score]
+                if flagged:
+                    flag_manual_review(flagged)
+                    logger.info(f"Очередь скоринга: {len(flagged)} заявок высокого риска отправлены на модерацию")
+                self.written_total += written
+                self.flagged_total += len(flagged)
+                return written
+            except Exception as e:
+                # risk_details остается пустым — заявки подхватит recover_unscored при следующем запуске
+                self.failed_writes += len(batch)
+                logger.error(f"Очередь скоринга: не удалось записать пакет из {len(batch)}: {e}")
+                return 0
+
+    # --- Метрики ----------------------------------------------------------------
+
+    def stats(self) -> Dict[str, Any]:
+        """Глубина, лаг и пропускная способность очереди для дашборда."""
+        now = time.time()
+        with self._lock:
+            recent = [(ts, lag) for ts, lag in self._completions if now - ts <= 60.0]
+            waiting = list(self._queued.values())
+            buffered = len(self._pending_results)
+            deferred = len(self._deferred)
+        lags = [lag for _, lag in recent]
+        return {
+            'running': bool(self._threads),
+            'queue_fresh': sum(1 for p, _ in waiting if p == PRIORITY_FRESH),
+            'queue_backlog': sum(1 for p, _ in waiting if p != PRIORITY_FRESH),
+            'current_lag_seconds': round(now - min(ts for _, ts in waiting), 2) if waiting else 0.0,
+            'lag_threshold_seconds': self.lag_threshold,
+            'buffered_results': buffered,
+            'deferred': deferred,
+            'scored_total': self.scored_total,
+            'degraded_total': self.degraded_total,
+            'flagged_total': self.flagged_total,
+            'written_total': self.written_total,
+            'failed_writes': self.failed_writes,
+            'throughput_per_min': len(recent),
+            'avg_lag_seconds': round(sum(lags) / len(lags), 2) if lags else 0.0,
+            'max_lag_seconds': round(max(lags), 2) if lags else 0.0,
+        }
+
+
+_risk_queue: Optional[RiskScoringQueue] = None
+_risk_queue_lock = threading.Lock()
+
+
+def get_risk_queue() -> RiskScoringQueue:
+    """Синглтон очереди скоринга (создание не запускает потоки)."""
+    global _risk_queue
+    if _risk_queue is None:
+        with _risk_queue_lock:
+            if _risk_queue is None:
+                _risk_queue = RiskScoringQueue(ring_index=get_ring_index(), velocity=get_velocity_tracker())
+    return _risk_queue
+
+
+def start_risk_queue() -> RiskScoringQueue:
+    q = get_risk_queue()
+    q.start()
+    return q
+
+
+__all__ = [
+    'RiskScoringQueue',
+    'get_risk_queue',
+    'start_risk_queue',
+]
@@ -0,0 +1,100 @@
+"""
+Однократное выполнение по ключу (single-flight)
+
+Двойное нажатие или повторная отправка фото приходят в разные потоки
+TeleBot почти одновременно. SingleFlight пропускает по ключу (telegram_id)
+только один вызов: остальные, пришедшие, пока он выполняется, ждут его
+результата вместо того, чтобы повторять работу и упираться в
+UNIQUE-ограничения заявки. Ожидание ограничено по времени: зависший ведущий
+вызов не должен навсегда занимать потоки TeleBot.
+"""
+
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30.0  # сек ожидания ведущего вызова
+
+
+class SingleFlight:
+    """Реестр выполняющихся вызовов по ключу."""
+
+    def __init__(self, name: str = 'single-flight', timeout: float = DEFAULT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        Выполняет fn, если по ключу ничего не выполняется, иначе ждет текущий вызов
+
+        Args:
+            timeout: Сколько повторный вызов ждет ведущий (по умолчанию self.timeout)
+
+        Returns:
+            tuple: (результат, shared) — shared=True, если результат получен
+            от чужого вызова; исключение ведущего вызова пробрасывается всем
+
+        Raises:
+            concurrent.futures.TimeoutError: Ведущий вызов не завершился за timeout
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            logger.info(f"{self.name}: повторный вызов для {key} ждет уже выполняющийся")
+            try:
+                return future.result(timeout=self.timeout if timeout is None else timeout), True
+            except FutureTimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                logger.warning(f"{self.name}: вызов для {key} не дождался выполняющегося")
+                raise
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+                'in_flight': len(self._in_flight),
+            }
+
+
+_registration_flight = SingleFlight('Регистрация')
+
+
+def get_registration_flight() -> SingleFlight:
+    """Реестр завершения регистрации по telegram_id"""
+    return _registration_flight
+
+
+__all__ = [
+    'SingleFlight',
+    'get_registration_flight',
+]
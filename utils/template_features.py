@@ -0,0 +1,314 @@
+"""
+Предвычисленные признаки шаблонов лифлетов и сопоставление фото с шаблонами
+
+Для каждого шаблона один раз считаются границы зон, уменьшенный эталон из
+template_image_path и его FFT; признаки кэшируются в памяти процесса (в том
+числе в воркерах пула анализа). Фото сравнивается со всеми активными
+шаблонами за один векторный проход: покрытие всех зон — по одному
+интегральному изображению, сходство с эталонами — кросс-корреляцией через
+FFT сразу для всей пачки шаблонов.
+
+Зоны в validation_zones заданы в долях эталона. Перед подсчетом стикеров
+фото выравнивается по эталону фазовой корреляцией на 128x128 (сдвиг и
+масштаб из ALIGN_SCALES), и зоны переносятся в координаты фото.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Сторона уменьшенного эталона и фото для сравнения
+REFERENCE_SIZE = 128
+
+# Доля зоны, закрытая "чернилами", чтобы считать стикер видимым
+STICKER_COVERAGE_THRESHOLD = 0.20
+
+# Выравнивание фото по эталону фазовой корреляцией: перебираемые масштабы
+# (во сколько раз лифлет на фото крупнее эталона), минимальная высота пика
+# и максимальный сдвиг (доля кадра), при которых выравнивание принимается
+ALIGN_TO_REFERENCE = True
+ALIGN_SCALES = (0.8, 0.85, 0.9, 0.95, 1.0, 1.05, 1.1, 1.17, 1.25)
+ALIGN_MIN_PEAK = 0.12
+ALIGN_MAX_SHIFT = 0.25
+
+_FEATURES_CACHE_LIMIT = 64
+
+
+@dataclass
+class TemplateFeatures:
+    template_id: Optional[int]
+    name: str
+    required_stickers: int
+    zones: np.ndarray                      # (N, 4) относительные x, y, w, h
+    reference: Optional[np.ndarray]        # (S, S) float32, нулевое среднее, единичная норма
+    reference_fft: Optional[np.ndarray]    # conj(rfft2(reference)), complex64
+    align_ffts: Optional[np.ndarray]       # (len(ALIGN_SCALES), S, S//2+1) conj FFT масштабированных эталонов
+
+
+def parse_zones(zones_json: str) -> np.ndarray:
+    try:
+        arr = json.loads(zones_json or '[]')
+    except Exception:
+        arr = []
+    if not isinstance(arr, list):
+        arr = []
+    zones = [[float(z['x']), float(z['y']), float(z['w']), float(z['h'])]
+             for z in arr if isinstance(z, dict) and all(k in z for k in ('x', 'y', 'w', 'h'))]
+    return np.array(zones, dtype=np.float64).reshape(-1, 4)
+
+
+def normalize_patch(gray: np.ndarray, size: int = REFERENCE_SIZE) -> Optional[np.ndarray]:
+    """Уменьшает изображение до size x size и нормирует (нулевое среднее, единичная норма)."""
+    patch = np.asarray(
+        Image.fromarray(np.ascontiguousarray(gray)).resize((size, size), Image.Resampling.BILINEAR),
+        dtype=np.float32,
+    )
+    patch = patch - patch.mean()
+    norm = float(np.sqrt(np.dot(patch.ravel(), patch.ravel())))
+    if norm < 1e-6:
+        return None
+    return patch / norm
+
+
+def _load_reference(path: str) -> Optional[np.ndarray]:
+    """Эталон шаблона, уменьшенный до REFERENCE_SIZE x REFERENCE_SIZE (uint8)."""
+    if not path or not os.path.exists(path):
+        return None
+    # Импорт здесь: image_validation импортирует этот модуль
+    from utils.image_validation import decode_gray
+    try:
+        with Image.open(path) as img:
+            gray = decode_gray(img, max_side=REFERENCE_SIZE * 4)
+        return np.asarray(Image.fromarray(np.ascontiguousarray(gray)).resize(
+            (REFERENCE_SIZE, REFERENCE_SIZE), Image.Resampling.BILINEAR))
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить эталон шаблона {path}: {e}")
+        return None
+
+
+_HANN = np.outer(np.hanning(REFERENCE_SIZE), np.hanning(REFERENCE_SIZE)).astype(np.float32)
+
+
+def _whitened(patch: np.ndarray) -> np.ndarray:
+    """Окно Ханна поверх центрированного патча (убирает разрыв на краях для FFT)."""
+    patch = np.asarray(patch, dtype=np.float32)
+    return (patch - patch.mean()) * _HANN
+
+
+def _zoom_about_center(gray: np.ndarray, scale: float) -> np.ndarray:
+    """Содержимое, увеличенное в scale раз относительно центра; поля — белые (бумага)."""
+    if scale == 1.0:
+        return gray
+    size = gray.shape[1], gray.shape[0]
+    inv = 1.0 / scale
+    cx, cy = size[0] / 2.0, size[1] / 2.0
+    img = Image.fromarray(gray).transform(
+        size, Image.Transform.AFFINE, (inv, 0, cx * (1 - inv), 0, inv, cy * (1 - inv)),
+        resample=Image.Resampling.BILINEAR, fillcolor=255)
+    return np.asarray(img)
+
+
+def _cache_key(template: Dict[str, Any]) -> Tuple:
+    path = template.get('template_image_path') or ''
+    try:
+        mtime = os.path.getmtime(path) if path else 0.0
+    except OSError:
+        mtime = 0.0
+    return (template.get('id'), int(template.get('required_stickers') or 0),
+            template.get('validation_zones') or '[]', path, mtime)
+
+
+_features_cache: Dict[Tuple, TemplateFeatures] = {}
+_features_lock = threading.Lock()
+
+
+def get_template_features(template: Dict[str, Any]) -> TemplateFeatures:
+    """Признаки шаблона из кэша; пересчитываются при изменении шаблона или файла эталона."""
+    key = _cache_key(template)
+    features = _features_cache.get(key)
+    if features is not None:
+        return features
+    reference_gray = _load_reference(template.get('template_image_path') or '')
+    reference = normalize_patch(reference_gray) if reference_gray is not None else None
+    align_ffts = None
+    if reference is not None:
+        align_ffts = np.conj(np.fft.rfft2(np.stack([
+            _whitened(_zoom_about_center(reference_gray, scale)) for scale in ALIGN_SCALES
+        ]))).astype(np.complex64)
+    features = TemplateFeatures(
+        template_id=template.get('id'),
+        name=template.get('name') or '',
+        required_stickers=int(template.get('required_stickers') or 0),
+        zones=parse_zones(template.get('validation_zones') or '[]'),
+        reference=reference,
+        reference_fft=np.conj(np.fft.rfft2(reference)).astype(np.complex64) if reference is not None else None,
+        align_ffts=align_ffts,
+    )
+    with _features_lock:
+        if len(_features_cache) >= _FEATURES_CACHE_LIMIT:
+            _features_cache.clear()
+        _features_cache[key] = features
+    return features
+
+
+def zone_bounds(zones: np.ndarray, w: int, h: int) -> np.ndarray:
+    """Пиксельные границы зон [x0, y0, x1, y1] с обрезкой по изображению."""
+    x0 = np.clip((zones[:, 0] * w).astype(np.int64), 0, w - 1)
+    y0 = np.clip((zones[:, 1] * h).astype(np.int64), 0, h - 1)
+    x1 = np.clip(x0 + (zones[:, 2] * w).astype(np.int64), 0, w)
+    y1 = np.clip(y0 + (zones[:, 3] * h).astype(np.int64), 0, h)
+    return np.stack([x0, y0, x1, y1], axis=1)
+
+
+def zone_coverage(integral: np.ndarray, zones: np.ndarray) -> np.ndarray:
+    """Доли "не белого" в зонах по интегральному изображению — O(1) на зону."""
+    if not len(zones):
+        return np.zeros(0, dtype=np.float64)
+    h, w = integral.shape[0] - 1, integral.shape[1] - 1
+    x0, y0, x1, y1 = zone_bounds(zones, w, h).T
+    area = (x1 - x0) * (y1 - y0)
+    filled = (integral[y1, x1].astype(np.int64) - integral[y0, x1]
+              - integral[y1, x0] + integral[y0, x0])
+    return np.where((x1 > x0) & (y1 > y0), filled / np.maximum(area, 1), 0.0)
+
+
+def appearance_scores(patch: Optional[np.ndarray], features: Sequence[TemplateFeatures]) -> np.ndarray:
+    """Максимум нормированной кросс-корреляции фото с каждым эталоном (устойчиво к сдвигу).
+
+    Все эталоны обрабатываются одним батчевым irfft2. Для шаблонов без эталона — NaN.
+    """
+    scores = np.full(len(features), np.nan)
+    with_ref = [i for i, f in enumerate(features) if f.reference_fft is not None]
+    if patch is None or not with_ref:
+        return scores
+    photo_fft = np.fft.rfft2(patch)
+    refs = np.stack([features[i].reference_fft for i in with_ref])
+    corr = np.fft.irfft2(refs * photo_fft[None], s=patch.shape, axes=(-2, -1))
+    scores[with_ref] = np.clip(corr.reshape(len(with_ref), -1).max(axis=1), 0.0, 1.0)
+    return scores
+
+
+def estimate_alignment(photo_gray_patch: np.ndarray,
+                       features: Sequence[TemplateFeatures]) -> List[Optional[Tuple[float, float, float, float]]]:
+    """Масштаб и сдвиг фото относительно эталона каждого шаблона (фазовая корреляция).
+
+    Все шаблоны и все масштабы из ALIGN_SCALES считаются одним батчевым irfft2
+    на REFERENCE_SIZE x REFERENCE_SIZE. Возвращает для каждого шаблона
+    (scale, dx, dy, peak) — сдвиг в долях кадра — или None, если эталона нет
+    или пик слишком слабый.
+    """
+    result: List[Optional[Tuple[float, float, float, float]]] = [None] * len(features)
+    with_ref = [i for i, f in enumerate(features) if f.align_ffts is not None]
+    if not with_ref:
+        return result
+    size = REFERENCE_SIZE
+    photo_fft = np.fft.rfft2(_whitened(photo_gray_patch))
+    cross = np.stack([features[i].align_ffts for i in with_ref]) * photo_fft
+    cross /= np.abs(cross) + 1e-6
+    corr = np.fft.irfft2(cross, s=(size, size), axes=(-2, -1))  # (K, n_scales, S, S)
+    flat = corr.reshape(len(with_ref), -1)
+    best = flat.argmax(axis=1)
+    for k, i in enumerate(with_ref):
+        scale_idx, dy, dx = np.unravel_index(best[k], corr.shape[1:])
+        peak = float(flat[k, best[k]])
+        # Сдвиги больше половины кадра — отрицательные (циклическая корреляция)
+        dy = dy - size if dy > size // 2 else dy
+        dx = dx - size if dx > size // 2 else dx
+        dx_rel, dy_rel = dx / size, dy / size
+        if peak < ALIGN_MIN_PEAK or max(abs(dx_rel), abs(dy_rel)) > ALIGN_MAX_SHIFT:
+            continue
+        result[i] = (float(ALIGN_SCALES[scale_idx]), float(dx_rel), float(dy_rel), peak)
+    return result
+
+
+def map_zones(zones: np.ndarray, alignment: Optional[Tuple[float, float, float, float]]) -> np.ndarray:
+    """Переносит зоны из координат эталона в координаты фото: p = 0.5 + s·(u − 0.5) + d."""
+    if alignment is None or not len(zones):
+        return zones
+    scale, dx, dy, _ = alignment
+    mapped = zones.copy()
+    mapped[:, 0] = 0.5 + scale * (zones[:, 0] - 0.5) + dx
+    mapped[:, 1] = 0.5 + scale * (zones[:, 1] - 0.5) + dy
+    mapped[:, 2:] = zones[:, 2:] * scale
+    # Зоны, частично ушедшие за левый/верхний край, обрезаем по краю
+    for pos, ext in ((0, 2), (1, 3)):
+        overflow = np.minimum(mapped[:, pos], 0.0)
+        mapped[:, ext] = np.maximum(mapped[:, ext] + overflow, 0.0)
+        mapped[:, pos] -= overflow
+    return mapped
+
+
+def match_templates(gray: np.ndarray, integral: np.ndarray,
+                    templates: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """Оценивает фото по всем шаблонам и возвращает лучший.
+
+    Уверенность: доля найденных стикеров от требуемых, а при наличии эталона —
+    среднее этой доли и сходства с эталоном. Шаблон без требуемых стикеров
+    выбирается, только если других нет: иначе его уверенность без проверки
+    стикеров перебивала бы настоящие шаблоны.
+    """
+    features = [get_template_features(t) for t in templates]
+    if not features:
+        return {'template_id': None, 'template_confidence': 0.0, 'required_stickers': 0,
+                'stickers_count': 0, 'zones_coverage': [], 'alignment': None}
+
+    has_reference = any(f.reference_fft is not None for f in features)
+    small = None
+    if has_reference:
+        small = np.asarray(Image.fromarray(np.ascontiguousarray(gray)).resize(
+            (REFERENCE_SIZE, REFERENCE_SIZE), Image.Resampling.BILINEAR))
+    alignments = estimate_alignment(small, features) if has_reference and ALIGN_TO_REFERENCE else [None] * len(features)
+
+    # Все зоны всех шаблонов (в координатах фото) — одним массивом
+    counts = np.array([len(f.zones) if f.required_stickers > 0 else 0 for f in features])
+    all_zones = np.concatenate([map_zones(f.zones, a) for f, a, n in zip(features, alignments, counts) if n]
+                               or [np.zeros((0, 4))])
+    coverage = zone_coverage(integral, all_zones)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    visible = np.concatenate([[0], np.cumsum(coverage >= STICKER_COVERAGE_THRESHOLD)])
+    stickers = visible[offsets[1:]] - visible[offsets[:-1]]
+
+    required = np.array([f.required_stickers for f in features], dtype=np.float64)
+    sticker_score = np.where(required > 0, np.minimum(stickers / np.maximum(required, 1), 1.0), 1.0)
+    appearance = appearance_scores(normalize_patch(small) if has_reference else None, features)
+    confidence = np.where(np.isnan(appearance), sticker_score, 0.5 * (sticker_score + appearance))
+
+    candidates = required > 0
+    if not candidates.any():
+        candidates[:] = True
+    best = int(np.argmax(np.where(candidates, confidence, -np.inf)))  # при равенстве — более новый шаблон
+    return {
+        'template_id': features[best].template_id,
+        'template_confidence': round(float(confidence[best]), 4),
+        'required_stickers': int(features[best].required_stickers),
+        'stickers_count': int(stickers[best]),
+        'zones_coverage': [float(c) for c in coverage[offsets[best]:offsets[best + 1]]],
+        'alignment': _alignment_dict(alignments[best]),
+    }
+
+
+def _alignment_dict(alignment: Optional[Tuple[float, float, float, float]]) -> Optional[Dict[str, float]]:
+    if alignment is None:
+        return None
+    scale, dx, dy, peak = alignment
+    return {'scale': scale, 'dx': round(dx, 4), 'dy': round(dy, 4), 'peak': round(peak, 4)}
+
+
+__all__ = [
+    'TemplateFeatures',
+    'estimate_alignment',
+    'get_template_features',
+    'map_zones',
+    'match_templates',
+    'zone_coverage',
+]
@@ -0,0 +1,115 @@
+"""
+Превью фото для админки
+
+Превью строятся по запросу в нескольких фиксированных размерах и кэшируются
+на диске по хешу содержимого оригинала: thumbnails/<size>/ab/cd/<key>.jpg.
+JPEG декодируется сразу в уменьшенном масштабе (draft), поэтому превью
+12-Мп фото строится за десятки миллисекунд, а повторно — только читается.
+"""
+
+import hashlib
+import io
+import logging
+import os
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from config import THUMBNAILS_DIR, PHOTO_THUMBNAIL_SIZES
+from utils.photo_store import content_path, digest_from_path, write_atomic, local_photo_path
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_QUALITY = 80
+
+
+def snap_size(requested: Optional[int]) -> Optional[int]:
+    """Ближайший поддерживаемый размер не меньше запрошенного (None — оригинал)"""
+    if not requested or requested <= 0:
+        return None
+    for size in PHOTO_THUMBNAIL_SIZES:
+        if size >= requested:
+            return size
+    return PHOTO_THUMBNAIL_SIZES[-1]
+
+
+def thumbnail_key(source_path: str) -> str:
+    """Ключ кэша: SHA-256 оригинала из имени файла, для старых путей — путь+mtime+размер"""
+    digest = digest_from_path(source_path)
+    if digest is not None:
+        return digest
+    stat = os.stat(source_path)
+    raw = f"{os.path.abspath(source_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def render_thumbnail(source_path: str, size: int) -> bytes:
+    """JPEG-превью с длинной стороной не больше size (с учетом EXIF-ориентации)"""
+    with Image.open(source_path) as image:
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.thumbnail((size, size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        buf = io.BytesIO()
+        image.save(buf, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+        return buf.getvalue()
+
+
+def get_thumbnail(source_path: str, size: int, root: str = THUMBNAILS_DIR) -> str:
+    """
+    Путь к превью фото; строит и кэширует его при первом запросе
+
+    Args:
+        source_path: Путь к оригиналу
+        size: Один из PHOTO_THUMBNAIL_SIZES
+        root: Корень кэша превью
+
+    Returns:
+        str: Путь к файлу превью
+    """
+    path = content_path(thumbnail_key(source_path), '.jpg', os.path.join(root, str(size)))
+    if not os.path.exists(path):
+        # Параллельные запросы могут построить превью дважды — запись атомарная,
+        # поэтому результат одинаков, а блокировка на каждый файл не нужна
+        write_atomic(path, render_thumbnail(source_path, size))
+        logger.info(f"Превью {size}px создано: {path}")
+    return path
+
+
+def warm_thumbnail(source_path: str, size: Optional[int] = None, root: str = THUMBNAILS_DIR) -> bool:
+    """Заранее строит превью галереи (по умолчанию — наименьший размер); ошибки не пробрасывает"""
+    try:
+        local_path = local_photo_path(source_path)
+        if local_path is None:
+            return False
+        get_thumbnail(local_path, size or PHOTO_THUMBNAIL_SIZES[0], root)
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось построить превью {source_path}: {e}")
+        return False
+
+
+def remove_thumbnails(source_path: str, root: str = THUMBNAILS_DIR) -> int:
+    """Удаляет превью фото из хранилища (после удаления оригинала)"""
+    digest = digest_from_path(source_path)
+    if digest is None:
+        return 0
+    removed = 0
+    for size in PHOTO_THUMBNAIL_SIZES:
+        try:
+            os.remove(content_path(digest, '.jpg', os.path.join(root, str(size))))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+__all__ = [
+    'snap_size',
+    'thumbnail_key',
+    'render_thumbnail',
+    'get_thumbnail',
+    'warm_thumbnail',
+    'remove_thumbnails',
+]
@@ -0,0 +1,440 @@
+"""
+Скорость регистраций по измерениям
+
+Глобальный счетчик "больше 30 регистраций за 60 с" штрафует всех участников
+во время легального всплеска и не видит медленной целевой атаки. Здесь
+скорость считается отдельно по ключам измерений — блок номеров телефона,
+блок номеров карт, имя, шаблон username, час суток. Для каждого ключа:
+
+* скользящее окно — приближенный счетчик из двух фиксированных окон
+  (текущее + доля предыдущего), O(1) памяти и времени;
+* token bucket — burst жетонов, пополнение limit / window в секунду;
+  пустое ведро — всплеск по этому ключу (признак velocity_<измерение>_throttled).
+
+Пороги счетчиков задаются в правилах (fraud_rules.json), ведра — здесь.
+Ключи каждого измерения хранятся в LRU не больше max_keys. Время события —
+время регистрации заявки, поэтому повторный скоринг и доигрывание истории
+дают те же признаки; для уже учтенной заявки признаки берутся из кэша.
+Кэш привязан к id заявки: очистка БД (id начинаются заново) сбрасывает
+трекер и его снапшот.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import VELOCITY_MAX_KEYS, VELOCITY_SNAPSHOT_PATH, VELOCITY_SNAPSHOT_INTERVAL
+from database.db_manager import on_applications_deleted
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+
+
+def _digits(value: Any) -> str:
+    return re.sub(r"\D", "", str(value or ''))
+
+
+def _phone_prefix(app: Dict[str, Any], registered: datetime) -> Optional[str]:
+    digits = _digits(app.get('phone_number'))
+    return digits[:-4] if len(digits) > 6 else None
+
+
+def _card_prefix(app: Dict[str, Any], registered: datetime) -> Optional[str]:
+    digits = _digits(app.get('loyalty_card_number'))
+    return digits[:-3] if len(digits) > 5 else None
+
+
+def _name(app: Dict[str, Any], registered: datetime) -> Optional[str]:
+    name = ' '.join((app.get('name') or '').casefold().split())
+    return name or None
+
+
+def _username_pattern(app: Dict[str, Any], registered: datetime) -> Optional[str]:
+    # anna_1987 и anna_2024 — один шаблон; имена без цифр уникальны сами по себе
+    username = (app.get('telegram_username') or '').strip().lstrip('@').lower()
+    return re.sub(r"\d+", "#", username) if re.search(r"\d", username) else None
+
+
+def _hour(app: Dict[str, Any], registered: datetime) -> Optional[str]:
+    return f"{registered.hour:02d}"
+
+
+# Измерение: (ключ заявки, окно счетчика в сек, устойчивый лимит за окно, burst ведра)
+DIMENSIONS: Dict[str, Tuple[Callable[[Dict[str, Any], datetime], Optional[str]], int, int, int]] = {
+    'phone_prefix': (_phone_prefix, 3600, 10, 5),
+    'card_prefix': (_card_prefix, 3600, 10, 5),
+    'name': (_name, 86400, 5, 3),
+    'username_pattern': (_username_pattern, 3600, 10, 5),
+    'hour': (_hour, 3600, 1200, 300),
+}
+
+FEATURE_DEFAULTS: Dict[str, Any] = {
+    **{f'velocity_{dim}': 0 for dim in DIMENSIONS},
+    **{f'velocity_{dim}_throttled': False for dim in DIMENSIONS},
+}
+
+
+def _registered_at(value: Any) -> Optional[datetime]:
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str) and value:
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return None
+
+
+class VelocityTracker:
+    """Скользящие окна и token bucket по ключам измерений с LRU-вытеснением."""
+
+    def __init__(self, max_keys: int = VELOCITY_MAX_KEYS, snapshot_path: Optional[str] = VELOCITY_SNAPSHOT_PATH,
+                 snapshot_interval: float = VELOCITY_SNAPSHOT_INTERVAL):
+        self.max_keys = max(1, max_keys)
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+
+        self._lock = threading.Lock()
+        # ключ -> [индекс окна, счет предыдущего окна, счет текущего, жетоны, время последнего события]
+        self._states: Dict[str, "OrderedDict[str, List[float]]"] = {dim: OrderedDict() for dim in DIMENSIONS}
+        # заявка -> признаки, посчитанные при ее учете
+        self._seen: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+
+        self._dirty = False
+        self._snapshot_at = time.time()
+        self.observed_total = 0
+        self.evicted_total = 0
+
+    # --- Учет ---------------------------------------------------------------------
+
+    def _touch(self, dim: str, key: str, ts: float) -> Tuple[int, bool]:
+        _, window, limit, burst = DIMENSIONS[dim]
+        states = self._states[dim]
+        idx = int(ts // window)
+        state = states.get(key)
+        if state is None:
+            state = [idx, 0, 0, float(burst), ts]
+            states[key] = state
+            if len(states) > self.max_keys:
+                states.popitem(last=False)
+                self.evicted_total += 1
+        else:
+            states.move_to_end(key)
+
+        if idx < state[0] - 1:
+            return 0, False  # событие старше окна счетчика — не учитываем
+        if idx > state[0]:
+            state[1] = state[2] if idx == state[0] + 1 else 0
+            state[2] = 0
+            state[0] = idx
+        if idx == state[0]:
+            state[2] += 1
+        else:
+            state[1] += 1  # запоздавшее событие предыдущего окна
+
+        # Token bucket: пополнение только вперед по времени
+        if ts > state[4]:
+            state[3] = min(float(burst), state[3] + (ts - state[4]) * limit / window)
+            state[4] = ts
+        throttled = state[3] < 1.0
+        if not throttled:
+            state[3] -= 1.0
+
+        elapsed = max(0.0, ts - state[0] * window) / window
+        count = state[2] + state[1] * max(0.0, 1.0 - elapsed)
+        return int(round(count)), throttled
+
+    def observe(self, app: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Учитывает регистрацию заявки (один раз на id) и возвращает ее признаки скорости
+
+        Returns:
+            dict: velocity_<измерение> (регистраций с тем же ключом в окне),
+                  velocity_<измерение>_throttled (ведро ключа пусто)
+        """
+        registered = _registered_at(app.get('timestamp'))
+        if registered is None:
+            return dict(FEATURE_DEFAULTS)
+        app_id = app.get('id')
+        with self._lock:
+            if app_id is not None and app_id in self._seen:
+                self._seen.move_to_end(app_id)
+                return dict(self._seen[app_id])
+            ts = registered.timestamp()
+            features = dict(FEATURE_DEFAULTS)
+            for dim, (key_of, _, _, _) in DIMENSIONS.items():
+                key = key_of(app, registered)
+                if key is not None:
+                    features[f'velocity_{dim}'], features[f'velocity_{dim}_throttled'] = self._touch(dim, key, ts)
+            if app_id is not None:
+                self._seen[app_id] = features
+                if len(self._seen) > self.max_keys:
+                    self._seen.popitem(last=False)
+            self.observed_total += 1
+            self._dirty = True
+            return dict(features)
+
+    def observe_many(self, apps: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        features = [self.observe(app) for app in apps]
+        self.maybe_snapshot()
+        return features
+
+    def _peek(self, dim: str, key: str, ts: float) -> Tuple[int, bool]:
+        _, window, limit, burst = DIMENSIONS[dim]
+        state = self._states[dim].get(key)
+        if state is None:
+            return 0, False
+        idx = int(ts // window)
+        if idx == state[0]:
+            curr, prev = state[2], state[1]
+        elif idx == state[0] + 1:
+            curr, prev = 0, state[2]
+        elif idx == state[0] - 1:
+            curr, prev = state[1], 0
+        else:
+            return 0, False
+        tokens = state[3]
+        if ts > state[4]:
+            tokens = min(float(burst), tokens + (ts - state[4]) * limit / window)
+        elapsed = max(0.0, ts - idx * window) / window
+        return int(round(curr + prev * max(0.0, 1.0 - elapsed))), tokens < 1.0
+
+    def peek(self, app: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Признаки скорости без учета события — для пересчета уже сохраненной заявки
+
+        Учтенная заявка получает признаки из кэша; вытесненная из него или не
+        учтенная — текущие счетчики ее ключей на момент регистрации.
+        """
+        registered = _registered_at(app.get('timestamp'))
+        if registered is None:
+            return dict(FEATURE_DEFAULTS)
+        app_id = app.get('id')
+        with self._lock:
+            if app_id is not None and app_id in self._seen:
+                return dict(self._seen[app_id])
+            ts = registered.timestamp()
+            features = dict(FEATURE_DEFAULTS)
+            for dim, (key_of, _, _, _) in DIMENSIONS.items():
+                key = key_of(app, registered)
+                if key is not None:
+                    features[f'velocity_{dim}'], features[f'velocity_{dim}_throttled'] = self._peek(dim, key, ts)
+            return features
+
+    def reset(self) -> None:
+        """Пустые счетчики и кэш, без снапшота — после очистки БД"""
+        with self._lock:
+            self._states = {dim: OrderedDict() for dim in DIMENSIONS}
+            self._seen = OrderedDict()
+            self._dirty = False
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            try:
+                os.remove(self.snapshot_path)
+            except OSError as e:
+                logger.error(f"Скорость регистраций: не удалось удалить снапшот: {e}")
+        logger.info("Скорость регистраций: трекер сброшен")
+
+    def on_deleted(self, ids: Optional[List[int]]) -> None:
+        """Обработчик удаления заявок в БД (db_manager.on_applications_deleted)"""
+        if ids is None:
+            self.reset()
+            return
+        with self._lock:
+            for app_id in ids:
+                if self._seen.pop(app_id, None) is not None:
+                    self._dirty = True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'keys': {dim: len(states) for dim, states in self._states.items()},
+                'max_keys': self.max_keys,
+                'seen_applications': len(self._seen),
+                'observed_total': self.observed_total,
+                'evicted_total': self.evicted_total,
+            }
+
+    # --- Снапшот --------------------------------------------------------------------
+
+    def _signature(self) -> str:
+        return ';'.join(f"{dim}={window}:{limit}:{burst}" for dim, (_, window, limit, burst) in DIMENSIONS.items())
+
+    def save_snapshot(self) -> bool:
+        """Атомарно пишет состояние в snapshot_path (временный файл + переименование)"""
+        if not self.snapshot_path:
+            return False
+        with self._lock:
+            payload = json.dumps({
+                'format': SNAPSHOT_FORMAT,
+                'signature': self._signature(),
+                'states': {dim: list(states.items()) for dim, states in self._states.items()},
+                'seen': list(self._seen.items()),
+            })
+            self._dirty = False
+            self._snapshot_at = time.time()
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            directory = os.path.dirname(self.snapshot_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_path, self.snapshot_path)
+            return True
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"Скорость регистраций: не удалось записать снапшот: {e}")
+            return False
+
+    def maybe_snapshot(self) -> bool:
+        if self._dirty and time.time() - self._snapshot_at >= self.snapshot_interval:
+            return self.save_snapshot()
+        return False
+
+    def load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('format') != SNAPSHOT_FORMAT or data.get('signature') != self._signature():
+                logger.info("Скорость регистраций: снапшот другой версии, счетчики начинаются с нуля")
+                return False
+            states = {dim: OrderedDict((key, state) for key, state in data['states'].get(dim, [])[-self.max_keys:])
+                      for dim in DIMENSIONS}
+            seen = OrderedDict((int(app_id), features) for app_id, features in data['seen'][-self.max_keys:])
+        except Exception as e:
+            logger.error(f"Скорость регистраций: не удалось прочитать снапшот: {e}")
+            return False
+        with self._lock:
+            self._states = states
+            self._seen = seen
+            self._dirty = False
+        logger.info(f"Скорость регистраций: снапшот загружен ({len(seen)} заявок)")
+        return True
+
+
+def _text(frame: pd.DataFrame, column: str) -> pd.Series:
+    if column not in frame:
+        return pd.Series([''] * len(frame), index=frame.index, dtype=object)
+    return frame[column].fillna('').astype(str)
+
+
+def _vector_digits_prefix(frame: pd.DataFrame, column: str, cut: int, min_len: int) -> pd.Series:
+    digits = _text(frame, column).str.replace(r"\D", "", regex=True)
+    return digits.str[:-cut].where(digits.str.len() > min_len)
+
+
+def _vector_username_pattern(frame: pd.DataFrame) -> pd.Series:
+    username = _text(frame, 'telegram_username').str.strip().str.lstrip('@').str.lower()
+    return username.str.replace(r"\d+", "#", regex=True).where(username.str.contains(r"\d", regex=True))
+
+
+# Колоночные аналоги ключей DIMENSIONS (frame, время регистрации) -> Series, NaN — нет ключа
+_VECTOR_KEYS: Dict[str, Callable[[pd.DataFrame, pd.Series], pd.Series]] = {
+    'phone_prefix': lambda f, stamps: _vector_digits_prefix(f, 'phone_number', 4, 6),
+    'card_prefix': lambda f, stamps: _vector_digits_prefix(f, 'loyalty_card_number', 3, 5),
+    'name': lambda f, stamps: _text(f, 'name').str.casefold().str.split().str.join(' ').replace('', np.nan),
+    'username_pattern': lambda f, stamps: _vector_username_pattern(f),
+    'hour': lambda f, stamps: stamps.dt.hour,
+}
+
+
+def velocity_frame(frame: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """
+    Признаки скорости всех строк frame — как если бы строки учитывались онлайн
+    в порядке регистрации свежим трекером без вытеснения ключей
+
+    Счетчики окон считаются группировками; token bucket — рекуррентно, но
+    только для ключей, событий у которых больше, чем жетонов в ведре.
+    """
+    columns = {name: np.zeros(len(frame), dtype=bool if isinstance(default, bool) else np.int64)
+               for name, default in FEATURE_DEFAULTS.items()}
+    if 'timestamp' not in frame or frame.empty:
+        return columns
+    stamps = pd.to_datetime(frame['timestamp'], errors='coerce', format='ISO8601')
+    valid = stamps.notna().to_numpy()
+    seconds = np.zeros(len(frame))
+    seconds[valid] = [t.timestamp() for t in stamps[valid].dt.to_pydatetime()]
+    order = np.argsort(stamps.to_numpy(), kind='stable')
+
+    for dim, (_, window, limit, burst) in DIMENSIONS.items():
+        keys = _VECTOR_KEYS[dim](frame, stamps).to_numpy()
+        has_key = valid & pd.notna(keys)
+        pos = order[has_key[order]]
+        if not len(pos):
+            continue
+        key_codes = pd.factorize(keys[pos])[0]
+        ts = seconds[pos]
+        idx = (ts // window).astype(np.int64)
+
+        # Скользящее окно: текущее окно до события включительно + доля предыдущего
+        groups = pd.DataFrame({'key': key_codes, 'idx': idx})
+        curr = groups.groupby(['key', 'idx'], sort=False).cumcount().to_numpy() + 1
+        sizes = groups.groupby(['key', 'idx']).size()
+        prev = sizes.reindex(pd.MultiIndex.from_arrays([key_codes, idx - 1])).fillna(0).to_numpy()
+        elapsed = np.maximum(0.0, ts - idx * window) / window
+        columns[f'velocity_{dim}'][pos] = np.round(curr + prev * np.maximum(0.0, 1.0 - elapsed)).astype(np.int64)
+
+        # Token bucket: ключи, у которых событий не больше burst, опустошить ведро не могут
+        hot = np.flatnonzero(np.bincount(key_codes)[key_codes] > burst)
+        hot = hot[np.argsort(key_codes[hot], kind='stable')]
+        throttled = np.zeros(len(pos), dtype=bool)
+        current_key, tokens, last = None, 0.0, 0.0
+        for j, key, t in zip(hot.tolist(), key_codes[hot].tolist(), ts[hot].tolist()):
+            if key != current_key:
+                current_key, tokens, last = key, float(burst), t
+            elif t > last:
+                tokens = min(float(burst), tokens + (t - last) * limit / window)
+                last = t
+            if tokens < 1.0:
+                throttled[j] = True
+            else:
+                tokens -= 1.0
+        columns[f'velocity_{dim}_throttled'][pos] = throttled
+    return columns
+
+
+_velocity_tracker: Optional[VelocityTracker] = None
+_velocity_tracker_lock = threading.Lock()
+
+
+def get_velocity_tracker() -> VelocityTracker:
+    """Синглтон трекера (создание не читает снапшот)."""
+    global _velocity_tracker
+    if _velocity_tracker is None:
+        with _velocity_tracker_lock:
+            if _velocity_tracker is None:
+                _velocity_tracker = VelocityTracker()
+                on_applications_deleted(_velocity_tracker.on_deleted)
+    return _velocity_tracker
+
+
+def start_velocity_tracker() -> VelocityTracker:
+    tracker = get_velocity_tracker()
+    tracker.load_snapshot()
+    return tracker
+
+
+__all__ = [
+    'DIMENSIONS',
+    'FEATURE_DEFAULTS',
+    'VelocityTracker',
+    'velocity_frame',
+    'get_velocity_tracker',
+    'start_velocity_tracker',
+]
@@ -8,24 +8,43 @@ import time
 from functools import wraps
 from datetime import datetime
 
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, send_file, session, redirect, url_for
 import telebot
 
-from config import ADMIN_PASSWORD, PHOTOS_DIR, BOT_TOKEN
+from config import (
+    ADMIN_PASSWORD, PHOTOS_DIR, BOT_TOKEN, PHOTO_CACHE_MAX_AGE, PHOTO_X_ACCEL_PREFIX, FRAUD_RING_MIN_SIZE,
+    PHOTO_CACHE_DIR, THUMBNAILS_DIR,
+)
 from database.db_manager import (
     get_all_applications, get_applications_page, delete_application, get_random_winner,
     get_winner, get_applications_count, get_filtered_applications_count, add_user_manually, 
     update_user, get_user_by_id,
     get_open_support_tickets, get_support_ticket, reply_support_ticket,
-    count_duplicate_photo_hash, count_recent_registrations, update_risk, set_status,
-    get_active_leaflet_template,
+    update_risk, set_status,
+    get_active_leaflet_template, bulk_update_leaflet_results,
     set_campaign_type, set_manual_review_status, update_admin_notes,
-    bulk_set_campaign_type, bulk_set_manual_review_status,
+    bulk_set_campaign_type, bulk_set_manual_review_status, get_application_photo_path,
+    get_failed_photo_downloads, get_risk_participants,
 )
 from utils.file_handler import export_to_csv, export_to_excel
+from utils.photo_store import (
+    release_photo, resolve_photo, photo_relpath, digest_from_path, photo_mimetype, local_photo_path,
+)
+from utils.thumbnails import snap_size, get_thumbnail, remove_thumbnails
 from utils.randomizer import create_winner_announcement, get_hash_seed
 from utils.anti_fraud import AntiFraudSystem
-from utils.image_validation import analyze_leaflet
+from utils.fraud_context import FraudContextProvider
+from utils.fraud_rules import get_rules_status
+from utils.risk_batch import rescore_all
+from utils.risk_queue import get_risk_queue
+from utils.fraud_rings import get_ring_index
+from utils.velocity import get_velocity_tracker
+from utils.analysis_service import get_analysis_service
+from utils.analysis_queue import get_analysis_queue
+from utils.photo_downloader import get_photo_downloader
+from utils.single_flight import get_registration_flight
+from utils.revalidation_job import start_revalidation, get_current_revalidation, cancel_revalidation
+from database.db_manager import get_revalidation_job
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +52,25 @@ logger = logging.getLogger(__name__)
 _cache = {}
 _cache_ttl = {}
 CACHE_DURATION = 5  # 5 секунд кэша для частых запросов
+RING_MEMBERS_SHOWN = 20  # заявок кольца с данными в ответе /api/fraud/rings
+
+# Каталоги, которые nginx отдает по X-Accel-Redirect: <префикс>/<область>/<путь в каталоге>
+X_ACCEL_AREAS = (
+    ('photos', PHOTOS_DIR),
+    ('photo_cache', PHOTO_CACHE_DIR),
+    ('thumbnails', THUMBNAILS_DIR),
+)
+
+
+def x_accel_path(file_path, prefix=PHOTO_X_ACCEL_PREFIX, areas=X_ACCEL_AREAS):
+    """URI internal-location nginx для файла; None — файл вне известных каталогов"""
+    real = os.path.realpath(file_path)
+    for area, root in areas:
+        base = os.path.realpath(root)
+        if os.path.commonpath([base, real]) == base:
+            return f"{prefix.rstrip('/')}/{area}/" + os.path.relpath(real, base).replace(os.sep, '/')
+    return None
+
 
 def get_cached_or_fetch(key, fetch_func, ttl=CACHE_DURATION):
     """Получает данные из кэша или выполняет функцию с retry-механизмом"""
@@ -92,6 +130,11 @@ def create_web_app() -> Flask:
     def basename_filter(path):
         return os.path.basename(path)
     
+    # Путь фото относительно хранилища для /photo/<path>
+    @app.template_filter('photo_url')
+    def photo_url_filter(path):
+        return photo_relpath(path)
+    
     # Добавляем кастомный фильтр для форматирования даты
     @app.template_filter('format_datetime')
     def format_datetime_filter(datetime_str):
@@ -213,6 +256,7 @@ def create_web_app() -> Flask:
                 cat_stats=stats,
                 leaflet_required=leaflet_required,
                 ready_for_lottery=ready_for_lottery,
+                analysis_stats=get_analysis_queue().stats(),
             )
             
         except Exception as e:
@@ -243,9 +287,12 @@ def create_web_app() -> Flask:
         """API для удаления заявки"""
         try:
             logger.info(f"WEB click: delete application {application_id}")
+            photo_path = get_application_photo_path(application_id)
             success = delete_application(application_id)
             
             if success:
+                if photo_path and release_photo(photo_path):
+                    remove_thumbnails(photo_path)
                 logger.info(f"Заявка {application_id} удалена через веб-админку")
                 return jsonify({'success': True})
             else:
@@ -263,36 +310,112 @@ def create_web_app() -> Flask:
             user = get_user_by_id(user_id)
             if not user:
                 return jsonify({'success': False, 'error': 'Пользователь не найден'})
-            photo_path = user.get('photo_path') or ''
-            if not photo_path or not os.path.exists(photo_path):
+            # Локальная копия фото (для удаленного хранилища — из кэша)
+            photo_path = local_photo_path(user.get('photo_path') or '')
+            if not photo_path:
                 return jsonify({'success': False, 'error': 'Фото не найдено'})
-            with open(photo_path, 'rb') as f:
-                photo_bytes = f.read()
-            res = analyze_leaflet(photo_bytes)
+            # Анализ в пуле процессов: передаем путь, а не байты
+            res = get_analysis_service().analyze(photo_path)
             # Обновим поля в БД
-            from database.db_manager import get_db_connection
-            import json as _json
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute('''
-                    UPDATE applications
-                    SET leaflet_status = ?, stickers_count = ?, validation_notes = ?, manual_review_required = ?, photo_phash = ?
-                    WHERE id = ?
-                ''', (
-                    res['leaflet_status'],
-                    res['stickers_count'],
-                    _json.dumps(res['validation_notes'], ensure_ascii=False),
-                    int(res['manual_review_required']),
-                    res['photo_phash'],
-                    user_id
-                ))
-                conn.commit()
+            bulk_update_leaflet_results([dict(res, id=user_id)])
             return jsonify({'success': True, 'result': res})
         except Exception as e:
             logger.error(f"Ошибка в api_validate_leaflet: {e}")
             return jsonify({'success': False, 'error': str(e)})
     
     
+    # Очередь анализа фото: пропускная способность и лаг
+    @app.route('/api/analysis/stats')
+    @require_auth
+    def api_analysis_stats():
+        try:
+            stats = get_analysis_queue().stats()
+            stats['pool'] = dict(get_analysis_service().stats) if stats['running'] else {}
+            return jsonify({'success': True, 'stats': stats})
+        except Exception as e:
+            logger.error(f"Ошибка в api_analysis_stats: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+    
+    
+    # Отложенное скачивание фото: очередь, неудачные скачивания и их повтор
+    @app.route('/api/downloads/stats')
+    @require_auth
+    def api_downloads_stats():
+        try:
+            return jsonify({
+                'success': True,
+                'stats': get_photo_downloader().stats(),
+                'failed': get_failed_photo_downloads(),
+            })
+        except Exception as e:
+            logger.error(f"Ошибка в api_downloads_stats: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+    
+    @app.route('/api/registration/stats')
+    @require_auth
+    def api_registration_stats():
+        """Сколько повторных отправок фото объединено с выполняющейся регистрацией"""
+        try:
+            return jsonify({'success': True, 'stats': get_registration_flight().stats()})
+        except Exception as e:
+            logger.error(f"Ошибка в api_registration_stats: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+    
+    @app.route('/api/downloads/requeue', methods=['POST'])
+    @require_auth
+    def api_downloads_requeue():
+        try:
+            data = request.get_json(silent=True) or {}
+            ids = [int(i) for i in data.get('ids') or []]
+            count = get_photo_downloader().requeue_failed(ids or None)
+            logger.info(f"WEB click: requeue photo downloads {ids or 'all'} -> {count}")
+            return jsonify({'success': True, 'requeued': count})
+        except Exception as e:
+            logger.error(f"Ошибка в api_downloads_requeue: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+    
+    
+    # Массовая перевалидация фото (после смены шаблона или порога размытия)
+    @app.route('/api/revalidate/start', methods=['POST'])
+    @require_auth
+    def api_revalidate_start():
+        try:
+            data = request.get_json(silent=True) or {}
+            job = start_revalidation(
+                campaign=(data.get('campaign') or '').strip() or None,
+                status=(data.get('status') or '').strip() or None,
+                only_failed=bool(data.get('only_failed')),
+                resume=bool(data.get('resume')),
+            )
+            logger.info(f"WEB click: revalidate start {job.filters}")
+            return jsonify({'success': True, 'progress': job.progress()})
+        except Exception as e:
+            logger.error(f"Ошибка в api_revalidate_start: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+    
+    @app.route('/api/revalidate/status')
+    @require_auth
+    def api_revalidate_status():
+        try:
+            job = get_current_revalidation()
+            if job is not None:
+                return jsonify({'success': True, 'progress': job.progress()})
+            # После рестарта — последняя задача из БД
+            return jsonify({'success': True, 'progress': get_revalidation_job()})
+        except Exception as e:
+            logger.error(f"Ошибка в api_revalidate_status: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+    
+    @app.route('/api/revalidate/cancel', methods=['POST'])
+    @require_auth
+    def api_revalidate_cancel():
+        try:
+            return jsonify({'success': cancel_revalidation()})
+        except Exception as e:
+            logger.error(f"Ошибка в api_revalidate_cancel: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+    
+    
     @app.route('/api/select_winner', methods=['POST'])
     @require_auth
     def api_select_winner():
@@ -373,20 +496,49 @@ def create_web_app() -> Flask:
             return jsonify({'success': False, 'error': str(e)})
     
     
-    @app.route('/photo/<filename>')
+    def _photo_response(file_path: str, variant: str):
+        """Ответ с фото: ETag/Last-Modified/304, долгий Cache-Control, X-Accel-Redirect"""
+        # send_file разрешает относительные пути от каталога приложения, а не от cwd
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        digest = digest_from_path(file_path)
+        etag = f"{digest or f'{stat.st_mtime_ns:x}-{stat.st_size:x}'}-{variant}"
+        last_modified = datetime.fromtimestamp(stat.st_mtime)
+        accel_path = x_accel_path(file_path) if PHOTO_X_ACCEL_PREFIX else None
+        if accel_path:
+            # Байты отдает nginx (internal location), Flask только проверяет доступ
+            response = Response(mimetype=photo_mimetype(file_path))
+            response.headers['X-Accel-Redirect'] = accel_path
+            response.set_etag(etag)
+            response.last_modified = last_modified
+        else:
+            response = send_file(file_path, mimetype=photo_mimetype(file_path), conditional=True,
+                                 etag=etag, last_modified=last_modified, max_age=PHOTO_CACHE_MAX_AGE)
+        # За авторизацией: кэширует только браузер, не общие прокси
+        response.cache_control.no_cache = None
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.max_age = PHOTO_CACHE_MAX_AGE
+        if digest:
+            response.cache_control.immutable = True
+        return response.make_conditional(request)
+    
+    @app.route('/photo/<path:filename>')
     @require_auth
     def serve_photo(filename):
-        """Обслуживание фотографий"""
+        """Обслуживание фотографий (photos/ab/cd/<sha256>.jpg и старые плоские имена); ?size= — превью"""
         try:
-            # Простое решение: используем абсолютный путь от текущей директории
-            current_dir = os.getcwd()
-            photo_path = os.path.join(current_dir, 'photos', filename)
+            photo_path = resolve_photo(filename)
             
-            if not os.path.exists(photo_path):
-                logger.error(f"Фото не найдено: {photo_path}")
+            if photo_path is None or not os.path.isfile(photo_path):
+                logger.error(f"Фото не найдено: {filename}")
                 return "Фото не найдено", 404
             
-            return send_file(photo_path, mimetype='image/jpeg')
+            size = snap_size(request.args.get('size', type=int))
+            if size:
+                photo_path = get_thumbnail(photo_path, size)
+            
+            return _photo_response(photo_path, str(size) if size else 'orig')
             
         except Exception as e:
             logger.error(f"Ошибка в serve_photo: {e}")
@@ -670,17 +822,19 @@ def create_web_app() -> Flask:
 
             antifraud = AntiFraudSystem()
             participant = {
+                'id': user_id,
                 'name': user['name'],
                 'phone_number': user['phone_number'],
                 'loyalty_card_number': user.get('loyalty_card_number') or '',
                 'telegram_id': user['telegram_id'],
                 'photo_hash': user['photo_hash'] or '',
+                'photo_phash': user.get('photo_phash') or '',
+                'telegram_username': user.get('telegram_username') or '',
+                'timestamp': user.get('timestamp'),
             }
-            context = {
-                'is_telegram_id_unique': True,  # в админке не проверяем уникальность повторно
-                'duplicate_photo_count': count_duplicate_photo_hash(user['photo_hash'] or ''),
-                'recent_registrations_60s': count_recent_registrations(60),
-            }
+            # Заявка уже учтена трекером скорости — повторно не считаем
+            context = FraudContextProvider(velocity=get_velocity_tracker(),
+                                           record_velocity=False).for_participant(participant)
             score, level, details = antifraud.calculate_risk_score(participant, context)
             import json as _json
             update_risk(user_id, score, level, _json.dumps(details, ensure_ascii=False))
@@ -689,6 +843,69 @@ def create_web_app() -> Flask:
             logger.error(f"Ошибка в api_risk_recompute: {e}")
             return jsonify({'success': False, 'error': str(e)})
 
+    # Антифрод: очередь скоринга новых заявок (лаг, деградация, автофлаги) и трекер скорости
+    @app.route('/api/risk/queue/stats')
+    @require_auth
+    def api_risk_queue_stats():
+        try:
+            return jsonify({'success': True, 'stats': get_risk_queue().stats(),
+                            'velocity': get_velocity_tracker().stats()})
+        except Exception as e:
+            logger.error(f"Ошибка в api_risk_queue_stats: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+
+    # Антифрод: кольца заявок, связанных общими атрибутами (индекс обновляется онлайн)
+    @app.route('/api/fraud/rings')
+    @require_auth
+    def api_fraud_rings():
+        try:
+            min_size = max(2, int(request.args.get('min_size', FRAUD_RING_MIN_SIZE)))
+            limit = min(200, int(request.args.get('limit', 50)))
+            index = get_ring_index()
+            rings = index.rings(min_size, limit)
+            shown = [app_id for ring in rings for app_id in ring['members'][:RING_MEMBERS_SHOWN]]
+            apps = {p['id']: p for p in get_risk_participants(shown)}
+            for ring in rings:
+                ring['applications'] = [
+                    {k: apps[app_id].get(k) for k in ('id', 'name', 'phone_number', 'loyalty_card_number',
+                                                       'telegram_username')}
+                    for app_id in ring['members'][:RING_MEMBERS_SHOWN] if app_id in apps
+                ]
+            return jsonify({'success': True, 'stats': index.stats(min_size), 'rings': rings})
+        except Exception as e:
+            logger.error(f"Ошибка в api_fraud_rings: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+
+    @app.route('/api/fraud/rings/<int:app_id>')
+    @require_auth
+    def api_fraud_ring_of(app_id):
+        try:
+            index = get_ring_index()
+            return jsonify({'success': True, **index.ring_of(app_id), 'members': index.members(app_id)})
+        except Exception as e:
+            logger.error(f"Ошибка в api_fraud_ring_of: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+
+    # Антифрод: действующие правила (файл перечитывается автоматически при изменении)
+    @app.route('/api/risk/rules')
+    @require_auth
+    def api_risk_rules():
+        try:
+            return jsonify({'success': True, 'rules': get_rules_status()})
+        except Exception as e:
+            logger.error(f"Ошибка в api_risk_rules: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+
+    # Антифрод: пересчитать риск всех заявок одним проходом
+    @app.route('/api/risk/recompute_all', methods=['POST'])
+    @require_auth
+    def api_risk_recompute_all():
+        try:
+            return jsonify({'success': True, 'stats': rescore_all()})
+        except Exception as e:
+            logger.error(f"Ошибка в api_risk_recompute_all: {e}")
+            return jsonify({'success': False, 'error': str(e)})
+
     # Антифрод: установить статус
     @app.route('/api/risk/status/<int:user_id>', methods=['POST'])
     @require_auth